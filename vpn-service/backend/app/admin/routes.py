@@ -11,6 +11,7 @@ from sqlalchemy import select, func, String, case, text, delete, desc
 from sqlalchemy.orm import joinedload, selectinload
 from datetime import datetime, timedelta
 from typing import Optional, Dict, Any, List
+import asyncio
 import structlog
 import json
 from pydantic import BaseModel
@@ -31,8 +32,8 @@ from models.country import Country
 from models.user_server_assignment import UserServerAssignment
 from models.server_switch_log import ServerSwitchLog
 from services.country_service import CountryService
+from services.country_stats import CountryStats
 from services.user_server_service import UserServerService
-from services.x3ui_client import x3ui_client
 from services.node_manager import NodeManager, NodeConfig
 from services.load_balancer import LoadBalancer
 from services.health_checker import HealthChecker
@@ -583,7 +584,7 @@ async def get_users_paginated(db: AsyncSession, page: int = 1, size: int = 50, s
     users = result.scalars().all()
     
     # Получаем данные активности из X3UI
-    x3ui_activity_data = await get_x3ui_user_activity()
+    x3ui_activity_data = await get_x3ui_user_activity(db)
     
     # Формируем ответ
     user_items = []
@@ -707,94 +708,105 @@ async def get_vpn_keys_paginated(db: AsyncSession, page: int = 1, size: int = 50
         "pages": (total + size - 1) // size
     }
 
-async def get_x3ui_user_activity() -> Dict[str, Dict]:
-    """Получение данных активности пользователей из X3UI панели"""
+async def get_x3ui_user_activity(db: AsyncSession) -> Dict[str, Dict]:
+    """Получение данных активности пользователей из X3UI панелей активных нод"""
     try:
-        # Получаем список inbound правил
-        inbounds = await x3ui_client.get_inbounds()
-        if not inbounds:
-            return {}
+        from services.x3ui_client import X3UIClient
+        
+        nodes_result = await db.execute(select(VPNNode).where(VPNNode.status == "active"))
+        nodes = nodes_result.scalars().all()
+        
+        # Индексированные снимки inbound'ов (из кэша, панель опрашивается только при промахе)
+        snapshots = await asyncio.gather(*[
+            X3UIClient(
+                base_url=node.x3ui_url,
+                username=node.x3ui_username,
+                password=node.x3ui_password
+            ).get_inbound_snapshot()
+            for node in nodes
+        ], return_exceptions=True)
         
         activity_data = {}
         
-        for inbound in inbounds:
-            try:
-                # Парсим настройки клиентов
-                import json
-                settings = json.loads(inbound.get('settings', '{}'))
-                clients = settings.get('clients', [])
+        for snapshot in snapshots:
+            if not snapshot or isinstance(snapshot, BaseException):
+                continue
+            for inbound in snapshot.inbounds:
+                try:
+                    # Настройки клиентов уже распарсены в снимке
+                    clients = snapshot.get_clients(inbound.get('id'))
                 
-                # Получаем статистику клиентов
-                client_stats = inbound.get('clientStats', [])
+                    # Статистика клиентов, индексированная по email
+                    client_stats = {s.get('email'): s for s in (inbound.get('clientStats') or [])}
                 
-                for client in clients:
-                    client_email = client.get('email', '')
-                    client_id = client.get('id', '')
-                    tg_id = client.get('tgId', '')
+                    for client in clients:
+                        client_email = client.get('email', '')
+                        client_id = client.get('id', '')
+                        tg_id = client.get('tgId', '')
                     
-                    # Извлекаем telegram_id из email если tgId не указан
-                    if not tg_id and client_email:
-                        # Пробуем различные форматы
-                        import re
+                        # Извлекаем telegram_id из email если tgId не указан
+                        if not tg_id and client_email:
+                            # Пробуем различные форматы
+                            import re
                         
-                        # Формат: telegram_id (@username)
-                        match = re.search(r'^(\d{8,})\s*\(', client_email)
-                        if not match:
-                            # Формат: tg_XXXXXX_username
-                            match = re.search(r'tg_(\d{8,})_', client_email)
-                        if not match:
-                            # Просто число в начале
-                            match = re.search(r'^(\d{8,})', client_email)
-                        if not match:
-                            # Любое число 8+ символов в email
-                            match = re.search(r'(\d{8,})', client_email)
+                            # Формат: telegram_id (@username)
+                            match = re.search(r'^(\d{8,})\s*\(', client_email)
+                            if not match:
+                                # Формат: tg_XXXXXX_username
+                                match = re.search(r'tg_(\d{8,})_', client_email)
+                            if not match:
+                                # Просто число в начале
+                                match = re.search(r'^(\d{8,})', client_email)
+                            if not match:
+                                # Любое число 8+ символов в email
+                                match = re.search(r'(\d{8,})', client_email)
                         
-                        if match:
-                            tg_id = match.group(1)
+                            if match:
+                                tg_id = match.group(1)
                     
-                    if tg_id:
-                        # Находим статистику для этого клиента
-                        stats = next((s for s in client_stats if s.get('email') == client_email), {})
+                        if tg_id:
+                            # Находим статистику для этого клиента
+                            stats = client_stats.get(client_email, {})
                         
-                        # Рассчитываем общий трафик в ГБ
-                        up_traffic = stats.get('up', 0)
-                        down_traffic = stats.get('down', 0)
-                        total_traffic_bytes = up_traffic + down_traffic
-                        traffic_gb = round(total_traffic_bytes / (1024**3), 2)
+                            # Рассчитываем общий трафик в ГБ
+                            up_traffic = stats.get('up', 0)
+                            down_traffic = stats.get('down', 0)
+                            total_traffic_bytes = up_traffic + down_traffic
+                            traffic_gb = round(total_traffic_bytes / (1024**3), 2)
                         
-                        # Определяем статус (активен/неактивен)
-                        is_enabled = client.get('enable', False)
-                        expiry_time = client.get('expiryTime', 0)
-                        is_expired = expiry_time > 0 and datetime.utcnow().timestamp() * 1000 > expiry_time
+                            # Определяем статус (активен/неактивен)
+                            is_enabled = client.get('enable', False)
+                            expiry_time = client.get('expiryTime', 0)
+                            is_expired = expiry_time > 0 and datetime.utcnow().timestamp() * 1000 > expiry_time
                         
-                        status = "active" if is_enabled and not is_expired else "inactive"
+                            status = "active" if is_enabled and not is_expired else "inactive"
                         
-                        # Определяем последнюю активность
-                        # X3UI не предоставляет точную дату последнего подключения,
-                        # но если есть трафик, значит было подключение
-                        last_connection = None
-                        if total_traffic_bytes > 0:
-                            # Если есть трафик, считаем что последняя активность была недавно
-                            # Это приблизительная оценка
-                            last_connection = datetime.utcnow() - timedelta(hours=1)
+                            # Определяем последнюю активность
+                            # X3UI не предоставляет точную дату последнего подключения,
+                            # но если есть трафик, значит было подключение
+                            last_connection = None
+                            if total_traffic_bytes > 0:
+                                # Если есть трафик, считаем что последняя активность была недавно
+                                # Это приблизительная оценка
+                                last_connection = datetime.utcnow() - timedelta(hours=1)
                         
-                        activity_data[tg_id] = {
-                            "status": status,
-                            "traffic_gb": traffic_gb,
-                            "up_traffic": up_traffic,
-                            "down_traffic": down_traffic,
-                            "last_connection": last_connection,
-                            "is_enabled": is_enabled,
-                            "is_expired": is_expired,
-                            "inbound_id": inbound.get('id'),
-                            "client_id": client_id,
-                            "email": client_email
-                        }
+                            activity_data[tg_id] = {
+                                "status": status,
+                                "traffic_gb": traffic_gb,
+                                "up_traffic": up_traffic,
+                                "down_traffic": down_traffic,
+                                "last_connection": last_connection,
+                                "is_enabled": is_enabled,
+                                "is_expired": is_expired,
+                                "inbound_id": inbound.get('id'),
+                                "client_id": client_id,
+                                "email": client_email
+                            }
                         
-            except Exception as e:
-                # Логируем ошибку, но продолжаем обработку других inbound
-                print(f"Error processing inbound {inbound.get('id', 'unknown')}: {e}")
-                continue
+                except Exception as e:
+                    # Логируем ошибку, но продолжаем обработку других inbound
+                    print(f"Error processing inbound {inbound.get('id', 'unknown')}: {e}")
+                    continue
         
         return activity_data
         
@@ -1444,24 +1456,37 @@ async def admin_check_all_nodes_health(
         }
     
     return JSONResponse(
-        content={"success": True, "statuses": result}
+        content={
+            "success": True,
+            "statuses": result,
+            "sweep_duration_ms": health_checker.last_sweep_duration_ms
+        }
     )
 
 @router.post("/nodes/rebalance")
 async def admin_rebalance_nodes(
+    dry_run: bool = False,
     current_admin: str = Depends(get_current_admin),
     db: AsyncSession = Depends(get_db)
 ):
-    """Перебалансировка пользователей между нодами"""
+    """Перебалансировка пользователей между нодами (dry_run - только план)"""
     
     # Инициализируем LoadBalancer
     load_balancer = LoadBalancer(db)
     
     # Выполняем перебалансировку
-    result = await load_balancer.rebalance_users()
+    result = await load_balancer.rebalance_users(dry_run=dry_run)
     
     return JSONResponse(content=result)
 
+@router.get("/nodes/rebalance/status")
+async def admin_rebalance_status(
+    current_admin: str = Depends(get_current_admin)
+):
+    """Прогресс и пропускная способность текущей и последних перебалансировок"""
+    from services.node_rebalancer import rebalance_runs
+    return JSONResponse(content={"success": True, **rebalance_runs.get_stats()})
+
 @router.get("/nodes/{node_id}/users", response_class=HTMLResponse)
 async def admin_node_users_page(
     node_id: int,
@@ -3019,34 +3044,19 @@ async def admin_countries_page(
         result = await db.execute(select(Country).order_by(Country.priority.desc(), Country.name))
         countries = result.scalars().all()
         
-        # Получаем статистику по каждой стране
+        # Статистика по всем странам - один сгруппированный запрос (кэшируется)
+        country_stats = await country_service.get_country_stats()
         countries_stats = []
         for country in countries:
-            # Получаем ноды для страны
-            nodes = await country_service.get_nodes_by_country(country.id)
-            
-            # Подсчитываем статистику
-            total_nodes = len(nodes)
-            healthy_nodes = len([n for n in nodes if n.is_healthy])
-            total_capacity = sum(n.max_users for n in nodes)
-            current_users = sum(n.current_users for n in nodes)
-            
-            # Получаем количество назначений пользователей
-            assignments_result = await db.execute(
-                select(func.count(UserServerAssignment.user_id)).where(
-                    UserServerAssignment.country_id == country.id
-                )
-            )
-            user_assignments = assignments_result.scalar() or 0
-            
+            aggregate = country_stats.get(country.id) or CountryStats(country.id)
             countries_stats.append({
                 "country": country,
-                "total_nodes": total_nodes,
-                "healthy_nodes": healthy_nodes,
-                "total_capacity": total_capacity,
-                "current_users": current_users,
-                "user_assignments": user_assignments,
-                "load_percentage": (current_users / total_capacity * 100) if total_capacity > 0 else 0
+                "total_nodes": aggregate.nodes_total,
+                "healthy_nodes": aggregate.nodes_healthy,
+                "total_capacity": aggregate.total_capacity,
+                "current_users": aggregate.current_users,
+                "user_assignments": aggregate.user_assignments,
+                "load_percentage": aggregate.load_percentage
             })
         
         return templates.TemplateResponse(
@@ -3237,23 +3247,18 @@ async def api_countries_stats(
     try:
         country_service = CountryService(db)
         countries = await country_service.get_available_countries()
+        country_stats = await country_service.get_country_stats()
         
         stats = []
         for country in countries:
-            nodes = await country_service.get_nodes_by_country(country.id)
-            
-            total_nodes = len(nodes)
-            healthy_nodes = len([n for n in nodes if n.is_healthy])
-            total_capacity = sum(n.max_users for n in nodes)
-            current_users = sum(n.current_users for n in nodes)
-            
+            aggregate = country_stats.get(country.id) or CountryStats(country.id)
             stats.append({
                 "country": country.to_dict(),
-                "nodes_total": total_nodes,
-                "nodes_healthy": healthy_nodes,
-                "total_capacity": total_capacity,
-                "current_users": current_users,
-                "load_percentage": (current_users / total_capacity * 100) if total_capacity > 0 else 0
+                "nodes_total": aggregate.nodes_total,
+                "nodes_healthy": aggregate.nodes_healthy,
+                "total_capacity": aggregate.total_capacity,
+                "current_users": aggregate.current_users,
+                "load_percentage": aggregate.load_percentage
             })
         
         return {"countries": stats}
@@ -3263,6 +3268,29 @@ async def api_countries_stats(
         return {"error": str(e)}
 
 
+@router.get("/api/jobs")
+async def api_scheduled_jobs(
+    job_name: Optional[str] = None,
+    limit: int = 50,
+    current_admin: str = Depends(get_current_admin),
+    db: AsyncSession = Depends(get_db)
+):
+    """API фоновых задач: расписание и лидерство в этом процессе, история запусков"""
+    try:
+        from services.job_scheduler import job_scheduler
+        from services.subscription_event_engine import subscription_event_engine
+        runs = await job_scheduler.recent_runs(db, job_name=job_name, limit=min(limit, 500))
+        return {
+            "scheduler": job_scheduler.get_stats(),
+            "subscription_events": subscription_event_engine.get_stats(),
+            "runs": [run.to_dict() for run in runs]
+        }
+        
+    except Exception as e:
+        logger.error("Error getting scheduled jobs", error=str(e))
+        return {"error": str(e)}
+
+
 @router.get("/countries/create", response_class=HTMLResponse)
 async def admin_create_country_form(
     request: Request,
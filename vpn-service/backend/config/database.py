@@ -75,6 +75,12 @@ async def init_database():
         from models.vpn_key import VPNKey
         from models.vpn_node import VPNNode
         from models.user_node_assignment import UserNodeAssignment
+        from models.x3ui_panel_session import X3UIPanelSession
+        from models.node_health_sample import NodeHealthSample
+        from models.spare_client import SpareClient
+        from models.job_checkpoint import JobCheckpoint
+        from models.scheduled_job_run import ScheduledJobRun
+        from models.notification_outbox import NotificationOutbox
         
         async with engine.begin() as conn:
             # Создаем все таблицы
@@ -35,6 +35,127 @@ class Settings(BaseSettings):
     # x3ui_password: str = ""  # Удалено - используется node.x3ui_password
     # x3ui_server_ip убран - используем ноды из базы данных
     x3ui_default_inbound_id: int = 2  # Используется как fallback
+
+    # Keep-alive пул HTTP соединений к X3UI панелям (на одну ноду)
+    x3ui_pool_connections_per_node: int = 10
+    x3ui_pool_keepalive_timeout: int = 60  # секунды
+    x3ui_pool_dns_cache_ttl: int = 300  # секунды
+
+    # Пул X3UI клиентов: максимум клиентов в памяти и время простоя до вытеснения (секунды)
+    x3ui_client_pool_max_clients: int = 100
+    x3ui_client_pool_idle_ttl: int = 1800
+
+    # Таймауты запросов к панели: общий и отдельный короткий на установку соединения (секунды)
+    x3ui_request_timeout: float = 30.0
+    x3ui_connect_timeout: float = 3.0
+
+    # Повторы идемпотентных чтений: число повторов и границы экспоненциальной паузы с jitter
+    x3ui_retry_attempts: int = 2
+    x3ui_retry_base_delay: float = 0.2
+    x3ui_retry_max_delay: float = 2.0
+
+    # Circuit breaker по ноде: окно вызовов, пороги доли ошибок / медленных ответов, пауза open
+    x3ui_breaker_window: int = 20
+    x3ui_breaker_min_calls: int = 5
+    x3ui_breaker_failure_rate: float = 0.5
+    x3ui_breaker_slow_call_ms: int = 5000
+    x3ui_breaker_slow_rate: float = 0.8
+    x3ui_breaker_open_seconds: int = 30
+    x3ui_breaker_half_open_calls: int = 1
+
+    # Сколько клиентов передавать в одном запросе addClient при пакетном создании
+    x3ui_bulk_chunk_size: int = 100
+
+    # TTL индексированного снимка inbound'ов/клиентов X3UI (секунды)
+    x3ui_inbound_cache_ttl: int = 30
+
+    # Хранить cookie сессий X3UI в БД, чтобы воркеры и рестарты не логинились заново
+    x3ui_session_persist: bool = False
+
+    # Фоновая проверка клиента в панели после локальной сборки VLESS URL
+    x3ui_verify_client_url: bool = True
+
+    # Обход health check: сколько нод проверять одновременно и дедлайн на одну ноду (секунды);
+    # дедлайн больше x3ui_request_timeout, чтобы зависший запрос завершился своим таймаутом
+    health_check_concurrency: int = 10
+    health_check_node_timeout: float = 45.0
+
+    # Временной ряд проверок: размер окна для p50/p95/error-rate и срок хранения проб в БД
+    health_metrics_window: int = 60
+    health_samples_retention_days: int = 7
+
+    # Снимок нод в памяти для выбора ноды: страховочный TTL (секунды), основное обновление - по commit'у
+    node_registry_ttl: int = 60
+
+    # Период сверки VPNNode.current_users с user_server_assignments (секунды)
+    node_capacity_reconcile_interval: int = 600
+
+    # Перебалансировка: максимум миграций за запуск, допуск отклонения от цели (% max_users),
+    # общий лимит параллельных миграций и лимит на одну ноду
+    rebalance_max_moves: int = 1000
+    rebalance_tolerance_percent: float = 5.0
+    rebalance_concurrency: int = 20
+    rebalance_node_concurrency: int = 4
+
+    # Режим назначения ноды внутри страны: score (оценка нагрузки) или rendezvous (липкий HRW по weight)
+    node_assignment_mode: str = "score"
+
+    # Живая нагрузка нод из панели: сглаживание EWMA, доля в оценке нагрузки (0 - только current_users),
+    # пропускная способность ноды для нормировки трафика (Мбит/с) и срок годности сигнала (секунды)
+    node_live_load_alpha: float = 0.3
+    node_live_load_weight: float = 0.5
+    node_bandwidth_mbps: int = 1000
+    node_live_load_max_age: int = 900
+
+    # Кэш агрегатов по странам (секунды); сбрасывается и при изменении нод/назначений
+    country_stats_cache_ttl: int = 30
+
+    # Эвакуация с недоступной ноды: сколько целевых панелей наполнять клиентами одновременно
+    evacuation_node_concurrency: int = 4
+
+    # Очередь уведомлений Telegram (outbox): сообщений в секунду всего (лимит Bot API ~30/с)
+    # и в один чат (~1/с), размер пачки и параллельных отправок, попыток до failed,
+    # опрос таблицы (секунды) и хранение отправленных (дни)
+    notification_rate_per_second: float = 25.0
+    notification_per_chat_rate: float = 1.0
+    notification_batch_size: int = 100
+    notification_sender_concurrency: int = 10
+    notification_max_attempts: int = 5
+    notification_poll_interval: float = 1.0
+    notification_outbox_retention_days: int = 7
+
+    # Теплый пул отключенных клиентов на ноду: пополняется до верхней отметки,
+    # когда запасных меньше нижней; период фоновой проверки всех нод (секунды)
+    spare_pool_enabled: bool = True
+    spare_pool_low_watermark: int = 5
+    spare_pool_high_watermark: int = 20
+    spare_pool_refill_interval: int = 300
+
+    # Деактивация истекших ключей: ключей на страницу keyset-прохода, клиентов в одном
+    # обновлении панели и сколько нод обрабатывать одновременно
+    expiry_sweep_page_size: int = 1000
+    expiry_sweep_batch_size: int = 200
+    expiry_sweep_node_concurrency: int = 8
+
+    # Встроенный планировщик: включен ли, как часто процесс пытается стать лидером задач (секунды),
+    # cron-расписания (UTC) деактивации истекших подписок и автоплатежей
+    scheduler_enabled: bool = True
+    scheduler_leader_retry_interval: int = 15
+    scheduler_expiry_cron: str = "0 */6 * * *"
+    scheduler_autopay_cron: str = "0 * * * *"
+
+    # Автоплатежи: строк за один захват, одновременных списаний, запросов к провайдеру в секунду
+    # и аренда захваченной строки (секунды) - после сбоя прогона строка снова станет доступна
+    autopay_claim_batch_size: int = 50
+    autopay_concurrency: int = 10
+    autopay_provider_rate_per_second: float = 5.0
+    autopay_claim_lease: int = 900
+
+    # Движок событий подписок: окно загружаемых сроков и период его перезагрузки (секунды),
+    # за сколько дней до окончания подписки напоминать (через запятую)
+    subscription_events_window: int = 3600
+    subscription_events_reload_interval: int = 600
+    subscription_reminder_days: str = "3,1"
     
     # Настройки теперь в БД через app_settings:
     # - app_name → app_settings.site_name
@@ -25,6 +25,16 @@ from routes.auto_payments import router as auto_payments_router
 from routes.countries import router as countries_router  # NEW: Country management
 from routes.vpn_keys import router as vpn_keys_router  # NEW: VPN keys management
 from services.health_checker import HealthChecker
+from services.x3ui_http_pool import x3ui_http_pool
+from services.x3ui_client_pool import x3ui_client_pool
+from services.node_capacity import NodeCapacity
+from services.spare_client_pool import spare_client_pool
+from services.subscription_expiry_sweep import SubscriptionExpirySweep
+from services.payment_scheduler_service import PaymentSchedulerService
+from services.job_scheduler import job_scheduler, IntervalTrigger, CronTrigger
+from services.subscription_event_engine import subscription_event_engine
+from services.notification_outbox import notification_outbox
+from config.settings import get_settings
 from app.admin.routes import router as admin_router
 
 # Настройка логирования
@@ -59,49 +69,145 @@ app.include_router(vpn_keys_router, prefix="/api/v1") # NEW: VPN keys management
 # Период проверки здоровья нод (в секундах)
 HEALTH_CHECK_INTERVAL = 300  # 5 минут
 
+# Хранение истории запусков фоновых задач (дни)
+JOB_RUNS_RETENTION_DAYS = 30
+
 @app.on_event("startup")
 async def startup_event():
     """Действия при запуске приложения"""
     # Инициализируем базу данных
     await init_database()
     
-    # Запускаем задачу проверки здоровья нод
-    asyncio.create_task(health_check_task())
+    # Прогреваем пул X3UI клиентов (параллельный логин во все активные ноды)
+    asyncio.create_task(x3ui_client_pool.warm_up())
+    
+    # Отправка уведомлений из outbox (при включенном планировщике - только лидером)
+    await notification_outbox.start()
+    
+    # Фоновые задачи: каждую выполняет один процесс-лидер среди всех воркеров
+    settings = get_settings()
+    if settings.scheduler_enabled:
+        register_scheduled_jobs(settings)
+        await job_scheduler.start()
+        # Сроки подписок в памяти: окончания, напоминания и списания срабатывают точно в срок
+        await subscription_event_engine.start()
     
     logger.info("🚀 VPN Service Backend запущен!")
     logger.info("📋 Загружены модули:")
     logger.info("  ✅ Admin Interface - интерфейс управления")
     logger.info("  ✅ Multi-Node - поддержка множества VPN нод")
     logger.info("  ✅ Health Checker - мониторинг здоровья нод")
+    logger.info("  ✅ Job Scheduler - фоновые задачи с выбором лидера")
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Действия при остановке приложения"""
+    # Останавливаем планировщик и отдаем лидерство другим воркерам
+    await subscription_event_engine.stop()
+    await job_scheduler.stop()
+    await notification_outbox.stop()
+    # Закрываем keep-alive сессии к X3UI панелям
+    await x3ui_client_pool.clear_cache()
+    await x3ui_http_pool.close_all()
+    logger.info("🛑 VPN Service Backend остановлен")
 
-async def health_check_task():
-    """Периодическая проверка здоровья нод"""
-    logger.info("🏥 Запущена задача проверки здоровья нод")
+def register_scheduled_jobs(settings):
+    """Регистрация фоновых задач планировщика (бывшие циклы startup и cron-скрипты)"""
+    job_scheduler.add_job(
+        "health_check", health_check_job,
+        IntervalTrigger(HEALTH_CHECK_INTERVAL, run_immediately=True), timeout=HEALTH_CHECK_INTERVAL - 60
+    )
+    job_scheduler.add_job(
+        "node_capacity_reconcile", node_capacity_reconcile_job,
+        IntervalTrigger(settings.node_capacity_reconcile_interval, run_immediately=True), timeout=300
+    )
+    job_scheduler.add_job(
+        "spare_client_pool", spare_client_pool_job,
+        IntervalTrigger(settings.spare_pool_refill_interval, run_immediately=True), timeout=600
+    )
+    job_scheduler.add_job(
+        "subscription_expiry", subscription_expiry_job,
+        CronTrigger(settings.scheduler_expiry_cron), timeout=3 * 3600
+    )
+    job_scheduler.add_job(
+        "autopay", autopay_job,
+        CronTrigger(settings.scheduler_autopay_cron), timeout=50 * 60
+    )
+    job_scheduler.add_job(
+        "subscription_events", subscription_events_job,
+        IntervalTrigger(settings.subscription_events_reload_interval, run_immediately=True), timeout=300
+    )
+    job_scheduler.add_job(
+        "notification_outbox", notification_outbox_job,
+        IntervalTrigger(3600), timeout=300
+    )
+    job_scheduler.add_job(
+        "job_runs_cleanup", job_runs_cleanup_job,
+        CronTrigger("30 3 * * *"), timeout=300
+    )
+
+async def health_check_job():
+    """Проверка здоровья нод"""
+    async with get_db_session() as db:
+        # Создаем экземпляр HealthChecker
+        health_checker = HealthChecker(db)
+        
+        # Проверяем все ноды (параллельно, с дедлайном на каждую ноду)
+        logger.info("🔍 Выполняем проверку здоровья всех нод...")
+        results = await health_checker.check_all_nodes()
+    
+    # Логируем результаты
+    healthy_nodes = sum(1 for r in results.values() if r.is_healthy)
+    total_nodes = len(results)
+    logger.info(f"✅ Проверка завершена: {healthy_nodes}/{total_nodes} нод здоровы "
+                f"за {health_checker.last_sweep_duration_ms} мс")
     
-    while True:
-        try:
-            # Получаем сессию БД
-            db = get_db_session()
-            
-            # Создаем экземпляр HealthChecker
-            health_checker = HealthChecker(db)
-            
-            # Проверяем все ноды
-            logger.info("🔍 Выполняем проверку здоровья всех нод...")
-            results = await health_checker.check_all_nodes()
-            
-            # Логируем результаты
-            healthy_nodes = sum(1 for r in results.values() if r.get('is_healthy', False))
-            total_nodes = len(results)
-            logger.info(f"✅ Проверка завершена: {healthy_nodes}/{total_nodes} нод здоровы")
-            
-            # Ждем до следующей проверки
-            await asyncio.sleep(HEALTH_CHECK_INTERVAL)
-            
-        except Exception as e:
-            logger.error(f"❌ Ошибка при проверке здоровья нод: {e}")
-            # В случае ошибки ждем немного и пробуем снова
-            await asyncio.sleep(60)
+    return {
+        "healthy_nodes": healthy_nodes,
+        "total_nodes": total_nodes,
+        "sweep_duration_ms": health_checker.last_sweep_duration_ms
+    }
+
+async def node_capacity_reconcile_job():
+    """Сверка current_users нод с фактическими назначениями"""
+    async with get_db_session() as db:
+        drift = await NodeCapacity(db).reconcile()
+    if drift:
+        logger.info(f"🔢 Счетчики пользователей исправлены на {len(drift)} нодах")
+    return {"corrected_nodes": len(drift) if drift else 0}
+
+async def spare_client_pool_job():
+    """Пополнение пулов запасных клиентов"""
+    created = await spare_client_pool.maintain()
+    if created:
+        logger.info(f"🧊 Пул запасных клиентов пополнен на {sum(created.values())} "
+                    f"клиентов ({len(created)} нод)")
+    return {"created": sum(created.values()), "nodes": len(created)}
+
+async def subscription_expiry_job():
+    """Деактивация ключей с истекшей подпиской (бывший cron subscription_expiry_handler)"""
+    async with get_db_session() as db:
+        report = await SubscriptionExpirySweep(db).run()
+    return report.to_dict()
+
+async def autopay_job():
+    """Обработка автоплатежей (бывший cron autopay_cron)"""
+    async with get_db_session() as db:
+        stats = await PaymentSchedulerService(db).process_due_autopayments()
+        await db.commit()
+    return stats
+
+async def subscription_events_job():
+    """Перезагрузка окна сроков подписок (лидер этой задачи обрабатывает события)"""
+    return await subscription_event_engine.reload_window()
+
+async def notification_outbox_job():
+    """Очистка отправленных уведомлений (лидер этой задачи отправляет outbox)"""
+    return await notification_outbox.prune(get_settings().notification_outbox_retention_days)
+
+async def job_runs_cleanup_job():
+    """Очистка старой истории запусков фоновых задач"""
+    return await job_scheduler.prune_runs(JOB_RUNS_RETENTION_DAYS)
 
 @app.get("/", response_class=HTMLResponse)
 async def admin_index(request: Request):
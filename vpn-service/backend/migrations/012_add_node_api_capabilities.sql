@@ -0,0 +1,16 @@
+-- Миграция 012: Сохранение результата probe API X3UI панели
+-- Описание: Добавляет колонку api_capabilities в vpn_nodes, чтобы вариант API
+-- (panel_api / panel / xui / api) определялся один раз, а не на каждом запросе
+
+DO $$
+BEGIN
+    IF NOT EXISTS (
+        SELECT 1 FROM information_schema.columns
+        WHERE table_name = 'vpn_nodes' AND column_name = 'api_capabilities'
+    ) THEN
+        ALTER TABLE vpn_nodes ADD COLUMN api_capabilities JSON;
+        RAISE NOTICE 'Добавлена колонка api_capabilities';
+    ELSE
+        RAISE NOTICE 'Колонка api_capabilities уже существует';
+    END IF;
+END $$;
@@ -0,0 +1,13 @@
+-- Миграция 013: Общие cookie сессий X3UI панелей
+-- Описание: Таблица для хранения cookie сессий панелей между воркерами и рестартами
+-- (используется при x3ui_session_persist = true)
+
+CREATE TABLE IF NOT EXISTS x3ui_panel_sessions (
+    session_key VARCHAR(255) PRIMARY KEY,
+    cookie_name VARCHAR(64),
+    token VARCHAR(2048) NOT NULL,
+    expires_at TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS ix_x3ui_panel_sessions_expires_at ON x3ui_panel_sessions(expires_at);
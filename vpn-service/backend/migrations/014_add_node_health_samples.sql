@@ -0,0 +1,16 @@
+-- Миграция 014: Временной ряд проверок здоровья нод
+-- Описание: Каждая проба health check (время, задержка, успех, число inbound'ов);
+-- старые строки удаляются при обходе нод (health_samples_retention_days)
+
+CREATE TABLE IF NOT EXISTS node_health_samples (
+    id SERIAL PRIMARY KEY,
+    node_id INTEGER NOT NULL REFERENCES vpn_nodes(id) ON DELETE CASCADE,
+    checked_at TIMESTAMP NOT NULL,
+    latency_ms INTEGER,
+    success BOOLEAN NOT NULL,
+    inbounds_total INTEGER NOT NULL DEFAULT 0,
+    inbounds_active INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS ix_node_health_samples_node_checked ON node_health_samples(node_id, checked_at);
+CREATE INDEX IF NOT EXISTS ix_node_health_samples_checked_at ON node_health_samples(checked_at);
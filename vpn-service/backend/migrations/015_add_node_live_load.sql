@@ -0,0 +1,7 @@
+-- Миграция 015: Живая нагрузка нод по данным панели
+-- Описание: Сглаженные (EWMA) число онлайн-клиентов и трафик ноды, которые health check
+-- снимает с панели; используются в оценке нагрузки наравне с current_users
+
+ALTER TABLE vpn_nodes ADD COLUMN IF NOT EXISTS live_online_clients DOUBLE PRECISION;
+ALTER TABLE vpn_nodes ADD COLUMN IF NOT EXISTS live_throughput_mbps DOUBLE PRECISION;
+ALTER TABLE vpn_nodes ADD COLUMN IF NOT EXISTS live_load_updated_at TIMESTAMP WITH TIME ZONE;
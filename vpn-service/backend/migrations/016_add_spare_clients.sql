@@ -0,0 +1,17 @@
+-- Миграция 016: Теплый пул запасных клиентов нод
+-- Описание: Отключенные клиенты Reality inbound'а с заранее собранным VLESS URL;
+-- выдача ключа берет запасного клиента вместо создания нового в панели
+
+CREATE TABLE IF NOT EXISTS spare_clients (
+    id SERIAL PRIMARY KEY,
+    node_id INTEGER NOT NULL REFERENCES vpn_nodes(id) ON DELETE CASCADE,
+    inbound_id INTEGER NOT NULL,
+    client_id VARCHAR(36) NOT NULL UNIQUE,
+    email VARCHAR(255) NOT NULL,
+    vless_url TEXT NOT NULL,
+    public_key TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+-- Выданный клиент удаляется из таблицы: индекс для выборки старейшего запасного ноды
+CREATE INDEX IF NOT EXISTS ix_spare_clients_node_id ON spare_clients(node_id, id);
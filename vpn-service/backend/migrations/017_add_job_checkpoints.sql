@@ -0,0 +1,17 @@
+-- Миграция 017: Контрольные точки фоновых задач
+-- Описание: Курсор keyset-прохода (например, деактивации истекших ключей), чтобы прогон,
+-- прерванный сбоем, продолжался с места остановки, а не с начала
+
+CREATE TABLE IF NOT EXISTS job_checkpoints (
+    name VARCHAR(100) PRIMARY KEY,
+    cursor INTEGER NOT NULL DEFAULT 0,
+    cutoff TIMESTAMP WITH TIME ZONE,
+    processed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    started_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Выборка активных ключей по id для keyset-пагинации прохода
+CREATE INDEX IF NOT EXISTS ix_vpn_keys_status_id ON vpn_keys(status, id);
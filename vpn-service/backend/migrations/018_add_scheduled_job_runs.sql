@@ -0,0 +1,19 @@
+-- Миграция 018: История запусков встроенного планировщика задач
+-- Описание: Каждый запуск фоновой задачи (health check, сверка счетчиков, истекшие подписки,
+-- автоплатежи) пишет длительность и результат; задачу выполняет один процесс - лидер,
+-- выбранный через pg_try_advisory_lock
+
+CREATE TABLE IF NOT EXISTS scheduled_job_runs (
+    id SERIAL PRIMARY KEY,
+    job_name VARCHAR(100) NOT NULL,
+    worker VARCHAR(255),
+    status VARCHAR(20) NOT NULL DEFAULT 'running',
+    scheduled_for TIMESTAMP WITH TIME ZONE,
+    started_at TIMESTAMP WITH TIME ZONE NOT NULL,
+    finished_at TIMESTAMP WITH TIME ZONE,
+    duration_ms INTEGER,
+    result JSON,
+    error TEXT
+);
+
+CREATE INDEX IF NOT EXISTS ix_scheduled_job_runs_job_started ON scheduled_job_runs(job_name, started_at);
@@ -0,0 +1,12 @@
+-- Миграция 019: Ключ идемпотентности попытки автоплатежа
+-- Описание: Попытка заводится при захвате автоплатежа вместе с ожидающим платежом; id платежа
+-- уходит в Robokassa как InvoiceID, повтор после сбоя использует тот же номер счета
+
+ALTER TABLE payment_retry_attempts ADD COLUMN IF NOT EXISTS idempotency_key VARCHAR(64);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_payment_retry_attempts_idempotency_key
+    ON payment_retry_attempts(idempotency_key);
+
+-- Выборка автоплатежей, которые пора списать
+CREATE INDEX IF NOT EXISTS idx_auto_payments_status_next_payment
+    ON auto_payments(status, next_payment_date);
@@ -0,0 +1,6 @@
+-- Миграция 020: Индексы движка событий подписок
+-- Описание: Движок загружает окончания подписок и напоминания на окно вперед диапазоном
+-- по valid_until среди активных пользователей; списания автоплатежей выбираются
+-- индексом auto_payments(status, next_payment_date) из миграции 019
+
+CREATE INDEX IF NOT EXISTS ix_users_active_valid_until ON users(is_active, valid_until);
@@ -0,0 +1,27 @@
+-- Миграция 021: Очередь исходящих сообщений Telegram (outbox)
+-- Описание: Уведомления пишутся в таблицу и отправляются фоновым воркером с общей
+-- HTTP-сессией, пачками по приоритету, с лимитами Bot API (глобальным и на чат)
+-- и повтором после retry_after; одинаковое ожидающее сообщение хранится один раз
+
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id SERIAL PRIMARY KEY,
+    telegram_id BIGINT NOT NULL,
+    text TEXT NOT NULL,
+    parse_mode VARCHAR(16),
+    reply_markup JSON,
+    priority SMALLINT NOT NULL DEFAULT 5,
+    dedupe_key VARCHAR(64) NOT NULL,
+    status VARCHAR(16) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    available_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    locked_until TIMESTAMP WITH TIME ZONE,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    sent_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS uq_notification_outbox_pending_dedupe
+    ON notification_outbox(dedupe_key) WHERE status = 'pending';
+
+CREATE INDEX IF NOT EXISTS ix_notification_outbox_pending
+    ON notification_outbox(priority, available_at, id) WHERE status = 'pending';
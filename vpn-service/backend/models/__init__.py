@@ -13,6 +13,12 @@ from .payment_retry_attempt import PaymentRetryAttempt
 from .user_notification_preferences import UserNotificationPreferences
 from .server_switch_log import ServerSwitchLog
 from .app_settings import AppSettings
+from .x3ui_panel_session import X3UIPanelSession
+from .node_health_sample import NodeHealthSample
+from .spare_client import SpareClient
+from .job_checkpoint import JobCheckpoint
+from .scheduled_job_run import ScheduledJobRun
+from .notification_outbox import NotificationOutbox
 
 __all__ = [
     "User",
@@ -28,5 +34,11 @@ __all__ = [
     "PaymentRetryAttempt",
     "UserNotificationPreferences",
     "ServerSwitchLog",
-    "AppSettings"
+    "AppSettings",
+    "X3UIPanelSession",
+    "NodeHealthSample",
+    "SpareClient",
+    "JobCheckpoint",
+    "ScheduledJobRun",
+    "NotificationOutbox"
 ] 
\ No newline at end of file
@@ -0,0 +1,28 @@
+"""
+Модель JobCheckpoint - прогресс длинной фоновой задачи (возобновление после сбоя)
+"""
+
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.sql import func
+from config.database import Base
+
+
+class JobCheckpoint(Base):
+    """Курсор keyset-прохода задачи: последний обработанный id и граница выборки прогона"""
+    __tablename__ = "job_checkpoints"
+
+    name = Column(String(100), primary_key=True)
+    cursor = Column(Integer, default=0, nullable=False)  # Последний обработанный id
+    cutoff = Column(DateTime(timezone=True), nullable=True)  # Момент, на который отбираются записи прогона
+    processed = Column(Integer, default=0, nullable=False)
+    failed = Column(Integer, default=0, nullable=False)
+    started_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)  # NULL - прогон не завершен
+
+    @property
+    def is_running(self) -> bool:
+        return self.finished_at is None
+
+    def __repr__(self):
+        return f"<JobCheckpoint(name={self.name}, cursor={self.cursor}, finished_at={self.finished_at})>"
@@ -0,0 +1,37 @@
+"""
+Модель NodeHealthSample - результат одной проверки здоровья ноды (временной ряд)
+"""
+
+from sqlalchemy import Column, Integer, Boolean, DateTime, ForeignKey, Index
+from config.database import Base
+
+
+class NodeHealthSample(Base):
+    """Проба health check; хранится ограниченное время (health_samples_retention_days)"""
+    __tablename__ = "node_health_samples"
+
+    id = Column(Integer, primary_key=True)
+    node_id = Column(Integer, ForeignKey("vpn_nodes.id", ondelete="CASCADE"), nullable=False)
+    checked_at = Column(DateTime, nullable=False)
+    latency_ms = Column(Integer, nullable=True)
+    success = Column(Boolean, nullable=False)
+    inbounds_total = Column(Integer, default=0, nullable=False)
+    inbounds_active = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (
+        Index("ix_node_health_samples_node_checked", "node_id", "checked_at"),
+        Index("ix_node_health_samples_checked_at", "checked_at"),
+    )
+
+    def __repr__(self):
+        return f"<NodeHealthSample(node_id={self.node_id}, checked_at={self.checked_at}, success={self.success})>"
+
+    def to_dict(self) -> dict:
+        return {
+            "node_id": self.node_id,
+            "checked_at": self.checked_at.isoformat() if self.checked_at else None,
+            "latency_ms": self.latency_ms,
+            "success": self.success,
+            "inbounds_total": self.inbounds_total,
+            "inbounds_active": self.inbounds_active
+        }
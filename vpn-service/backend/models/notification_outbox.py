@@ -0,0 +1,39 @@
+"""
+Модель NotificationOutbox - исходящее сообщение Telegram, ожидающее отправки
+"""
+
+from sqlalchemy import Column, Integer, SmallInteger, BigInteger, String, Text, DateTime, JSON, Index
+from sqlalchemy import text as sa_text
+from sqlalchemy.sql import func
+from config.database import Base
+
+
+class NotificationOutbox(Base):
+    """Сообщение в очереди отправки: пишется вызывающим, отправляется воркером"""
+    __tablename__ = "notification_outbox"
+
+    id = Column(Integer, primary_key=True)
+    telegram_id = Column(BigInteger, nullable=False)
+    text = Column(Text, nullable=False)
+    parse_mode = Column(String(16), nullable=True)  # HTML / Markdown
+    reply_markup = Column(JSON, nullable=True)
+    priority = Column(SmallInteger, default=5, nullable=False)  # 0 - самый срочный
+    dedupe_key = Column(String(64), nullable=False)  # sha256 чата, текста и клавиатуры
+    status = Column(String(16), default="pending", nullable=False)  # pending / sent / failed
+    attempts = Column(Integer, default=0, nullable=False)
+    available_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)  # не раньше (retry_after)
+    locked_until = Column(DateTime(timezone=True), nullable=True)  # аренда воркера
+    last_error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    sent_at = Column(DateTime(timezone=True), nullable=True)
+
+    __table_args__ = (
+        # Одинаковое сообщение в очереди может быть только одно
+        Index("uq_notification_outbox_pending_dedupe", "dedupe_key", unique=True,
+              postgresql_where=sa_text("status = 'pending'")),
+        Index("ix_notification_outbox_pending", "priority", "available_at", "id",
+              postgresql_where=sa_text("status = 'pending'")),
+    )
+
+    def __repr__(self):
+        return f"<NotificationOutbox(id={self.id}, telegram_id={self.telegram_id}, status={self.status})>"
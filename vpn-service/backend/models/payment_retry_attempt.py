@@ -22,6 +22,7 @@ class PaymentRetryAttempt(Base):
     error_type = Column(String(50), nullable=False)  # 'insufficient_funds', 'technical_error', 'card_issue'
     error_message = Column(Text, nullable=True)  # Полный текст ошибки от Robokassa
     robokassa_response = Column(Text, nullable=True)  # Raw ответ API для дебага
+    idempotency_key = Column(String(64), unique=True, nullable=True)  # InvoiceID списания (id платежа попытки)
     
     # Временные метки попытки
     scheduled_at = Column(DateTime(timezone=True), nullable=False, index=True)
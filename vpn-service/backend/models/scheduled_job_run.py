@@ -0,0 +1,43 @@
+"""
+Модель ScheduledJobRun - один запуск фоновой задачи встроенного планировщика
+"""
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Index
+from config.database import Base
+
+
+class ScheduledJobRun(Base):
+    """Запуск задачи: когда, где, сколько длился и чем закончился"""
+    __tablename__ = "scheduled_job_runs"
+
+    id = Column(Integer, primary_key=True)
+    job_name = Column(String(100), nullable=False)
+    worker = Column(String(255), nullable=True)  # hostname:pid процесса-лидера
+    status = Column(String(20), default="running", nullable=False)  # running / success / failed / timeout
+    scheduled_for = Column(DateTime(timezone=True), nullable=True)
+    started_at = Column(DateTime(timezone=True), nullable=False)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+    duration_ms = Column(Integer, nullable=True)
+    result = Column(JSON, nullable=True)  # Итог, который вернула задача
+    error = Column(Text, nullable=True)
+
+    __table_args__ = (
+        Index("ix_scheduled_job_runs_job_started", "job_name", "started_at"),
+    )
+
+    def __repr__(self):
+        return f"<ScheduledJobRun(job_name={self.job_name}, status={self.status}, started_at={self.started_at})>"
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "job_name": self.job_name,
+            "worker": self.worker,
+            "status": self.status,
+            "scheduled_for": self.scheduled_for.isoformat() if self.scheduled_for else None,
+            "started_at": self.started_at.isoformat() if self.started_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "duration_ms": self.duration_ms,
+            "result": self.result,
+            "error": self.error
+        }
@@ -0,0 +1,29 @@
+"""
+Модель SpareClient - заранее созданный отключенный клиент панели (теплый пул ноды)
+"""
+
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, Index
+from sqlalchemy.sql import func
+from config.database import Base
+
+
+class SpareClient(Base):
+    """Запасной клиент: создан в Reality inbound'е отключенным, VLESS URL собран заранее"""
+    __tablename__ = "spare_clients"
+
+    id = Column(Integer, primary_key=True)
+    node_id = Column(Integer, ForeignKey("vpn_nodes.id", ondelete="CASCADE"), nullable=False)
+    inbound_id = Column(Integer, nullable=False)
+    client_id = Column(String(36), unique=True, nullable=False)  # UUID клиента в панели
+    email = Column(String(255), nullable=False)  # Временный email до выдачи
+    vless_url = Column(Text, nullable=False)
+    public_key = Column(Text, nullable=True)  # Ключ Reality, с которым собран URL
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+    # Строка удаляется при выдаче, поэтому в таблице только доступные клиенты
+    __table_args__ = (
+        Index("ix_spare_clients_node_id", "node_id", "id"),
+    )
+
+    def __repr__(self):
+        return f"<SpareClient(id={self.id}, node_id={self.node_id}, client_id={self.client_id})>"
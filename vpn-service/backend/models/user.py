@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, DateTime, Boolean, BigInteger, Enum
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, BigInteger, Enum, Index
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from config.database import Base
@@ -14,6 +14,10 @@ class UserSubscriptionStatus(str, enum.Enum):
 class User(Base):
     """Модель пользователя"""
     __tablename__ = "users"
+    __table_args__ = (
+        # Выборка сроков подписок на окно вперед (движок событий подписок)
+        Index("ix_users_active_valid_until", "is_active", "valid_until"),
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     telegram_id = Column(BigInteger, unique=True, index=True, nullable=False)
@@ -2,6 +2,8 @@ from sqlalchemy import Column, Integer, String, DateTime, Boolean, Float, Text,
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
 from config.database import Base
+from config.settings import get_settings
+from datetime import datetime, timezone
 import enum
 
 class NodeMode(str, enum.Enum):
@@ -9,6 +11,29 @@ class NodeMode(str, enum.Enum):
     default = "default"
     reality = "reality"
 
+def blended_load_ratio(node) -> float:
+    """
+    Доля загрузки ноды для выбора: зарегистрированные пользователи (current_users / max_users),
+    смешанные с живой нагрузкой панели (онлайн-клиенты, трафик) в пропорции node_live_load_weight.
+    Без свежего сигнала панели - только зарегистрированные пользователи
+    """
+    registered = node.current_users / node.max_users if node.max_users > 0 else 1.0
+    settings = get_settings()
+    updated_at = node.live_load_updated_at
+    if updated_at is None or node.live_online_clients is None or settings.node_live_load_weight <= 0:
+        return registered
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    if (datetime.now(timezone.utc) - updated_at).total_seconds() > settings.node_live_load_max_age:
+        return registered
+
+    live = node.live_online_clients / node.max_users if node.max_users > 0 else 1.0
+    if node.live_throughput_mbps is not None and settings.node_bandwidth_mbps > 0:
+        live = max(live, node.live_throughput_mbps / settings.node_bandwidth_mbps)
+    weight = min(1.0, settings.node_live_load_weight)
+    return (1.0 - weight) * registered + weight * min(1.0, live)
+
+
 class VPNNode(Base):
     """Модель серверной ноды VPN"""
     __tablename__ = "vpn_nodes"
@@ -49,6 +74,14 @@ class VPNNode(Base):
     # Конфигурация для Reality
     reality_config = Column(JSON, nullable=True)
     
+    # Результат probe API панели: {"flavour": ..., "version": ..., "probed_at": ...}
+    api_capabilities = Column(JSON, nullable=True)
+    
+    # Живая нагрузка по данным панели (EWMA, обновляет health check)
+    live_online_clients = Column(Float, nullable=True)
+    live_throughput_mbps = Column(Float, nullable=True)
+    live_load_updated_at = Column(DateTime(timezone=True), nullable=True)
+    
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
     
@@ -83,7 +116,7 @@ class VPNNode(Base):
         if not self.can_accept_users:
             return float('inf')
         
-        load_ratio = self.current_users / self.max_users if self.max_users > 0 else 1.0
+        load_ratio = blended_load_ratio(self)
         priority_score = self.priority / 100.0
         weight_score = self.weight
         
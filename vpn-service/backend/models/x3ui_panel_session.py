@@ -0,0 +1,28 @@
+"""
+Модель X3UIPanelSession - общий cookie сессии X3UI панели для всех воркеров
+"""
+
+from datetime import datetime
+
+from sqlalchemy import Column, String, DateTime
+from sqlalchemy.sql import func
+from config.database import Base
+
+
+class X3UIPanelSession(Base):
+    """Сохраненная сессия панели (cookie), чтобы рестарт воркеров не вызывал шквал логинов"""
+    __tablename__ = "x3ui_panel_sessions"
+
+    # node_key + username + хеш пароля, см. X3UISessionRegistry.session_key
+    session_key = Column(String(255), primary_key=True)
+    cookie_name = Column(String(64), nullable=True)
+    token = Column(String(2048), nullable=False)
+    expires_at = Column(DateTime, nullable=False, index=True)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+    def __repr__(self):
+        return f"<X3UIPanelSession(session_key={self.session_key}, expires_at={self.expires_at})>"
+
+    @property
+    def is_valid(self) -> bool:
+        return self.expires_at is not None and datetime.utcnow() < self.expires_at
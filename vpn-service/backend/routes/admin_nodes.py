@@ -15,7 +15,7 @@ from config.database import get_db
 from services.node_manager import NodeManager, NodeConfig
 from services.load_balancer import LoadBalancer
 from services.health_checker import HealthChecker
-from services.x3ui_client_pool import X3UIClientPool
+from services.x3ui_client_pool import x3ui_client_pool
 from models.vpn_node import VPNNode
 from services.node_automation import (
     NodeAutomationService, 
@@ -178,13 +178,20 @@ async def nodes_dashboard(
 
 @router.post("/rebalance")
 async def rebalance_nodes(
+    dry_run: bool = False,
     db: AsyncSession = Depends(get_db)
 ):
-    """Ребалансировка пользователей между нодами"""
+    """Ребалансировка пользователей между нодами (dry_run - только план)"""
     load_balancer = LoadBalancer(db)
-    result = await load_balancer.rebalance_users()
+    result = await load_balancer.rebalance_users(dry_run=dry_run)
     return result
 
+@router.get("/rebalance/status")
+async def rebalance_status():
+    """Прогресс текущей и последних ребалансировок"""
+    from services.node_rebalancer import rebalance_runs
+    return {"success": True, **rebalance_runs.get_stats()}
+
 @router.post("/health-check")
 async def health_check_all_nodes(
     db: AsyncSession = Depends(get_db)
@@ -192,7 +199,46 @@ async def health_check_all_nodes(
     """Проверка здоровья всех нод"""
     health_checker = HealthChecker(db)
     results = await health_checker.check_all_nodes()
-    return {"success": True, "results": results}
+    return {
+        "success": True,
+        "results": results,
+        "sweep_duration_ms": health_checker.last_sweep_duration_ms
+    }
+
+@router.get("/api/connection-stats")
+async def connection_stats():
+    """Статистика переиспользования keep-alive соединений к X3UI панелям"""
+    from services.x3ui_inbound_cache import x3ui_inbound_cache
+    from services.x3ui_session_registry import x3ui_session_registry
+    from services.x3ui_circuit_breaker import x3ui_circuit_breakers
+    from services.node_registry import node_registry
+    from services.notification_outbox import notification_outbox
+    from services.country_stats import country_stats_cache
+    from services.spare_client_pool import spare_client_pool
+    return {
+        "success": True,
+        "nodes": x3ui_client_pool.get_connection_stats(),
+        "client_pool": x3ui_client_pool.get_stats(),
+        "inbound_cache": x3ui_inbound_cache.get_stats(),
+        "panel_sessions": x3ui_session_registry.get_stats(),
+        "circuits": x3ui_circuit_breakers.get_stats(),
+        "node_registry": node_registry.get_stats(),
+        "notification_outbox": {**notification_outbox.get_stats(), **await notification_outbox.get_depth()},
+        "country_stats": country_stats_cache.get_stats(),
+        "spare_client_pool": spare_client_pool.get_stats()
+    }
+
+@router.get("/{node_id:int}/health-series")
+async def node_health_series(node_id: int, bucket_minutes: int = 0):
+    """Временной ряд проверок ноды и скользящие p50/p95/error-rate (для графиков)"""
+    from services.node_health_metrics import node_health_metrics
+    await node_health_metrics.ensure_loaded()
+    return {
+        "success": True,
+        "node_id": node_id,
+        "summary": node_health_metrics.get_summary(node_id),
+        "points": node_health_metrics.get_series(node_id, bucket_minutes)
+    }
 
 @router.get("/{node_id:int}", response_class=HTMLResponse)
 async def view_node(
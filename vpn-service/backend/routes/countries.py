@@ -10,6 +10,7 @@ import structlog
 
 from config.database import get_db
 from services.country_service import CountryService
+from services.country_stats import CountryStats
 from services.user_server_service import UserServerService, NodeSelectionResult
 
 logger = structlog.get_logger(__name__)
@@ -221,6 +222,7 @@ async def get_country_statistics(
         country_service = CountryService(db)
         
         countries = await country_service.get_available_countries()
+        country_stats = await country_service.get_country_stats()
         
         stats = {
             "total_countries": len(countries),
@@ -228,26 +230,17 @@ async def get_country_statistics(
         }
         
         for country in countries:
-            nodes = await country_service.get_nodes_by_country(country.id)
+            aggregate = country_stats.get(country.id) or CountryStats(country.id)
             
-            # Подсчитываем статистику по нодам
-            total_nodes = len(nodes)
-            healthy_nodes = len([n for n in nodes if n.is_healthy])
-            total_capacity = sum(n.max_users for n in nodes)
-            total_users = sum(n.current_users for n in nodes)
-            avg_load = (total_users / total_capacity * 100) if total_capacity > 0 else 0
-            
-            country_stats = {
+            stats["countries"].append({
                 "country": country.to_dict(),
-                "nodes_total": total_nodes,
-                "nodes_healthy": healthy_nodes,
-                "total_capacity": total_capacity,
-                "current_users": total_users,
-                "average_load_percentage": round(avg_load, 1),
-                "availability": healthy_nodes > 0
-            }
-            
-            stats["countries"].append(country_stats)
+                "nodes_total": aggregate.nodes_total,
+                "nodes_healthy": aggregate.nodes_healthy,
+                "total_capacity": aggregate.total_capacity,
+                "current_users": aggregate.current_users,
+                "average_load_percentage": round(aggregate.load_percentage, 1),
+                "availability": aggregate.availability
+            })
         
         logger.info("Country statistics generated", countries_count=len(countries))
         return stats
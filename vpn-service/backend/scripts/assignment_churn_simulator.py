@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+"""
+Симулятор churn назначения пользователей на ноды
+Сравнивает режимы node_assignment_mode (score и rendezvous) по числу переездов на одном
+сценарии с отказами нод и перебалансировкой. Выбор идет через настоящий код
+(services.load_balancer_simulation), здесь - только отчет по миграциям. Запуск:
+python scripts/assignment_churn_simulator.py --nodes 6 --arrivals 3000 --failures 3
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import os
+
+# Добавляем корневую директорию проекта в PYTHONPATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import structlog
+
+structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+
+from services.load_balancer_simulation import (
+    FleetSpec, WorkloadSpec, STRATEGIES, MODES, run_benchmark
+)
+from services.node_hashing import ASSIGNMENT_MODE_SCORE, ASSIGNMENT_MODE_RENDEZVOUS
+
+# Поля прогона, относящиеся к churn
+CHURN_FIELDS = ("migrations", "failover_moves", "rebalance_moves", "stranded_users", "max_to_mean_load")
+
+
+def churn_report(results) -> dict:
+    """{стратегия: {режим: поля churn, доля переездов rendezvous относительно score}}"""
+    report = {}
+    for result in results:
+        entry = report.setdefault(result["strategy"], {})
+        entry[result["mode"]] = {name: result[name] for name in CHURN_FIELDS}
+    for entry in report.values():
+        score = entry.get(ASSIGNMENT_MODE_SCORE)
+        rendezvous = entry.get(ASSIGNMENT_MODE_RENDEZVOUS)
+        if score and rendezvous and score["migrations"]:
+            entry["rendezvous_to_score_migrations"] = round(
+                rendezvous["migrations"] / score["migrations"], 4
+            )
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Churn simulator: score vs rendezvous assignment")
+    parser.add_argument("--nodes", type=int, default=6)
+    parser.add_argument("--countries", type=int, default=1)
+    parser.add_argument("--arrivals", type=int, default=3000)
+    parser.add_argument("--departure-rate", type=float, default=0.1)
+    parser.add_argument("--failures", type=int, default=3, help="Сколько нод выпадает (и возвращается)")
+    parser.add_argument("--rebalance-every", type=int, default=500, help="0 - без перебалансировки")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--strategy", choices=STRATEGIES, action="append")
+    args = parser.parse_args()
+
+    fleet_spec = FleetSpec(nodes=args.nodes, countries=args.countries)
+    workload_spec = WorkloadSpec(
+        arrivals=args.arrivals,
+        departure_rate=args.departure_rate,
+        node_failures=args.failures,
+        rebalance_every=args.rebalance_every
+    )
+    results = asyncio.run(run_benchmark(
+        fleet_spec, workload_spec, args.seed,
+        strategies=args.strategy or STRATEGIES,
+        modes=MODES
+    ))
+    print(json.dumps(churn_report(results), indent=2, ensure_ascii=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,9 @@
 #!/usr/bin/env python3
 """
-Cron скрипт для обработки автоплатежей
-Запускать каждый час через cron:
-0 * * * * /path/to/python /path/to/autopay_cron.py >> /var/log/autopay.log 2>&1
+Скрипт для обработки автоплатежей
+По расписанию (scheduler_autopay_cron) их обрабатывает встроенный планировщик приложения;
+скрипт оставлен для ручного запуска - не добавляйте его в crontab вместе с планировщиком:
+/path/to/python /path/to/autopay_cron.py >> /var/log/autopay.log 2>&1
 """
 
 import asyncio
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Бенчмарк выбора нод на синтетическом парке (без БД и панелей)
+Прогоняет один и тот же детерминированный поток событий через LoadBalancer и
+UserServerService-скоринг в режимах score и rendezvous, печатает JSON с решениями/с,
+p99 задержки выбора, max/mean и Джини загрузки, числом миграций. Запуск:
+python scripts/load_balancer_benchmark.py --nodes 20 --arrivals 20000 --seed 1
+С порогами (--max-gini, --max-imbalance, --max-p99-ms) код возврата 1 при регрессии
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import sys
+import os
+
+# Добавляем корневую директорию проекта в PYTHONPATH
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import structlog
+
+# Логи выбора нод не должны искажать замер задержки
+structlog.configure(wrapper_class=structlog.make_filtering_bound_logger(logging.WARNING))
+
+from services.load_balancer_simulation import (
+    FleetSpec, WorkloadSpec, STRATEGIES, MODES, run_benchmark
+)
+
+
+def check_thresholds(results, args) -> list:
+    """Нарушения порогов по всем прогонам"""
+    violations = []
+    for result in results:
+        label = f"{result['strategy']}/{result['mode']}"
+        if args.max_gini is not None and result["gini"] > args.max_gini:
+            violations.append(f"{label}: gini {result['gini']} > {args.max_gini}")
+        if args.max_imbalance is not None and result["max_to_mean_load"] > args.max_imbalance:
+            violations.append(f"{label}: max/mean {result['max_to_mean_load']} > {args.max_imbalance}")
+        if args.max_p99_ms is not None and result["p99_selection_ms"] > args.max_p99_ms:
+            violations.append(f"{label}: p99 {result['p99_selection_ms']}ms > {args.max_p99_ms}ms")
+    return violations
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Deterministic load balancer simulation")
+    parser.add_argument("--nodes", type=int, default=20)
+    parser.add_argument("--countries", type=int, default=2)
+    parser.add_argument("--arrivals", type=int, default=20000)
+    parser.add_argument("--departure-rate", type=float, default=0.2)
+    parser.add_argument("--failures", type=int, default=2, help="Сколько нод выпадает (и возвращается)")
+    parser.add_argument("--rebalance-every", type=int, default=5000, help="0 - без перебалансировки")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--strategy", choices=STRATEGIES, action="append")
+    parser.add_argument("--mode", choices=MODES, action="append")
+    parser.add_argument("--max-gini", type=float)
+    parser.add_argument("--max-imbalance", type=float, help="Порог max/mean загрузки")
+    parser.add_argument("--max-p99-ms", type=float)
+    args = parser.parse_args()
+
+    fleet_spec = FleetSpec(nodes=args.nodes, countries=args.countries)
+    workload_spec = WorkloadSpec(
+        arrivals=args.arrivals,
+        departure_rate=args.departure_rate,
+        node_failures=args.failures,
+        rebalance_every=args.rebalance_every
+    )
+    results = asyncio.run(run_benchmark(
+        fleet_spec, workload_spec, args.seed,
+        strategies=args.strategy or STRATEGIES,
+        modes=args.mode or MODES
+    ))
+
+    violations = check_thresholds(results, args)
+    print(json.dumps({"results": results, "violations": violations}, indent=2, ensure_ascii=False))
+    sys.exit(1 if violations else 0)
+
+
+if __name__ == "__main__":
+    main()
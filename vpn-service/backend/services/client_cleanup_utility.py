@@ -12,6 +12,8 @@ from datetime import datetime
 from services.x3ui_client import X3UIClient
 from models.vpn_node import VPNNode
 from models.vpn_key import VPNKey, VPNKeyStatus
+from models.spare_client import SpareClient
+from services.spare_client_pool import SPARE_EMAIL_PREFIX
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, update
 
@@ -88,6 +90,12 @@ class ClientCleanupUtility:
         db_client_ids = set([key.xui_client_id for key in active_keys if key.xui_client_id])
         db_client_emails = set([key.xui_email for key in active_keys if key.xui_email])
         
+        # Запасные клиенты пула не привязаны к ключам, но осиротевшими не являются
+        spare_result = await self.session.execute(
+            select(SpareClient.client_id).where(SpareClient.node_id == node.id)
+        )
+        spare_client_ids = set(spare_result.scalars().all())
+        
         # Находим клиентов, которых нет в базе данных
         orphaned_clients = []
         duplicate_clients = []
@@ -100,6 +108,10 @@ class ClientCleanupUtility:
             # Подсчитываем количество клиентов с одинаковым email
             email_count[email] = email_count.get(email, 0) + 1
             
+            # Запасной клиент (в т.ч. созданный в панели, но еще не записанный в пул)
+            if client_id in spare_client_ids or email.startswith(SPARE_EMAIL_PREFIX):
+                continue
+            
             # Если клиента нет в базе данных
             if client_id not in db_client_ids and email not in db_client_emails:
                 orphaned_clients.append(client)
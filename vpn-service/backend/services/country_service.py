@@ -4,13 +4,15 @@ CountryService - сервис для управления странами VPN 
 
 import json
 import os
-from typing import List, Optional
+from typing import Dict, List, Optional
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_
 from sqlalchemy.orm import selectinload
 
 from models.country import Country
 from models.vpn_node import VPNNode
+from services.node_registry import node_registry, NodeView
+from services.country_stats import country_stats_cache, CountryStats
 import structlog
 
 logger = structlog.get_logger(__name__)
@@ -50,18 +52,11 @@ class CountryService:
             logger.error("Failed to get available countries", error=str(e))
             return []
     
-    async def get_nodes_by_country(self, country_id: int) -> List[VPNNode]:
-        """Получить все активные ноды для указанной страны"""
+    async def get_nodes_by_country(self, country_id: int) -> List[NodeView]:
+        """Получить все активные ноды для указанной страны (из снимка node_registry)"""
         try:
-            query = select(VPNNode).where(
-                and_(
-                    VPNNode.country_id == country_id,
-                    VPNNode.status == "active"
-                )
-            ).order_by(VPNNode.priority.desc())
-            
-            result = await self.db.execute(query)
-            nodes = result.scalars().all()
+            snapshot = await node_registry.get_snapshot()
+            nodes = snapshot.select(country_id=country_id, status="active")
             
             logger.info("Retrieved nodes for country", country_id=country_id, count=len(nodes))
             return list(nodes)
@@ -70,6 +65,10 @@ class CountryService:
             logger.error("Failed to get nodes by country", country_id=country_id, error=str(e))
             return []
     
+    async def get_country_stats(self) -> Dict[int, CountryStats]:
+        """Агрегаты по всем странам {country_id: CountryStats} (один запрос, кэшируется)"""
+        return await country_stats_cache.get(self.db)
+    
     async def get_country_by_code(self, code: str) -> Optional[Country]:
         """Получить страну по ISO коду"""
         try:
@@ -109,16 +108,8 @@ class CountryService:
     async def validate_country_availability(self, country_id: int) -> bool:
         """Проверить, есть ли у страны доступные здоровые ноды"""
         try:
-            query = select(VPNNode).where(
-                and_(
-                    VPNNode.country_id == country_id,
-                    VPNNode.status == "active",
-                    VPNNode.health_status == "healthy"
-                )
-            )
-            
-            result = await self.db.execute(query)
-            nodes = result.scalars().all()
+            snapshot = await node_registry.get_snapshot()
+            nodes = snapshot.select(country_id=country_id, status="active", health=("healthy",))
             
             # Проверяем, есть ли ноды с доступной capacity
             available_nodes = [node for node in nodes if node.can_accept_users]
@@ -0,0 +1,177 @@
+"""
+Country Stats - агрегаты по странам одним сгруппированным запросом с коротким кэшем
+Число нод, здоровых нод, емкость, пользователи и назначения по всем странам считаются
+в БД за один запрос; кэш сбрасывается после commit'а, изменившего vpn_nodes
+(включая счетчики current_users) или user_server_assignments, и страхуется TTL
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import Dict, Any, Optional
+
+import structlog
+from sqlalchemy import select, func, event
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from config.settings import get_settings
+from models.country import Country
+from models.vpn_node import VPNNode
+from models.user_server_assignment import UserServerAssignment
+
+logger = structlog.get_logger(__name__)
+
+
+@dataclass(frozen=True)
+class CountryStats:
+    """Агрегаты активных нод страны"""
+    country_id: int
+    nodes_total: int = 0
+    nodes_healthy: int = 0
+    total_capacity: int = 0
+    current_users: int = 0
+    user_assignments: int = 0
+
+    @property
+    def load_percentage(self) -> float:
+        return (self.current_users / self.total_capacity * 100) if self.total_capacity > 0 else 0.0
+
+    @property
+    def availability(self) -> bool:
+        return self.nodes_healthy > 0
+
+
+async def aggregate_country_stats(db: AsyncSession) -> Dict[int, CountryStats]:
+    """Один запрос: страны + сгруппированные активные ноды + сгруппированные назначения"""
+    nodes = (
+        select(
+            VPNNode.country_id.label("country_id"),
+            func.count().label("nodes_total"),
+            func.count().filter(VPNNode.health_status == "healthy").label("nodes_healthy"),
+            func.coalesce(func.sum(VPNNode.max_users), 0).label("total_capacity"),
+            func.coalesce(func.sum(VPNNode.current_users), 0).label("current_users")
+        )
+        .where(VPNNode.status == "active", VPNNode.country_id.isnot(None))
+        .group_by(VPNNode.country_id)
+        .subquery()
+    )
+    assignments = (
+        select(
+            UserServerAssignment.country_id.label("country_id"),
+            func.count().label("user_assignments")
+        )
+        .group_by(UserServerAssignment.country_id)
+        .subquery()
+    )
+    result = await db.execute(
+        select(
+            Country.id,
+            func.coalesce(nodes.c.nodes_total, 0),
+            func.coalesce(nodes.c.nodes_healthy, 0),
+            func.coalesce(nodes.c.total_capacity, 0),
+            func.coalesce(nodes.c.current_users, 0),
+            func.coalesce(assignments.c.user_assignments, 0)
+        )
+        .outerjoin(nodes, nodes.c.country_id == Country.id)
+        .outerjoin(assignments, assignments.c.country_id == Country.id)
+    )
+    return {
+        row[0]: CountryStats(row[0], int(row[1]), int(row[2]), int(row[3]), int(row[4]), int(row[5]))
+        for row in result.all()
+    }
+
+
+class CountryStatsCache:
+    """Процессный кэш агрегатов по странам"""
+
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        self.ttl = ttl_seconds if ttl_seconds is not None else get_settings().country_stats_cache_ttl
+        self._stats: Optional[Dict[int, CountryStats]] = None
+        self._loaded_at = 0.0
+        self._dirty = True
+        self._lock = asyncio.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def invalidate(self) -> None:
+        self._dirty = True
+
+    def _is_fresh(self) -> bool:
+        return (self._stats is not None and not self._dirty
+                and time.monotonic() - self._loaded_at < self.ttl)
+
+    async def get(self, db: AsyncSession) -> Dict[int, CountryStats]:
+        """{country_id: CountryStats}; при промахе - один запрос в сессии вызывающего"""
+        if self._is_fresh():
+            self.hits += 1
+            return self._stats
+        async with self._lock:
+            if self._is_fresh():
+                self.hits += 1
+                return self._stats
+            self.misses += 1
+            # Флаг сбрасываем до чтения: изменение во время запроса вызовет повторную загрузку
+            self._dirty = False
+            try:
+                stats = await aggregate_country_stats(db)
+            except Exception:
+                self._dirty = True
+                raise
+            self._stats = stats
+            self._loaded_at = time.monotonic()
+            logger.debug("Country stats aggregated", countries=len(stats))
+            return stats
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "countries": len(self._stats) if self._stats else 0,
+            "dirty": self._dirty,
+            "hits": self.hits,
+            "misses": self.misses,
+            "ttl_seconds": self.ttl
+        }
+
+
+# Глобальный кэш статистики стран (один на процесс)
+country_stats_cache = CountryStatsCache()
+
+
+# Инвалидация: любые записи нод (в том числе только счетчиков) и назначений пользователей
+
+_DIRTY_FLAG = "country_stats_dirty"
+_TRACKED = (VPNNode, UserServerAssignment)
+
+
+def _mark_session(session: Optional[Session]) -> None:
+    if session is not None:
+        session.info[_DIRTY_FLAG] = True
+
+
+@event.listens_for(VPNNode, "after_insert")
+@event.listens_for(VPNNode, "after_update")
+@event.listens_for(VPNNode, "after_delete")
+@event.listens_for(UserServerAssignment, "after_insert")
+@event.listens_for(UserServerAssignment, "after_update")
+@event.listens_for(UserServerAssignment, "after_delete")
+def _on_flush(mapper, connection, target) -> None:
+    _mark_session(Session.object_session(target))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _on_orm_execute(orm_execute_state) -> None:
+    if (orm_execute_state.is_update or orm_execute_state.is_delete or orm_execute_state.is_insert) \
+            and orm_execute_state.bind_mapper is not None \
+            and orm_execute_state.bind_mapper.class_ in _TRACKED:
+        _mark_session(orm_execute_state.session)
+
+
+@event.listens_for(Session, "after_commit")
+def _on_commit(session) -> None:
+    if session.info.pop(_DIRTY_FLAG, False):
+        country_stats_cache.invalidate()
+
+
+@event.listens_for(Session, "after_rollback")
+def _on_rollback(session) -> None:
+    session.info.pop(_DIRTY_FLAG, None)
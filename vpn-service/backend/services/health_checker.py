@@ -4,6 +4,7 @@ HealthChecker Service - Мониторинг здоровья VPN нод
 
 import structlog
 import asyncio
+import time
 from typing import Optional, List, Dict, Any
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
@@ -13,21 +14,33 @@ import json
 
 from models.vpn_node import VPNNode
 from models.user_node_assignment import UserNodeAssignment
+from models.node_health_sample import NodeHealthSample
 from services.x3ui_client import X3UIClient
-from services.x3ui_client_pool import X3UIClientPool
+from services.x3ui_client_pool import x3ui_client_pool
 from services.load_balancer import LoadBalancer
+from services.x3ui_http_pool import x3ui_http_pool
+from services.x3ui_api_discovery import x3ui_api_registry
+from services.node_health_metrics import node_health_metrics, NodeHealthMetrics, HealthSample
+from services.node_registry import node_registry
+from services.node_evacuation import NodeEvacuation
+from services.node_load_collector import node_load_collector, LiveLoadSample
 from config.database import get_db
+from config.settings import get_settings
 
 logger = structlog.get_logger(__name__)
 
 class HealthStatus:
     """Статус здоровья ноды"""
     def __init__(self, node_id: int, is_healthy: bool, response_time_ms: Optional[int] = None,
-                 error_message: Optional[str] = None):
+                 error_message: Optional[str] = None, inbounds_total: int = 0,
+                 inbounds_active: int = 0, live_load: Optional[LiveLoadSample] = None):
         self.node_id = node_id
         self.is_healthy = is_healthy
         self.response_time_ms = response_time_ms
         self.error_message = error_message
+        self.inbounds_total = inbounds_total
+        self.inbounds_active = inbounds_active
+        self.live_load = live_load
         self.checked_at = datetime.utcnow()
 
 class HealthChecker:
@@ -35,9 +48,10 @@ class HealthChecker:
     
     def __init__(self, db_session: AsyncSession = None):
         self.db = db_session
-        self.client_pool = X3UIClientPool(db_session)
+        self.client_pool = x3ui_client_pool
         self.load_balancer = LoadBalancer(db_session)
         self.check_interval = timedelta(minutes=5)  # Проверка каждые 5 минут
+        self.last_sweep_duration_ms: Optional[int] = None
     
     async def check_node_health_by_id(self, node_id: int) -> HealthStatus:
         """Проверка состояния конкретной ноды"""
@@ -52,45 +66,18 @@ class HealthChecker:
                 logger.error("Node not found for health check", node_id=node_id)
                 return HealthStatus(node_id, False, error_message="Node not found")
             
-            start_time = datetime.utcnow()
-            
-            # Создаем временный клиент для проверки
-            client = X3UIClient()
-            client.base_url = node.x3ui_url
-            client.username = node.x3ui_username
-            client.password = node.x3ui_password
-            
-            # Проверяем соединение
-            login_success = await client._login()
-            
-            # Если успешно - проверяем доступность inbounds
-            is_healthy = False
-            if login_success:
-                inbounds = await client.get_inbounds()
-                is_healthy = inbounds is not None
-            
-            end_time = datetime.utcnow()
-            response_time = int((end_time - start_time).total_seconds() * 1000)
+            status = await self._probe_node(node)
             
             # Обновляем статус ноды в БД
-            health_status = 'healthy' if is_healthy else 'unhealthy'
-            node.health_status = health_status
-            node.last_health_check = datetime.utcnow()
-            node.response_time_ms = response_time
-            
+            self._apply_status(node, status)
             await self.db.commit()
             
             logger.info("Node health check completed", 
                        node_id=node_id, 
-                       is_healthy=is_healthy,
-                       response_time=response_time)
+                       is_healthy=status.is_healthy,
+                       response_time=status.response_time_ms)
             
-            return HealthStatus(
-                node_id=node_id,
-                is_healthy=is_healthy,
-                response_time_ms=response_time,
-                error_message=None if is_healthy else "Connection failed"
-            )
+            return status
             
         except Exception as e:
             logger.error("Error checking node health", 
@@ -117,17 +104,78 @@ class HealthChecker:
                 error_message=str(e)
             )
     
+    async def _probe_node(self, node: VPNNode) -> HealthStatus:
+        """Сетевая проверка ноды (логин + список inbound'ов) без обращений к БД"""
+        start_time = datetime.utcnow()
+        
+        # Создаем временный клиент для проверки
+        client = X3UIClient.from_node(node)
+        
+        # Проверяем соединение
+        login_success = await client._login()
+        
+        # Если успешно - проверяем доступность inbounds
+        is_healthy = False
+        inbounds = None
+        if login_success:
+            inbounds = await client.get_inbounds()
+            is_healthy = inbounds is not None
+        
+        response_time = int((datetime.utcnow() - start_time).total_seconds() * 1000)
+        
+        # Живая нагрузка (онлайн-клиенты, трафик) - после замера задержки, чтобы не искажать его
+        live_load = await node_load_collector.sample(client, node.id, inbounds) if is_healthy else None
+        
+        return HealthStatus(
+            node_id=node.id,
+            is_healthy=is_healthy,
+            response_time_ms=response_time,
+            error_message=None if is_healthy else "Connection failed",
+            inbounds_total=len(inbounds) if inbounds else 0,
+            inbounds_active=sum(1 for i in inbounds if i.get('enable', False)) if inbounds else 0,
+            live_load=live_load
+        )
+    
+    def _apply_status(self, node: VPNNode, status: HealthStatus) -> None:
+        """Перенести результат проверки в модель ноды и временной ряд (commit делает вызывающий)"""
+        node.health_status = 'healthy' if status.is_healthy else 'unhealthy'
+        node.last_health_check = status.checked_at
+        if status.response_time_ms is not None:
+            node.response_time_ms = status.response_time_ms
+        self._persist_api_capabilities(node)
+        if status.live_load is not None:
+            node_load_collector.apply(node, status.live_load)
+        
+        sample = HealthSample(
+            status.checked_at, status.response_time_ms, status.is_healthy,
+            status.inbounds_total, status.inbounds_active
+        )
+        node_health_metrics.record(node.id, sample)
+        self.db.add(NodeHealthSample(
+            node_id=node.id,
+            checked_at=sample.checked_at,
+            latency_ms=sample.latency_ms,
+            success=sample.success,
+            inbounds_total=sample.inbounds_total,
+            inbounds_active=sample.inbounds_active
+        ))
+    
+    def _persist_api_capabilities(self, node: VPNNode) -> None:
+        """Сохранить в ноду вариант API панели, если probe дал новый результат"""
+        capabilities = x3ui_api_registry.get(node.x3ui_url)
+        if capabilities is None:
+            return
+        stored = node.api_capabilities or {}
+        if (stored.get("flavour"), stored.get("version")) != (capabilities.flavour, capabilities.version):
+            node.api_capabilities = capabilities.to_dict()
+    
     async def check_node_health(self, node: VPNNode) -> tuple[bool, Optional[str], Optional[int], int, int]:
         """Проверка состояния ноды - возвращает (is_healthy, error_msg, response_time, inbounds_count, active_inbounds_count)"""
         try:
             start_time = datetime.utcnow()
             
             # Создаем клиент с параметрами ноды
-            client = X3UIClient(
-                base_url=node.x3ui_url,
-                username=node.x3ui_username,
-                password=node.x3ui_password
-            )
+            client = X3UIClient.from_node(node)
             
             # Проверяем авторизацию
             login_success = await client._login()
@@ -171,22 +219,71 @@ class HealthChecker:
             
             return False, f"Connection error: {str(e)}", None, 0, 0
     
-    async def check_all_nodes(self) -> Dict[int, HealthStatus]:
-        """Проверка всех нод"""
+    async def check_all_nodes(self, concurrency: Optional[int] = None,
+                              node_timeout: Optional[float] = None) -> Dict[int, HealthStatus]:
+        """
+        Проверка всех нод
+
+        Ноды проверяются параллельно (не более concurrency одновременно), каждая - с
+        собственным дедлайном node_timeout, чтобы мертвые ноды не растягивали обход.
+        Результаты записываются в БД одним commit'ом; длительность обхода - в last_sweep_duration_ms
+        """
+        settings = get_settings()
+        concurrency = concurrency or settings.health_check_concurrency
+        node_timeout = node_timeout or settings.health_check_node_timeout
+        if node_timeout <= settings.x3ui_request_timeout:
+            logger.warning("Health check deadline is not longer than X3UI request timeout",
+                          node_timeout=node_timeout,
+                          request_timeout=settings.x3ui_request_timeout)
+        sweep_started = time.monotonic()
+        
         try:
             # Получаем все ноды
             result = await self.db.execute(select(VPNNode))
             nodes = result.scalars().all()
-            
-            # Проверяем каждую ноду
+            await node_health_metrics.ensure_loaded()
+            
+            semaphore = asyncio.Semaphore(concurrency)
+            
+            async def probe(node: VPNNode) -> HealthStatus:
+                async with semaphore:
+                    try:
+                        return await asyncio.wait_for(self._probe_node(node), timeout=node_timeout)
+                    except asyncio.TimeoutError:
+                        return HealthStatus(
+                            node.id, False,
+                            response_time_ms=int(node_timeout * 1000),
+                            error_message=f"Health check timed out after {node_timeout}s"
+                        )
+                    except Exception as e:
+                        return HealthStatus(node.id, False, error_message=str(e))
+            
+            statuses = await asyncio.gather(*(probe(node) for node in nodes))
+            
+            # Один batched commit на весь обход
             health_statuses = {}
-            for node in nodes:
-                status = await self.check_node_health_by_id(node.id)
+            for node, status in zip(nodes, statuses):
+                self._apply_status(node, status)
                 health_statuses[node.id] = status
+            await NodeHealthMetrics.prune(self.db)
+            await self.db.commit()
+            
+            # Публикуем новый снимок нод сразу, чтобы выбор ноды не перечитывал БД на запросе
+            await node_registry.refresh(force=True)
+            
+            self.last_sweep_duration_ms = int((time.monotonic() - sweep_started) * 1000)
+            logger.info("Health sweep completed",
+                       nodes=len(nodes),
+                       healthy=sum(1 for st in statuses if st.is_healthy),
+                       timed_out=sum(1 for st in statuses
+                                     if st.error_message and st.error_message.startswith("Health check timed out")),
+                       concurrency=concurrency,
+                       sweep_duration_ms=self.last_sweep_duration_ms)
             
             return health_statuses
             
         except Exception as e:
+            self.last_sweep_duration_ms = int((time.monotonic() - sweep_started) * 1000)
             logger.error("Error checking all nodes", error=str(e))
             return {}
     
@@ -213,39 +310,13 @@ class HealthChecker:
             node.health_status = 'unhealthy'
             await self.db.commit()
             
-            # Получаем пользователей на этой ноде
-            users_result = await self.db.execute(
-                select(User)
-                .join(UserNodeAssignment)
-                .where(UserNodeAssignment.node_id == node_id)
-                .where(UserNodeAssignment.is_active == True)
-            )
-            users = users_result.scalars().all()
-            
-            # Мигрируем пользователей на другие ноды
-            migrated_count = 0
-            failed_count = 0
-            
-            for user in users:
-                # Выбираем оптимальную ноду для миграции
-                optimal_node = await self.load_balancer.select_optimal_node()
-                
-                if not optimal_node:
-                    logger.error("No healthy nodes available for migration")
-                    break
-                
-                # Мигрируем пользователя
-                success = await self.load_balancer.migrate_user(user.id, optimal_node.id)
-                
-                if success:
-                    migrated_count += 1
-                else:
-                    failed_count += 1
+            # Переносим пользователей и ключи одним пакетом: план, клиенты на панелях, set-based UPDATE
+            report = await NodeEvacuation(self.db).evacuate(node_id)
             
             logger.info("Unhealthy node handled", 
                        node_id=node_id, 
-                       migrated_users=migrated_count,
-                       failed_migrations=failed_count)
+                       migrated_users=report.moved_users,
+                       failed_migrations=report.failed_users + report.unplaced_users)
             
             return True
             
@@ -270,8 +341,8 @@ class HealthChecker:
                     if not status.is_healthy:
                         await self.handle_unhealthy_node(node_id)
                 
-                # Обновляем кэш клиентов
-                await self.client_pool.clear_cache()
+                # Вытесняем простаивающих клиентов из пула
+                self.client_pool.evict_idle()
                 
             except Exception as e:
                 logger.error("Error in monitoring cycle", error=str(e))
@@ -321,8 +392,13 @@ class HealthChecker:
                     "current_users": node.current_users,
                     "max_users": node.max_users,
                     "load_percentage": node.load_percentage,
+                    "live_online_clients": node.live_online_clients,
+                    "live_throughput_mbps": node.live_throughput_mbps,
+                    "api_capabilities": node.api_capabilities,
                     "last_health_check": node.last_health_check.isoformat() if node.last_health_check else None,
-                    "response_time_ms": node.response_time_ms
+                    "response_time_ms": node.response_time_ms,
+                    "latency": node_health_metrics.get_summary(node.id),
+                    "http_pool": x3ui_http_pool.get_stats(node.x3ui_url)
                 })
             
             return report
@@ -349,10 +425,7 @@ class HealthChecker:
                 return {"error": "Node not found"}
             
             # Получаем дополнительную статистику через X3UI
-            client = X3UIClient()
-            client.base_url = node.x3ui_url
-            client.username = node.x3ui_username
-            client.password = node.x3ui_password
+            client = X3UIClient.from_node(node)
             
             x3ui_stats = {
                 "connected": False,
@@ -410,9 +483,11 @@ class HealthChecker:
                 "health_stats": {
                     "last_check": node.last_health_check.isoformat() if node.last_health_check else None,
                     "response_time_ms": node.response_time_ms,
-                    "is_healthy": node.health_status == "healthy"
+                    "is_healthy": node.health_status == "healthy",
+                    "latency": node_health_metrics.get_summary(node.id)
                 },
                 "x3ui_stats": x3ui_stats,
+                "http_pool_stats": client.get_connection_stats(),
                 "generated_at": datetime.utcnow().isoformat()
             }
             
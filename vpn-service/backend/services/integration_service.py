@@ -599,7 +599,7 @@ class IntegrationService:
                     
                     if create_result:
                         # Генерируем VLESS URL
-                        vless_url = await real_x3ui.generate_client_url(reality_inbound["id"], xui_client_id)
+                        vless_url = await real_x3ui.generate_client_url(reality_inbound["id"], xui_client_id, node=best_node)
                         x3ui_connected = True
                         
                         logger.info("✅ NEW X3UI client created for UPDATE", 
@@ -1021,6 +1021,21 @@ class IntegrationService:
                        node_name=active_node.name,
                        user_id=user_id)
             
+            # Сначала пробуем теплый пул: запасной клиент уже создан, остается включить его
+            from datetime import datetime
+            from services.spare_client_pool import spare_client_pool
+            
+            claimed = await spare_client_pool.claim(
+                session, active_node, user.telegram_id,
+                email=f"{user.telegram_id}_{int(datetime.utcnow().timestamp())}",
+                total_gb=100 * 1024 * 1024 * 1024  # 100GB
+            )
+            if claimed:
+                return await self._save_reality_vpn_key(
+                    session, user_id, key_name, active_node,
+                    claimed.client_id, claimed.email, claimed.inbound_id, claimed.vless_url
+                )
+            
             # 2. Проверяем и создаем Reality inbound если нужно
             from services.reality_inbound_service import RealityInboundService
             
@@ -1144,7 +1159,7 @@ class IntegrationService:
             
             # 6. Получаем РЕАЛЬНЫЙ VLESS URL из панели X3UI
             # ИСПРАВЛЕНИЕ БАГА: Используем реальные данные из панели вместо ручной генерации
-            vless_url = await x3ui_client.generate_client_url(inbound_id, client_uuid)
+            vless_url = await x3ui_client.generate_client_url(inbound_id, client_uuid, node=active_node)
             
             if not vless_url:
                 logger.error("Failed to generate VLESS URL from X3UI panel", 
@@ -1163,52 +1178,11 @@ class IntegrationService:
                        panel_generated=True)
             
             # 7. Сохраняем ключ в базу данных
-            from models.vpn_key import VPNKey, VPNKeyStatus
-            
-            vpn_key = VPNKey(
-                user_id=user_id,
-                node_id=active_node.id,
-                uuid=client_uuid,
-                key_name=key_name,
-                vless_url=vless_url,
-                xui_email=client_email,
-                status=VPNKeyStatus.ACTIVE.value,
-                xui_client_id=client_uuid,
-                xui_inbound_id=inbound_id,
-                total_download=0,
-                total_upload=0
+            return await self._save_reality_vpn_key(
+                session, user_id, key_name, active_node,
+                client_uuid, client_email, inbound_id, vless_url
             )
             
-            session.add(vpn_key)
-            await session.commit()
-            await session.refresh(vpn_key)
-            
-            # Обновляем статистику ноды
-            from services.node_manager import NodeManager
-            node_manager = NodeManager(session)
-            await node_manager.update_node_stats(active_node.id)
-            
-            logger.info("VPN key saved to database", 
-                       vpn_key_id=vpn_key.id,
-                       user_id=user_id,
-                       node_id=active_node.id)
-            
-            return {
-                "success": True,
-                "vpn_key_id": vpn_key.id,
-                "message": "VPN ключ успешно создан через Reality inbound",
-                "vpn_key": {
-                    "id": vpn_key.id,
-                    "key_name": vpn_key.key_name,
-                    "vless_url": vpn_key.vless_url,
-                    "status": vpn_key.status,
-                    "x3ui_connected": True,
-                    "x3ui_source": True,
-                    "node_id": active_node.id,
-                    "created_at": vpn_key.created_at.isoformat() if vpn_key.created_at else None
-                }
-            }
-            
         except Exception as e:
             logger.error("Error in _create_vpn_key_with_reality_inbound", 
                         user_id=user_id,
@@ -1220,5 +1194,63 @@ class IntegrationService:
                 "message": "Внутренняя ошибка при создании VPN ключа"
             }
 
+    async def _save_reality_vpn_key(
+        self,
+        session: AsyncSession,
+        user_id: int,
+        key_name: str,
+        active_node,
+        client_uuid: str,
+        client_email: str,
+        inbound_id: int,
+        vless_url: str
+    ) -> Dict[str, Any]:
+        """Сохранение созданного (или взятого из пула) клиента как VPN ключа"""
+        from models.vpn_key import VPNKey, VPNKeyStatus
+        
+        vpn_key = VPNKey(
+            user_id=user_id,
+            node_id=active_node.id,
+            uuid=client_uuid,
+            key_name=key_name,
+            vless_url=vless_url,
+            xui_email=client_email,
+            status=VPNKeyStatus.ACTIVE.value,
+            xui_client_id=client_uuid,
+            xui_inbound_id=inbound_id,
+            total_download=0,
+            total_upload=0
+        )
+        
+        session.add(vpn_key)
+        await session.commit()
+        await session.refresh(vpn_key)
+        
+        # Обновляем статистику ноды
+        from services.node_manager import NodeManager
+        node_manager = NodeManager(session)
+        await node_manager.update_node_stats(active_node.id)
+        
+        logger.info("VPN key saved to database", 
+                   vpn_key_id=vpn_key.id,
+                   user_id=user_id,
+                   node_id=active_node.id)
+        
+        return {
+            "success": True,
+            "vpn_key_id": vpn_key.id,
+            "message": "VPN ключ успешно создан через Reality inbound",
+            "vpn_key": {
+                "id": vpn_key.id,
+                "key_name": vpn_key.key_name,
+                "vless_url": vpn_key.vless_url,
+                "status": vpn_key.status,
+                "x3ui_connected": True,
+                "x3ui_source": True,
+                "node_id": active_node.id,
+                "created_at": vpn_key.created_at.isoformat() if vpn_key.created_at else None
+            }
+        }
+
 # Глобальный экземпляр сервиса интеграции
 integration_service = IntegrationService() 
\ No newline at end of file
@@ -0,0 +1,390 @@
+"""
+Job Scheduler - встроенный планировщик фоновых задач
+Задачи запускаются по интервалу или cron-расписанию (UTC). Планировщик работает в каждом
+процессе, но задачу выполняет только лидер - процесс, удерживающий pg_try_advisory_lock
+этой задачи на выделенном соединении. Если лидер падает, соединение закрывается,
+блокировка освобождается, и задачу подхватывает другой процесс. Запуски одной задачи
+не перекрываются, каждый ограничен таймаутом и записывается в scheduled_job_runs
+"""
+
+import asyncio
+import json
+import os
+import socket
+import time
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Any, List, Optional, Set, Union
+
+import structlog
+from sqlalchemy import select, update, delete, func, desc
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.database import engine, async_session_maker
+from config.settings import get_settings
+from models.scheduled_job_run import ScheduledJobRun
+
+logger = structlog.get_logger(__name__)
+
+# Старшие 32 бита ключей advisory lock планировщика ("JOBS")
+LOCK_NAMESPACE = 0x4A4F4253
+
+JobFunc = Callable[[], Awaitable[Optional[Dict[str, Any]]]]
+
+
+def job_lock_key(name: str) -> int:
+    """Ключ advisory lock задачи, одинаковый во всех процессах (hash() строк рандомизирован)"""
+    return (LOCK_NAMESPACE << 32) | zlib.crc32(name.encode())
+
+
+class IntervalTrigger:
+    """Запуск через seconds после окончания предыдущего (как прежние while True + sleep)"""
+
+    def __init__(self, seconds: float, run_immediately: bool = False):
+        self.interval = timedelta(seconds=seconds)
+        self.run_immediately = run_immediately
+
+    def first(self, now: datetime) -> datetime:
+        return now if self.run_immediately else now + self.interval
+
+    def next_after(self, now: datetime) -> datetime:
+        return now + self.interval
+
+    def describe(self) -> str:
+        return f"every {int(self.interval.total_seconds())}s"
+
+
+def _parse_cron_field(spec: str, low: int, high: int) -> Set[int]:
+    """Поле cron: *, n, a-b, */s, a-b/s, n/s и списки через запятую"""
+    values: Set[int] = set()
+    for part in spec.split(","):
+        step = 1
+        has_step = "/" in part
+        if has_step:
+            part, step_spec = part.split("/", 1)
+            step = int(step_spec)
+        if part == "*":
+            start, end = low, high
+        elif "-" in part:
+            start_spec, end_spec = part.split("-", 1)
+            start, end = int(start_spec), int(end_spec)
+        else:
+            start = int(part)
+            end = high if has_step else start
+        if step < 1 or start < low or end > high or start > end:
+            raise ValueError(f"Invalid cron field: {spec}")
+        values.update(range(start, end + 1, step))
+    return values
+
+
+class CronTrigger:
+    """Классическое cron-выражение из пяти полей: минута час день месяц день_недели (UTC)"""
+
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ValueError(f"Cron expression must have 5 fields: {expression}")
+        self.expression = expression
+        self.minutes = _parse_cron_field(fields[0], 0, 59)
+        self.hours = _parse_cron_field(fields[1], 0, 23)
+        self.days = _parse_cron_field(fields[2], 1, 31)
+        self.months = _parse_cron_field(fields[3], 1, 12)
+        # 0 и 7 - воскресенье
+        self.weekdays = {value % 7 for value in _parse_cron_field(fields[4], 0, 7)}
+        self.any_day = fields[2] == "*"
+        self.any_weekday = fields[4] == "*"
+
+    def _day_matches(self, moment: datetime) -> bool:
+        day_ok = moment.day in self.days
+        weekday_ok = (moment.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day_ok and weekday_ok
+        # Оба поля заданы - как в cron, достаточно совпадения любого
+        return day_ok or weekday_ok
+
+    def first(self, now: datetime) -> datetime:
+        return self.next_after(now)
+
+    def next_after(self, now: datetime) -> datetime:
+        moment = now.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = moment + timedelta(days=366 * 5)
+        while moment < limit:
+            if moment.month not in self.months:
+                moment = (moment.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(moment):
+                moment = moment.replace(hour=0, minute=0) + timedelta(days=1)
+            elif moment.hour not in self.hours:
+                moment = moment.replace(minute=0) + timedelta(hours=1)
+            elif moment.minute not in self.minutes:
+                moment += timedelta(minutes=1)
+            else:
+                return moment
+        raise ValueError(f"Cron expression never fires: {self.expression}")
+
+    def describe(self) -> str:
+        return f"cron {self.expression}"
+
+
+Trigger = Union[IntervalTrigger, CronTrigger]
+
+
+@dataclass
+class ScheduledJob:
+    """Зарегистрированная задача и ее состояние в этом процессе"""
+    name: str
+    func: JobFunc
+    trigger: Trigger
+    timeout: float
+    next_run_at: Optional[datetime] = None
+    running: bool = False
+    last_status: Optional[str] = None
+    last_duration_ms: Optional[int] = None
+
+
+def _json_safe(result: Any) -> Optional[Dict[str, Any]]:
+    """Результат задачи в виде, пригодном для JSON-колонки"""
+    if result is None:
+        return None
+    if not isinstance(result, dict):
+        result = {"value": result}
+    return json.loads(json.dumps(result, default=str))
+
+
+class JobScheduler:
+    """Процессный планировщик с выбором лидера на каждую задачу"""
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.worker = f"{socket.gethostname()}:{os.getpid()}"
+        self._jobs: Dict[str, ScheduledJob] = {}
+        self._leading: Set[str] = set()
+        # Выделенное соединение, на котором удерживаются advisory lock'и лидерства
+        self._lock_conn = None
+        self._conn_lock = asyncio.Lock()
+        self._tasks: List[asyncio.Task] = []
+        self._stopping: Optional[asyncio.Event] = None
+        self._elected: Optional[asyncio.Event] = None
+
+    def add_job(self, name: str, func: JobFunc, trigger: Trigger, timeout: float) -> None:
+        if name in self._jobs:
+            raise ValueError(f"Job already registered: {name}")
+        self._jobs[name] = ScheduledJob(name=name, func=func, trigger=trigger, timeout=timeout)
+
+    def is_leader(self, name: str) -> bool:
+        """Этот процесс - лидер задачи name"""
+        return name in self._leading
+
+    async def start(self) -> None:
+        if self._tasks:
+            return
+        self._stopping = asyncio.Event()
+        self._elected = asyncio.Event()
+        self._tasks.append(asyncio.create_task(self._election_loop()))
+        for job in self._jobs.values():
+            self._tasks.append(asyncio.create_task(self._job_loop(job)))
+        logger.info("Job scheduler started", worker=self.worker, jobs=list(self._jobs))
+
+    async def stop(self) -> None:
+        if not self._tasks:
+            return
+        self._stopping.set()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+        await self._release_leadership()
+        logger.info("Job scheduler stopped", worker=self.worker)
+
+    async def _sleep(self, seconds: float) -> bool:
+        """Пауза, прерываемая остановкой; True - планировщик останавливается"""
+        try:
+            await asyncio.wait_for(self._stopping.wait(), timeout=max(seconds, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    # Выбор лидера
+
+    async def _election_loop(self) -> None:
+        while True:
+            try:
+                await self._elect()
+            except Exception as e:
+                logger.error("Job leader election failed", worker=self.worker, error=str(e))
+                await self._drop_connection()
+            self._elected.set()
+            if await self._sleep(self.settings.scheduler_leader_retry_interval):
+                return
+
+    async def _elect(self) -> None:
+        """Проверить соединение лидерства и попытаться захватить задачи без лидера"""
+        async with self._conn_lock:
+            if self._lock_conn is None:
+                self._lock_conn = await engine.connect()
+                self._leading.clear()
+            else:
+                # Соединение живо - значит, и его блокировки на месте
+                await self._lock_conn.execute(select(1))
+            for name in self._jobs:
+                if name in self._leading:
+                    continue
+                acquired = await self._lock_conn.scalar(select(func.pg_try_advisory_lock(job_lock_key(name))))
+                if acquired:
+                    self._leading.add(name)
+                    logger.info("Became job leader", job=name, worker=self.worker)
+            # Блокировки сессионные и переживают commit; открытую транзакцию не держим
+            await self._lock_conn.commit()
+
+    async def _drop_connection(self) -> None:
+        """Соединение потеряно: его блокировки сняты сервером, лидерство считаем утраченным"""
+        async with self._conn_lock:
+            if self._lock_conn is not None:
+                try:
+                    # Не возвращаем в пул соединение, которое может держать блокировки
+                    await self._lock_conn.invalidate()
+                    await self._lock_conn.close()
+                except Exception:
+                    pass
+            self._lock_conn = None
+            if self._leading:
+                logger.warning("Job leadership lost", jobs=sorted(self._leading), worker=self.worker)
+            self._leading.clear()
+
+    async def _release_leadership(self) -> None:
+        async with self._conn_lock:
+            if self._lock_conn is None:
+                return
+            try:
+                await self._lock_conn.execute(select(func.pg_advisory_unlock_all()))
+                await self._lock_conn.commit()
+                await self._lock_conn.close()
+            except Exception as e:
+                logger.warning("Failed to release job leadership", error=str(e))
+                try:
+                    await self._lock_conn.invalidate()
+                except Exception:
+                    pass
+            self._lock_conn = None
+            self._leading.clear()
+
+    # Запуск задач
+
+    async def _job_loop(self, job: ScheduledJob) -> None:
+        # Первый запуск - только после первой попытки стать лидером
+        await self._elected.wait()
+        job.next_run_at = job.trigger.first(datetime.now(timezone.utc))
+        while True:
+            delay = (job.next_run_at - datetime.now(timezone.utc)).total_seconds()
+            if await self._sleep(delay):
+                return
+            if job.name in self._leading:
+                await self._run(job, job.next_run_at)
+            job.next_run_at = job.trigger.next_after(datetime.now(timezone.utc))
+
+    async def _run(self, job: ScheduledJob, scheduled_for: datetime) -> None:
+        """Один запуск: задачи выполняются последовательно, поэтому запуски не перекрываются"""
+        started_at = datetime.now(timezone.utc)
+        started = time.monotonic()
+        run_id = await self._record_start(job, scheduled_for, started_at)
+
+        status, result, error = "success", None, None
+        job.running = True
+        try:
+            result = await asyncio.wait_for(job.func(), timeout=job.timeout)
+        except asyncio.TimeoutError:
+            status, error = "timeout", f"Job exceeded timeout of {job.timeout}s"
+            logger.error("Scheduled job timed out", job=job.name, timeout=job.timeout)
+        except Exception as e:
+            status, error = "failed", str(e)
+            logger.error("Scheduled job failed", job=job.name, error=str(e), exc_info=True)
+        finally:
+            job.running = False
+
+        duration_ms = int((time.monotonic() - started) * 1000)
+        job.last_status = status
+        job.last_duration_ms = duration_ms
+        await self._record_finish(run_id, status, duration_ms, result, error)
+        logger.info("Scheduled job finished", job=job.name, status=status, duration_ms=duration_ms)
+
+    async def _record_start(self, job: ScheduledJob, scheduled_for: datetime,
+                            started_at: datetime) -> Optional[int]:
+        try:
+            async with async_session_maker() as db:
+                run = ScheduledJobRun(
+                    job_name=job.name,
+                    worker=self.worker,
+                    status="running",
+                    scheduled_for=scheduled_for,
+                    started_at=started_at
+                )
+                db.add(run)
+                await db.commit()
+                return run.id
+        except Exception as e:
+            logger.error("Failed to record job start", job=job.name, error=str(e))
+            return None
+
+    async def _record_finish(self, run_id: Optional[int], status: str, duration_ms: int,
+                             result: Any, error: Optional[str]) -> None:
+        if run_id is None:
+            return
+        try:
+            async with async_session_maker() as db:
+                await db.execute(
+                    update(ScheduledJobRun)
+                    .where(ScheduledJobRun.id == run_id)
+                    .values(
+                        status=status,
+                        finished_at=datetime.now(timezone.utc),
+                        duration_ms=duration_ms,
+                        result=_json_safe(result),
+                        error=error
+                    )
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error("Failed to record job finish", run_id=run_id, error=str(e))
+
+    # Просмотр и обслуживание
+
+    async def recent_runs(self, db: AsyncSession, job_name: Optional[str] = None,
+                          limit: int = 50) -> List[ScheduledJobRun]:
+        query = select(ScheduledJobRun).order_by(desc(ScheduledJobRun.started_at)).limit(limit)
+        if job_name:
+            query = query.where(ScheduledJobRun.job_name == job_name)
+        result = await db.execute(query)
+        return result.scalars().all()
+
+    async def prune_runs(self, days: int) -> Dict[str, Any]:
+        """Удалить историю запусков старше days дней"""
+        async with async_session_maker() as db:
+            result = await db.execute(
+                delete(ScheduledJobRun)
+                .where(ScheduledJobRun.started_at < datetime.now(timezone.utc) - timedelta(days=days))
+            )
+            await db.commit()
+        return {"deleted": result.rowcount or 0}
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "worker": self.worker,
+            "running": bool(self._tasks),
+            "jobs": [
+                {
+                    "name": job.name,
+                    "trigger": job.trigger.describe(),
+                    "timeout_seconds": job.timeout,
+                    "leader": job.name in self._leading,
+                    "running": job.running,
+                    "next_run_at": job.next_run_at.isoformat() if job.next_run_at else None,
+                    "last_status": job.last_status,
+                    "last_duration_ms": job.last_duration_ms
+                }
+                for job in self._jobs.values()
+            ]
+        }
+
+
+# Глобальный планировщик задач (один на процесс)
+job_scheduler = JobScheduler()
@@ -2,6 +2,7 @@
 LoadBalancer Service - Балансировка нагрузки между VPN нодами
 """
 
+import contextlib
 import structlog
 import random
 from typing import Optional, List, Dict, Any, Tuple
@@ -14,55 +15,78 @@ from models.vpn_node import VPNNode
 from models.user_node_assignment import UserNodeAssignment
 from models.user import User
 from config.database import get_db
+from config.settings import get_settings, Settings
+from services.x3ui_circuit_breaker import x3ui_circuit_breakers
+from services.node_registry import node_registry, NodeRegistry, NodeView
+from services.node_capacity import NodeCapacity
+from services.node_hashing import is_rendezvous_mode, rank_nodes_hrw
 
 logger = structlog.get_logger(__name__)
 
 class LoadBalancer:
     """Балансировка нагрузки между нодами"""
     
-    def __init__(self, db_session: AsyncSession = None):
+    def __init__(self, db_session: AsyncSession = None, registry: Optional[NodeRegistry] = None,
+                 settings: Optional[Settings] = None):
         self.db = db_session
+        # Реестр и настройки подменяются симуляцией; по умолчанию - общие для процесса
+        self.registry = registry or node_registry
+        self.settings = settings or get_settings()
     
-    async def select_optimal_node(self, user_id: Optional[int] = None) -> Optional[VPNNode]:
+    async def rank_nodes(self, user_id: Optional[int] = None,
+                         country_id: Optional[int] = None) -> List[NodeView]:
         """
-        Выбор оптимальной ноды для пользователя
+        Кандидаты для новых пользователей по возрастанию взвешенной нагрузки
         
         Алгоритм:
         1. Фильтрация только здоровых нод
         2. Расчет нагрузки (current_users / max_users)
         3. Применение весов и приоритетов
-        4. Выбор ноды с наименьшей взвешенной нагрузкой
+        4. Сортировка по взвешенной нагрузке (меньше = лучше)
+        
+        В режиме rendezvous при известном user_id порядок - по HRW (липкая нода пользователя).
+        Ноды берутся из снимка node_registry (без запроса к БД)
         """
+        # Получаем только активные и здоровые ноды
+        snapshot = await self.registry.get_snapshot()
+        healthy_nodes = snapshot.select(country_id=country_id, status='active', health=('healthy',))
+        
+        if not healthy_nodes:
+            logger.error("No healthy nodes available")
+            return []
+        
+        # Рассчитываем оценку для каждой ноды
+        scored_nodes = []
+        for node in healthy_nodes:
+            # Проверяем может ли нода принимать пользователей
+            if not node.can_accept_users:
+                continue
+            
+            # Панель ноды сейчас не отвечает (автомат открыт) - не ждем флага health check
+            if x3ui_circuit_breakers.is_open(node.x3ui_url):
+                logger.info("Skipping node with open circuit", node_id=node.id)
+                continue
+            
+            # Рассчитываем финальную оценку (меньше = лучше)
+            scored_nodes.append((node, node.calculate_score()))
+        
+        if user_id is not None and is_rendezvous_mode(self.settings):
+            return rank_nodes_hrw(user_id, [node for node, _ in scored_nodes])
+        
+        scored_nodes.sort(key=lambda x: x[1])
+        return [node for node, _ in scored_nodes]
+    
+    async def select_optimal_node(self, user_id: Optional[int] = None,
+                                  country_id: Optional[int] = None) -> Optional[NodeView]:
+        """Выбор оптимальной ноды для пользователя (нода с наименьшей взвешенной нагрузкой)"""
         try:
-            # Получаем только активные и здоровые ноды
-            result = await self.db.execute(
-                select(VPNNode)
-                .where(VPNNode.status == 'active')
-                .where(VPNNode.health_status == 'healthy')
-            )
-            healthy_nodes = result.scalars().all()
+            ranked_nodes = await self.rank_nodes(user_id, country_id)
             
-            if not healthy_nodes:
-                logger.error("No healthy nodes available")
-                return None
-            
-            # Рассчитываем оценку для каждой ноды
-            scored_nodes = []
-            for node in healthy_nodes:
-                # Проверяем может ли нода принимать пользователей
-                if not node.can_accept_users:
-                    continue
-                
-                # Рассчитываем финальную оценку (меньше = лучше)
-                final_score = node.calculate_score()
-                scored_nodes.append((node, final_score))
-            
-            if not scored_nodes:
+            if not ranked_nodes:
                 logger.error("No nodes available for new users")
                 return None
             
-            # Выбираем ноду с наименьшей оценкой
-            optimal_node = min(scored_nodes, key=lambda x: x[1])[0]
+            optimal_node = ranked_nodes[0]
             
             logger.info("Selected optimal node", 
                        node_id=optimal_node.id, 
@@ -78,12 +102,14 @@ class LoadBalancer:
     async def assign_user_to_node(self, user_id: int, node_id: Optional[int] = None) -> Optional[UserNodeAssignment]:
         """Привязка пользователя к ноде"""
         try:
-            # Если нода не указана - выбираем оптимальную
+            # Если нода не указана - кандидаты по возрастанию нагрузки
             if node_id is None:
-                optimal_node = await self.select_optimal_node()
-                if not optimal_node:
+                candidate_ids = [node.id for node in await self.rank_nodes(user_id)]
+                if not candidate_ids:
+                    logger.error("No nodes available for new users")
                     return None
-                node_id = optimal_node.id
+            else:
+                candidate_ids = [node_id]
             
             # Проверяем существование пользователя
             user_result = await self.db.execute(select(User).where(User.id == user_id))
@@ -93,12 +119,15 @@ class LoadBalancer:
                 logger.error("User not found", user_id=user_id)
                 return None
             
-            # Проверяем существование ноды
-            node_result = await self.db.execute(select(VPNNode).where(VPNNode.id == node_id))
-            node = node_result.scalar_one_or_none()
+            # Атомарно занимаем место: заполненная с момента выбора нода пропускается,
+            # нода, где пользователь уже учтен (по любому назначению), места не занимает
+            capacity = NodeCapacity(self.db)
+            before = await capacity.placed_map([user_id])
+            node_id = await capacity.reserve_first(candidate_ids, placed=before[user_id])
             
-            if not node:
-                logger.error("Node not found", node_id=node_id)
+            if node_id is None:
+                logger.error("No node capacity available", candidates=candidate_ids)
+                await self.db.rollback()
                 return None
             
             # Деактивируем все текущие привязки
@@ -107,6 +136,7 @@ class LoadBalancer:
                 .where(UserNodeAssignment.user_id == user_id)
                 .where(UserNodeAssignment.is_active == True)
                 .values(is_active=False)
+                .execution_options(synchronize_session=False)
             )
             
             # Создаем новую привязку
@@ -118,10 +148,8 @@ class LoadBalancer:
             )
             
             self.db.add(new_assignment)
-            
-            # Обновляем счетчик пользователей
-            node.current_users += 1
-            
+            # Места освобождаются на нодах, где пользователя больше не осталось
+            await capacity.settle(before)
             await self.db.commit()
             await self.db.refresh(new_assignment)
             
@@ -161,17 +189,12 @@ class LoadBalancer:
             # Получаем текущую ноду
             current_node = await self.get_user_node(user_id)
             
-            # Создаем новый assignment
+            # Создаем новый assignment (место на старой ноде освобождается там же)
             new_assignment = await self.assign_user_to_node(user_id, target_node_id)
             
             if not new_assignment:
                 return False
             
-            # Обновляем счетчик на старой ноде
-            if current_node:
-                current_node.current_users = max(0, current_node.current_users - 1)
-                await self.db.commit()
-            
             logger.info("User migrated successfully", 
                        user_id=user_id,
                        from_node=current_node.id if current_node else None,
@@ -187,77 +210,41 @@ class LoadBalancer:
             await self.db.rollback()
             return False
     
-    async def rebalance_users(self) -> Dict[str, Any]:
+    async def rebalance_users(self, dry_run: bool = False, max_moves: Optional[int] = None) -> Dict[str, Any]:
         """
         Перебалансировка пользователей между нодами
         для более равномерного распределения нагрузки
+        
+        План строится сразу по всем нодам (см. NodeRebalancer); при dry_run возвращается
+        только план, иначе миграции запускаются в фоне - прогресс в rebalance_runs
         """
+        from services.node_rebalancer import NodeRebalancer, rebalance_runs
+        
         try:
-            # Получаем все активные ноды
-            nodes_result = await self.db.execute(
-                select(VPNNode)
-                .where(VPNNode.status == 'active')
-                .where(VPNNode.health_status == 'healthy')
-            )
-            nodes = nodes_result.scalars().all()
-            
-            if not nodes or len(nodes) < 2:
-                logger.info("Not enough healthy nodes for rebalancing")
-                return {"success": False, "reason": "not_enough_nodes"}
-            
-            # Находим ноды с максимальной и минимальной нагрузкой
-            max_load_node = max(nodes, key=lambda n: n.load_percentage)
-            min_load_node = min(nodes, key=lambda n: n.load_percentage)
-            
-            # Если разница в нагрузке меньше 20% - не балансируем
-            load_difference = max_load_node.load_percentage - min_load_node.load_percentage
-            if load_difference < 20:
-                logger.info("Load difference too small for rebalancing", 
-                           difference=load_difference)
-                return {"success": False, "reason": "small_difference"}
-            
-            # Получаем пользователей на ноде с максимальной нагрузкой
-            users_result = await self.db.execute(
-                select(User)
-                .join(UserNodeAssignment)
-                .where(UserNodeAssignment.node_id == max_load_node.id)
-                .where(UserNodeAssignment.is_active == True)
-                .limit(10)  # Мигрируем не более 10 пользователей за раз
-            )
-            users = users_result.scalars().all()
-            
-            if not users:
-                logger.info("No users to migrate")
-                return {"success": False, "reason": "no_users"}
-            
-            # Определяем количество пользователей для миграции
-            # Перемещаем примерно столько, чтобы выровнять нагрузку
-            users_to_migrate = min(
-                len(users),
-                int((max_load_node.current_users - min_load_node.current_users) / 2)
-            )
-            
-            if users_to_migrate < 1:
-                logger.info("No need to migrate users")
-                return {"success": False, "reason": "balanced"}
-            
-            # Мигрируем пользователей
-            migrated_count = 0
-            for user in users[:users_to_migrate]:
-                success = await self.migrate_user(user.id, min_load_node.id)
-                if success:
-                    migrated_count += 1
-            
-            logger.info("Users rebalanced successfully", 
-                       from_node=max_load_node.id,
-                       to_node=min_load_node.id,
-                       migrated_count=migrated_count)
+            # Проверка и запуск - под одной блокировкой (dry_run ничего не запускает)
+            async with (rebalance_runs.lock if not dry_run else contextlib.nullcontext()):
+                if not dry_run and rebalance_runs.is_running:
+                    return {"success": False, "reason": "already_running",
+                            "run": rebalance_runs.current.to_dict()}
+                
+                plan = await NodeRebalancer(self.db).build_plan(max_moves)
+                
+                if not plan.moves:
+                    logger.info("Nodes are balanced, nothing to migrate", nodes=len(plan.loads))
+                    return {"success": False, "reason": "balanced", "plan": plan.to_dict()}
+                
+                if dry_run:
+                    return {"success": True, "dry_run": True, "plan": plan.to_dict()}
+                
+                run = rebalance_runs.start(plan)
+            logger.info("Rebalance started", run_id=run.run_id, planned_moves=len(plan.moves))
             
             return {
                 "success": True,
-                "from_node": max_load_node.id,
-                "to_node": min_load_node.id,
-                "migrated_count": migrated_count
+                "dry_run": False,
+                "message": f"Ребалансировка запущена: {len(plan.moves)} миграций",
+                "plan": plan.to_dict(),
+                "run": run.to_dict()
             }
             
         except Exception as e:
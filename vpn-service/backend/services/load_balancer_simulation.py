@@ -0,0 +1,374 @@
+"""
+Load Balancer Simulation - детерминированный прогон выбора нод без БД и панелей
+Синтетический парк нод и поток событий (приход и уход пользователей, отказы нод,
+перебалансировка) проходят через настоящий код выбора: LoadBalancer.rank_nodes,
+rank_user_nodes (UserServerService), NodeEvacuation.plan и NodeRebalancer.build_plan.
+Состояние хранится в памяти, снимок нод публикуется в собственный реестр прогона, режим
+назначения - в копию настроек: глобальные node_registry и get_settings() не меняются
+"""
+
+import math
+import random
+import time
+from collections import deque
+from dataclasses import dataclass, field, replace
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, List, Tuple, Deque, Sequence, Set
+
+import structlog
+
+from config.settings import get_settings, Settings
+from services.load_balancer import LoadBalancer
+from services.node_evacuation import NodeEvacuation, EvacuatedUser
+from services.node_hashing import ASSIGNMENT_MODE_SCORE, ASSIGNMENT_MODE_RENDEZVOUS, is_rendezvous_mode
+from services.node_rebalancer import NodeRebalancer, water_fill
+from services.node_registry import NodeRegistry, NodeRegistrySnapshot, NodeView, SELECTABLE_HEALTH
+from services.node_scoring import UserAffinity
+from services.user_server_service import rank_user_nodes
+
+logger = structlog.get_logger(__name__)
+
+# Чей код выбора прогоняется
+STRATEGY_LOAD_BALANCER = "load_balancer"   # LoadBalancer.rank_nodes
+STRATEGY_USER_SERVER = "user_server"       # UserServerService: rank_user_nodes
+STRATEGIES = (STRATEGY_LOAD_BALANCER, STRATEGY_USER_SERVER)
+MODES = (ASSIGNMENT_MODE_SCORE, ASSIGNMENT_MODE_RENDEZVOUS)
+
+
+@dataclass
+class FleetSpec:
+    """Параметры синтетического парка нод"""
+    nodes: int = 20
+    countries: int = 2
+    min_users: int = 500
+    max_users: int = 2000
+    weights: Tuple[float, ...] = (0.5, 1.0, 1.0, 1.5, 2.0)
+    priorities: Tuple[int, ...] = (50, 100, 100, 150)
+    min_latency_ms: int = 30
+    max_latency_ms: int = 900
+
+
+@dataclass
+class WorkloadSpec:
+    """Параметры потока событий"""
+    arrivals: int = 20000
+    departure_rate: float = 0.2     # доля пришедших, которые уходят по ходу прогона
+    node_failures: int = 2          # выпадения нод (каждая позже возвращается)
+    rebalance_every: int = 5000     # перебалансировка каждые N приходов (0 - без нее)
+    sample_every: int = 500         # как часто снимать дисбаланс для пикового значения
+
+
+@dataclass
+class SimulationEvent:
+    """arrive / depart / fail / recover / rebalance"""
+    kind: str
+    user_id: Optional[int] = None
+    country_id: Optional[int] = None
+    node_id: Optional[int] = None
+
+
+def generate_fleet(spec: FleetSpec, seed: int = 0) -> List[NodeView]:
+    """Ноды с разной емкостью, весом, приоритетом и задержкой; все здоровы"""
+    rng = random.Random(seed)
+    now = datetime.now(timezone.utc)
+    fleet = []
+    for index in range(spec.nodes):
+        node_id = index + 1
+        country_id = index % max(1, spec.countries) + 1
+        fleet.append(NodeView(
+            id=node_id, name=f"sim-{node_id}", description=None,
+            location=f"country-{country_id}", country_id=country_id,
+            x3ui_url=f"https://sim-{node_id}.invalid:2053", x3ui_username="sim", x3ui_password="sim",
+            mode="reality", public_key=None, short_id=None, sni_mask=None,
+            max_users=rng.randint(spec.min_users, spec.max_users), current_users=0,
+            status="active", health_status="healthy", last_health_check=now,
+            response_time_ms=rng.randint(spec.min_latency_ms, spec.max_latency_ms),
+            priority=rng.choice(spec.priorities), weight=rng.choice(spec.weights),
+            reality_config=None, api_capabilities=None,
+            live_online_clients=None, live_throughput_mbps=None, live_load_updated_at=None,
+            created_at=now, updated_at=now
+        ))
+    return fleet
+
+
+def generate_workload(spec: WorkloadSpec, fleet: Sequence[NodeView], seed: int = 0) -> List[SimulationEvent]:
+    """Детерминированный поток событий для парка (один и тот же seed - один и тот же поток)"""
+    rng = random.Random(seed)
+    countries = sorted({node.country_id for node in fleet})
+    events: List[SimulationEvent] = []
+    present: List[int] = []
+
+    # Отказы равномерно по прогону, возврат - через половину интервала
+    interval = spec.arrivals // (spec.node_failures + 1) if spec.node_failures else 0
+    failures = {interval * (i + 1): fleet[rng.randrange(len(fleet))].id for i in range(spec.node_failures)}
+    recoveries = {step + interval // 2: node_id for step, node_id in failures.items()}
+
+    for step in range(1, spec.arrivals + 1):
+        events.append(SimulationEvent("arrive", user_id=step, country_id=rng.choice(countries)))
+        present.append(step)
+        if present and rng.random() < spec.departure_rate:
+            index = rng.randrange(len(present))
+            present[index], present[-1] = present[-1], present[index]
+            events.append(SimulationEvent("depart", user_id=present.pop()))
+        if step in failures:
+            events.append(SimulationEvent("fail", node_id=failures[step]))
+        if step in recoveries:
+            events.append(SimulationEvent("recover", node_id=recoveries[step]))
+        if spec.rebalance_every and step % spec.rebalance_every == 0:
+            events.append(SimulationEvent("rebalance"))
+    return events
+
+
+def gini(values: Sequence[float]) -> float:
+    """Коэффициент Джини (0 - поровну, ->1 - все на одной ноде)"""
+    ordered = sorted(values)
+    total = sum(ordered)
+    if not ordered or total <= 0:
+        return 0.0
+    n = len(ordered)
+    return 2 * sum((i + 1) * value for i, value in enumerate(ordered)) / (n * total) - (n + 1) / n
+
+
+def _percentile(ordered: Sequence[float], q: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+@dataclass
+class SimulationReport:
+    """Итог прогона одной пары (стратегия, режим)"""
+    strategy: str
+    mode: str
+    decisions: int = 0
+    failed_decisions: int = 0
+    latencies: List[float] = field(default_factory=list)
+    failover_moves: int = 0
+    rebalance_moves: int = 0
+    stranded_users: int = 0
+    peak_max_to_mean: float = 0.0
+    max_to_mean: float = 0.0
+    gini: float = 0.0
+    target_deviation: float = 0.0
+    wall_seconds: float = 0.0
+
+    def to_dict(self) -> Dict[str, Any]:
+        ordered = sorted(self.latencies)
+        selecting = sum(ordered)
+        return {
+            "strategy": self.strategy,
+            "mode": self.mode,
+            "decisions": self.decisions,
+            "failed_decisions": self.failed_decisions,
+            "decisions_per_second": round(len(ordered) / selecting, 1) if selecting > 0 else 0.0,
+            "p50_selection_ms": round(_percentile(ordered, 0.50) * 1000, 4),
+            "p99_selection_ms": round(_percentile(ordered, 0.99) * 1000, 4),
+            "migrations": self.failover_moves + self.rebalance_moves,
+            "failover_moves": self.failover_moves,
+            "rebalance_moves": self.rebalance_moves,
+            "stranded_users": self.stranded_users,
+            "max_to_mean_load": round(self.max_to_mean, 4),
+            "peak_max_to_mean_load": round(self.peak_max_to_mean, 4),
+            "gini": round(self.gini, 4),
+            "target_deviation": round(self.target_deviation, 4),
+            "wall_seconds": round(self.wall_seconds, 3)
+        }
+
+
+class _SimulationRegistry(NodeRegistry):
+    """Реестр прогона: снимок только публикуется, БД не читается"""
+
+    async def refresh(self, force: bool = False) -> NodeRegistrySnapshot:
+        return self._snapshot
+
+
+class _SimulationState:
+    """Парк нод, назначения пользователей и их история (для affinity) в памяти"""
+
+    def __init__(self, fleet: Sequence[NodeView]):
+        self.registry = _SimulationRegistry()
+        self.nodes: Dict[int, NodeView] = {node.id: replace(node, current_users=0) for node in fleet}
+        self.assignment: Dict[int, int] = {}
+        self.order: Dict[int, List[int]] = {node_id: [] for node_id in self.nodes}
+        self.history: Dict[int, Set[int]] = {}
+        self._dirty = True
+
+    def publish(self) -> None:
+        """Отдать текущее состояние коду выбора через реестр прогона"""
+        if self._dirty:
+            self.registry.publish(self.nodes.values())
+            self._dirty = False
+
+    def _count(self, node_id: int, delta: int) -> None:
+        node = self.nodes[node_id]
+        self.nodes[node_id] = replace(node, current_users=node.current_users + delta)
+        self._dirty = True
+
+    def place(self, user_id: int, node_id: int) -> None:
+        self.remove(user_id)
+        self.assignment[user_id] = node_id
+        self.order[node_id].append(user_id)
+        self.history.setdefault(user_id, set()).add(node_id)
+        self._count(node_id, 1)
+
+    def remove(self, user_id: int) -> Optional[int]:
+        node_id = self.assignment.pop(user_id, None)
+        if node_id is not None:
+            self.order[node_id].remove(user_id)
+            self._count(node_id, -1)
+        return node_id
+
+    def set_health(self, node_id: int, healthy: bool) -> None:
+        self.nodes[node_id] = replace(
+            self.nodes[node_id],
+            status="active" if healthy else "inactive",
+            health_status="healthy" if healthy else "unhealthy"
+        )
+        self._dirty = True
+
+    def affinity(self, user_id: int) -> UserAffinity:
+        return UserAffinity(self.assignment.get(user_id), frozenset(self.history.get(user_id, ())))
+
+    def active_nodes(self) -> List[NodeView]:
+        return [node for node in self.nodes.values() if node.is_healthy]
+
+
+class _SimulatedRebalancer(NodeRebalancer):
+    """NodeRebalancer, который берет назначения из состояния симуляции вместо БД"""
+
+    def __init__(self, state: _SimulationState, settings: Settings):
+        super().__init__(None, settings)
+        self.state = state
+
+    async def _load_snapshot(self):
+        # Опубликованный снимок симуляции и есть актуальное состояние - БД не читаем
+        return await self.state.registry.get_snapshot()
+
+    async def _load_movable_users(self, surplus: Dict[int, int]) -> Dict[int, Deque[int]]:
+        return {
+            node_id: deque(list(reversed(self.state.order[node_id]))[:count])
+            for node_id, count in surplus.items()
+        }
+
+    async def _load_assignments(self, node_ids: List[int]) -> List[Tuple[int, int]]:
+        wanted = set(node_ids)
+        return sorted((user_id, node_id) for user_id, node_id in self.state.assignment.items()
+                      if node_id in wanted)
+
+
+async def _select(state: _SimulationState, balancer: LoadBalancer, strategy: str, user_id: int,
+                  country_id: Optional[int]) -> Optional[int]:
+    """Один выбор ноды кодом выбранной стратегии"""
+    if strategy == STRATEGY_LOAD_BALANCER:
+        ranked_nodes = await balancer.rank_nodes(user_id, country_id)
+        return ranked_nodes[0].id if ranked_nodes else None
+
+    # Как UserServerService.select_optimal_node, но users.id и история - из состояния прогона
+    snapshot = await state.registry.get_snapshot()
+    nodes = snapshot.select(country_id=country_id, status="active", health=SELECTABLE_HEALTH)
+    hrw_key = user_id if is_rendezvous_mode(balancer.settings) else None
+    ranked = rank_user_nodes(nodes, hrw_key, state.affinity(user_id))
+    return ranked[0].node.id if ranked else None
+
+
+def _imbalance(state: _SimulationState) -> Tuple[float, float, float]:
+    """(max/mean загрузки, Джини загрузки, доля пользователей не на своем water-fill месте)"""
+    nodes = [node for node in state.active_nodes() if node.max_users]
+    loads = [node.current_users / node.max_users for node in nodes]
+    mean = sum(loads) / len(loads) if loads else 0.0
+    max_to_mean = max(loads) / mean if mean else 0.0
+
+    by_country: Dict[Optional[int], List[NodeView]] = {}
+    for node in nodes:
+        by_country.setdefault(node.country_id, []).append(node)
+    deviation = 0
+    total = 0
+    for country_nodes in by_country.values():
+        users = sum(node.current_users for node in country_nodes)
+        targets = water_fill(country_nodes, users)
+        deviation += sum(abs(node.current_users - targets[node.id]) for node in country_nodes)
+        total += users
+    return max_to_mean, gini(loads), (deviation / 2 / total) if total else 0.0
+
+
+async def run_simulation(fleet: Sequence[NodeView], events: Sequence[SimulationEvent],
+                         strategy: str = STRATEGY_LOAD_BALANCER, mode: str = ASSIGNMENT_MODE_SCORE,
+                         sample_every: int = 500, max_moves: Optional[int] = None) -> SimulationReport:
+    """Прогнать поток событий через код выбора одной стратегии в одном режиме"""
+    if strategy not in STRATEGIES:
+        raise ValueError(f"Unknown strategy: {strategy}")
+    settings = get_settings().model_copy(update={"node_assignment_mode": mode})
+
+    state = _SimulationState(fleet)
+    report = SimulationReport(strategy=strategy, mode=mode)
+    balancer = LoadBalancer(registry=state.registry, settings=settings)
+    rebalancer = _SimulatedRebalancer(state, settings)
+    evacuation = NodeEvacuation(None, settings)
+    started = time.perf_counter()
+    arrivals = 0
+
+    for event in events:
+        if event.kind == "arrive":
+            state.publish()
+            begin = time.perf_counter()
+            node_id = await _select(state, balancer, strategy, event.user_id, event.country_id)
+            report.latencies.append(time.perf_counter() - begin)
+            report.decisions += 1
+            if node_id is None:
+                report.failed_decisions += 1
+            else:
+                state.place(event.user_id, node_id)
+            arrivals += 1
+            if sample_every and arrivals % sample_every == 0:
+                report.peak_max_to_mean = max(report.peak_max_to_mean, _imbalance(state)[0])
+
+        elif event.kind == "depart":
+            state.remove(event.user_id)
+
+        elif event.kind == "fail":
+            state.set_health(event.node_id, False)
+            state.publish()
+            snapshot = await state.registry.get_snapshot()
+            # Назначения планирует NodeEvacuation; в симуляции users.id и telegram_id совпадают
+            displaced = [EvacuatedUser(user_id, user_id) for user_id in state.order[event.node_id]]
+            evacuation.plan(snapshot.get(event.node_id), snapshot, displaced)
+            for user in displaced:
+                if user.target_node_id is not None:
+                    state.place(user.user_id, user.target_node_id)
+                    report.failover_moves += 1
+                else:
+                    state.remove(user.user_id)
+                    report.stranded_users += 1
+
+        elif event.kind == "recover":
+            state.set_health(event.node_id, True)
+
+        elif event.kind == "rebalance":
+            state.publish()
+            plan = await rebalancer.build_plan(max_moves)
+            for move in plan.moves:
+                state.place(move.user_id, move.to_node_id)
+            report.rebalance_moves += len(plan.moves)
+
+        else:
+            raise ValueError(f"Unknown event kind: {event.kind}")
+
+    report.max_to_mean, report.gini, report.target_deviation = _imbalance(state)
+    report.peak_max_to_mean = max(report.peak_max_to_mean, report.max_to_mean)
+    report.wall_seconds = time.perf_counter() - started
+    return report
+
+
+async def run_benchmark(fleet_spec: FleetSpec, workload_spec: WorkloadSpec, seed: int = 0,
+                        strategies: Sequence[str] = STRATEGIES,
+                        modes: Sequence[str] = MODES) -> List[Dict[str, Any]]:
+    """Один и тот же парк и поток для всех пар (стратегия, режим)"""
+    fleet = generate_fleet(fleet_spec, seed)
+    events = generate_workload(workload_spec, fleet, seed)
+    results = []
+    for strategy in strategies:
+        for mode in modes:
+            report = await run_simulation(fleet, events, strategy, mode, workload_spec.sample_every)
+            results.append(report.to_dict())
+            logger.info("Load balancer simulation finished", **results[-1])
+    return results
@@ -7,6 +7,7 @@ import structlog
 from typing import Optional, Dict, Any
 from datetime import datetime, timezone
 from config.settings import get_settings
+from services.notification_outbox import notification_outbox, PRIORITY_HIGH
 
 logger = structlog.get_logger(__name__)
 
@@ -182,39 +183,10 @@ class MenuUpdaterService:
     
     async def _send_telegram_message_with_keyboard(self, telegram_id: int, message: str, keyboard: Dict[str, Any]) -> bool:
         """Отправить сообщение в Telegram с клавиатурой"""
-        bot_token = await self._get_bot_token()
-        if not bot_token:
-            logger.warning("Bot token not configured, skipping menu update")
-            return False
-        
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        
-        payload = {
-            "chat_id": telegram_id,
-            "text": message,
-            "parse_mode": "Markdown",
-            "reply_markup": keyboard,
-            "disable_web_page_preview": True
-        }
-        
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, timeout=30) as response:
-                    if response.status == 200:
-                        logger.debug("Telegram message with keyboard sent successfully", telegram_id=telegram_id)
-                        return True
-                    else:
-                        response_text = await response.text()
-                        logger.error("Failed to send Telegram message with keyboard", 
-                                   telegram_id=telegram_id,
-                                   status=response.status,
-                                   response=response_text)
-                        return False
-        except Exception as e:
-            logger.error("Error sending Telegram message with keyboard", 
-                        telegram_id=telegram_id,
-                        error=str(e))
-            return False
+        # Отправка через outbox: общая сессия, лимиты Bot API, повтор после retry_after
+        return await notification_outbox.send(
+            telegram_id, message, PRIORITY_HIGH, parse_mode="Markdown", reply_markup=keyboard
+        )
 
 # Создаем глобальный экземпляр сервиса
 menu_updater_service = MenuUpdaterService() 
\ No newline at end of file
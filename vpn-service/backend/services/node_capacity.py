@@ -0,0 +1,200 @@
+"""
+Node Capacity - атомарное резервирование мест на нодах (VPNNode.current_users)
+Счетчик меняется одним UPDATE ... WHERE current_users < max_users RETURNING, без read-modify-write
+через ORM объекты.
+
+current_users - число разных пользователей (users.id), размещенных на ноде по любому из
+назначений: активному user_node_assignments или user_server_assignments (по telegram_id).
+Вызывающие занимают место, только если пользователя на ноде еще нет (placed_nodes до изменений),
+и освобождают через settle() те ноды, где после изменений его не осталось; периодическая
+сверка пересчитывает счетчики по тому же правилу
+"""
+
+from typing import Dict, Iterable, Optional, Set, Tuple
+
+import structlog
+from sqlalchemy import select, update, func, union
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
+
+from models.user import User
+from models.vpn_node import VPNNode
+from models.user_node_assignment import UserNodeAssignment
+from models.user_server_assignment import UserServerAssignment
+from services.node_registry import record_counters
+
+logger = structlog.get_logger(__name__)
+
+# Изменение только счетчика не сбрасывает снимок node_registry: значения из RETURNING
+# применяются к снимку после commit (record_counters), лимит все равно проверяется в БД
+COUNTER_ONLY = {"vpn_nodes_counter_only": True}
+
+
+def placed_users(user_ids: Optional[Iterable[int]] = None):
+    """Подзапрос (node_id, user_id): пользователь учитывается на ноде один раз по обоим назначениям"""
+    node_assignments = select(UserNodeAssignment.node_id, UserNodeAssignment.user_id) \
+        .where(UserNodeAssignment.is_active == True)
+    server_assignments = select(UserServerAssignment.node_id, User.id) \
+        .join(User, User.telegram_id == UserServerAssignment.user_id)
+    if user_ids is not None:
+        user_ids = list(user_ids)
+        node_assignments = node_assignments.where(UserNodeAssignment.user_id.in_(user_ids))
+        server_assignments = server_assignments.where(User.id.in_(user_ids))
+    return union(node_assignments, server_assignments).subquery()
+
+
+class NodeCapacity:
+    """Резервирование и освобождение мест на нодах (commit делает вызывающий)"""
+
+    def __init__(self, db_session: AsyncSession):
+        self.db = db_session
+
+    async def reserve(self, node_id: int) -> bool:
+        """
+        Занять место на ноде; False - нода заполнена, неактивна или не существует.
+        Строка ноды остается заблокированной до commit/rollback вызывающего,
+        поэтому параллельные резервирования не превышают max_users
+        """
+        result = await self.db.execute(
+            update(VPNNode)
+            .where(VPNNode.id == node_id)
+            .where(VPNNode.status == "active")
+            .where(VPNNode.current_users < VPNNode.max_users)
+            .values(current_users=VPNNode.current_users + 1)
+            .returning(VPNNode.id, VPNNode.current_users)
+            .execution_options(synchronize_session="fetch", **COUNTER_ONLY)
+        )
+        row = result.first()
+        if row is None:
+            logger.info("Node capacity reservation rejected", node_id=node_id)
+            return False
+        record_counters(self.db.info, [tuple(row)])
+        logger.debug("Node capacity reserved", node_id=node_id, current_users=row.current_users)
+        return True
+
+    async def reserve_first(self, node_ids: Iterable[int],
+                            placed: Iterable[int] = ()) -> Optional[int]:
+        """
+        Занять место на первой ноде из списка кандидатов, где оно есть;
+        нода из placed (пользователь уже учтен на ней) выбирается без резервирования
+        """
+        placed = set(placed)
+        for node_id in node_ids:
+            if node_id in placed or await self.reserve(node_id):
+                return node_id
+        return None
+
+    async def placed_map(self, user_ids: Iterable[int]) -> Dict[int, Set[int]]:
+        """{users.id: ноды, на которых пользователь сейчас учтен} - один запрос"""
+        user_ids = list(user_ids)
+        placed: Dict[int, Set[int]] = {user_id: set() for user_id in user_ids}
+        if not user_ids:
+            return placed
+        subquery = placed_users(user_ids)
+        result = await self.db.execute(select(subquery.c.node_id, subquery.c.user_id))
+        for node_id, user_id in result.all():
+            placed.setdefault(user_id, set()).add(node_id)
+        return placed
+
+    async def placed_nodes(self, user_id: Optional[int]) -> Set[int]:
+        """Ноды, на которых пользователь (users.id) сейчас учтен"""
+        if user_id is None:
+            return set()
+        return (await self.placed_map([user_id]))[user_id]
+
+    async def settle(self, before: Dict[int, Set[int]]) -> Dict[int, int]:
+        """
+        Освободить места на нодах, где пользователей больше нет после изменений назначений
+        before - placed_map до изменений; изменения должны быть уже отправлены в БД (flush)
+        Returns: {node_id: освобождено}
+        """
+        await self.db.flush()
+        after = await self.placed_map(before)
+        released: Dict[int, int] = {}
+        for user_id, nodes in before.items():
+            for node_id in nodes - after.get(user_id, set()):
+                released[node_id] = released.get(node_id, 0) + 1
+        for node_id, count in released.items():
+            await self.release(node_id, count)
+        return released
+
+    async def reserve_many(self, node_id: int, count: int) -> int:
+        """
+        Занять до count мест на ноде одним блоком; возвращает, сколько удалось занять.
+        Строка блокируется (FOR UPDATE) до commit/rollback вызывающего
+        """
+        if count <= 0:
+            return 0
+        result = await self.db.execute(
+            select(VPNNode.current_users, VPNNode.max_users)
+            .where(VPNNode.id == node_id)
+            .where(VPNNode.status == "active")
+            .with_for_update()
+        )
+        row = result.first()
+        if row is None:
+            return 0
+        granted = max(0, min(count, (row.max_users or 0) - (row.current_users or 0)))
+        if granted:
+            result = await self.db.execute(
+                update(VPNNode)
+                .where(VPNNode.id == node_id)
+                .values(current_users=VPNNode.current_users + granted)
+                .returning(VPNNode.id, VPNNode.current_users)
+                .execution_options(synchronize_session="fetch", **COUNTER_ONLY)
+            )
+            record_counters(self.db.info, [tuple(row) for row in result.all()])
+        if granted < count:
+            logger.info("Node capacity partially reserved", node_id=node_id,
+                       requested=count, granted=granted)
+        return granted
+
+    async def release(self, node_id: Optional[int], count: int = 1) -> None:
+        """Освободить места на ноде (счетчик не уходит ниже нуля)"""
+        if node_id is None or count <= 0:
+            return
+        result = await self.db.execute(
+            update(VPNNode)
+            .where(VPNNode.id == node_id)
+            .values(current_users=func.greatest(VPNNode.current_users - count, 0))
+            .returning(VPNNode.id, VPNNode.current_users)
+            .execution_options(synchronize_session="fetch", **COUNTER_ONLY)
+        )
+        record_counters(self.db.info, [tuple(row) for row in result.all()])
+
+    async def reconcile(self) -> Dict[int, Tuple[int, int]]:
+        """
+        Пересчитать current_users по фактическим назначениям одним UPDATE ... FROM
+        Строки нод блокируются до пересчета: резервирования и освобождения ждут commit,
+        а уже начатые успевают зафиксироваться и попадают в подсчет
+        Returns: {node_id: (было, стало)} для нод, где счетчик разошелся
+        """
+        await self.db.execute(select(VPNNode.id).order_by(VPNNode.id).with_for_update())
+
+        placed = placed_users()
+        counts = select(placed.c.node_id, func.count().label("users")) \
+            .group_by(placed.c.node_id).subquery()
+        node = aliased(VPNNode)
+        target = select(
+            node.id,
+            func.coalesce(node.current_users, 0).label("old"),
+            func.coalesce(counts.c.users, 0).label("new")
+        ).outerjoin(counts, counts.c.node_id == node.id).subquery()
+
+        result = await self.db.execute(
+            update(VPNNode)
+            .where(VPNNode.id == target.c.id)
+            .where(target.c.old != target.c.new)
+            .values(current_users=target.c.new)
+            .returning(VPNNode.id, target.c.old, VPNNode.current_users)
+            .execution_options(synchronize_session=False, **COUNTER_ONLY)
+        )
+        drift = {node_id: (old, new) for node_id, old, new in result.all()}
+        record_counters(self.db.info, [(node_id, new) for node_id, (_, new) in drift.items()])
+        await self.db.commit()
+
+        if drift:
+            logger.warning("Node user counters reconciled",
+                          nodes=len(drift),
+                          drift={node_id: new - old for node_id, (old, new) in drift.items()})
+        return drift
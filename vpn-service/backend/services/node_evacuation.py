@@ -0,0 +1,422 @@
+"""
+Node Evacuation - массовый перенос пользователей с недоступной ноды
+Назначения планируются за один проход по снимку node_registry с учетом емкости,
+клиенты создаются на целевых панелях пачками (параллельно по нодам), ключи и назначения
+обновляются set-based запросами. Переносятся все неотозванные ключи (приостановленные -
+отключенными клиентами), уведомления о новых активных ключах пишутся в notification_outbox
+в той же транзакции
+"""
+
+import asyncio
+import heapq
+import time
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Sequence, Set
+
+import structlog
+from sqlalchemy import select, update, insert, or_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.settings import get_settings, Settings
+from models.user import User
+from models.vpn_key import VPNKey, VPNKeyStatus
+from models.user_node_assignment import UserNodeAssignment
+from models.user_server_assignment import UserServerAssignment
+from services.node_registry import node_registry, NodeView
+from services.node_capacity import NodeCapacity
+from services.node_hashing import is_rendezvous_mode, pick_node_hrw
+from services.node_scoring import is_node_available
+from services.notification_outbox import notification_outbox
+from services.notification_service import notification_service
+from services.subscription_expiry_sweep import ACTIVE_STATUSES
+from services.x3ui_client import X3UIClient
+
+logger = structlog.get_logger(__name__)
+
+# Отозванные ключи не переносятся; остальные переезжают в любом статусе
+EVACUATED_KEYS = VPNKey.status != VPNKeyStatus.REVOKED.value
+
+
+@dataclass
+class EvacuatedKey:
+    """Неотозванный ключ на выпавшей ноде и его новый клиент на целевой"""
+    key_id: int
+    key_name: Optional[str]
+    expires_at: Optional[datetime]
+    status: Optional[str] = None
+    client_id: Optional[str] = None
+    email: Optional[str] = None
+    inbound_id: Optional[int] = None
+    vless_url: Optional[str] = None
+
+    @property
+    def provisioned(self) -> bool:
+        return bool(self.vless_url)
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in ACTIVE_STATUSES
+
+
+@dataclass
+class EvacuatedUser:
+    """Пользователь выпавшей ноды (user_id - users.id)"""
+    user_id: int
+    telegram_id: int
+    keys: List[EvacuatedKey] = field(default_factory=list)
+    target_node_id: Optional[int] = None
+    # Ноды, на которых пользователь учтен в current_users до переноса
+    placed: Set[int] = field(default_factory=set)
+
+    @property
+    def provisioned(self) -> bool:
+        return all(key.provisioned for key in self.keys)
+
+
+@dataclass
+class EvacuationReport:
+    """Итог эвакуации одной ноды"""
+    node_id: int
+    users: int = 0
+    keys: int = 0
+    moved_users: int = 0
+    moved_keys: int = 0
+    failed_users: int = 0
+    unplaced_users: int = 0
+    notifications_queued: int = 0
+    per_node: Dict[int, int] = field(default_factory=dict)
+    duration_ms: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "node_id": self.node_id,
+            "users": self.users,
+            "keys": self.keys,
+            "moved_users": self.moved_users,
+            "moved_keys": self.moved_keys,
+            "failed_users": self.failed_users,
+            "unplaced_users": self.unplaced_users,
+            "notifications_queued": self.notifications_queued,
+            "per_node": self.per_node,
+            "duration_ms": self.duration_ms
+        }
+
+
+def _weighted_load(node: NodeView, users: int) -> float:
+    """Как VPNNode.calculate_score, но для смоделированного числа пользователей"""
+    divisor = ((node.priority or 0) / 100.0) * (node.weight or 0.0)
+    if users >= node.max_users or divisor <= 0:
+        return float('inf')
+    return (users / node.max_users) / divisor
+
+
+def plan_destinations(user_ids: Sequence[int], candidates: Sequence[NodeView],
+                      settings: Optional[Settings] = None) -> Dict[int, int]:
+    """
+    Распределить пользователей по кандидатам за один проход: {user_id: node_id}
+    Нагрузка кандидатов моделируется локально, поэтому ни одна нода не переполняется;
+    в режиме rendezvous пользователь получает следующую по HRW ноду, где есть место
+    """
+    load = {node.id: node.current_users or 0 for node in candidates}
+    plan: Dict[int, int] = {}
+
+    if is_rendezvous_mode(settings):
+        for user_id in user_ids:
+            node = pick_node_hrw(user_id, candidates, accept=lambda n: load[n.id] < n.max_users)
+            if node is None:
+                continue
+            plan[user_id] = node.id
+            load[node.id] += 1
+        return plan
+
+    # Куча по взвешенной нагрузке: каждый пользователь - на наименее загруженную ноду
+    heap = [(_weighted_load(node, load[node.id]), node.id, node) for node in candidates]
+    heap = [entry for entry in heap if entry[0] != float('inf')]
+    heapq.heapify(heap)
+    for user_id in user_ids:
+        if not heap:
+            break
+        _, node_id, node = heapq.heappop(heap)
+        plan[user_id] = node_id
+        load[node_id] += 1
+        score = _weighted_load(node, load[node_id])
+        if score != float('inf'):
+            heapq.heappush(heap, (score, node_id, node))
+    return plan
+
+
+class NodeEvacuation:
+    """Эвакуация пользователей и ключей с недоступной ноды (вызывается из HealthChecker)"""
+
+    def __init__(self, db_session: AsyncSession, settings: Optional[Settings] = None):
+        self.db = db_session
+        self.settings = settings or get_settings()
+        self.capacity = NodeCapacity(db_session)
+
+    async def _load_users(self, node_id: int) -> List[EvacuatedUser]:
+        """Пользователи ноды (по ключам и обоим видам назначений) и их неотозванные ключи - два запроса"""
+        users_result = await self.db.execute(
+            select(User.id, User.telegram_id)
+            .where(or_(
+                User.id.in_(
+                    select(VPNKey.user_id)
+                    .where(VPNKey.node_id == node_id, EVACUATED_KEYS)
+                ),
+                User.id.in_(
+                    select(UserNodeAssignment.user_id)
+                    .where(UserNodeAssignment.node_id == node_id, UserNodeAssignment.is_active == True)
+                ),
+                User.telegram_id.in_(
+                    select(UserServerAssignment.user_id)
+                    .where(UserServerAssignment.node_id == node_id)
+                )
+            ))
+            .order_by(User.id)
+        )
+        users = {row.id: EvacuatedUser(row.id, row.telegram_id) for row in users_result.all()}
+        for user_id, placed in (await self.capacity.placed_map(users)).items():
+            users[user_id].placed = placed
+
+        keys_result = await self.db.execute(
+            select(VPNKey.id, VPNKey.user_id, VPNKey.key_name, VPNKey.expires_at, VPNKey.status)
+            .where(VPNKey.node_id == node_id, EVACUATED_KEYS)
+        )
+        for row in keys_result.all():
+            user = users.get(row.user_id)
+            if user:
+                user.keys.append(EvacuatedKey(row.id, row.key_name, row.expires_at, row.status))
+        return list(users.values())
+
+    def plan(self, failed: NodeView, snapshot, users: List[EvacuatedUser]) -> None:
+        """Сначала ноды той же страны, остаток - любые доступные ноды"""
+        available = [
+            node for node in snapshot.select()
+            if node.id != failed.id and is_node_available(node)
+        ]
+        same_country = [node for node in available if node.country_id == failed.country_id]
+        other = [node for node in available if node.country_id != failed.country_id]
+
+        pending = [user.user_id for user in users]
+        plan = plan_destinations(pending, same_country, self.settings)
+        leftover = [user_id for user_id in pending if user_id not in plan]
+        if leftover and other:
+            plan.update(plan_destinations(leftover, other, self.settings))
+
+        for user in users:
+            user.target_node_id = plan.get(user.user_id)
+
+    async def _reserve(self, users: List[EvacuatedUser]) -> Dict[int, List[EvacuatedUser]]:
+        """
+        Занять места на целевых нодах блоком на ноду (одна короткая транзакция);
+        пользователи сверх выданного лимита остаются без цели
+        """
+        groups: Dict[int, List[EvacuatedUser]] = {}
+        for user in users:
+            if user.target_node_id is not None:
+                groups.setdefault(user.target_node_id, []).append(user)
+
+        reserved: Dict[int, List[EvacuatedUser]] = {}
+        for target_id in sorted(groups):
+            # Пользователь, уже учтенный на целевой ноде, места не занимает
+            placed = [user for user in groups[target_id] if target_id in user.placed]
+            group = [user for user in groups[target_id] if target_id not in user.placed]
+            granted = await self.capacity.reserve_many(target_id, len(group))
+            for user in group[granted:]:
+                user.target_node_id = None
+            if granted or placed:
+                reserved[target_id] = placed + group[:granted]
+        await self.db.commit()
+        return reserved
+
+    async def _provision(self, node: NodeView, users: List[EvacuatedUser],
+                         semaphore: asyncio.Semaphore) -> None:
+        """Создать клиентов для всех ключей группы на целевой панели пачками и собрать URL локально"""
+        keyed = [(user, key) for user in users for key in user.keys]
+        if not keyed:
+            return
+        async with semaphore:
+            try:
+                client = X3UIClient.from_node(node)
+                snapshot = await client.get_inbound_snapshot()
+                inbound_id = snapshot.find_reality_inbound_id() if snapshot else None
+                if inbound_id is None:
+                    logger.error("No Reality inbound on evacuation target", node_id=node.id)
+                    return
+
+                timestamp = int(time.time())
+                configs = [
+                    {
+                        "id": str(uuid.uuid4()),
+                        "email": f"{user.telegram_id}_{timestamp}_{key.key_id}@vpn.local",
+                        "telegram_id": user.telegram_id,
+                        "limit_ip": 2,
+                        "expiry_time": int(key.expires_at.timestamp() * 1000) if key.expires_at else 0,
+                        # Приостановленный или истекший ключ переезжает отключенным
+                        "enable": key.is_active
+                    }
+                    for user, key in keyed
+                ]
+                results = await client.create_clients_bulk(inbound_id, configs)
+
+                for (user, key), result in zip(keyed, results):
+                    if not result.get("success"):
+                        logger.warning("Evacuation client not created", node_id=node.id,
+                                      key_id=key.key_id, error=result.get("error"))
+                        continue
+                    key.client_id = result["client_id"]
+                    key.email = result["email"]
+                    key.inbound_id = inbound_id
+                    # Панель только что приняла клиента - фоновая проверка не нужна
+                    key.vless_url = await client.generate_client_url(
+                        inbound_id, key.client_id, node=node, email=key.email, verify=False
+                    )
+            except Exception as e:
+                logger.error("Evacuation provisioning failed", node_id=node.id, error=str(e))
+
+    async def _discard_partial(self, node: NodeView, users: List[EvacuatedUser]) -> None:
+        """Удалить созданных клиентов пользователей, у которых перенос не удался целиком"""
+        orphans = [(key.inbound_id, key.client_id)
+                   for user in users for key in user.keys if key.provisioned]
+        if not orphans:
+            return
+        try:
+            await X3UIClient.from_node(node).delete_clients_bulk(orphans)
+        except Exception as e:
+            logger.warning("Failed to clean up evacuation clients", node_id=node.id, error=str(e))
+
+    async def _apply(self, failed_node_id: int, moved: Dict[int, List[EvacuatedUser]],
+                     snapshot) -> int:
+        """
+        Ключи, назначения, счетчики и уведомления - в одной транзакции
+        Returns: число уведомлений, поставленных в outbox
+        """
+        key_rows = [
+            {
+                "id": key.key_id,
+                "node_id": target_id,
+                "uuid": key.client_id,
+                "xui_client_id": key.client_id,
+                "xui_email": key.email,
+                "xui_inbound_id": key.inbound_id,
+                "vless_url": key.vless_url,
+                "qr_code_data": None
+            }
+            for target_id, users in moved.items() for user in users for key in user.keys
+        ]
+        if key_rows:
+            # ORM bulk UPDATE по первичному ключу - один executemany
+            await self.db.execute(update(VPNKey), key_rows)
+
+        user_ids = [user.user_id for users in moved.values() for user in users]
+        await self.db.execute(
+            update(UserNodeAssignment)
+            .where(UserNodeAssignment.node_id == failed_node_id)
+            .where(UserNodeAssignment.user_id.in_(user_ids))
+            .where(UserNodeAssignment.is_active == True)
+            .values(is_active=False)
+            .execution_options(synchronize_session=False)
+        )
+        await self.db.execute(
+            insert(UserNodeAssignment),
+            [
+                {
+                    "user_id": user.user_id,
+                    "node_id": target_id,
+                    "is_active": True,
+                    "xui_inbound_id": user.keys[0].inbound_id if user.keys else None,
+                    "xui_client_email": user.keys[0].email if user.keys else None
+                }
+                for target_id, users in moved.items() for user in users
+            ]
+        )
+
+        for target_id, users in moved.items():
+            target = snapshot.get(target_id)
+            await self.db.execute(
+                update(UserServerAssignment)
+                .where(UserServerAssignment.node_id == failed_node_id)
+                .where(UserServerAssignment.user_id.in_([user.telegram_id for user in users]))
+                .values(node_id=target_id, country_id=target.country_id, last_switch_at=func.now())
+                .execution_options(synchronize_session=False)
+            )
+
+        # Места освобождаются на нодах, где пользователей больше не осталось
+        await self.capacity.settle({
+            user.user_id: user.placed for users in moved.values() for user in users
+        })
+        queued = await self._notify(moved, snapshot)
+        await self.db.commit()
+        notification_outbox.wake()
+        return queued
+
+    async def _notify(self, moved: Dict[int, List[EvacuatedUser]], snapshot) -> int:
+        """Новые конфигурации активных ключей - в outbox (commit делает _apply)"""
+        queued = 0
+        for target_id, users in moved.items():
+            target = snapshot.get(target_id)
+            location = target.location or target.name
+            for user in users:
+                for key in user.keys:
+                    if key.is_active and await notification_service.queue_vpn_key_moved_notification(
+                            self.db, user.telegram_id, key.key_name, location, key.vless_url):
+                        queued += 1
+        return queued
+
+    async def evacuate(self, node_id: int) -> EvacuationReport:
+        """
+        Перенести всех пользователей ноды (нода уже помечена inactive/unhealthy вызывающим)
+        Пользователи, для которых не нашлось места или клиента, остаются на ноде
+        и попадают в отчет (unplaced_users / failed_users)
+        """
+        started = time.monotonic()
+        report = EvacuationReport(node_id=node_id)
+
+        snapshot = await node_registry.get_snapshot()
+        failed = snapshot.get(node_id)
+        if failed is None:
+            logger.error("Node not found for evacuation", node_id=node_id)
+            return report
+
+        users = await self._load_users(node_id)
+        report.users = len(users)
+        report.keys = sum(len(user.keys) for user in users)
+        if not users:
+            return report
+
+        self.plan(failed, snapshot, users)
+        reserved = await self._reserve(users)
+
+        semaphore = asyncio.Semaphore(self.settings.evacuation_node_concurrency)
+        await asyncio.gather(*(
+            self._provision(snapshot.get(target_id), group, semaphore)
+            for target_id, group in reserved.items()
+        ))
+
+        moved: Dict[int, List[EvacuatedUser]] = {}
+        for target_id, group in reserved.items():
+            ok = [user for user in group if user.provisioned]
+            failed_users = [user for user in group if not user.provisioned]
+            if failed_users:
+                report.failed_users += len(failed_users)
+                await self._discard_partial(snapshot.get(target_id), failed_users)
+                await self.capacity.release(
+                    target_id, sum(1 for user in failed_users if target_id not in user.placed)
+                )
+            if ok:
+                moved[target_id] = ok
+                report.per_node[target_id] = len(ok)
+
+        if moved:
+            report.notifications_queued = await self._apply(node_id, moved, snapshot)
+        else:
+            await self.db.commit()
+
+        report.moved_users = sum(len(group) for group in moved.values())
+        report.moved_keys = sum(len(user.keys) for group in moved.values() for user in group)
+        report.unplaced_users = sum(1 for user in users if user.target_node_id is None)
+        report.duration_ms = int((time.monotonic() - started) * 1000)
+
+        logger.info("Node evacuated", **report.to_dict())
+        return report
@@ -0,0 +1,59 @@
+"""
+Node Hashing - взвешенный rendezvous (HRW) выбор ноды для пользователя
+Для каждой пары (пользователь, нода) считается детерминированный вес -weight / ln(u),
+пользователь получает ноду с максимальным весом. При изменении набора нод
+переезжают только пользователи удаленной ноды (или доля, доставшаяся новой ноде)
+"""
+
+import hashlib
+import math
+from typing import Callable, List, Optional, Sequence, TypeVar
+
+from config.settings import get_settings, Settings
+from services.node_scoring import ScoredNode, is_node_available
+
+NodeT = TypeVar("NodeT")
+
+ASSIGNMENT_MODE_SCORE = "score"
+ASSIGNMENT_MODE_RENDEZVOUS = "rendezvous"
+
+
+def is_rendezvous_mode(settings: Optional[Settings] = None) -> bool:
+    """Включен ли режим липкого назначения по rendezvous hashing (по умолчанию - настройки процесса)"""
+    return (settings or get_settings()).node_assignment_mode == ASSIGNMENT_MODE_RENDEZVOUS
+
+
+def _unit_hash(user_key: int, node_id: int) -> float:
+    """Стабильное (не зависит от PYTHONHASHSEED) число в интервале (0, 1)"""
+    digest = hashlib.blake2b(f"{user_key}:{node_id}".encode(), digest_size=8).digest()
+    return (int.from_bytes(digest, "big") + 1) / (2 ** 64 + 2)
+
+
+def hrw_weight(user_key: int, node_id: int, weight: float) -> float:
+    """Вес пары для weighted rendezvous: доля пользователей ноды пропорциональна weight"""
+    if not weight or weight <= 0:
+        return float("-inf")
+    return -weight / math.log(_unit_hash(user_key, node_id))
+
+
+def rank_nodes_hrw(user_key: int, nodes: Sequence[NodeT]) -> List[NodeT]:
+    """Ноды в порядке предпочтения для пользователя (первая - «домашняя»)"""
+    return sorted(nodes, key=lambda node: hrw_weight(user_key, node.id, node.weight or 0.0), reverse=True)
+
+
+def pick_node_hrw(user_key: int, nodes: Sequence[NodeT],
+                  accept: Optional[Callable[[NodeT], bool]] = None) -> Optional[NodeT]:
+    """Первая по предпочтению нода, прошедшая фильтр accept (например, есть место)"""
+    for node in rank_nodes_hrw(user_key, nodes):
+        if accept is None or accept(node):
+            return node
+    return None
+
+
+def rank_available_hrw(user_key: int, nodes: Sequence[NodeT]) -> List[ScoredNode]:
+    """Доступные ноды в порядке HRW (score - вес rendezvous) - замена score_nodes в липком режиме"""
+    return [
+        ScoredNode(node, hrw_weight(user_key, node.id, node.weight or 0.0))
+        for node in rank_nodes_hrw(user_key, nodes)
+        if (node.weight or 0) > 0 and is_node_available(node)
+    ]
@@ -0,0 +1,196 @@
+"""
+Node Health Metrics - скользящие p50/p95/error-rate по результатам health check
+Каждая нода держит кольцевой буфер последних проб; статистика обновляется
+инкрементально при добавлении пробы, без пересчета по сырым строкам БД
+"""
+
+import bisect
+import math
+from collections import deque
+from typing import Dict, Any, Optional, List, Deque
+from datetime import datetime, timedelta
+
+import structlog
+from sqlalchemy import select, delete, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.settings import get_settings
+from models.node_health_sample import NodeHealthSample
+
+logger = structlog.get_logger(__name__)
+
+
+class HealthSample:
+    """Одна проба (облегченная копия строки NodeHealthSample)"""
+
+    __slots__ = ("checked_at", "latency_ms", "success", "inbounds_total", "inbounds_active")
+
+    def __init__(self, checked_at: datetime, latency_ms: Optional[int], success: bool,
+                 inbounds_total: int = 0, inbounds_active: int = 0):
+        self.checked_at = checked_at
+        self.latency_ms = latency_ms
+        self.success = success
+        self.inbounds_total = inbounds_total
+        self.inbounds_active = inbounds_active
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "checked_at": self.checked_at.isoformat(),
+            "latency_ms": self.latency_ms,
+            "success": self.success,
+            "inbounds_total": self.inbounds_total,
+            "inbounds_active": self.inbounds_active
+        }
+
+
+class NodeHealthSeries:
+    """Кольцевой буфер проб ноды + отсортированные задержки успешных проб для перцентилей"""
+
+    def __init__(self, window: int):
+        self.samples: Deque[HealthSample] = deque()
+        self.window = window
+        self._sorted_latencies: List[int] = []
+        self._failures = 0
+
+    def add(self, sample: HealthSample) -> None:
+        if len(self.samples) >= self.window:
+            self._evict(self.samples.popleft())
+        self.samples.append(sample)
+        if sample.success and sample.latency_ms is not None:
+            bisect.insort(self._sorted_latencies, sample.latency_ms)
+        if not sample.success:
+            self._failures += 1
+
+    def _evict(self, sample: HealthSample) -> None:
+        if sample.success and sample.latency_ms is not None:
+            index = bisect.bisect_left(self._sorted_latencies, sample.latency_ms)
+            if index < len(self._sorted_latencies):
+                del self._sorted_latencies[index]
+        if not sample.success:
+            self._failures -= 1
+
+    def percentile(self, q: float) -> Optional[int]:
+        """Перцентиль задержки (nearest-rank) по успешным пробам окна"""
+        if not self._sorted_latencies:
+            return None
+        rank = max(0, math.ceil(q * len(self._sorted_latencies)) - 1)
+        return self._sorted_latencies[rank]
+
+    @property
+    def error_rate(self) -> float:
+        return self._failures / len(self.samples) if self.samples else 0.0
+
+    def summary(self) -> Dict[str, Any]:
+        last = self.samples[-1] if self.samples else None
+        return {
+            "samples": len(self.samples),
+            "p50_ms": self.percentile(0.50),
+            "p95_ms": self.percentile(0.95),
+            "error_rate": round(self.error_rate, 4),
+            "last_checked_at": last.checked_at.isoformat() if last else None,
+            "inbounds_active": last.inbounds_active if last else None
+        }
+
+
+class NodeHealthMetrics:
+    """Процессный реестр временных рядов здоровья нод"""
+
+    def __init__(self, window: Optional[int] = None):
+        self.window = window or get_settings().health_metrics_window
+        self._series: Dict[int, NodeHealthSeries] = {}
+        self._loaded = False
+
+    def _series_for(self, node_id: int) -> NodeHealthSeries:
+        if node_id not in self._series:
+            self._series[node_id] = NodeHealthSeries(self.window)
+        return self._series[node_id]
+
+    def record(self, node_id: int, sample: HealthSample) -> None:
+        self._series_for(node_id).add(sample)
+
+    def get_summary(self, node_id: int) -> Optional[Dict[str, Any]]:
+        """p50/p95/error-rate ноды; None - если проб еще не было"""
+        series = self._series.get(node_id)
+        if not series or not series.samples:
+            return None
+        return series.summary()
+
+    def get_series(self, node_id: int, bucket_minutes: int = 0) -> List[Dict[str, Any]]:
+        """
+        Точки для графика; при bucket_minutes > 0 пробы агрегируются по интервалам
+        (средняя задержка, доля ошибок)
+        """
+        series = self._series.get(node_id)
+        if not series:
+            return []
+        if bucket_minutes <= 0:
+            return [s.to_dict() for s in series.samples]
+
+        buckets: Dict[datetime, List[HealthSample]] = {}
+        for sample in series.samples:
+            ts = sample.checked_at
+            bucket = ts.replace(minute=ts.minute - ts.minute % bucket_minutes, second=0, microsecond=0)
+            buckets.setdefault(bucket, []).append(sample)
+
+        points = []
+        for bucket, samples in sorted(buckets.items()):
+            latencies = [s.latency_ms for s in samples if s.success and s.latency_ms is not None]
+            points.append({
+                "checked_at": bucket.isoformat(),
+                "latency_ms": int(sum(latencies) / len(latencies)) if latencies else None,
+                "error_rate": round(sum(1 for s in samples if not s.success) / len(samples), 4),
+                "samples": len(samples)
+            })
+        return points
+
+    def forget(self, node_id: int) -> None:
+        self._series.pop(node_id, None)
+
+    async def ensure_loaded(self) -> None:
+        """Один раз на процесс прогреть буферы последними пробами из БД (отдельной сессией)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        try:
+            from config.database import async_session_maker
+
+            ranked = select(
+                NodeHealthSample,
+                func.row_number().over(
+                    partition_by=NodeHealthSample.node_id,
+                    order_by=NodeHealthSample.checked_at.desc()
+                ).label("rn")
+            ).subquery()
+            async with async_session_maker() as db:
+                result = await db.execute(
+                    select(ranked)
+                    .where(ranked.c.rn <= self.window)
+                    .order_by(ranked.c.node_id, ranked.c.checked_at)
+                )
+                rows = result.mappings().all()
+
+            # Ноды, по которым в процессе уже есть пробы, не дублируем
+            known = set(self._series)
+            count = 0
+            for row in rows:
+                if row["node_id"] in known:
+                    continue
+                self.record(row["node_id"], HealthSample(
+                    row["checked_at"], row["latency_ms"], row["success"],
+                    row["inbounds_total"], row["inbounds_active"]
+                ))
+                count += 1
+            logger.info("Node health metrics loaded", samples=count, nodes=len(self._series))
+        except Exception as e:
+            logger.warning("Failed to load node health samples", error=str(e))
+
+    @staticmethod
+    async def prune(db: AsyncSession, retention_days: Optional[int] = None) -> None:
+        """Удалить пробы старше срока хранения (commit делает вызывающий)"""
+        retention_days = retention_days or get_settings().health_samples_retention_days
+        cutoff = datetime.utcnow() - timedelta(days=retention_days)
+        await db.execute(delete(NodeHealthSample).where(NodeHealthSample.checked_at < cutoff))
+
+
+# Глобальный реестр метрик (один на процесс)
+node_health_metrics = NodeHealthMetrics()
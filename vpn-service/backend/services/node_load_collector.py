@@ -0,0 +1,79 @@
+"""
+Node Load Collector - живая нагрузка нод по данным панели
+Во время health check снимаются число онлайн-клиентов (onlines) и суммарный трафик inbound'ов;
+трафик превращается в скорость по разнице с прошлой пробой, оба сигнала сглаживаются EWMA
+и сохраняются в vpn_nodes (live_online_clients, live_throughput_mbps)
+"""
+
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, List, Tuple
+
+import structlog
+
+from config.settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+
+@dataclass
+class LiveLoadSample:
+    """Сырые значения одной пробы (до сглаживания)"""
+    online_clients: Optional[int]
+    throughput_mbps: Optional[float]
+
+
+def _traffic_total(inbounds: List[Dict[str, Any]]) -> int:
+    """Накопленный трафик всех inbound'ов (up + down, байты)"""
+    return sum((inbound.get("up") or 0) + (inbound.get("down") or 0) for inbound in inbounds)
+
+
+def _ewma(previous: Optional[float], value: float, alpha: float) -> float:
+    return value if previous is None else alpha * value + (1.0 - alpha) * previous
+
+
+class NodeLoadCollector:
+    """Процессный сборщик: помнит прошлый счетчик трафика каждой ноды для вычисления скорости"""
+
+    def __init__(self, alpha: Optional[float] = None):
+        self.alpha = alpha if alpha is not None else get_settings().node_live_load_alpha
+        # node_id -> (накопленные байты, time.monotonic() пробы)
+        self._last_traffic: Dict[int, Tuple[int, float]] = {}
+
+    async def sample(self, client, node_id: int,
+                     inbounds: Optional[List[Dict[str, Any]]]) -> LiveLoadSample:
+        """Снять пробу с панели (только сеть, без БД); inbounds - уже полученный health check'ом список"""
+        online = await client.get_online_clients()
+        throughput = None
+        if inbounds is not None:
+            throughput = self._throughput(node_id, _traffic_total(inbounds), time.monotonic())
+        return LiveLoadSample(len(online) if online is not None else None, throughput)
+
+    def _throughput(self, node_id: int, total_bytes: int, now: float) -> Optional[float]:
+        previous = self._last_traffic.get(node_id)
+        self._last_traffic[node_id] = (total_bytes, now)
+        if previous is None:
+            return None
+        delta_bytes, elapsed = total_bytes - previous[0], now - previous[1]
+        # Сброс счетчиков в панели или слишком частая проба - скорость не считаем
+        if delta_bytes < 0 or elapsed <= 0:
+            return None
+        return delta_bytes * 8 / elapsed / 1_000_000
+
+    def apply(self, node, live: LiveLoadSample) -> None:
+        """Сгладить пробу в поля ноды (VPNNode, commit делает вызывающий)"""
+        if live.online_clients is None and live.throughput_mbps is None:
+            return
+        if live.online_clients is not None:
+            node.live_online_clients = _ewma(node.live_online_clients, live.online_clients, self.alpha)
+        if live.throughput_mbps is not None:
+            node.live_throughput_mbps = _ewma(node.live_throughput_mbps, live.throughput_mbps, self.alpha)
+        node.live_load_updated_at = datetime.now(timezone.utc)
+
+    def forget(self, node_id: int) -> None:
+        self._last_traffic.pop(node_id, None)
+
+
+# Глобальный сборщик живой нагрузки (один на процесс)
+node_load_collector = NodeLoadCollector()
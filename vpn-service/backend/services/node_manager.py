@@ -13,8 +13,12 @@ from models.vpn_node import VPNNode, NodeMode
 from models.user_node_assignment import UserNodeAssignment
 from models.user import User
 from services.x3ui_client import X3UIClient
+from services.x3ui_api_discovery import x3ui_api_registry
+from services.vless_url_builder import reality_template_cache
+from services.x3ui_client_pool import x3ui_client_pool
 from config.database import get_db
 from models.vpn_key import VPNKey, VPNKeyStatus
+from services.node_capacity import NodeCapacity
 
 logger = structlog.get_logger(__name__)
 
@@ -88,6 +92,11 @@ class NodeManager:
                 'reality_config': node_config.reality_config,
             }
             
+            # Сохраняем вариант API, определенный при проверке подключения
+            capabilities = x3ui_api_registry.get(node_config.x3ui_url)
+            if capabilities:
+                node_data['api_capabilities'] = capabilities.to_dict()
+            
             # Добавляем дополнительные параметры (для обратной совместимости или других случаев)
             node_data.update(additional_params)
             
@@ -151,13 +160,22 @@ class NodeManager:
                     x3ui_username=node.x3ui_username,
                     x3ui_password=node.x3ui_password
                 )
+                # Панель могла смениться - определяем API заново
+                x3ui_api_registry.invalidate(node.x3ui_url)
+                reality_template_cache.invalidate(node.x3ui_url)
                 if not await self._test_x3ui_connection(config):
                     logger.warning("Updated X3UI connection failed", node_id=node_id)
                     node.health_status = 'unhealthy'
+                
+                capabilities = x3ui_api_registry.get(node.x3ui_url)
+                node.api_capabilities = capabilities.to_dict() if capabilities else None
             
             await self.db.commit()
             await self.db.refresh(node)
             
+            # Клиент в пуле пересоздастся с новыми учетными данными при следующем запросе
+            x3ui_client_pool.invalidate(node_id)
+            
             logger.info("VPN node updated successfully", 
                        node_id=node.id, 
                        updates=list(updates.keys()))
@@ -198,6 +216,7 @@ class NodeManager:
             # Удаляем ноду
             await self.db.execute(delete(VPNNode).where(VPNNode.id == node_id))
             await self.db.commit()
+            x3ui_client_pool.invalidate(node_id)
             
             logger.info("VPN node deleted successfully", 
                        node_id=node_id, 
@@ -410,33 +429,42 @@ class NodeManager:
                 return False
             
             # Мигрируем пользователей
+            capacity = NodeCapacity(self.db)
+            before = await capacity.placed_map(a.user_id for a in assignments)
             migrated_count = 0
             for assignment in assignments:
-                # Выбираем ноду с наименьшей нагрузкой
-                target_node = min(healthy_nodes, key=lambda n: n.calculate_score())
+                # Кандидаты по возрастанию нагрузки; счетчики нод обновляются резервированием
+                candidates = sorted(healthy_nodes, key=lambda n: n.calculate_score())
+                target_node_id = await capacity.reserve_first(
+                    (n.id for n in candidates), placed=before[assignment.user_id]
+                )
+                if target_node_id is None:
+                    logger.error("No node capacity left for migration",
+                                node_id=node_id,
+                                remaining=len(assignments) - migrated_count)
+                    break
                 
                 # Создаем новый assignment
                 new_assignment = UserNodeAssignment(
                     user_id=assignment.user_id,
-                    node_id=target_node.id,
+                    node_id=target_node_id,
                     is_active=True
                 )
                 self.db.add(new_assignment)
                 
                 # Деактивируем старый assignment
                 assignment.is_active = False
-                
-                # Обновляем счетчики
-                target_node.current_users += 1
                 migrated_count += 1
             
+            # Места освобождаются на нодах, где пользователей больше не осталось
+            await capacity.settle(before)
             await self.db.commit()
             
             logger.info("Users migrated successfully", 
                        from_node=node_id, 
                        migrated_count=migrated_count)
             
-            return True
+            return migrated_count == len(assignments)
             
         except Exception as e:
             logger.error("Error migrating users from node", 
@@ -0,0 +1,366 @@
+"""
+Node Rebalancer - перебалансировка пользователей между всеми нодами по плану
+План строится за один проход (water-filling целевой нагрузки внутри страны с учетом
+max_users, weight и priority), затем миграции выполняются параллельно с лимитами на ноду
+"""
+
+import asyncio
+import math
+import time
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Dict, Any, Optional, List, Tuple, Deque
+
+import structlog
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.settings import get_settings, Settings
+from models.user_node_assignment import UserNodeAssignment
+from services.node_registry import node_registry, NodeView
+from services.node_hashing import is_rendezvous_mode, rank_nodes_hrw
+from services.x3ui_circuit_breaker import x3ui_circuit_breakers
+
+logger = structlog.get_logger(__name__)
+
+
+def _fill_weight(node: NodeView) -> float:
+    """Доля ноды при распределении: емкость с учетом веса и приоритета"""
+    return max(0.0, (node.max_users or 0) * (node.weight or 0.0) * ((node.priority or 0) / 100.0))
+
+
+def water_fill(nodes: List[NodeView], total_users: int) -> Dict[int, int]:
+    """
+    Целевое число пользователей на нодах группы: target_i = min(max_users_i, level * w_i),
+    где level подбирается так, чтобы сумма целей равнялась total_users.
+    Ноды насыщаются в порядке возрастания max_users / w; дробные остатки раздаются
+    методом наибольшего остатка, без выхода за max_users
+    """
+    targets: Dict[int, float] = {node.id: 0.0 for node in nodes}
+    weighted = sorted(
+        (node for node in nodes if _fill_weight(node) > 0),
+        key=lambda n: (n.max_users or 0) / _fill_weight(n)
+    )
+    remaining = float(total_users)
+    weight_sum = sum(_fill_weight(node) for node in weighted)
+
+    for index, node in enumerate(weighted):
+        level = remaining / weight_sum if weight_sum > 0 else 0.0
+        if level * _fill_weight(node) >= (node.max_users or 0):
+            targets[node.id] = float(node.max_users or 0)
+            remaining -= targets[node.id]
+            weight_sum -= _fill_weight(node)
+            continue
+        for rest in weighted[index:]:
+            targets[rest.id] = level * _fill_weight(rest)
+        break
+
+    # Округление с сохранением суммы
+    rounded = {node_id: int(math.floor(value)) for node_id, value in targets.items()}
+    leftover = min(total_users, sum(n.max_users or 0 for n in nodes)) - sum(rounded.values())
+    capacity = {node.id: node.max_users or 0 for node in nodes}
+    for node_id in sorted(targets, key=lambda nid: targets[nid] - rounded[nid], reverse=True):
+        if leftover <= 0:
+            break
+        if rounded[node_id] < capacity[node_id]:
+            rounded[node_id] += 1
+            leftover -= 1
+    return rounded
+
+
+@dataclass
+class PlannedMove:
+    """Одна миграция пользователя"""
+    user_id: int
+    from_node_id: int
+    to_node_id: int
+
+
+@dataclass
+class RebalancePlan:
+    """План перебалансировки: целевая нагрузка нод и список миграций"""
+    loads: Dict[int, int] = field(default_factory=dict)
+    targets: Dict[int, int] = field(default_factory=dict)
+    moves: List[PlannedMove] = field(default_factory=list)
+    truncated: bool = False
+
+    def to_dict(self) -> Dict[str, Any]:
+        flows: Dict[Tuple[int, int], int] = {}
+        for move in self.moves:
+            key = (move.from_node_id, move.to_node_id)
+            flows[key] = flows.get(key, 0) + 1
+        return {
+            "planned_moves": len(self.moves),
+            "truncated": self.truncated,
+            "nodes": [
+                {"node_id": node_id, "current_users": load, "target_users": self.targets.get(node_id, load)}
+                for node_id, load in sorted(self.loads.items())
+            ],
+            "flows": [
+                {"from_node": src, "to_node": dst, "users": count}
+                for (src, dst), count in sorted(flows.items())
+            ]
+        }
+
+
+class RebalanceRun:
+    """Прогресс выполнения плана"""
+
+    def __init__(self, plan: RebalancePlan):
+        self.run_id = uuid.uuid4().hex[:12]
+        self.plan = plan
+        self.status = "running"
+        self.migrated = 0
+        self.failed = 0
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+
+    @property
+    def done(self) -> int:
+        return self.migrated + self.failed
+
+    def to_dict(self) -> Dict[str, Any]:
+        elapsed = (self.finished_at or time.time()) - self.started_at
+        return {
+            "run_id": self.run_id,
+            "status": self.status,
+            "planned_moves": len(self.plan.moves),
+            "migrated": self.migrated,
+            "failed": self.failed,
+            "progress": round(self.done / len(self.plan.moves), 4) if self.plan.moves else 1.0,
+            "elapsed_seconds": round(elapsed, 2),
+            "moves_per_second": round(self.done / elapsed, 2) if elapsed > 0 else 0.0
+        }
+
+
+class NodeRebalancer:
+    """Построение и выполнение плана перебалансировки"""
+
+    def __init__(self, db_session: AsyncSession = None, settings: Optional[Settings] = None):
+        self.db = db_session
+        self.settings = settings or get_settings()
+
+    async def build_plan(self, max_moves: Optional[int] = None) -> RebalancePlan:
+        """Полный план миграций по всем нодам (только чтение)"""
+        max_moves = max_moves or self.settings.rebalance_max_moves
+        tolerance = self.settings.rebalance_tolerance_percent / 100.0
+
+        snapshot = await self._load_snapshot()
+        nodes = [
+            node for node in snapshot.select(status='active', health=('healthy',))
+            if not x3ui_circuit_breakers.is_open(node.x3ui_url)
+        ]
+
+        plan = RebalancePlan(loads={node.id: node.current_users or 0 for node in nodes})
+
+        if is_rendezvous_mode(self.settings):
+            return await self._build_rendezvous_plan(plan, nodes, max_moves)
+
+        # Пользователи переносятся только между нодами одной страны
+        by_country: Dict[Optional[int], List[NodeView]] = {}
+        for node in nodes:
+            by_country.setdefault(node.country_id, []).append(node)
+
+        # (донор, получатель, сколько)
+        flows: List[Tuple[int, int, int]] = []
+        for country_nodes in by_country.values():
+            if len(country_nodes) < 2:
+                continue
+            targets = water_fill(country_nodes, sum(plan.loads[n.id] for n in country_nodes))
+            plan.targets.update(targets)
+
+            donors = []
+            receivers = []
+            for node in country_nodes:
+                delta = plan.loads[node.id] - targets[node.id]
+                # Мелкие отклонения не трогаем - миграция стоит дороже
+                if delta > max(1, tolerance * (node.max_users or 0)):
+                    donors.append([node.id, delta])
+                elif delta < 0:
+                    receivers.append([node.id, -delta])
+
+            donors.sort(key=lambda d: d[1], reverse=True)
+            receivers.sort(key=lambda r: r[1], reverse=True)
+            d = r = 0
+            while d < len(donors) and r < len(receivers):
+                count = min(donors[d][1], receivers[r][1])
+                flows.append((donors[d][0], receivers[r][0], count))
+                donors[d][1] -= count
+                receivers[r][1] -= count
+                if donors[d][1] == 0:
+                    d += 1
+                if receivers[r][1] == 0:
+                    r += 1
+
+        if not flows:
+            return plan
+
+        surplus: Dict[int, int] = {}
+        for src, _, count in flows:
+            surplus[src] = surplus.get(src, 0) + count
+        movable = await self._load_movable_users(surplus)
+
+        for src, dst, count in flows:
+            users = movable.get(src, deque())
+            for _ in range(count):
+                if not users:
+                    break
+                if len(plan.moves) >= max_moves:
+                    plan.truncated = True
+                    return plan
+                plan.moves.append(PlannedMove(users.popleft(), src, dst))
+
+        return plan
+
+    async def _load_snapshot(self):
+        """Счетчики в снимке могут отставать на TTL - план строится по свежим current_users"""
+        return await node_registry.refresh(force=True)
+
+    async def _build_rendezvous_plan(self, plan: RebalancePlan, nodes: List[NodeView],
+                                     max_moves: int) -> RebalancePlan:
+        """
+        Липкий режим: переносятся только пользователи, чья HRW-нода в стране изменилась
+        (например, добавлена нода) и на ней есть место; остальные остаются на месте
+        """
+        node_by_id = {node.id: node for node in nodes}
+        assignments = await self._load_assignments(list(node_by_id))
+
+        country_nodes: Dict[Optional[int], List[NodeView]] = {}
+        for node in nodes:
+            country_nodes.setdefault(node.country_id, []).append(node)
+
+        loads = dict(plan.loads)
+        for user_id, node_id in assignments:
+            home = rank_nodes_hrw(user_id, country_nodes[node_by_id[node_id].country_id])[0]
+            if home.id == node_id or loads[home.id] >= (home.max_users or 0):
+                continue
+            if len(plan.moves) >= max_moves:
+                plan.truncated = True
+                break
+            plan.moves.append(PlannedMove(user_id, node_id, home.id))
+            loads[node_id] -= 1
+            loads[home.id] += 1
+
+        plan.targets = loads
+        return plan
+
+    async def _load_movable_users(self, surplus: Dict[int, int]) -> Dict[int, Deque[int]]:
+        """Конкретные пользователи доноров одним запросом (последние назначенные - первыми)"""
+        ranked = select(
+            UserNodeAssignment.user_id,
+            UserNodeAssignment.node_id,
+            func.row_number().over(
+                partition_by=UserNodeAssignment.node_id,
+                order_by=UserNodeAssignment.assigned_at.desc()
+            ).label("rn")
+        ).where(
+            UserNodeAssignment.is_active == True,
+            UserNodeAssignment.node_id.in_(list(surplus))
+        ).subquery()
+        result = await self.db.execute(
+            select(ranked.c.user_id, ranked.c.node_id)
+            .where(ranked.c.rn <= max(surplus.values()))
+            .order_by(ranked.c.node_id, ranked.c.rn)
+        )
+        movable: Dict[int, Deque[int]] = {}
+        for user_id, node_id in result.all():
+            if len(movable.setdefault(node_id, deque())) < surplus[node_id]:
+                movable[node_id].append(user_id)
+        return movable
+
+    async def _load_assignments(self, node_ids: List[int]) -> List[Tuple[int, int]]:
+        """Активные назначения (user_id, node_id) на ноды, по возрастанию user_id"""
+        result = await self.db.execute(
+            select(UserNodeAssignment.user_id, UserNodeAssignment.node_id)
+            .where(UserNodeAssignment.is_active == True)
+            .where(UserNodeAssignment.node_id.in_(node_ids))
+            .order_by(UserNodeAssignment.user_id)
+        )
+        return list(result.all())
+
+    async def execute(self, plan: RebalancePlan, run: Optional[RebalanceRun] = None) -> RebalanceRun:
+        """
+        Выполнить миграции параллельно: общий лимит rebalance_concurrency и не более
+        rebalance_node_concurrency одновременных миграций с участием одной ноды.
+        Каждая миграция - отдельная сессия и транзакция (резервирование места на получателе)
+        """
+        from config.database import async_session_maker
+        from services.load_balancer import LoadBalancer
+
+        run = run or RebalanceRun(plan)
+        global_limit = asyncio.Semaphore(self.settings.rebalance_concurrency)
+        node_limits: Dict[int, asyncio.Semaphore] = {}
+
+        def node_limit(node_id: int) -> asyncio.Semaphore:
+            if node_id not in node_limits:
+                node_limits[node_id] = asyncio.Semaphore(self.settings.rebalance_node_concurrency)
+            return node_limits[node_id]
+
+        async def migrate(move: PlannedMove) -> None:
+            # Семафоры нод берутся в порядке id - без взаимной блокировки
+            first, second = sorted((move.from_node_id, move.to_node_id))
+            async with global_limit, node_limit(first), node_limit(second):
+                try:
+                    async with async_session_maker() as session:
+                        assignment = await LoadBalancer(session).assign_user_to_node(
+                            move.user_id, move.to_node_id
+                        )
+                    ok = assignment is not None
+                except Exception as e:
+                    logger.error("Rebalance migration failed", user_id=move.user_id, error=str(e))
+                    ok = False
+            if ok:
+                run.migrated += 1
+            else:
+                run.failed += 1
+
+        try:
+            await asyncio.gather(*(migrate(move) for move in plan.moves))
+            run.status = "completed"
+        except Exception as e:
+            run.status = "failed"
+            logger.error("Rebalance run failed", run_id=run.run_id, error=str(e))
+        finally:
+            run.finished_at = time.time()
+
+        logger.info("Rebalance run finished", **run.to_dict())
+        return run
+
+
+class RebalanceRuns:
+    """Текущий и последние запуски перебалансировки (один запуск одновременно)"""
+
+    def __init__(self, history: int = 10):
+        self.current: Optional[RebalanceRun] = None
+        self.history: Deque[RebalanceRun] = deque(maxlen=history)
+        self._tasks: set = set()
+        # Держится от проверки is_running до start: два запроса не запустят два плана
+        self.lock = asyncio.Lock()
+
+    @property
+    def is_running(self) -> bool:
+        return self.current is not None and self.current.status == "running"
+
+    def start(self, plan: RebalancePlan) -> RebalanceRun:
+        """Запустить выполнение плана в фоне (миграции открывают собственные сессии)"""
+        if self.is_running:
+            raise RuntimeError("Rebalance is already running")
+        run = RebalanceRun(plan)
+        self.current = run
+        self.history.append(run)
+
+        task = asyncio.create_task(NodeRebalancer().execute(plan, run))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return run
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "current": self.current.to_dict() if self.current else None,
+            "history": [run.to_dict() for run in reversed(self.history)]
+        }
+
+
+# Глобальный реестр запусков (один на процесс)
+rebalance_runs = RebalanceRuns()
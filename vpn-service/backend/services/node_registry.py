@@ -0,0 +1,276 @@
+"""
+Node Registry - версионированный неизменяемый снимок VPN нод в памяти процесса
+Выбор ноды (балансировщик, страны, смена ключа) идет по индексам снимка без запросов к БД.
+Снимок перечитывается после commit'а, изменившего vpn_nodes, после обхода health check и по TTL;
+изменения только счетчиков current_users применяются к снимку без перечитывания
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, fields, replace
+from datetime import datetime
+from typing import Dict, Any, Optional, List, Tuple, Iterable
+
+import structlog
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+from config.settings import get_settings
+from models.vpn_node import VPNNode, blended_load_ratio
+
+logger = structlog.get_logger(__name__)
+
+# Ноды со статусом health "unknown" (еще не проверялись) считаются работоспособными при выборе по стране
+SELECTABLE_HEALTH = ("healthy", "unknown")
+
+
+@dataclass(frozen=True)
+class NodeView:
+    """Неизменяемая копия строки vpn_nodes (только для чтения и выбора)"""
+    id: int
+    name: str
+    description: Optional[str]
+    location: Optional[str]
+    country_id: Optional[int]
+    x3ui_url: str
+    x3ui_username: str
+    x3ui_password: str
+    mode: Any
+    public_key: Optional[str]
+    short_id: Optional[str]
+    sni_mask: Optional[str]
+    max_users: int
+    current_users: int
+    status: str
+    health_status: str
+    last_health_check: Optional[datetime]
+    response_time_ms: Optional[int]
+    priority: int
+    weight: float
+    reality_config: Optional[Dict[str, Any]]
+    api_capabilities: Optional[Dict[str, Any]]
+    live_online_clients: Optional[float]
+    live_throughput_mbps: Optional[float]
+    live_load_updated_at: Optional[datetime]
+    created_at: Optional[datetime]
+    updated_at: Optional[datetime]
+
+    @classmethod
+    def from_model(cls, node: VPNNode) -> "NodeView":
+        return cls(**{f.name: getattr(node, f.name) for f in fields(cls)})
+
+    # Те же вычисляемые свойства, что и у VPNNode
+
+    @property
+    def load_percentage(self) -> float:
+        if self.max_users == 0:
+            return 100.0
+        return (self.current_users / self.max_users) * 100
+
+    @property
+    def is_healthy(self) -> bool:
+        return self.status == 'active' and self.health_status == 'healthy'
+
+    @property
+    def can_accept_users(self) -> bool:
+        return (self.is_healthy and
+                self.current_users < self.max_users and
+                self.status == 'active')
+
+    def calculate_score(self) -> float:
+        """Оценка для load balancing (меньше = лучше), как VPNNode.calculate_score"""
+        if not self.can_accept_users:
+            return float('inf')
+        load_ratio = blended_load_ratio(self)
+        return load_ratio / ((self.priority / 100.0) * self.weight)
+
+
+class NodeRegistrySnapshot:
+    """Снимок нод с индексами по id, стране, статусу и здоровью"""
+
+    def __init__(self, version: int, nodes: Iterable[NodeView]):
+        self.version = version
+        self.loaded_at = time.monotonic()
+        # Порядок как в запросах сервисов: приоритет по убыванию
+        self.nodes: Tuple[NodeView, ...] = tuple(sorted(nodes, key=lambda n: -(n.priority or 0)))
+        self.by_id: Dict[int, NodeView] = {n.id: n for n in self.nodes}
+        self.by_country: Dict[Optional[int], Tuple[NodeView, ...]] = {}
+        self.by_status: Dict[str, Tuple[NodeView, ...]] = {}
+        self.by_health: Dict[str, Tuple[NodeView, ...]] = {}
+
+        country_index: Dict[Optional[int], List[NodeView]] = {}
+        status_index: Dict[str, List[NodeView]] = {}
+        health_index: Dict[str, List[NodeView]] = {}
+        for node in self.nodes:
+            country_index.setdefault(node.country_id, []).append(node)
+            status_index.setdefault(node.status, []).append(node)
+            health_index.setdefault(node.health_status, []).append(node)
+        self.by_country = {k: tuple(v) for k, v in country_index.items()}
+        self.by_status = {k: tuple(v) for k, v in status_index.items()}
+        self.by_health = {k: tuple(v) for k, v in health_index.items()}
+
+    def get(self, node_id: Optional[int]) -> Optional[NodeView]:
+        return self.by_id.get(node_id)
+
+    def select(self, country_id: Optional[int] = None, status: Optional[str] = "active",
+               health: Optional[Iterable[str]] = None) -> List[NodeView]:
+        """Ноды по фильтрам (порядок - priority по убыванию)"""
+        candidates = self.by_country.get(country_id, ()) if country_id is not None else self.nodes
+        health = tuple(health) if health is not None else None
+        return [
+            node for node in candidates
+            if (status is None or node.status == status)
+            and (health is None or node.health_status in health)
+        ]
+
+
+class NodeRegistry:
+    """Процессный реестр: хранит текущий снимок и перечитывает его при инвалидации"""
+
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        self.ttl = ttl_seconds if ttl_seconds is not None else get_settings().node_registry_ttl
+        self._snapshot: Optional[NodeRegistrySnapshot] = None
+        self._version = 0
+        self._dirty = True
+        self._lock = asyncio.Lock()
+        self.reloads = 0
+
+    @property
+    def version(self) -> int:
+        return self._version
+
+    def invalidate(self) -> None:
+        """Пометить снимок устаревшим; перечитается при следующем обращении"""
+        self._dirty = True
+
+    def _is_fresh(self) -> bool:
+        return (self._snapshot is not None and not self._dirty
+                and time.monotonic() - self._snapshot.loaded_at < self.ttl)
+
+    async def get_snapshot(self) -> NodeRegistrySnapshot:
+        if self._is_fresh():
+            return self._snapshot
+        return await self.refresh()
+
+    async def refresh(self, force: bool = False) -> NodeRegistrySnapshot:
+        """Перечитать vpn_nodes собственной сессией (параллельные вызовы - одна загрузка)"""
+        async with self._lock:
+            if not force and self._is_fresh():
+                return self._snapshot
+
+            from config.database import async_session_maker
+
+            # Сбрасываем флаг до чтения: инвалидация во время загрузки вызовет повторную
+            self._dirty = False
+            try:
+                async with async_session_maker() as db:
+                    result = await db.execute(select(VPNNode))
+                    views = [NodeView.from_model(node) for node in result.scalars().all()]
+            except Exception:
+                self._dirty = True
+                if self._snapshot is not None:
+                    logger.exception("Node registry reload failed, serving previous snapshot",
+                                     version=self._version)
+                    return self._snapshot
+                raise
+
+            self._version += 1
+            self._snapshot = NodeRegistrySnapshot(self._version, views)
+            self.reloads += 1
+            logger.debug("Node registry reloaded", version=self._version, nodes=len(views))
+            return self._snapshot
+
+    def apply_counters(self, counters: Dict[int, int]) -> None:
+        """
+        Применить закоммиченные значения current_users (RETURNING резервирований):
+        новый снимок с замененными NodeView, возраст для TTL сохраняется
+        """
+        snapshot = self._snapshot
+        if snapshot is None or self._dirty:
+            return
+        if self._lock.locked():
+            # Идущая перезагрузка могла прочитать строки до этого commit'а
+            self._dirty = True
+            return
+        changed = {
+            node_id: current for node_id, current in counters.items()
+            if node_id in snapshot.by_id and snapshot.by_id[node_id].current_users != current
+        }
+        if not changed:
+            return
+        views = [
+            replace(node, current_users=changed[node.id]) if node.id in changed else node
+            for node in snapshot.nodes
+        ]
+        self._version += 1
+        self._snapshot = NodeRegistrySnapshot(self._version, views)
+        self._snapshot.loaded_at = snapshot.loaded_at
+
+    def publish(self, nodes: Iterable[NodeView]) -> NodeRegistrySnapshot:
+        """Установить снимок из готовых NodeView без чтения БД (симуляция балансировки)"""
+        self._version += 1
+        self._dirty = False
+        self._snapshot = NodeRegistrySnapshot(self._version, nodes)
+        return self._snapshot
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "version": self._version,
+            "nodes": len(self._snapshot.nodes) if self._snapshot else 0,
+            "dirty": self._dirty,
+            "reloads": self.reloads,
+            "ttl_seconds": self.ttl
+        }
+
+
+# Глобальный реестр нод (один на процесс)
+node_registry = NodeRegistry()
+
+
+# Инвалидация на запись vpn_nodes: помечаем сессию, сбрасываем снимок после commit
+
+_DIRTY_FLAG = "vpn_nodes_dirty"
+_COUNTERS = "vpn_nodes_counters"
+
+
+def _mark_session(session: Optional[Session]) -> None:
+    if session is not None:
+        session.info[_DIRTY_FLAG] = True
+
+
+def record_counters(info: Dict[str, Any], rows: Iterable[Tuple[int, int]]) -> None:
+    """Запомнить (node_id, current_users) из RETURNING в session.info - применятся после commit"""
+    info.setdefault(_COUNTERS, {}).update(rows)
+
+
+@event.listens_for(VPNNode, "after_insert")
+@event.listens_for(VPNNode, "after_update")
+@event.listens_for(VPNNode, "after_delete")
+def _on_node_flush(mapper, connection, target) -> None:
+    _mark_session(Session.object_session(target))
+
+
+@event.listens_for(Session, "do_orm_execute")
+def _on_orm_execute(orm_execute_state) -> None:
+    # Массовые update(VPNNode)/delete(VPNNode) не проходят через mapper events;
+    # резервирование мест (только current_users) снимок не сбрасывает - см. record_counters
+    if (orm_execute_state.is_update or orm_execute_state.is_delete) \
+            and orm_execute_state.bind_mapper is not None \
+            and orm_execute_state.bind_mapper.class_ is VPNNode \
+            and not orm_execute_state.execution_options.get("vpn_nodes_counter_only"):
+        _mark_session(orm_execute_state.session)
+
+
+@event.listens_for(Session, "after_commit")
+def _on_commit(session) -> None:
+    counters = session.info.pop(_COUNTERS, None)
+    if session.info.pop(_DIRTY_FLAG, False):
+        node_registry.invalidate()
+    elif counters:
+        node_registry.apply_counters(counters)
+
+
+@event.listens_for(Session, "after_rollback")
+def _on_rollback(session) -> None:
+    session.info.pop(_DIRTY_FLAG, None)
+    session.info.pop(_COUNTERS, None)
@@ -0,0 +1,138 @@
+"""
+Node Scoring - пакетная оценка нод-кандидатов для UserServerService
+Назначение и история пользователя загружаются один раз, затем все кандидаты
+оцениваются за один проход по колонкам (емкость, задержка, ошибки, приоритет)
+"""
+
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import List, Optional, FrozenSet, Sequence
+
+import structlog
+
+from models.vpn_node import blended_load_ratio
+from services.node_health_metrics import node_health_metrics
+from services.x3ui_circuit_breaker import x3ui_circuit_breakers
+
+logger = structlog.get_logger(__name__)
+
+# Минимальный порог жизнеспособности ноды
+MIN_VIABLE_SCORE = 0.3
+# Медиана задержки выше порога - нода считается недоступной
+MAX_HEALTHY_LATENCY_MS = 5000
+# Проверка здоровья старше - предупреждение в лог (нода остается кандидатом)
+STALE_HEALTH_CHECK = timedelta(minutes=10)
+
+# Веса компонентов оценки (из креативной фазы)
+CAPACITY_WEIGHT = 0.50      # Capacity самое важное для load balancing
+PERFORMANCE_WEIGHT = 0.30   # Performance влияет на пользовательский опыт
+PRIORITY_WEIGHT = 0.15      # Приоритет, определенный админом
+AFFINITY_WEIGHT = 0.05      # Легкое предпочтение предыдущему серверу
+
+
+@dataclass(frozen=True)
+class UserAffinity:
+    """Текущая нода пользователя и ноды из недавней истории переключений"""
+    current_node_id: Optional[int] = None
+    recent_node_ids: FrozenSet[int] = frozenset()
+
+    def score(self, node_id: int) -> float:
+        if node_id == self.current_node_id:
+            return 0.8  # Высокое предпочтение текущему серверу
+        if node_id in self.recent_node_ids:
+            return 0.65  # Пользователь уже работал через эту ноду
+        return 0.5  # Нейтрально - нет истории с этой нодой
+
+
+@dataclass
+class ScoredNode:
+    """Кандидат и его оценка: 0.0 (непригодный) до 1.0 (оптимальный)"""
+    node: object
+    score: float
+
+
+def _response_score(response_time: Optional[int]) -> float:
+    """Оптимально: <500ms = 1.0, Плохо: >3000ms = 0.1, между - линейно"""
+    if not response_time:
+        return 0.5  # Неизвестно = нейтрально
+    if response_time <= 500:
+        return 1.0
+    if response_time >= 3000:
+        return 0.1
+    return 1.0 - ((response_time - 500) / 2500) * 0.9
+
+
+def _is_stale(last_check: Optional[datetime], now: datetime) -> bool:
+    if not last_check:
+        return False
+    if last_check.tzinfo is None:
+        # Если timezone не указан, считаем что это UTC
+        last_check = last_check.replace(tzinfo=timezone.utc)
+    return now - last_check > STALE_HEALTH_CHECK
+
+
+def _is_available(node, p50_ms: Optional[int]) -> bool:
+    return (node.health_status != 'unhealthy'
+            and not x3ui_circuit_breakers.is_open(node.x3ui_url)
+            and not (p50_ms and p50_ms > MAX_HEALTHY_LATENCY_MS)
+            and (node.max_users or 0) > 0
+            and (node.current_users or 0) < node.max_users)
+
+
+def is_node_available(node) -> bool:
+    """Нода может принять пользователя: здорова, панель отвечает, есть место"""
+    summary = node_health_metrics.get_summary(node.id) or {}
+    return _is_available(node, summary.get("p50_ms") or node.response_time_ms)
+
+
+def score_nodes(nodes: Sequence, affinity: UserAffinity,
+                min_score: float = MIN_VIABLE_SCORE) -> List[ScoredNode]:
+    """
+    Оценить всех кандидатов за один проход и вернуть жизнеспособных по убыванию оценки
+    (VPNNode или NodeView - используются только поля)
+    """
+    if not nodes:
+        return []
+    now = datetime.now(timezone.utc)
+
+    # Колонки признаков
+    summaries = [node_health_metrics.get_summary(node.id) or {} for node in nodes]
+    max_users = [node.max_users or 0 for node in nodes]
+    used = [node.current_users or 0 for node in nodes]
+    # Медиана окна проб для отсечения, p95 - для оценки; без проб - последняя проба
+    p50 = [s.get("p50_ms") or node.response_time_ms for s, node in zip(summaries, nodes)]
+    p95 = [s.get("p95_ms") or node.response_time_ms for s, node in zip(summaries, nodes)]
+    error_rate = [s.get("error_rate", 0.0) for s in summaries]
+
+    available = [_is_available(node, latency) for node, latency in zip(nodes, p50)]
+    capacity_score = [
+        min(1.0, (cap - count) / cap * 1.2) if ok else 0.0  # Легкое предпочтение более доступным
+        for ok, cap, count in zip(available, max_users, used)
+    ]
+    # Нагрузка - с учетом живых онлайн-клиентов и трафика из панели (blended_load_ratio)
+    load_score = [
+        max(0.1, 1.0 - blended_load_ratio(node)) if cap > 0 else 0.1  # Никогда не опускается ниже 0.1
+        for node, cap in zip(nodes, max_users)
+    ]
+    # Нестабильная нода (часть проб падает) теряет оценку пропорционально доле ошибок
+    performance_score = [
+        max(0.0, min(1.0, _response_score(latency) * (1.0 - errors) * 0.6 + load * 0.4))
+        for latency, errors, load in zip(p95, error_rate, load_score)
+    ]
+    priority_score = [min(1.0, (node.priority or 0) / 100.0) for node in nodes]
+    affinity_score = [affinity.score(node.id) for node in nodes]
+
+    ranked = []
+    for node, ok, cap_s, perf_s, prio_s, aff_s in zip(
+            nodes, available, capacity_score, performance_score, priority_score, affinity_score):
+        if not ok:
+            continue
+        if _is_stale(node.last_health_check, now):
+            logger.warning("Health check too old", node_id=node.id)
+        score = (cap_s * CAPACITY_WEIGHT + perf_s * PERFORMANCE_WEIGHT +
+                 prio_s * PRIORITY_WEIGHT + aff_s * AFFINITY_WEIGHT)
+        if score > min_score:
+            ranked.append(ScoredNode(node, score))
+
+    ranked.sort(key=lambda scored: scored.score, reverse=True)
+    return ranked
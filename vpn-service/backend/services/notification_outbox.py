@@ -0,0 +1,404 @@
+"""
+Notification Outbox - надежная очередь исходящих сообщений Telegram
+Сообщение пишется в notification_outbox (можно в транзакции вызывающего), одинаковое
+ожидающее сообщение хранится один раз. Воркер забирает пачки по приоритету
+(FOR UPDATE SKIP LOCKED) и отправляет их через одну HTTP-сессию с лимитами Bot API:
+общее ведро токенов и ведро на каждый чат; ответ 429 приостанавливает отправку
+на retry_after, а сообщение возвращается в очередь. Отправляет лидер задачи outbox
+"""
+
+import asyncio
+import hashlib
+import json
+import time
+from collections import deque
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+import aiohttp
+import structlog
+from sqlalchemy import select, update, delete, func, or_
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.database import async_session_maker
+from config.settings import get_settings
+from models.notification_outbox import NotificationOutbox
+from services.job_scheduler import job_scheduler
+
+logger = structlog.get_logger(__name__)
+
+# Задача планировщика: ее лидер отправляет сообщения, сама задача чистит старые
+JOB_NAME = "notification_outbox"
+
+# Приоритеты: меньше - раньше в пачке
+PRIORITY_HIGH = 0    # платежи
+PRIORITY_NORMAL = 5
+PRIORITY_LOW = 9     # массовые напоминания
+
+PENDING = "pending"
+SENT = "sent"
+FAILED = "failed"
+
+# Аренда захваченной пачки: после падения воркера сообщения снова станут доступны
+CLAIM_LEASE = timedelta(minutes=5)
+# Окно, за которое считается темп отправки (секунды)
+RATE_WINDOW = 60.0
+
+
+def dedupe_key(telegram_id: int, text: str, parse_mode: Optional[str],
+               reply_markup: Optional[Dict[str, Any]]) -> str:
+    payload = json.dumps([telegram_id, text, parse_mode, reply_markup], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class TokenBucket:
+    """Ведро токенов: rate в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Взять токен; сколько секунд ждать до его появления (токены уходят в долг)"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def is_idle(self) -> bool:
+        return self.tokens + (time.monotonic() - self.updated) * self.rate >= self.capacity
+
+
+@dataclass
+class OutboxMessage:
+    """Захваченное сообщение: поля, нужные для отправки"""
+    id: int
+    telegram_id: int
+    text: str
+    parse_mode: Optional[str]
+    reply_markup: Optional[Dict[str, Any]]
+    attempts: int
+
+
+class NotificationOutboxService:
+    """Постановка сообщений в outbox и процессный воркер отправки"""
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._global_bucket = TokenBucket(self.settings.notification_rate_per_second,
+                                          self.settings.notification_rate_per_second)
+        self._chat_buckets: Dict[int, TokenBucket] = {}
+        self._paused_until = 0.0
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker: Optional[asyncio.Task] = None
+        # Ссылки на фоновые постановки enqueue(), чтобы их не собрал GC
+        self._background: Set[asyncio.Task] = set()
+        self._sent_times: deque = deque()
+        self.enqueued = 0
+        self.deduplicated = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+
+    # Постановка
+
+    async def add(
+        self,
+        db: AsyncSession,
+        telegram_id: int,
+        text: str,
+        priority: int = PRIORITY_NORMAL,
+        parse_mode: Optional[str] = "HTML",
+        reply_markup: Optional[Dict[str, Any]] = None
+    ) -> bool:
+        """Записать сообщение в сессии вызывающего (уйдет после его commit); False - дубликат"""
+        message_id = await db.scalar(
+            insert(NotificationOutbox)
+            .values(
+                telegram_id=telegram_id,
+                text=text,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup,
+                priority=priority,
+                dedupe_key=dedupe_key(telegram_id, text, parse_mode, reply_markup),
+                status=PENDING
+            )
+            .on_conflict_do_nothing(
+                index_elements=[NotificationOutbox.dedupe_key],
+                index_where=NotificationOutbox.status == PENDING
+            )
+            .returning(NotificationOutbox.id)
+        )
+        if message_id is None:
+            self.deduplicated += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    async def send(self, telegram_id: int, text: str, priority: int = PRIORITY_NORMAL,
+                   parse_mode: Optional[str] = "HTML",
+                   reply_markup: Optional[Dict[str, Any]] = None) -> bool:
+        """Записать сообщение в собственной транзакции; True - в очереди (или уже было)"""
+        try:
+            async with async_session_maker() as db:
+                await self.add(db, telegram_id, text, priority, parse_mode, reply_markup)
+                await db.commit()
+        except Exception as e:
+            logger.error("Failed to enqueue notification", telegram_id=telegram_id, error=str(e))
+            return False
+        self.wake()
+        return True
+
+    def wake(self) -> None:
+        """Разбудить воркер, не дожидаясь опроса (после commit сообщений из add())"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def enqueue(self, telegram_id: int, text: str, priority: int = PRIORITY_NORMAL) -> bool:
+        """Поставить сообщение из синхронного кода: запись в outbox уходит в фон"""
+        task = asyncio.create_task(self.send(telegram_id, text, priority))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return True
+
+    # Воркер
+
+    async def start(self) -> None:
+        if self._worker is not None:
+            return
+        # Одна сессия на все запросы к Bot API
+        self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        self._wakeup = asyncio.Event()
+        self._worker = asyncio.create_task(self._run())
+        logger.info("Notification outbox sender started")
+
+    async def stop(self) -> None:
+        if self._worker is None:
+            return
+        self._worker.cancel()
+        await asyncio.gather(self._worker, return_exceptions=True)
+        self._worker = None
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+        await self._session.close()
+        self._session = None
+        logger.info("Notification outbox sender stopped")
+
+    def _may_send(self) -> bool:
+        # Без планировщика лидера нет - каждый процесс отправляет сам (SKIP LOCKED не даст дублей)
+        return not self.settings.scheduler_enabled or job_scheduler.is_leader(JOB_NAME)
+
+    async def _idle(self, seconds: float) -> None:
+        self._wakeup.clear()
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout=seconds)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                if not self._may_send():
+                    await self._idle(self.settings.scheduler_leader_retry_interval)
+                    continue
+                batch = await self._claim_batch()
+                if not batch:
+                    await self._idle(self.settings.notification_poll_interval)
+                    continue
+                await self._send_batch(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Notification outbox worker error", error=str(e))
+                await asyncio.sleep(self.settings.notification_poll_interval)
+
+    async def _claim_batch(self) -> List[OutboxMessage]:
+        """Пачка доступных сообщений по приоритету; захват - арендой locked_until"""
+        async with async_session_maker() as db:
+            rows = (await db.execute(
+                select(NotificationOutbox)
+                .where(
+                    NotificationOutbox.status == PENDING,
+                    NotificationOutbox.available_at <= func.now(),
+                    or_(NotificationOutbox.locked_until.is_(None),
+                        NotificationOutbox.locked_until < func.now())
+                )
+                .order_by(NotificationOutbox.priority, NotificationOutbox.available_at, NotificationOutbox.id)
+                .limit(self.settings.notification_batch_size)
+                .with_for_update(skip_locked=True)
+            )).scalars().all()
+            if not rows:
+                return []
+            await db.execute(
+                update(NotificationOutbox)
+                .where(NotificationOutbox.id.in_([row.id for row in rows]))
+                .values(locked_until=datetime.now(timezone.utc) + CLAIM_LEASE)
+            )
+            await db.commit()
+            return [
+                OutboxMessage(row.id, row.telegram_id, row.text, row.parse_mode,
+                              row.reply_markup, row.attempts)
+                for row in rows
+            ]
+
+    async def _send_batch(self, batch: List[OutboxMessage]) -> None:
+        """Чаты - параллельно, сообщения одного чата - по порядку; итоги - одним запросом"""
+        from services.notification_service import notification_service
+
+        bot_token = await notification_service._get_bot_token()
+        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
+        by_chat: Dict[int, List[OutboxMessage]] = {}
+        for message in batch:
+            by_chat.setdefault(message.telegram_id, []).append(message)
+
+        semaphore = asyncio.Semaphore(self.settings.notification_sender_concurrency)
+        results: List[Dict[str, Any]] = []
+
+        async def send_chat(messages: List[OutboxMessage]) -> None:
+            for message in messages:
+                results.append(await self._deliver(url, message, semaphore))
+
+        await asyncio.gather(*(send_chat(messages) for messages in by_chat.values()))
+        async with async_session_maker() as db:
+            await db.execute(update(NotificationOutbox), results)
+            await db.commit()
+        self._prune_chat_buckets()
+
+    async def _wait_for_slot(self, telegram_id: int) -> None:
+        bucket = self._chat_buckets.get(telegram_id)
+        if bucket is None:
+            bucket = TokenBucket(self.settings.notification_per_chat_rate, 1)
+            self._chat_buckets[telegram_id] = bucket
+        await asyncio.sleep(bucket.reserve())
+        await asyncio.sleep(max(0.0, self._paused_until - time.monotonic()))
+        await asyncio.sleep(self._global_bucket.reserve())
+
+    async def _deliver(self, url: str, message: OutboxMessage,
+                       semaphore: asyncio.Semaphore) -> Dict[str, Any]:
+        """Отправить одно сообщение; строка для bulk UPDATE с его итогом"""
+        await self._wait_for_slot(message.telegram_id)
+        async with semaphore:
+            status, retry_after, error = await self._post(url, message)
+
+        now = datetime.now(timezone.utc)
+        row = {
+            "id": message.id,
+            "status": PENDING,
+            "attempts": message.attempts + 1,
+            "available_at": now,
+            "locked_until": None,
+            "last_error": error,
+            "sent_at": None
+        }
+        if status == SENT:
+            row.update(status=SENT, sent_at=now)
+            self.sent += 1
+            self._sent_times.append(time.monotonic())
+        elif retry_after is not None:
+            # 429 - не ошибка сообщения: попытку не считаем
+            row.update(attempts=message.attempts, available_at=now + timedelta(seconds=retry_after))
+            self.rate_limited += 1
+        elif status == FAILED or row["attempts"] >= self.settings.notification_max_attempts:
+            row.update(status=FAILED)
+            self.failed += 1
+            logger.warning("Notification dropped", telegram_id=message.telegram_id, error=error)
+        else:
+            row.update(available_at=now + timedelta(seconds=min(30 * 2 ** message.attempts, 3600)))
+            self.retried += 1
+        return row
+
+    async def _post(self, url: str, message: OutboxMessage) -> Tuple[str, Optional[int], Optional[str]]:
+        """(sent / failed / pending, retry_after, ошибка)"""
+        payload = {
+            "chat_id": message.telegram_id,
+            "text": message.text,
+            "disable_web_page_preview": True
+        }
+        if message.parse_mode:
+            payload["parse_mode"] = message.parse_mode
+        if message.reply_markup:
+            payload["reply_markup"] = message.reply_markup
+
+        try:
+            async with self._session.post(url, json=payload) as response:
+                if response.status == 200:
+                    return SENT, None, None
+                body = await response.json(content_type=None)
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+            return PENDING, None, str(e) or e.__class__.__name__
+
+        error = f"{response.status}: {body.get('description') if isinstance(body, dict) else body}"
+        if response.status == 429:
+            retry_after = int((body.get("parameters") or {}).get("retry_after", 1))
+            # Лимит бота: притормаживаем всю отправку, а не только этот чат
+            self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+            logger.warning("Telegram rate limit hit", telegram_id=message.telegram_id, retry_after=retry_after)
+            return PENDING, retry_after, error
+        if 400 <= response.status < 500:
+            # Чат не найден, бот заблокирован, неверная разметка - повтор не поможет
+            return FAILED, None, error
+        return PENDING, None, error
+
+    def _prune_chat_buckets(self) -> None:
+        if len(self._chat_buckets) > 10000:
+            self._chat_buckets = {
+                chat_id: bucket for chat_id, bucket in self._chat_buckets.items() if not bucket.is_idle()
+            }
+
+    # Обслуживание и метрики
+
+    async def prune(self, retention_days: int) -> Dict[str, Any]:
+        """Удалить отправленные и окончательно неотправленные сообщения старше retention_days"""
+        async with async_session_maker() as db:
+            result = await db.execute(
+                delete(NotificationOutbox).where(
+                    NotificationOutbox.status.in_((SENT, FAILED)),
+                    NotificationOutbox.created_at < datetime.now(timezone.utc) - timedelta(days=retention_days)
+                )
+            )
+            await db.commit()
+        return {"deleted": result.rowcount, **await self.get_depth()}
+
+    async def get_depth(self) -> Dict[str, Any]:
+        """Глубина очереди: ожидающие по приоритетам и окончательно неотправленные"""
+        async with async_session_maker() as db:
+            rows = (await db.execute(
+                select(NotificationOutbox.status, NotificationOutbox.priority, func.count())
+                .where(NotificationOutbox.status.in_((PENDING, FAILED)))
+                .group_by(NotificationOutbox.status, NotificationOutbox.priority)
+            )).all()
+        pending = {str(priority): count for status, priority, count in rows if status == PENDING}
+        return {
+            "pending": sum(pending.values()),
+            "pending_by_priority": pending,
+            "failed": sum(count for status, _, count in rows if status == FAILED)
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        cutoff = time.monotonic() - RATE_WINDOW
+        while self._sent_times and self._sent_times[0] < cutoff:
+            self._sent_times.popleft()
+        return {
+            "sending": self._worker is not None and self._may_send(),
+            "enqueued": self.enqueued,
+            "deduplicated": self.deduplicated,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "rate_limited": self.rate_limited,
+            "send_rate_per_second": round(len(self._sent_times) / RATE_WINDOW, 2),
+            "paused_for_seconds": round(max(0.0, self._paused_until - time.monotonic()), 1),
+            "rate_per_second": self.settings.notification_rate_per_second,
+            "per_chat_rate": self.settings.notification_per_chat_rate
+        }
+
+
+# Глобальная очередь уведомлений (одна на процесс)
+notification_outbox = NotificationOutboxService()
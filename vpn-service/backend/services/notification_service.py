@@ -1,10 +1,10 @@
-import asyncio
-import aiohttp
-from typing import Optional, Dict, Any
+from typing import Optional
 import structlog
 from datetime import datetime
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config.settings import get_settings
+from services.notification_outbox import notification_outbox, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
 
 logger = structlog.get_logger(__name__)
 
@@ -55,7 +55,7 @@ class NotificationService:
 Спасибо за покупку! 🙏
 """
             
-            await self._send_telegram_message(telegram_id, message)
+            await self._send_telegram_message(telegram_id, message, PRIORITY_HIGH)
             
             logger.info("Payment success notification sent", 
                        telegram_id=telegram_id,
@@ -97,7 +97,7 @@ class NotificationService:
 🔄 Попробовать оплатить снова: /start
 """
             
-            await self._send_telegram_message(telegram_id, message)
+            await self._send_telegram_message(telegram_id, message, PRIORITY_HIGH)
             
             logger.info("Payment failed notification sent", 
                        telegram_id=telegram_id,
@@ -145,7 +145,7 @@ class NotificationService:
 💳 Продлить подписку: /start
 """
             
-            await self._send_telegram_message(telegram_id, message)
+            await self._send_telegram_message(telegram_id, message, PRIORITY_LOW)
             
             logger.info("Subscription expiring notification sent", 
                        telegram_id=telegram_id,
@@ -237,37 +237,39 @@ class NotificationService:
                         telegram_id=telegram_id,
                         error=str(e))
     
-    async def _send_telegram_message(self, telegram_id: int, message: str):
-        """Отправка сообщения через Telegram Bot API"""
-        bot_token = await self._get_bot_token()
-        if not bot_token:
-            logger.warning("Bot token not configured, skipping notification")
-            return
-        
-        url = f"https://api.telegram.org/bot{bot_token}/sendMessage"
-        
-        payload = {
-            "chat_id": telegram_id,
-            "text": message,
-            "parse_mode": "HTML",
-            "disable_web_page_preview": True
-        }
-        
-        try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=payload, timeout=30) as response:
-                    if response.status == 200:
-                        logger.debug("Telegram message sent successfully", telegram_id=telegram_id)
-                    else:
-                        response_text = await response.text()
-                        logger.error("Failed to send Telegram message", 
-                                   telegram_id=telegram_id,
-                                   status=response.status,
-                                   response=response_text)
-        except Exception as e:
-            logger.error("Error sending Telegram message", 
-                        telegram_id=telegram_id,
-                        error=str(e))
+    async def queue_vpn_key_moved_notification(
+        self,
+        db: AsyncSession,
+        telegram_id: int,
+        vpn_key_name: Optional[str],
+        server_location: str,
+        vless_url: str
+    ) -> bool:
+        """
+        Уведомление о переносе ключа на другой сервер: пишется в outbox в транзакции
+        вызывающего и уходит только вместе с переносом (False - такое уже в очереди)
+        """
+        message = f"""
+🔄 <b>VPN ключ перенесен на другой сервер</b>
+
+🔐 <b>Ключ:</b> {vpn_key_name or "VPN"}
+🌍 <b>Сервер:</b> {server_location}
+
+Прежний сервер недоступен, поэтому мы перенесли ваш ключ.
+Импортируйте новую конфигурацию в приложение:
+
+<code>{vless_url}</code>
+
+Также ее можно получить в разделе "🔐 Мой VPN"
+"""
+        return await notification_outbox.add(db, telegram_id, message)
+    
+    async def _send_telegram_message(self, telegram_id: int, message: str,
+                                     priority: int = PRIORITY_NORMAL) -> bool:
+        """Постановка сообщения в outbox; отправляет фоновый воркер с лимитами Bot API"""
+        return await notification_outbox.send(telegram_id, message, priority)
+
 
 # Создаем глобальный экземпляр сервиса
-notification_service = NotificationService() 
\ No newline at end of file
+notification_service = NotificationService()
+ 
\ No newline at end of file
@@ -1,119 +1,321 @@
 """
 Payment Scheduler Service
 Обработка автоплатежей по расписанию
+
+Строки, которые пора списать, захватываются пачками (SELECT ... FOR UPDATE SKIP LOCKED) и
+получают аренду: next_payment_date сдвигается на autopay_claim_lease, так что параллельный
+прогон или другой воркер их не возьмет. Для каждой строки заводится попытка
+(PaymentRetryAttempt) и ожидающий Payment; id платежа - ключ идемпотентности, он уходит
+в Robokassa как InvoiceID. Если прогон упал или исход запроса неизвестен (сеть, таймаут,
+5xx), попытка остается открытой и повторяется с тем же InvoiceID только после проверки
+статуса счета; новый счет заводится лишь после окончательного отказа шлюза, поэтому
+двойного списания не будет. Списания идут параллельно с ограничением частоты запросов к провайдеру,
+конфигурация провайдера и HTTP-сессия создаются один раз на прогон
 """
 
+import asyncio
+import time
 import structlog
-from typing import Optional, List, Dict, Any
+import aiohttp
+from typing import Optional, List, Dict, Any, Tuple
 from datetime import datetime, timedelta
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_, or_
 from sqlalchemy.sql import func
 
-from models.auto_payment import AutoPayment
+from config.database import async_session_maker
+from config.settings import get_settings
+from models.auto_payment import AutoPayment, AutoPaymentStatus
 from models.payment import Payment, PaymentStatus, PaymentMethod
-from models.payment_retry_attempt import PaymentRetryAttempt
+from models.payment_provider import PaymentProvider, PaymentProviderType
+from models.payment_retry_attempt import PaymentRetryAttempt, RetryResult
 from models.subscription import Subscription
 from models.user import User
 from services.robokassa_service import RobokassaService
 from services.subscription_service import SubscriptionService
-from services.notification_service import notification_service
+from services.notification_outbox import notification_outbox, PRIORITY_HIGH
 
 logger = structlog.get_logger(__name__)
 
+# Через сколько сверять попытку с неизвестным исходом (сеть, таймаут, 5xx)
+UNRESOLVED_RECHECK_INTERVAL = timedelta(hours=1)
+
+
+class ProviderRateLimiter:
+    """Не чаще rate_per_second запросов к одному провайдеру (общий для всех задач прогона)"""
+
+    def __init__(self, rate_per_second: float):
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0.0
+        self._next_slot = 0.0
+        self._lock = asyncio.Lock()
+
+    async def wait(self) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + self.interval
+        if delay > 0:
+            await asyncio.sleep(delay)
+
 
 class PaymentSchedulerService:
     """Сервис для обработки автоплатежей по расписанию"""
     
     def __init__(self, db: AsyncSession):
         self.db = db
+        self.settings = get_settings()
+        # Кэш на прогон: провайдер -> (id провайдера, сервис), лимитеры по id провайдера
+        self._providers: Dict[PaymentProviderType, Optional[Tuple[int, RobokassaService]]] = {}
+        self._limiters: Dict[int, ProviderRateLimiter] = {}
     
-    async def process_due_autopayments(self):
+    async def process_due_autopayments(self) -> Dict[str, Any]:
         """Обработка автоплатежей, которые пора выполнить"""
-        
-        # Находим автоплатежи, которые пора выполнить
-        due_autopayments = await self._get_due_autopayments()
-        
-        logger.info(f"🔄 Найдено {len(due_autopayments)} автоплатежей для обработки")
-        
-        for autopay in due_autopayments:
-            try:
-                await self._process_single_autopayment(autopay)
-            except Exception as e:
-                logger.error(f"❌ Ошибка обработки автоплатежа {autopay.id}: {e}")
+        stats = {"claimed": 0, "succeeded": 0, "failed": 0, "pending": 0, "errors": 0}
+        
+        provider = await self._get_provider(PaymentProviderType.robokassa)
+        if not provider:
+            # Строки не захватываем: отсутствие провайдера - не ошибка оплаты пользователя
+            logger.error("❌ Robokassa провайдер не найден, автоплатежи пропущены")
+            return stats
+        provider_id, robokassa_service = provider
+        limiter = self._limiters.setdefault(
+            provider_id, ProviderRateLimiter(self.settings.autopay_provider_rate_per_second)
+        )
+        semaphore = asyncio.Semaphore(self.settings.autopay_concurrency)
+        
+        # Одна HTTP-сессия к провайдеру на весь прогон
+        async with aiohttp.ClientSession() as http_session:
+            while True:
+                claims = await self._claim_due_autopayments(self.settings.autopay_claim_batch_size)
+                if not claims:
+                    break
+                stats["claimed"] += len(claims)
+                logger.info(f"🔄 Захвачено {len(claims)} автоплатежей для обработки")
+                
+                outcomes = await asyncio.gather(*(
+                    self._process_claim(autopay_id, attempt_id, robokassa_service,
+                                        limiter, semaphore, http_session)
+                    for autopay_id, attempt_id in claims
+                ))
+                for outcome in outcomes:
+                    stats[outcome] += 1
+        
+        logger.info("💳 Обработка автоплатежей завершена", **stats)
+        return stats
     
-    async def _get_due_autopayments(self) -> List[AutoPayment]:
-        """Получение автоплатежей, которые пора выполнить"""
-        
-        current_time = datetime.utcnow()
-        
-        result = await self.db.execute(
-            select(AutoPayment)
-            .where(
-                and_(
-                    AutoPayment.status == "active",
-                    AutoPayment.next_payment_date <= current_time
+    async def _get_provider(self, provider_type: PaymentProviderType) -> Optional[Tuple[int, RobokassaService]]:
+        """Активный провайдер и его сервис (конфигурация читается один раз на прогон)"""
+        if provider_type not in self._providers:
+            result = await self.db.execute(
+                select(PaymentProvider).where(
+                    PaymentProvider.provider_type == provider_type,
+                    PaymentProvider.is_active == True
+                ).order_by(PaymentProvider.priority.asc()).limit(1)
+            )
+            provider = result.scalar_one_or_none()
+            self._providers[provider_type] = (
+                (provider.id, RobokassaService(provider.get_robokassa_config())) if provider else None
+            )
+        return self._providers[provider_type]
+    
+    async def _claim_due_autopayments(self, limit: int) -> List[Tuple[int, int]]:
+        """
+        Захватить пачку автоплатежей, которые пора выполнить: [(auto_payment_id, attempt_id)]
+
+        Строки, заблокированные другим воркером, пропускаются (SKIP LOCKED); захваченные
+        получают аренду и попытку с ожидающим платежом - ключом идемпотентности
+        """
+        async with async_session_maker() as db:
+            current_time = datetime.utcnow()
+            result = await db.execute(
+                select(AutoPayment)
+                .where(
+                    and_(
+                        AutoPayment.status == AutoPaymentStatus.ACTIVE,
+                        AutoPayment.next_payment_date <= current_time
+                    )
                 )
+                .order_by(AutoPayment.next_payment_date)
+                .limit(limit)
+                .with_for_update(skip_locked=True)
             )
-        )
-        
-        return result.scalars().all()
+            autopayments = result.scalars().all()
+            if not autopayments:
+                return []
+            
+            # Незавершенные попытки прошлых прогонов повторяем с тем же ключом
+            pending_result = await db.execute(
+                select(PaymentRetryAttempt).where(
+                    PaymentRetryAttempt.auto_payment_id.in_([a.id for a in autopayments]),
+                    PaymentRetryAttempt.result == RetryResult.PENDING
+                )
+            )
+            pending = {attempt.auto_payment_id: attempt for attempt in pending_result.scalars().all()}
+            
+            claims = []
+            new_attempts = []
+            for autopay in autopayments:
+                attempt = pending.get(autopay.id)
+                if attempt is None:
+                    payment = Payment(
+                        user_id=autopay.user_id,
+                        subscription_id=autopay.subscription_id,
+                        amount=autopay.amount,
+                        currency=autopay.currency,
+                        status=PaymentStatus.PENDING,
+                        payment_method=PaymentMethod.robokassa,
+                        is_autopay_generated=True,
+                        autopay_attempt_number=(autopay.attempts_count or 0) + 1,
+                        autopay_parent_payment_id=autopay.payment_id,
+                        robokassa_recurring_id=autopay.robokassa_recurring_id,
+                        description="Автопродление подписки"
+                    )
+                    attempt = PaymentRetryAttempt(
+                        auto_payment_id=autopay.id,
+                        attempt_number=(autopay.attempts_count or 0) + 1,
+                        error_type="pending",
+                        scheduled_at=autopay.next_payment_date,
+                        result=RetryResult.PENDING
+                    )
+                    db.add(payment)
+                    db.add(attempt)
+                    new_attempts.append((payment, attempt))
+                autopay.next_payment_date = current_time + timedelta(seconds=self.settings.autopay_claim_lease)
+                claims.append((autopay, attempt))
+            
+            # id платежа - номер счета в Robokassa и ключ идемпотентности попытки
+            await db.flush()
+            for payment, attempt in new_attempts:
+                payment.robokassa_invoice_id = str(payment.id)
+                attempt.idempotency_key = str(payment.id)
+            await db.commit()
+            return [(autopay.id, attempt.id) for autopay, attempt in claims]
     
-    async def _process_single_autopayment(self, autopay: AutoPayment):
-        """Обработка одного автоплатежа"""
-        
-        logger.info(f"💳 Обработка автоплатежа {autopay.id} для пользователя {autopay.user_id}")
-        
-        # Получаем провайдера Robokassa
-        from services.payment_provider_service import get_payment_provider_service
-        provider_service = get_payment_provider_service(self.db)
-        robokassa_provider = await provider_service.get_default_provider("robokassa")
-        
-        if not robokassa_provider:
-            logger.error("❌ Robokassa провайдер не найден")
-            await self._handle_failed_autopayment(autopay, {"error": "Robokassa provider not found"})
-            return
+    async def _process_claim(
+        self,
+        autopay_id: int,
+        attempt_id: int,
+        robokassa_service: RobokassaService,
+        limiter: ProviderRateLimiter,
+        semaphore: asyncio.Semaphore,
+        http_session: aiohttp.ClientSession
+    ) -> str:
+        """Списание по одной захваченной строке в собственной сессии БД; итог для статистики"""
+        async with semaphore:
+            try:
+                async with async_session_maker() as db:
+                    autopay = await db.get(AutoPayment, autopay_id)
+                    attempt = await db.get(PaymentRetryAttempt, attempt_id)
+                    if autopay is None or attempt is None or attempt.result != RetryResult.PENDING:
+                        return "pending"
+                    worker = PaymentSchedulerService(db)
+                    return await worker._process_single_autopayment(
+                        autopay, attempt, robokassa_service, limiter, http_session
+                    )
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработки автоплатежа {autopay_id}: {e}")
+                return "errors"
+    
+    async def _process_single_autopayment(
+        self,
+        autopay: AutoPayment,
+        attempt: PaymentRetryAttempt,
+        robokassa_service: RobokassaService,
+        limiter: ProviderRateLimiter,
+        http_session: Optional[aiohttp.ClientSession] = None
+    ) -> str:
+        """Обработка одного автоплатежа по захваченной попытке"""
+        
+        logger.info(f"💳 Обработка автоплатежа {autopay.id} для пользователя {autopay.user_id}",
+                   idempotency_key=attempt.idempotency_key)
+        
+        if attempt.attempted_at is not None:
+            # Запрос по этой попытке уже уходил (сбой сети или прерванный прогон) -
+            # сначала спрашиваем статус счета; повторно отправляем только ненайденный счет
+            await limiter.wait()
+            status = await robokassa_service.check_payment_status(attempt.idempotency_key)
+            state = status.get("status")
+            if state == "paid":
+                await self._handle_successful_autopayment(autopay, attempt)
+                return "succeeded"
+            if state == "failed":
+                await self._handle_failed_autopayment(autopay, {
+                    'error': status.get('message'),
+                    'error_type': 'unknown_error',
+                    'raw_response': status.get('message')
+                }, attempt)
+                return "failed"
+            if state != "not_found":
+                # Счет еще обрабатывается или статус не получен - попытка остается открытой
+                await self._defer_unresolved_autopayment(autopay, attempt, status.get('message'))
+                return "pending"
+        
+        # Отмечаем отправку до запроса: после сбоя попытка будет сверена со статусом счета
+        attempt.attempted_at = datetime.utcnow()
+        await self.db.commit()
         
         # Выполняем списание через Robokassa Recurring API
-        robokassa_service = RobokassaService(robokassa_provider.config)
-        
-        recurring_result = await robokassa_service.create_recurring_subscription_with_logging(
-            auto_payment_id=autopay.id,
+        await limiter.wait()
+        recurring_result = await robokassa_service.charge_recurring(
             previous_invoice_id=autopay.robokassa_recurring_id,
             amount=float(autopay.amount),
-            description=f"Автопродление подписки (попытка {autopay.attempts_count + 1})"
+            description=f"Автопродление подписки (попытка {attempt.attempt_number})",
+            invoice_id=attempt.idempotency_key,
+            http_session=http_session
         )
         
         if recurring_result['success']:
             # Платеж успешен - продлеваем подписку
-            await self._handle_successful_autopayment(autopay)
-        else:
-            # Платеж неудачен - обрабатываем ошибку
-            await self._handle_failed_autopayment(autopay, recurring_result)
+            await self._handle_successful_autopayment(autopay, attempt)
+            return "succeeded"
+        
+        if recurring_result.get('ambiguous', True):
+            # Списание могло пройти: новый счет не открываем, пока статус этого не известен
+            await self._defer_unresolved_autopayment(autopay, attempt, recurring_result.get('error'))
+            return "pending"
+        
+        # Шлюз окончательно отказал - обрабатываем ошибку
+        await self._handle_failed_autopayment(autopay, recurring_result, attempt)
+        return "failed"
+    
+    async def _defer_unresolved_autopayment(self, autopay: AutoPayment, attempt: PaymentRetryAttempt,
+                                            error: Optional[str]):
+        """
+        Исход списания неизвестен: попытка и ее платеж остаются PENDING с тем же InvoiceID,
+        следующий захват сначала сверит статус счета
+        """
+        logger.warning(f"❓ Исход автоплатежа {autopay.id} неизвестен, счет {attempt.idempotency_key} "
+                       f"будет сверен повторно", error=error)
+        
+        recheck_at = datetime.utcnow() + UNRESOLVED_RECHECK_INTERVAL
+        attempt.error_message = error
+        attempt.next_attempt_at = recheck_at
+        autopay.last_attempt_date = datetime.utcnow()
+        autopay.last_error_type = 'technical_error'
+        autopay.next_payment_date = recheck_at
+        await self.db.commit()
     
-    async def _handle_successful_autopayment(self, autopay: AutoPayment):
+    async def _get_attempt_payment(self, attempt: PaymentRetryAttempt) -> Optional[Payment]:
+        result = await self.db.execute(
+            select(Payment).where(Payment.robokassa_invoice_id == attempt.idempotency_key)
+        )
+        return result.scalar_one_or_none()
+    
+    async def _handle_successful_autopayment(self, autopay: AutoPayment, attempt: PaymentRetryAttempt):
         """Обработка успешного автоплатежа"""
         
         logger.info(f"✅ Автоплатеж {autopay.id} успешно выполнен")
         
-        # Создаем запись платежа
-        payment = Payment(
-            user_id=autopay.user_id,
-            subscription_id=autopay.subscription_id,
-            amount=autopay.amount,
-            currency=autopay.currency,
-            status=PaymentStatus.SUCCEEDED,
-            payment_method=PaymentMethod.robokassa,
-            is_autopay_generated=True,
-            autopay_attempt_number=autopay.attempts_count + 1,
-            autopay_parent_payment_id=autopay.payment_id,
-            robokassa_recurring_id=autopay.robokassa_recurring_id,
-            description=f"Автопродление подписки",
-            paid_at=datetime.utcnow(),
-            processed_at=datetime.utcnow()
-        )
+        # Платеж попытки (создан при захвате) становится успешным
+        payment = await self._get_attempt_payment(attempt)
+        if payment:
+            payment.status = PaymentStatus.SUCCEEDED
+            payment.paid_at = payment.paid_at or datetime.utcnow()
+            payment.processed_at = datetime.utcnow()
         
-        self.db.add(payment)
+        attempt.result = RetryResult.SUCCESS
+        attempt.error_type = "none"
+        attempt.completed_at = datetime.utcnow()
         
         # Продлеваем подписку пользователя
         subscription_service = SubscriptionService(self.db)
@@ -130,13 +332,11 @@ class PaymentSchedulerService:
         await self.db.commit()
         
         # Отправляем уведомление об успешном продлении
-        await notification_service.send_notification(
-            user_id=autopay.user_id,
-            message=(
-                f"✅ Подписка продлена автоматически!\n\n"
-                f"💰 Списано: {autopay.amount}₽\n"
-                f"📅 Следующее списание: {autopay.next_payment_date.strftime('%d.%m.%Y')}"
-            )
+        await self._notify_user(
+            autopay.user_id,
+            f"✅ Подписка продлена автоматически!\n\n"
+            f"💰 Списано: {autopay.amount}₽\n"
+            f"📅 Следующее списание: {autopay.next_payment_date.strftime('%d.%m.%Y')}"
         )
         
         # НОВОЕ: Автоматически обновляем меню пользователя после успешного автоплатежа
@@ -158,10 +358,11 @@ class PaymentSchedulerService:
                        error=str(menu_error))
             # Не прерываем основной процесс из-за ошибки обновления меню
     
-    async def _handle_failed_autopayment(self, autopay: AutoPayment, error_result: Dict[str, Any]):
+    async def _handle_failed_autopayment(self, autopay: AutoPayment, error_result: Dict[str, Any],
+                                         attempt: PaymentRetryAttempt):
         """Обработка неудачного автоплатежа"""
         
-        autopay.attempts_count += 1
+        autopay.attempts_count = (autopay.attempts_count or 0) + 1
         autopay.last_attempt_date = datetime.utcnow()
         
         logger.warning(
@@ -171,24 +372,26 @@ class PaymentSchedulerService:
         
         # Классифицируем ошибку
         error_type = error_result.get('error_type', 'unknown_error')
+        autopay.last_error_type = error_type
         
-        # Создаем запись о попытке
-        retry_attempt = PaymentRetryAttempt(
-            auto_payment_id=autopay.id,
-            attempt_number=autopay.attempts_count,
-            error_type=error_type,
-            error_message=error_result.get('error'),
-            robokassa_response=error_result.get('raw_response'),
-            scheduled_at=autopay.next_payment_date,
-            attempted_at=datetime.utcnow(),
-            result='failed'
-        )
+        # Завершаем попытку, захваченную при старте
+        attempt.error_type = error_type
+        attempt.error_message = error_result.get('error')
+        attempt.robokassa_response = error_result.get('raw_response') or error_result.get('error')
+        attempt.completed_at = datetime.utcnow()
+        attempt.result = RetryResult.FAILED
+        
+        payment = await self._get_attempt_payment(attempt)
+        if payment:
+            payment.status = PaymentStatus.FAILED
+            payment.failure_reason = error_result.get('error')
+            payment.processed_at = datetime.utcnow()
         
         # Определяем следующую попытку
         next_attempt = self._calculate_next_attempt(error_type, autopay.attempts_count)
         
         if next_attempt:
-            retry_attempt.next_attempt_at = next_attempt
+            attempt.next_attempt_at = next_attempt
             autopay.next_payment_date = next_attempt
             
             # Отправляем уведомления в зависимости от попытки
@@ -196,12 +399,17 @@ class PaymentSchedulerService:
             
         else:
             # Все попытки исчерпаны
-            autopay.status = 'failed'
+            autopay.status = AutoPaymentStatus.FAILED
             await self._handle_max_attempts_reached(autopay)
         
-        self.db.add(retry_attempt)
         await self.db.commit()
     
+    async def _notify_user(self, user_id: int, message: str) -> None:
+        """Уведомление пользователя через outbox Telegram (не блокирует списания)"""
+        telegram_id = await self.db.scalar(select(User.telegram_id).where(User.id == user_id))
+        if telegram_id:
+            await notification_outbox.send(telegram_id, message, PRIORITY_HIGH)
+    
     def _calculate_next_attempt(self, error_type: str, attempt_number: int) -> Optional[datetime]:
         """Вычисление времени следующей попытки"""
         
@@ -262,10 +470,7 @@ class PaymentSchedulerService:
                 "🎯 Продлите подписку вручную, чтобы не потерять доступ"
             )
         
-        await notification_service.send_notification(
-            user_id=autopay.user_id,
-            message=message
-        )
+        await self._notify_user(autopay.user_id, message)
     
     def _get_error_reason_text(self, error_type: str) -> str:
         """Получение текста причины ошибки"""
@@ -285,11 +490,9 @@ class PaymentSchedulerService:
         logger.error(f"❌ Все попытки автоплатежа {autopay.id} исчерпаны")
         
         # Отправляем финальное уведомление
-        await notification_service.send_notification(
-            user_id=autopay.user_id,
-            message=(
-                "❌ Автоплатеж отключен\n\n"
-                "Не удалось автоматически продлить подписку после нескольких попыток.\n"
-                "Продлите подписку вручную в разделе 'Подписка'"
-            )
+        await self._notify_user(
+            autopay.user_id,
+            "❌ Автоплатеж отключен\n\n"
+            "Не удалось автоматически продлить подписку после нескольких попыток.\n"
+            "Продлите подписку вручную в разделе 'Подписка'"
         ) 
\ No newline at end of file
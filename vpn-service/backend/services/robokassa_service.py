@@ -4,6 +4,7 @@
 """
 
 import hashlib
+import re
 import hmac
 import logging
 from typing import Dict, Optional, Any
@@ -14,6 +15,9 @@ from datetime import datetime, timezone
 
 logger = logging.getLogger(__name__)
 
+# Ответы шлюза, после которых списание точно не прошло и можно открывать новый счет
+DEFINITIVE_DECLINES = ('insufficient_funds', 'card_issue', 'user_cancelled')
+
 class RobokassaService:
     """Сервис для работы с API Робокассы"""
     
@@ -88,7 +92,15 @@ class RobokassaService:
         # Для Recurring API Robokassa использует особый формат подписи
         # MerchantLogin:OutSum:PreviousInvoiceID:Password или MerchantLogin:ID:Password
         
-        if 'PreviousInvoiceID' in params:
+        if 'InvoiceID' in params:
+            # Списание с собственным номером счета: MerchantLogin:OutSum:InvoiceID:Password
+            signature_string = (
+                f"{params['MerchantLogin']}:"
+                f"{params['OutSum']}:"
+                f"{params['InvoiceID']}:"
+                f"{password}"
+            )
+        elif 'PreviousInvoiceID' in params:
             # Для создания recurring платежа
             signature_string = (
                 f"{params['MerchantLogin']}:"
@@ -276,6 +288,75 @@ class RobokassaService:
                         'status': 'failed'
                     }
     
+    async def charge_recurring(
+        self,
+        previous_invoice_id: str,
+        amount: float,
+        description: str,
+        invoice_id: str,
+        http_session: Optional[aiohttp.ClientSession] = None
+    ) -> Dict[str, Any]:
+        """
+        Повторное списание по сохраненной карте с заданным номером счета
+
+        invoice_id - ключ идемпотентности: Robokassa не проведет второй счет с тем же номером,
+        поэтому повтор попытки после сбоя не спишет деньги дважды
+        
+        Args:
+            previous_invoice_id: ID первого (материнского) платежа
+            amount: Сумма
+            description: Описание
+            invoice_id: Номер нового счета
+            http_session: Общая сессия прогона (иначе создается своя)
+            
+        Returns:
+            {'success', 'ambiguous', 'error', 'error_type', 'raw_response'};
+            ambiguous - исход неизвестен (сеть, таймаут, 5xx, нераспознанный ответ),
+            попытку нужно сверить через check_payment_status с тем же invoice_id
+        """
+        params = {
+            'MerchantLogin': self.shop_id,
+            'OutSum': str(amount),
+            'InvoiceID': invoice_id,
+            'PreviousInvoiceID': previous_invoice_id,
+            'Description': description
+        }
+        params['SignatureValue'] = self._generate_recurring_signature(params, self.password1)
+        
+        recurring_url = "https://auth.robokassa.ru/Merchant/Recurring"
+        
+        try:
+            if http_session is not None:
+                async with http_session.post(recurring_url, data=params) as response:
+                    http_status = response.status
+                    result = await response.text()
+            else:
+                async with aiohttp.ClientSession() as session:
+                    async with session.post(recurring_url, data=params) as response:
+                        http_status = response.status
+                        result = await response.text()
+        except Exception as e:
+            # Запрос мог дойти до Robokassa: исход неизвестен, пока не проверен статус счета
+            return {
+                'success': False,
+                'ambiguous': True,
+                'error': str(e) or e.__class__.__name__,
+                'error_type': 'technical_error',
+                'raw_response': None
+            }
+        
+        if "OK" in result:
+            return {'success': True, 'ambiguous': False, 'invoice_id': invoice_id, 'raw_response': result}
+        error_type = self._classify_robokassa_error(result)
+        return {
+            'success': False,
+            # Окончательный отказ - только распознанный ответ шлюза о карте или средствах
+            'ambiguous': http_status >= 500 or error_type not in DEFINITIVE_DECLINES,
+            'error': result,
+            'error_type': error_type,
+            'raw_response': result
+        }
+    
     async def cancel_recurring_subscription(self, recurring_id: str) -> Dict[str, Any]:
         """
         Отмена recurring подписки
@@ -604,14 +685,28 @@ class RobokassaService:
                 async with session.post(check_url, data=params) as response:
                     if response.status == 200:
                         result = await response.text()
+                        result_code = re.search(r"<Result>\s*<Code>(\d+)</Code>", result)
+                        state_code = re.search(r"<State>\s*<Code>(\d+)</Code>", result)
                         
                         # Простой парсинг XML ответа
-                        if "StateCode:100" in result:
+                        if result_code and result_code.group(1) == "3":
+                            # Счет с таким номером Robokassa не получала
+                            return {
+                                'status': 'not_found',
+                                'message': 'Invoice not found'
+                            }
+                        elif state_code and state_code.group(1) in ("10", "60"):
+                            # Отменен без оплаты или отклонен - окончательный отказ
+                            return {
+                                'status': 'failed',
+                                'message': f'Payment declined (state {state_code.group(1)})'
+                            }
+                        elif "StateCode:100" in result or (state_code and state_code.group(1) == "100"):
                             return {
                                 'status': 'paid',
                                 'message': 'Payment completed successfully'
                             }
-                        elif "StateCode:50" in result:
+                        elif "StateCode:50" in result or (state_code and state_code.group(1) in ("5", "50", "80")):
                             return {
                                 'status': 'pending',
                                 'message': 'Payment is being processed'
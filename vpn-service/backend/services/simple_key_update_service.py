@@ -42,6 +42,7 @@ class SimpleKeyUpdateService:
             # 2. Получаем ноду согласно назначению пользователя
             from models.vpn_node import VPNNode
             from models.user_server_assignment import UserServerAssignment
+            from services.node_registry import node_registry
             
             logger.info("🔍 Looking for user assignment", user_id=user.id, telegram_id=user.telegram_id)
             
@@ -56,26 +57,24 @@ class SimpleKeyUpdateService:
                        assignment_exists=assignment is not None,
                        assigned_node_id=assignment.node_id if assignment else None)
             
-            active_node = None
+            # Выбор ноды - по снимку node_registry, без запросов к БД
+            snapshot = await node_registry.get_snapshot()
+            selected_node = None
             
             if assignment and assignment.node_id:
                 logger.info("🔍 Checking assigned node", node_id=assignment.node_id)
                 
                 # Проверяем что назначенная нода активна
-                node_result = await session.execute(
-                    select(VPNNode).where(
-                        VPNNode.id == assignment.node_id,
-                        VPNNode.status == "active"
-                    )
-                )
-                active_node = node_result.scalar_one_or_none()
+                selected_node = snapshot.get(assignment.node_id)
+                if selected_node and selected_node.status != "active":
+                    selected_node = None
                 
-                if active_node:
+                if selected_node:
                     logger.info("✅ Using assigned node", 
                                user_id=user.id, 
                                node_id=assignment.node_id, 
-                               node_name=active_node.name,
-                               node_location=active_node.location)
+                               node_name=selected_node.name,
+                               node_location=selected_node.location)
                 else:
                     logger.warning("❌ Assigned node is not active, selecting fallback", 
                                   user_id=user.id, 
@@ -84,21 +83,20 @@ class SimpleKeyUpdateService:
                 logger.info("ℹ️ No assignment found, will use fallback", user_id=user.id)
             
             # Если нет назначения или назначенная нода неактивна, берем любую активную
-            if not active_node:
+            if not selected_node:
                 logger.info("🔄 Selecting fallback node", user_id=user.id)
                 
-                node_result = await session.execute(
-                    select(VPNNode).where(VPNNode.status == "active")
-                    .order_by(VPNNode.priority.desc())
-                    .limit(1)
-                )
-                active_node = node_result.scalar_one_or_none()
+                active_nodes = snapshot.select(status="active")
+                selected_node = active_nodes[0] if active_nodes else None
                 
                 logger.info("🆘 Using fallback node", 
                            user_id=user.id, 
-                           node_id=active_node.id if active_node else None,
-                           node_name=active_node.name if active_node else None,
-                           node_location=active_node.location if active_node else None)
+                           node_id=selected_node.id if selected_node else None,
+                           node_name=selected_node.name if selected_node else None,
+                           node_location=selected_node.location if selected_node else None)
+            
+            # Ниже нода изменяется (ключи Reality) - нужна ORM сущность сессии
+            active_node = await session.get(VPNNode, selected_node.id) if selected_node else None
             
             if not active_node:
                 return {"success": False, "error": "Нет доступных активных VPN нод"}
@@ -309,30 +307,42 @@ class SimpleKeyUpdateService:
                                email=unique_email, 
                                uuid=client_uuid)
                     
-                    # Создаем клиента в панели
-                    client_config = {
-                        "id": client_uuid,
-                        "email": unique_email,
-                        "limitIp": 2,
-                        "totalGB": 100 * 1024 * 1024 * 1024,  # 100GB
-                        "expiryTime": 0,  # Без ограничения времени
-                        "enable": True,
-                        "tgId": str(user.telegram_id),
-                        "subId": ""
-                    }
+                    # Запасной клиент из теплого пула ноды: включается одним updateClient
+                    from services.spare_client_pool import spare_client_pool
+                    claimed = await spare_client_pool.claim(
+                        session, active_node, user.telegram_id, unique_email,
+                        total_gb=100 * 1024 * 1024 * 1024  # 100GB
+                    )
+                    
+                    if claimed:
+                        client_uuid = claimed.client_id
+                        inbound_id = claimed.inbound_id
+                        vless_url = claimed.vless_url
+                    else:
+                        # Создаем клиента в панели
+                        client_config = {
+                            "id": client_uuid,
+                            "email": unique_email,
+                            "limitIp": 2,
+                            "totalGB": 100 * 1024 * 1024 * 1024,  # 100GB
+                            "expiryTime": 0,  # Без ограничения времени
+                            "enable": True,
+                            "tgId": str(user.telegram_id),
+                            "subId": ""
+                        }
                     
-                    client_result = await x3ui_client.create_client(inbound_id, client_config)
+                        client_result = await x3ui_client.create_client(inbound_id, client_config)
                     
-                    if not client_result or not client_result.get("success"):
-                        logger.error("❌ Не удалось создать нового клиента в панели")
-                        return {"success": False, "error": "Не удалось создать нового клиента в панели"}
+                        if not client_result or not client_result.get("success"):
+                            logger.error("❌ Не удалось создать нового клиента в панели")
+                            return {"success": False, "error": "Не удалось создать нового клиента в панели"}
                     
-                    # Получаем VLESS URL для нового клиента
-                    vless_url = await x3ui_client.generate_client_url(inbound_id, client_uuid)
+                        # Получаем VLESS URL для нового клиента
+                        vless_url = await x3ui_client.generate_client_url(inbound_id, client_uuid, node=active_node)
                     
-                    if not vless_url:
-                        logger.error("❌ Не удалось получить VLESS URL для нового клиента")
-                        return {"success": False, "error": "Не удалось получить VLESS URL для нового клиента"}
+                        if not vless_url:
+                            logger.error("❌ Не удалось получить VLESS URL для нового клиента")
+                            return {"success": False, "error": "Не удалось получить VLESS URL для нового клиента"}
                     
                     # Создаем новый ключ в БД (упрощенная архитектура)
                     new_key = VPNKey(
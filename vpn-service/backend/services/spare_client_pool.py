@@ -0,0 +1,252 @@
+"""
+Spare Client Pool - теплый пул отключенных клиентов на каждой ноде
+Клиенты заранее создаются в Reality inbound'е выключенными, их VLESS URL собирается сразу;
+выдача ключа забирает запасного (FOR UPDATE SKIP LOCKED), одним updateClient включает
+и переименовывает его - без addClient, без ожидания панели и сборки шаблона.
+Пул пополняется в фоне до верхней отметки, когда запасных становится меньше нижней
+"""
+
+import asyncio
+import uuid
+from dataclasses import dataclass
+from typing import Dict, Any, Optional, Set
+
+import structlog
+from sqlalchemy import select, func, insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.database import async_session_maker
+from config.settings import get_settings
+from models.spare_client import SpareClient
+from services.node_registry import node_registry, SELECTABLE_HEALTH
+from services.vless_url_builder import DEFAULT_FLOW, with_remark
+from services.x3ui_client import X3UIClient
+
+logger = structlog.get_logger(__name__)
+
+# Ключ advisory lock пополнения: база + id ноды (одно пополнение ноды на весь кластер)
+REFILL_LOCK_BASE = 0x5EA2E000
+
+# Префикс временного email запасного клиента (до выдачи пользователю)
+SPARE_EMAIL_PREFIX = "spare_"
+
+
+@dataclass
+class ClaimedClient:
+    """Выданный запасной клиент: уже включен в панели под email пользователя"""
+    client_id: str
+    email: str
+    inbound_id: int
+    vless_url: str
+
+
+class SpareClientPool:
+    """Процессный пул: выдача запасных клиентов и фоновое пополнение по нодам"""
+
+    def __init__(self):
+        self.settings = get_settings()
+        self._locks: Dict[int, asyncio.Lock] = {}
+        # Ссылки на фоновые задачи пополнения, чтобы их не собрал GC
+        self._refill_tasks: Dict[int, asyncio.Task] = {}
+        self._background: Set[asyncio.Task] = set()
+        self.claimed = 0
+        self.misses = 0
+        self.failed_claims = 0
+        self.created = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.settings.spare_pool_enabled and self.settings.spare_pool_high_watermark > 0
+
+    def _lock_for(self, node_id: int) -> asyncio.Lock:
+        if node_id not in self._locks:
+            self._locks[node_id] = asyncio.Lock()
+        return self._locks[node_id]
+
+    async def claim(
+        self,
+        db: AsyncSession,
+        node,
+        telegram_id: Any,
+        email: str,
+        limit_ip: int = 2,
+        total_gb: int = 0,
+        expiry_time: int = 0
+    ) -> Optional[ClaimedClient]:
+        """
+        Взять запасного клиента ноды и выдать его пользователю
+
+        Строка пула удаляется в сессии вызывающего - commit делается вместе с записью VPNKey.
+        None - пул пуст или панель не приняла обновление (вызывающий создает клиента обычным путем)
+        """
+        if not self.enabled:
+            return None
+
+        result = await db.execute(
+            select(SpareClient)
+            .where(SpareClient.node_id == node.id)
+            .order_by(SpareClient.id)
+            .limit(1)
+            .with_for_update(skip_locked=True)
+        )
+        spare = result.scalar_one_or_none()
+        self.schedule_refill(node.id)
+        if spare is None:
+            self.misses += 1
+            logger.info("Spare client pool is empty", node_id=node.id)
+            return None
+
+        x3ui_client = X3UIClient.from_node(node)
+        updated = await x3ui_client.update_client(spare.inbound_id, {
+            "id": spare.client_id,
+            "email": email,
+            "flow": DEFAULT_FLOW,
+            "limitIp": limit_ip,
+            "totalGB": total_gb,
+            "expiryTime": expiry_time,
+            "enable": True,
+            "tgId": str(telegram_id or ""),
+            "subId": ""
+        })
+        # Запасной в любом случае списывается: либо выдан, либо в панели его больше нет
+        await db.delete(spare)
+        if not updated:
+            self.failed_claims += 1
+            logger.warning("Spare client rejected by panel, discarded",
+                          node_id=node.id,
+                          client_id=spare.client_id)
+            return None
+
+        if node.public_key and spare.public_key != node.public_key:
+            # Ключ Reality ноды сменился после создания запасного - собираем URL заново
+            vless_url = await x3ui_client.generate_client_url(
+                spare.inbound_id, spare.client_id, node=node, email=email, verify=False
+            )
+        else:
+            vless_url = with_remark(spare.vless_url, email)
+        if not vless_url:
+            self.failed_claims += 1
+            return None
+
+        self.claimed += 1
+        logger.info("Spare client claimed",
+                   node_id=node.id,
+                   client_id=spare.client_id,
+                   email=email)
+        return ClaimedClient(spare.client_id, email, spare.inbound_id, vless_url)
+
+    def schedule_refill(self, node_id: int) -> None:
+        """Запустить пополнение ноды в фоне (не больше одной задачи на ноду)"""
+        task = self._refill_tasks.get(node_id)
+        if task is not None and not task.done():
+            return
+        task = asyncio.create_task(self._refill_quietly(node_id))
+        self._refill_tasks[node_id] = task
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _refill_quietly(self, node_id: int) -> None:
+        try:
+            await self.refill(node_id)
+        except Exception as e:
+            logger.error("Spare client refill failed", node_id=node_id, error=str(e))
+
+    async def refill(self, node_id: int) -> int:
+        """Дополнить пул ноды до верхней отметки, если запасных меньше нижней; число созданных"""
+        if not self.enabled:
+            return 0
+        async with self._lock_for(node_id):
+            async with async_session_maker() as db:
+                # Другой процесс уже пополняет эту ноду - не создаем лишних клиентов
+                locked = await db.scalar(select(func.pg_try_advisory_xact_lock(REFILL_LOCK_BASE + node_id)))
+                if not locked:
+                    return 0
+
+                available = await db.scalar(
+                    select(func.count()).select_from(SpareClient).where(SpareClient.node_id == node_id)
+                )
+                if available >= self.settings.spare_pool_low_watermark:
+                    return 0
+
+                node = (await node_registry.get_snapshot()).get(node_id)
+                if node is None or node.status != "active" or node.health_status not in SELECTABLE_HEALTH:
+                    return 0
+
+                x3ui_client = X3UIClient.from_node(node)
+                snapshot = await x3ui_client.get_inbound_snapshot()
+                inbound_id = snapshot.find_reality_inbound_id() if snapshot else None
+                if inbound_id is None:
+                    # Inbound создают обычные пути выдачи ключа; пул наполнится после этого
+                    logger.info("No Reality inbound for spare clients", node_id=node_id)
+                    return 0
+
+                configs = [
+                    {
+                        "id": str(uuid.uuid4()),
+                        "email": f"{SPARE_EMAIL_PREFIX}{node_id}_{uuid.uuid4().hex[:12]}",
+                        "enable": False,
+                        "limit_ip": 2
+                    }
+                    for _ in range(self.settings.spare_pool_high_watermark - available)
+                ]
+                results = await x3ui_client.create_clients_bulk(inbound_id, configs)
+
+                rows = []
+                for created in results:
+                    if not created.get("success"):
+                        continue
+                    vless_url = await x3ui_client.generate_client_url(
+                        inbound_id, created["client_id"], node=node, email=created["email"], verify=False
+                    )
+                    if vless_url:
+                        rows.append({
+                            "node_id": node_id,
+                            "inbound_id": inbound_id,
+                            "client_id": created["client_id"],
+                            "email": created["email"],
+                            "vless_url": vless_url,
+                            "public_key": node.public_key
+                        })
+                if rows:
+                    await db.execute(insert(SpareClient), rows)
+                await db.commit()
+
+            self.created += len(rows)
+            logger.info("Spare client pool refilled",
+                       node_id=node_id,
+                       created=len(rows),
+                       requested=len(configs),
+                       available=available + len(rows))
+            return len(rows)
+
+    async def maintain(self) -> Dict[int, int]:
+        """Проверить пулы всех выбираемых нод: {node_id: создано клиентов}"""
+        if not self.enabled:
+            return {}
+        snapshot = await node_registry.get_snapshot()
+        created = {}
+        for node in snapshot.select(health=SELECTABLE_HEALTH):
+            try:
+                count = await self.refill(node.id)
+            except Exception as e:
+                logger.error("Spare client refill failed", node_id=node.id, error=str(e))
+                continue
+            if count:
+                created[node.id] = count
+        return created
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "low_watermark": self.settings.spare_pool_low_watermark,
+            "high_watermark": self.settings.spare_pool_high_watermark,
+            "claimed": self.claimed,
+            "misses": self.misses,
+            "failed_claims": self.failed_claims,
+            "created": self.created,
+            "refills_running": sum(1 for task in self._refill_tasks.values() if not task.done())
+        }
+
+
+# Глобальный пул запасных клиентов (один на процесс)
+spare_client_pool = SpareClientPool()
@@ -0,0 +1,343 @@
+"""
+Subscription Event Engine - сроки подписок в памяти и срабатывание точно в срок
+Ближайшие сроки (окончание подписки, напоминания, списания автоплатежей) загружаются
+из БД на окно вперед в кучу с ленивой отменой; диспетчер спит до ближайшего срока.
+Изменения сроков в этом процессе применяются после commit'а (события сессии), изменения
+из других процессов подхватывает периодическая перезагрузка окна. В момент срабатывания
+состояние перепроверяется по БД, поэтому устаревшее событие ничего не делает.
+События обрабатывает только лидер задачи перезагрузки окна
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional, Set, Tuple
+
+import structlog
+from sqlalchemy import select, exists, event, inspect
+from sqlalchemy.orm import Session
+
+from config.database import async_session_maker
+from config.settings import get_settings
+from models.auto_payment import AutoPayment, AutoPaymentStatus
+from models.user import User
+from models.vpn_key import VPNKey
+from services.job_scheduler import job_scheduler
+from services.notification_service import NotificationService
+from services.payment_scheduler_service import PaymentSchedulerService
+from services.subscription_expiry_sweep import SubscriptionExpirySweep, ACTIVE_STATUSES
+
+logger = structlog.get_logger(__name__)
+
+# Задача планировщика, лидер которой обрабатывает события
+JOB_NAME = "subscription_events"
+
+EXPIRY = "expiry"
+REMINDER = "reminder"
+CHARGE = "charge"
+
+# (вид события, id сущности, дни до окончания для напоминаний / 0)
+EventKey = Tuple[str, int, int]
+
+
+def _aware(moment: datetime) -> datetime:
+    """Наивные даты в проекте - UTC"""
+    return moment if moment.tzinfo else moment.replace(tzinfo=timezone.utc)
+
+
+def parse_reminder_days(spec: str) -> List[int]:
+    """'3,1' -> [3, 1]"""
+    return sorted({int(part) for part in spec.split(",") if part.strip()}, reverse=True)
+
+
+class SubscriptionEventEngine:
+    """Процессная очередь сроков подписок с диспетчером"""
+
+    def __init__(self):
+        self.settings = get_settings()
+        self.window = timedelta(seconds=self.settings.subscription_events_window)
+        self.reminder_days = parse_reminder_days(self.settings.subscription_reminder_days)
+        # Куча (срок, порядковый номер, ключ); актуальный срок ключа - в _due,
+        # записи кучи, не совпадающие с ним, пропускаются при извлечении
+        self._heap: List[Tuple[float, int, EventKey]] = []
+        self._due: Dict[EventKey, float] = {}
+        self._seq = itertools.count()
+        self._window_end = 0.0
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        # Сработавшие события по видам; на вид - не больше одной задачи обработки
+        self._pending: Dict[str, Set[EventKey]] = {EXPIRY: set(), REMINDER: set(), CHARGE: set()}
+        self._handlers: Dict[str, asyncio.Task] = {}
+        self.fired: Dict[str, int] = {EXPIRY: 0, REMINDER: 0, CHARGE: 0}
+        self.dropped = 0
+        self.reloads = 0
+        self.last_reload_at: Optional[datetime] = None
+
+    # Очередь
+
+    def schedule(self, key: EventKey, due_at: Optional[datetime]) -> None:
+        """Поставить (или переставить) событие; None или срок за окном - отмена"""
+        if due_at is None:
+            self._due.pop(key, None)
+            return
+        due = _aware(due_at).timestamp()
+        if due > self._window_end:
+            # Дальше окна - событие подхватит следующая перезагрузка
+            self._due.pop(key, None)
+            return
+        if self._due.get(key) == due:
+            return
+        self._due[key] = due
+        heapq.heappush(self._heap, (due, next(self._seq), key))
+        if self._heap[0][2] == key and self._wakeup is not None:
+            self._wakeup.set()
+
+    def _pop_due(self, now: float) -> List[EventKey]:
+        fired = []
+        while self._heap and self._heap[0][0] <= now:
+            due, _, key = heapq.heappop(self._heap)
+            if self._due.get(key) != due:
+                continue
+            del self._due[key]
+            fired.append(key)
+        # Куча не разрастается от отмененных записей
+        if len(self._heap) > 2 * len(self._due) + 1024:
+            self._heap = [(due, next(self._seq), key) for key, due in self._due.items()]
+            heapq.heapify(self._heap)
+        return fired
+
+    # Изменения сроков
+
+    def apply_user(self, user_id: int, valid_until: Optional[datetime], is_active: bool) -> None:
+        """Срок подписки пользователя изменился: переставить окончание и напоминания"""
+        if not is_active:
+            valid_until = None
+        self.schedule((EXPIRY, user_id, 0), valid_until)
+        now = time.time()
+        for days in self.reminder_days:
+            remind_at = valid_until - timedelta(days=days) if valid_until else None
+            if remind_at is not None and _aware(remind_at).timestamp() <= now:
+                remind_at = None
+            self.schedule((REMINDER, user_id, days), remind_at)
+
+    def apply_autopay(self, autopay_id: int, next_payment_date: Optional[datetime], status: Any) -> None:
+        """Дата списания или статус автоплатежа изменились"""
+        active = status in (AutoPaymentStatus.ACTIVE, AutoPaymentStatus.ACTIVE.value)
+        self.schedule((CHARGE, autopay_id, 0), next_payment_date if active else None)
+
+    async def reload_window(self) -> Dict[str, Any]:
+        """Загрузить сроки на окно вперед (после рестарта и периодически)"""
+        now = datetime.now(timezone.utc)
+        window_end = now + self.window
+        async with async_session_maker() as db:
+            # Просроченные подписки с активными ключами тоже попадают в очередь и срабатывают сразу
+            has_active_keys = exists().where(
+                VPNKey.user_id == User.id, VPNKey.status.in_(ACTIVE_STATUSES)
+            )
+            expiries = (await db.execute(
+                select(User.id, User.valid_until).where(
+                    User.is_active == True,
+                    User.valid_until.isnot(None),
+                    User.valid_until <= window_end,
+                    (User.valid_until > now) | has_active_keys
+                )
+            )).all()
+
+            reminders = []
+            for days in self.reminder_days:
+                offset = timedelta(days=days)
+                rows = (await db.execute(
+                    select(User.id, User.valid_until).where(
+                        User.is_active == True,
+                        User.valid_until > now + offset,
+                        User.valid_until <= window_end + offset
+                    )
+                )).all()
+                reminders.extend((user_id, days, valid_until - offset) for user_id, valid_until in rows)
+
+            charges = (await db.execute(
+                select(AutoPayment.id, AutoPayment.next_payment_date).where(
+                    AutoPayment.status == AutoPaymentStatus.ACTIVE,
+                    AutoPayment.next_payment_date <= window_end
+                )
+            )).all()
+
+        self._heap = []
+        self._due = {}
+        self._window_end = window_end.timestamp()
+        for user_id, valid_until in expiries:
+            self.schedule((EXPIRY, user_id, 0), valid_until)
+        for user_id, days, remind_at in reminders:
+            self.schedule((REMINDER, user_id, days), remind_at)
+        for autopay_id, next_payment_date in charges:
+            self.schedule((CHARGE, autopay_id, 0), next_payment_date)
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+        self.reloads += 1
+        self.last_reload_at = now
+        stats = {"expiries": len(expiries), "reminders": len(reminders), "charges": len(charges)}
+        logger.info("Subscription events window loaded",
+                   window_end=window_end.isoformat(), **stats)
+        return stats
+
+    # Диспетчер
+
+    async def start(self) -> None:
+        if self._task is not None:
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._dispatch_loop())
+        logger.info("Subscription event engine started")
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        tasks = [self._task, *self._handlers.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._task = None
+        self._handlers.clear()
+        logger.info("Subscription event engine stopped")
+
+    async def _dispatch_loop(self) -> None:
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+            fired = self._pop_due(now)
+            if fired:
+                self._dispatch(fired)
+            delay = self._heap[0][0] - now if self._heap else self.window.total_seconds()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(delay, 0.0))
+            except asyncio.TimeoutError:
+                pass
+
+    def _dispatch(self, fired: List[EventKey]) -> None:
+        if not job_scheduler.is_leader(JOB_NAME):
+            # Обрабатывает только лидер; у него эти сроки есть в собственном окне
+            self.dropped += len(fired)
+            return
+        for key in fired:
+            self._pending[key[0]].add(key)
+        for kind, keys in self._pending.items():
+            task = self._handlers.get(kind)
+            if keys and (task is None or task.done()):
+                self._handlers[kind] = asyncio.create_task(self._drain(kind))
+
+    async def _drain(self, kind: str) -> None:
+        """Обработать накопившиеся события вида; пришедшие во время обработки - следующей пачкой"""
+        while self._pending[kind]:
+            keys = list(self._pending[kind])
+            self._pending[kind].clear()
+            try:
+                if kind == EXPIRY:
+                    await self._fire_expiries([key[1] for key in keys])
+                elif kind == REMINDER:
+                    await self._fire_reminders(keys)
+                else:
+                    await self._fire_charges()
+            except Exception as e:
+                logger.error("Subscription events failed", kind=kind, events=len(keys), error=str(e))
+            self.fired[kind] += len(keys)
+
+    async def _fire_expiries(self, user_ids: List[int]) -> None:
+        async with async_session_maker() as db:
+            report = await SubscriptionExpirySweep(db).deactivate_users(user_ids)
+        logger.info("Expired subscriptions deactivated",
+                   users=len(user_ids),
+                   keys=report.deactivated_keys,
+                   panel_failures=report.panel_failures)
+
+    async def _fire_reminders(self, keys: List[EventKey]) -> None:
+        async with async_session_maker() as db:
+            rows = (await db.execute(
+                select(User.id, User.telegram_id, User.valid_until, User.is_active)
+                .where(User.id.in_({key[1] for key in keys}))
+            )).all()
+        users = {row[0]: row for row in rows}
+        notification_service = NotificationService()
+        now = datetime.now(timezone.utc)
+        for _, user_id, days in keys:
+            user = users.get(user_id)
+            if user is None or not user[3] or user[2] is None:
+                continue
+            # Подписку продлили после постановки события - напоминание уже не к месту
+            if _aware(user[2]) - timedelta(days=days) > now + timedelta(minutes=1):
+                continue
+            await notification_service.send_subscription_expiring_notification(user[1], "VPN", days)
+
+    async def _fire_charges(self) -> None:
+        # Срабатывание только будит обработку: захват строк и идемпотентность - в PaymentSchedulerService
+        async with async_session_maker() as db:
+            await PaymentSchedulerService(db).process_due_autopayments()
+            await db.commit()
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "leader": job_scheduler.is_leader(JOB_NAME),
+            "scheduled": len(self._due),
+            "heap_size": len(self._heap),
+            "next_due_at": (datetime.fromtimestamp(min(self._due.values()), timezone.utc).isoformat()
+                            if self._due else None),
+            "window_seconds": int(self.window.total_seconds()),
+            "reminder_days": self.reminder_days,
+            "fired": dict(self.fired),
+            "dropped": self.dropped,
+            "reloads": self.reloads,
+            "last_reload_at": self.last_reload_at.isoformat() if self.last_reload_at else None
+        }
+
+
+# Глобальный движок событий подписок (один на процесс)
+subscription_event_engine = SubscriptionEventEngine()
+
+
+# Изменения сроков копятся в сессии и применяются только после commit'а
+
+_PENDING_CHANGES = "subscription_event_changes"
+
+
+def _stash(target, key: Tuple[str, int], values: Tuple[Any, ...]) -> None:
+    session = Session.object_session(target)
+    if session is not None:
+        session.info.setdefault(_PENDING_CHANGES, {})[key] = values
+
+
+def _changed(target, *attrs: str) -> bool:
+    state = inspect(target)
+    return any(state.attrs[attr].history.has_changes() for attr in attrs)
+
+
+@event.listens_for(User, "after_insert")
+@event.listens_for(User, "after_update")
+def _on_user_flush(mapper, connection, target) -> None:
+    if _changed(target, "valid_until", "is_active"):
+        _stash(target, ("user", target.id), (target.valid_until, bool(target.is_active)))
+
+
+@event.listens_for(AutoPayment, "after_insert")
+@event.listens_for(AutoPayment, "after_update")
+def _on_autopay_flush(mapper, connection, target) -> None:
+    if _changed(target, "next_payment_date", "status"):
+        _stash(target, ("autopay", target.id), (target.next_payment_date, target.status))
+
+
+@event.listens_for(Session, "after_commit")
+def _on_commit(session) -> None:
+    changes = session.info.pop(_PENDING_CHANGES, None)
+    if not changes:
+        return
+    for (entity, entity_id), (due_at, state) in changes.items():
+        if entity == "user":
+            subscription_event_engine.apply_user(entity_id, due_at, state)
+        else:
+            subscription_event_engine.apply_autopay(entity_id, due_at, state)
+
+
+@event.listens_for(Session, "after_rollback")
+def _on_rollback(session) -> None:
+    session.info.pop(_PENDING_CHANGES, None)
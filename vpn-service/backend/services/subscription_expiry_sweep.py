@@ -0,0 +1,273 @@
+"""
+Subscription Expiry Sweep - потоковая деактивация ключей с истекшей подпиской
+Активные ключи истекших пользователей читаются страницами по id (keyset), страница
+группируется по нодам и отключается в панелях пакетами (ноды - параллельно, с ограничением),
+статусы пишутся одним UPDATE на страницу вместе с курсором в job_checkpoints:
+прерванный прогон продолжается с последней закоммиченной страницы
+"""
+
+import asyncio
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Set, Tuple
+
+import structlog
+from sqlalchemy import select, update, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config.settings import get_settings
+from models.job_checkpoint import JobCheckpoint
+from models.user import User
+from models.vpn_key import VPNKey, VPNKeyStatus
+from services.node_registry import node_registry
+from services.x3ui_client import X3UIClient
+
+logger = structlog.get_logger(__name__)
+
+SWEEP_NAME = "subscription_expiry"
+ACTIVE_STATUSES = ("active", "ACTIVE", VPNKeyStatus.ACTIVE.value)
+# Сколько сообщений об ошибках возвращать в отчете (остальные только считаются)
+MAX_REPORTED_ERRORS = 100
+
+
+@dataclass
+class ExpiredKey:
+    """Минимум полей ключа, нужный для отключения в панели"""
+    id: int
+    user_id: int
+    node_id: int
+    xui_email: str
+
+
+@dataclass
+class SweepReport:
+    """Итог прогона (счетчики - только за этот запуск)"""
+    resumed: bool = False
+    pages: int = 0
+    processed_users: int = 0
+    deactivated_keys: int = 0
+    panel_failures: int = 0
+    duration_ms: int = 0
+    errors: List[str] = field(default_factory=list)
+
+    def add_error(self, message: str) -> None:
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append(message)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "resumed": self.resumed,
+            "pages": self.pages,
+            "processed_users": self.processed_users,
+            "deactivated_keys": self.deactivated_keys,
+            "panel_failures": self.panel_failures,
+            "duration_ms": self.duration_ms,
+            "errors": self.errors
+        }
+
+
+def _chunks(items: List[ExpiredKey], size: int) -> List[List[ExpiredKey]]:
+    return [items[i:i + size] for i in range(0, len(items), max(size, 1))]
+
+
+class SubscriptionExpirySweep:
+    """Проход по истекшим подпискам: keyset-страницы, пакеты по нодам, set-based UPDATE"""
+
+    def __init__(self, db_session: AsyncSession):
+        self.db = db_session
+        self.settings = get_settings()
+
+    async def _start(self) -> Tuple[int, datetime, bool]:
+        """Курсор и граница прогона: незавершенный прогон продолжается, иначе начинается новый"""
+        checkpoint = await self.db.get(JobCheckpoint, SWEEP_NAME)
+        if checkpoint is not None and checkpoint.is_running and checkpoint.cutoff is not None:
+            logger.info("Resuming subscription expiry sweep",
+                       cursor=checkpoint.cursor,
+                       cutoff=checkpoint.cutoff.isoformat(),
+                       processed=checkpoint.processed)
+            return checkpoint.cursor, checkpoint.cutoff, True
+
+        now = datetime.now(timezone.utc)
+        if checkpoint is None:
+            checkpoint = JobCheckpoint(name=SWEEP_NAME)
+            self.db.add(checkpoint)
+        checkpoint.cursor = 0
+        checkpoint.cutoff = now
+        checkpoint.processed = 0
+        checkpoint.failed = 0
+        checkpoint.started_at = now
+        checkpoint.finished_at = None
+        await self.db.commit()
+        return 0, now, False
+
+    async def _fetch_page(self, cutoff: datetime, cursor: int) -> List[ExpiredKey]:
+        """Следующая страница активных ключей пользователей, чья подписка истекла до cutoff"""
+        result = await self.db.execute(
+            select(VPNKey.id, VPNKey.user_id, VPNKey.node_id, VPNKey.xui_email)
+            .join(User, User.id == VPNKey.user_id)
+            .where(
+                VPNKey.id > cursor,
+                VPNKey.status.in_(ACTIVE_STATUSES),
+                User.valid_until.isnot(None),
+                User.valid_until < cutoff,
+                User.is_active == True
+            )
+            .order_by(VPNKey.id)
+            .limit(self.settings.expiry_sweep_page_size)
+        )
+        return [ExpiredKey(*row) for row in result.all()]
+
+    async def _disable_on_node(self, node, keys: List[ExpiredKey],
+                               semaphore: asyncio.Semaphore) -> Set[int]:
+        """
+        Отключить ключи одной ноды; id ключей, которые панель не отключила
+
+        Пакеты одной ноды идут последовательно: обновление переписывает inbound целиком,
+        и параллельные пакеты затирали бы друг друга
+        """
+        failed: Set[int] = set()
+        async with semaphore:
+            x3ui_client = X3UIClient.from_node(node)
+            for chunk in _chunks(keys, self.settings.expiry_sweep_batch_size):
+                try:
+                    results = await x3ui_client.set_clients_enabled([key.xui_email for key in chunk], False)
+                except Exception as e:
+                    logger.error("Error disabling expired keys on node",
+                                node_id=node.id,
+                                keys_count=len(chunk),
+                                error=str(e))
+                    results = {}
+                failed.update(key.id for key in chunk if not results.get(key.xui_email))
+        return failed
+
+    async def _disable_page(self, keys: List[ExpiredKey]) -> Set[int]:
+        """Отключить страницу ключей в панелях; id ключей, которые отключить не удалось"""
+        failed: Set[int] = set()
+        keys_by_node: Dict[int, List[ExpiredKey]] = {}
+        for key in keys:
+            if not key.node_id or not key.xui_email:
+                failed.add(key.id)
+                continue
+            keys_by_node.setdefault(key.node_id, []).append(key)
+
+        snapshot = await node_registry.get_snapshot()
+        semaphore = asyncio.Semaphore(self.settings.expiry_sweep_node_concurrency)
+        tasks = []
+        for node_id, node_keys in keys_by_node.items():
+            node = snapshot.get(node_id)
+            if node is None:
+                logger.warning("Node not found for expired keys", node_id=node_id, keys_count=len(node_keys))
+                failed.update(key.id for key in node_keys)
+                continue
+            tasks.append(self._disable_on_node(node, node_keys, semaphore))
+
+        for node_failed in await asyncio.gather(*tasks):
+            failed |= node_failed
+        return failed
+
+    async def _mark_suspended(self, key_ids: List[int]) -> None:
+        """Один UPDATE на набор ключей (commit - у вызывающего)"""
+        # Как и прежде, ключ помечается suspended даже если панель его не отключила
+        await self.db.execute(
+            update(VPNKey)
+            .where(VPNKey.id.in_(key_ids), VPNKey.status.in_(ACTIVE_STATUSES))
+            .values(status=VPNKeyStatus.SUSPENDED.value, updated_at=datetime.now(timezone.utc))
+        )
+
+    async def _commit_page(self, key_ids: List[int], cursor: int, failed_count: int) -> None:
+        """Статусы страницы и курсор - в одной транзакции"""
+        await self._mark_suspended(key_ids)
+        await self.db.execute(
+            update(JobCheckpoint)
+            .where(JobCheckpoint.name == SWEEP_NAME)
+            .values(
+                cursor=cursor,
+                processed=JobCheckpoint.processed + len(key_ids),
+                failed=JobCheckpoint.failed + failed_count
+            )
+        )
+        await self.db.commit()
+
+    async def deactivate_users(self, user_ids: List[int]) -> SweepReport:
+        """
+        Деактивировать ключи конкретных пользователей (без контрольной точки)
+
+        Подписка перепроверяется по БД: пользователи, успевшие продлиться, пропускаются
+        """
+        started = time.monotonic()
+        report = SweepReport()
+        if not user_ids:
+            return report
+        result = await self.db.execute(
+            select(VPNKey.id, VPNKey.user_id, VPNKey.node_id, VPNKey.xui_email)
+            .join(User, User.id == VPNKey.user_id)
+            .where(
+                VPNKey.user_id.in_(user_ids),
+                VPNKey.status.in_(ACTIVE_STATUSES),
+                User.valid_until.isnot(None),
+                User.valid_until < datetime.now(timezone.utc),
+                User.is_active == True
+            )
+            .order_by(VPNKey.id)
+        )
+        keys = [ExpiredKey(*row) for row in result.all()]
+        if keys:
+            failed = await self._disable_page(keys)
+            await self._mark_suspended([key.id for key in keys])
+            await self.db.commit()
+            report.pages = 1
+            report.deactivated_keys = len(keys)
+            report.panel_failures = len(failed)
+            report.processed_users = len({key.user_id for key in keys})
+        report.duration_ms = int((time.monotonic() - started) * 1000)
+        return report
+
+    async def run(self) -> SweepReport:
+        """Пройти все истекшие подписки (или продолжить прерванный прогон)"""
+        started = time.monotonic()
+        cursor, cutoff, resumed = await self._start()
+        report = SweepReport(resumed=resumed)
+        users: Set[int] = set()
+
+        while True:
+            keys = await self._fetch_page(cutoff, cursor)
+            if not keys:
+                break
+
+            failed = await self._disable_page(keys)
+            key_ids = [key.id for key in keys]
+            cursor = key_ids[-1]
+            await self._commit_page(key_ids, cursor, len(failed))
+
+            report.pages += 1
+            report.deactivated_keys += len(key_ids)
+            report.panel_failures += len(failed)
+            users.update(key.user_id for key in keys)
+            for key in keys:
+                if key.id in failed:
+                    report.add_error(f"Key {key.id}: 3xUI deactivation failed, but marked as suspended")
+
+            logger.info("Expiry sweep page processed",
+                       page=report.pages,
+                       cursor=cursor,
+                       keys=len(key_ids),
+                       panel_failures=len(failed))
+
+        await self.db.execute(
+            update(JobCheckpoint)
+            .where(JobCheckpoint.name == SWEEP_NAME)
+            .values(finished_at=func.now())
+        )
+        await self.db.commit()
+
+        report.processed_users = len(users)
+        report.duration_ms = int((time.monotonic() - started) * 1000)
+        logger.info("Subscription expiry sweep finished",
+                   resumed=report.resumed,
+                   pages=report.pages,
+                   users=report.processed_users,
+                   keys=report.deactivated_keys,
+                   panel_failures=report.panel_failures,
+                   duration_ms=report.duration_ms)
+        return report
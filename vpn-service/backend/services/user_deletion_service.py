@@ -19,6 +19,7 @@ from models.server_switch_log import ServerSwitchLog
 from models.auto_payment import AutoPayment
 from models.payment import Payment
 from services.x3ui_client import X3UIClient
+from services.node_capacity import NodeCapacity
 from pydantic import BaseModel
 
 logger = structlog.get_logger(__name__)
@@ -346,16 +347,10 @@ class UserDeletionService:
             
             # Создаем X3UI клиент для ноды
             try:
-                x3ui_client = X3UIClient(
-                    base_url=node.x3ui_url,
-                    username=node.x3ui_username,
-                    password=node.x3ui_password
-                )
+                x3ui_client = X3UIClient.from_node(node)
                 
-                # Удаляем каждый ключ
-                for key in node_keys:
-                    result = await self._delete_single_key_from_x3ui(x3ui_client, key, node.name)
-                    results.append(result)
+                # Удаляем ключи ноды пакетно (одна проверка панели до и после)
+                results.extend(await self._delete_node_keys_from_x3ui(x3ui_client, node_keys, node.name))
                     
             except Exception as e:
                 # Если не удалось подключиться к ноде
@@ -383,76 +378,43 @@ class UserDeletionService:
         
         return results
     
-    async def _delete_single_key_from_x3ui(
-        self, 
-        x3ui_client: X3UIClient, 
-        vpn_key: VPNKey, 
+    async def _delete_node_keys_from_x3ui(
+        self,
+        x3ui_client: X3UIClient,
+        vpn_keys: List[VPNKey],
         node_name: str
-    ) -> KeyDeletionResult:
-        """Удалить один VPN ключ из X3UI панели"""
-        try:
-            if not vpn_key.xui_client_id or not vpn_key.xui_inbound_id:
-                return KeyDeletionResult(
-                    vpn_key_id=vpn_key.id,
-                    node_name=node_name,
-                    x3ui_success=False,
-                    error_message="Отсутствует client_id или inbound_id",
-                    client_id=vpn_key.xui_client_id,
-                    inbound_id=vpn_key.xui_inbound_id
-                )
-            
-            self.logger.info(
-                "Deleting VPN key from X3UI",
-                vpn_key_id=vpn_key.id,
-                node_name=node_name,
-                client_id=vpn_key.xui_client_id,
-                inbound_id=vpn_key.xui_inbound_id
-            )
-            
-            success = await x3ui_client.delete_client(
-                vpn_key.xui_inbound_id, 
-                vpn_key.xui_client_id
-            )
-            
-            if success:
-                self.logger.info(
-                    "VPN key deleted from X3UI successfully",
-                    vpn_key_id=vpn_key.id,
-                    node_name=node_name
-                )
-                return KeyDeletionResult(
-                    vpn_key_id=vpn_key.id,
-                    node_name=node_name,
-                    x3ui_success=True,
-                    client_id=vpn_key.xui_client_id,
-                    inbound_id=vpn_key.xui_inbound_id
-                )
+    ) -> List[KeyDeletionResult]:
+        """Удалить ключи одной ноды из X3UI панели пакетно"""
+        deletable = [key for key in vpn_keys if key.xui_client_id and key.xui_inbound_id]
+        
+        self.logger.info(
+            "Deleting VPN keys from X3UI",
+            node_name=node_name,
+            keys_count=len(deletable)
+        )
+        
+        deleted = await x3ui_client.delete_clients_bulk(
+            [(key.xui_inbound_id, key.xui_client_id) for key in deletable]
+        )
+        
+        results = []
+        for key in vpn_keys:
+            if not key.xui_client_id or not key.xui_inbound_id:
+                error_message = "Отсутствует client_id или inbound_id"
+                success = False
             else:
-                return KeyDeletionResult(
-                    vpn_key_id=vpn_key.id,
-                    node_name=node_name,
-                    x3ui_success=False,
-                    error_message="X3UI API вернул ошибку при удалении",
-                    client_id=vpn_key.xui_client_id,
-                    inbound_id=vpn_key.xui_inbound_id
-                )
-                
-        except Exception as e:
-            self.logger.error(
-                "Error deleting VPN key from X3UI",
-                vpn_key_id=vpn_key.id,
-                node_name=node_name,
-                error=str(e),
-                exc_info=True
-            )
-            return KeyDeletionResult(
-                vpn_key_id=vpn_key.id,
+                success = deleted.get(key.xui_client_id, False)
+                error_message = None if success else "X3UI API вернул ошибку при удалении"
+            results.append(KeyDeletionResult(
+                vpn_key_id=key.id,
                 node_name=node_name,
-                x3ui_success=False,
-                error_message=f"Исключение при удалении: {str(e)}",
-                client_id=vpn_key.xui_client_id,
-                inbound_id=vpn_key.xui_inbound_id
-            )
+                x3ui_success=success,
+                error_message=error_message,
+                client_id=key.xui_client_id,
+                inbound_id=key.xui_inbound_id
+            ))
+        
+        return results
     
     async def _delete_user_data_from_db(self, user_id: int) -> None:
         """Удалить данные пользователя из БД транзакционно"""
@@ -475,9 +437,14 @@ class UserDeletionService:
             )
             self.logger.info("VPN keys deleted from database", user_id=user_id)
             
-            # 2. Удаляем назначения серверов
+            # 2. Освобождаем места на всех нодах пользователя (оба вида назначений;
+            #    user_node_assignments удалятся каскадом вместе с пользователем) и удаляем назначения
+            capacity = NodeCapacity(self.db)
+            for node_id in await capacity.placed_nodes(user_id):
+                await capacity.release(node_id)
             await self.db.execute(
-                delete(UserServerAssignment).where(UserServerAssignment.user_id == user_telegram_id)
+                delete(UserServerAssignment)
+                .where(UserServerAssignment.user_id == user_telegram_id)
             )
             self.logger.info("Server assignments deleted", user_id=user_id)
             
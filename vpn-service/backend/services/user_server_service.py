@@ -5,22 +5,38 @@ UserServerService - сервис для управления назначени
 
 import time
 from datetime import datetime, timedelta
-from typing import List, Optional, Dict, Any
-from dataclasses import dataclass
+from typing import List, Optional, Dict, Any, Set
+from dataclasses import dataclass, field
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select, and_, update, insert, delete
 from sqlalchemy.orm import selectinload
 
 from models.country import Country
+from models.user import User
 from models.vpn_node import VPNNode
 from models.user_server_assignment import UserServerAssignment
 from models.server_switch_log import ServerSwitchLog
 from services.country_service import CountryService
+from services.node_registry import node_registry, NodeView, SELECTABLE_HEALTH
+from services.node_capacity import NodeCapacity
+from services.node_scoring import score_nodes, ScoredNode, UserAffinity
+from services.node_hashing import is_rendezvous_mode, rank_available_hrw
 import structlog
 
 logger = structlog.get_logger(__name__)
 
 
+def rank_user_nodes(nodes: List[NodeView], hrw_key: Optional[int],
+                    affinity: UserAffinity) -> List[ScoredNode]:
+    """
+    Кандидаты для пользователя: при известном ключе HRW (users.id, липкий режим) - его
+    «домашняя» нода и далее по HRW, иначе - оценка с учетом истории пользователя
+    """
+    if hrw_key is not None:
+        return rank_available_hrw(hrw_key, nodes)
+    return score_nodes(nodes, affinity)
+
+
 @dataclass
 class NodeSelectionResult:
     """Результат выбора ноды"""
@@ -29,10 +45,14 @@ class NodeSelectionResult:
     error_message: Optional[str] = None
     fallback_used: bool = False
     processing_time_ms: int = 0
+    # Остальные кандидаты по убыванию оценки - для повторного выбора без пересчета
+    ranked_nodes: List[ScoredNode] = field(default_factory=list)
     
     @classmethod
-    def success_result(cls, node: VPNNode, processing_time_ms: int = 0) -> 'NodeSelectionResult':
-        return cls(success=True, node=node, processing_time_ms=processing_time_ms)
+    def success_result(cls, node: VPNNode, processing_time_ms: int = 0,
+                       ranked_nodes: Optional[List[ScoredNode]] = None) -> 'NodeSelectionResult':
+        return cls(success=True, node=node, processing_time_ms=processing_time_ms,
+                   ranked_nodes=ranked_nodes or [])
     
     @classmethod
     def fallback_result(cls, node: VPNNode, message: str, processing_time_ms: int = 0) -> 'NodeSelectionResult':
@@ -67,6 +87,10 @@ class UserServerService:
             logger.error("Failed to get user assignment", user_id=user_id, error=str(e))
             return None
     
+    async def _resolve_user_id(self, telegram_id: int) -> Optional[int]:
+        """users.id по Telegram ID (назначения на серверы хранят Telegram ID)"""
+        return await self.db.scalar(select(User.id).where(User.telegram_id == telegram_id))
+    
     async def assign_user_to_country(self, user_id: int, country_code: str) -> NodeSelectionResult:
         """Назначить пользователя на оптимальный сервер в указанной стране"""
         start_time = time.time()
@@ -80,11 +104,19 @@ class UserServerService:
             # Выбираем оптимальную ноду
             selection_result = await self.select_optimal_node(country_code, user_id)
             
-            if not selection_result.success:
-                return selection_result
-            
-            # Сохраняем назначение
-            await self._save_user_assignment(user_id, selection_result.node, country)
+            # Сохраняем назначение; если нода заполнилась после выбора - берем следующего кандидата
+            full_node_ids = set()
+            while True:
+                if not selection_result.success:
+                    return selection_result
+                if selection_result.node.id in full_node_ids:
+                    return NodeSelectionResult.error_result("No node capacity available")
+                if await self._save_user_assignment(user_id, selection_result.node, country):
+                    break
+                full_node_ids.add(selection_result.node.id)
+                selection_result = await self._retry_selection_without_node(
+                    country_code, user_id, full_node_ids, selection_result.ranked_nodes
+                )
             
             # Логируем переключение
             await self._log_server_switch(
@@ -140,188 +172,86 @@ class UserServerService:
             if not nodes:
                 return await self._handle_no_nodes_fallback(country_code, user_id)
             
-            # Phase 2: Вычисляем оценки и ранжируем ноды
-            scored_nodes = []
-            for node in nodes:
-                score = await self._calculate_enhanced_node_score(node, user_id)
-                if score > 0.3:  # Минимальный порог жизнеспособности
-                    scored_nodes.append((node, score))
+            # Phase 2: Ранжируем кандидатов
+            # Ключ HRW - users.id, как у балансировщика, эвакуации и ребалансировщика
+            hrw_key = await self._resolve_user_id(user_id) if is_rendezvous_mode() else None
+            # Липкий режим: «домашняя» нода пользователя по HRW, при смене набора нод переезжает минимум;
+            # иначе оцениваем всех кандидатов одним проходом (история пользователя - один раз)
+            affinity = UserAffinity() if hrw_key is not None else await self._load_user_affinity(user_id)
+            ranked_nodes = rank_user_nodes(nodes, hrw_key, affinity)
             
-            if not scored_nodes:
+            if not ranked_nodes:
                 return await self._handle_no_viable_nodes_fallback(country_code, user_id)
             
             # Phase 3: Выбираем лучший node
-            best_node = max(scored_nodes, key=lambda x: x[1])[0]
+            best_node = ranked_nodes[0].node
             
             # Phase 4: Проверяем доступность
             if await self._verify_node_availability(best_node):
-                return NodeSelectionResult.success_result(best_node)
+                return NodeSelectionResult.success_result(best_node, ranked_nodes=ranked_nodes[1:])
             else:
-                return await self._retry_selection_without_node(country_code, user_id, best_node.id)
+                return await self._retry_selection_without_node(
+                    country_code, user_id, {best_node.id}, ranked_nodes[1:]
+                )
                 
         except Exception as e:
             logger.error("Node selection failed", error=str(e), user_id=user_id, country=country_code)
             return await self._emergency_fallback_selection(user_id)
     
-    async def _get_healthy_nodes_by_country(self, country_id: int) -> List[VPNNode]:
-        """Получить здоровые ноды для страны"""
+    async def _get_healthy_nodes_by_country(self, country_id: int) -> List[NodeView]:
+        """Получить здоровые ноды для страны (из снимка node_registry, без запроса к БД)"""
         try:
-            query = select(VPNNode).where(
-                and_(
-                    VPNNode.country_id == country_id,
-                    VPNNode.status == "active",
-                    VPNNode.health_status.in_(["healthy", "unknown"])  # Unknown считаем работоспособным
-                )
-            ).order_by(VPNNode.priority.desc())
-            
-            result = await self.db.execute(query)
-            nodes = result.scalars().all()
-            
-            return list(nodes)
+            snapshot = await node_registry.get_snapshot()
+            # Unknown считаем работоспособным
+            return snapshot.select(country_id=country_id, status="active", health=SELECTABLE_HEALTH)
             
         except Exception as e:
             logger.error("Failed to get healthy nodes", country_id=country_id, error=str(e))
             return []
     
-    async def _calculate_enhanced_node_score(self, node: VPNNode, user_id: int) -> float:
-        """
-        Вычислить комплексную оценку ноды для выбора
-        Диапазон оценки: 0.0 (непригодный) до 1.0 (оптимальный)
-        """
+    async def _load_user_affinity(self, user_id: int) -> UserAffinity:
+        """Текущее назначение и последние успешные переключения пользователя (один раз на выбор)"""
         try:
-            # Health Check (Binary: 0.0 или 1.0)
-            health_ok = await self._check_node_health(node)
-            if not health_ok:
-                return 0.0
-            
-            # Capacity Score (0.0 до 1.0)
-            if node.current_users >= node.max_users:
-                return 0.0  # Нода на пределе capacity
-            
-            available_ratio = (node.max_users - node.current_users) / node.max_users
-            capacity_score = min(1.0, available_ratio * 1.2)  # Легкое предпочтение более доступным
-            
-            # Performance Score (0.0 до 1.0)
-            performance_score = await self._get_node_performance_score(node)
-            
-            # Priority Score (0.0 до 1.0)
-            priority_score = min(1.0, node.priority / 100.0)
-            
-            # User Affinity Score (0.0 до 1.0)
-            affinity_score = await self._get_user_affinity_score(user_id, node.id)
+            assignment = await self.get_user_current_assignment(user_id)
             
-            # Взвешенная комбинация (из креативной фазы)
-            final_score = (
-                capacity_score * 0.50 +      # Capacity самое важное для load balancing
-                performance_score * 0.30 +   # Performance влияет на пользовательский опыт
-                priority_score * 0.15 +      # Приоритет, определенный админом
-                affinity_score * 0.05        # Легкое предпочтение предыдущему серверу
+            history = await self.db.execute(
+                select(ServerSwitchLog.to_node_id)
+                .where(ServerSwitchLog.user_id == user_id)
+                .where(ServerSwitchLog.success == True)
+                .order_by(ServerSwitchLog.created_at.desc())
+                .limit(5)
             )
             
-            return final_score
-            
-        except Exception as e:
-            logger.error("Failed to calculate node score", node_id=node.id, error=str(e))
-            return 0.0
-    
-    async def _check_node_health(self, node: VPNNode) -> bool:
-        """Комплексная проверка здоровья ноды"""
-        try:
-            # Проверяем статус в БД
-            if node.health_status == 'unhealthy':
-                return False
-            
-            # Проверяем свежесть последней проверки здоровья
-            if node.last_health_check:
-                # ИСПРАВЛЕНИЕ: Используем timezone-aware datetime
-                from datetime import timezone
-                now = datetime.now(timezone.utc)
-                
-                # Убеждаемся что last_health_check тоже timezone-aware
-                last_check = node.last_health_check
-                if last_check.tzinfo is None:
-                    # Если timezone не указан, считаем что это UTC
-                    last_check = last_check.replace(tzinfo=timezone.utc)
-                
-                time_since_check = now - last_check
-                if time_since_check > timedelta(minutes=10):
-                    # Проверка здоровья слишком старая
-                    logger.warning("Health check too old", 
-                                 node_id=node.id, 
-                                 time_since=str(time_since_check),
-                                 last_check=last_check.isoformat())
-                    # Можно считать такую ноду менее надежной, но не полностью недоступной
-                    # TODO: Реализовать perform_live_health_check
-            
-            # Проверяем время отклика
-            if node.response_time_ms and node.response_time_ms > 5000:  # 5 секунд порог
-                logger.warning("Node response time too high", 
-                             node_id=node.id, 
-                             response_time=node.response_time_ms)
-                return False
-            
-            return True
+            return UserAffinity(
+                current_node_id=assignment.node_id if assignment else None,
+                recent_node_ids=frozenset(history.scalars().all())
+            )
             
         except Exception as e:
-            logger.warning("Health check failed", node_id=node.id, error=str(e))
-            return False
-    
-    async def _get_node_performance_score(self, node: VPNNode) -> float:
-        """Вычислить оценку производительности на основе времени отклика и нагрузки"""
-        try:
-            # Компонент времени отклика (0.0 до 1.0)
-            if not node.response_time_ms:
-                response_score = 0.5  # Неизвестно = нейтрально
-            else:
-                # Оптимально: <500ms = 1.0, Плохо: >3000ms = 0.1
-                if node.response_time_ms <= 500:
-                    response_score = 1.0
-                elif node.response_time_ms >= 3000:
-                    response_score = 0.1
-                else:
-                    # Линейная интерполяция между 500ms и 3000ms
-                    response_score = 1.0 - ((node.response_time_ms - 500) / 2500) * 0.9
-            
-            # Компонент нагрузки (0.0 до 1.0)
-            load_ratio = node.current_users / node.max_users if node.max_users > 0 else 0
-            load_score = max(0.1, 1.0 - load_ratio)  # Никогда не опускается ниже 0.1
-            
-            # Объединенная оценка производительности
-            performance_score = (response_score * 0.6 + load_score * 0.4)
-            
-            return max(0.0, min(1.0, performance_score))
-            
-        except Exception:
-            return 0.5  # Нейтральная оценка при ошибке
-    
-    async def _get_user_affinity_score(self, user_id: int, node_id: int) -> float:
-        """Вычислить оценку пользовательского соответствия ноде на основе истории"""
-        try:
-            # Проверяем, был ли пользователь ранее назначен на эту ноду
-            assignment = await self.get_user_current_assignment(user_id)
-            if assignment and assignment.node_id == node_id:
-                return 0.8  # Высокое предпочтение текущему серверу
-            
-            # TODO: Проверить исторические назначения когда будет реализована
-            # history = await self.get_user_server_history(user_id, limit=5)
-            
-            return 0.5  # Нейтрально - нет истории с этой нодой
-            
-        except Exception:
-            return 0.5  # Нейтрально при ошибке
+            logger.warning("Failed to load user affinity", user_id=user_id, error=str(e))
+            return UserAffinity()  # Нейтрально при ошибке
     
     async def _verify_node_availability(self, node: VPNNode) -> bool:
         """Проверить, что нода все еще доступна"""
         # Простая проверка - можно расширить
         return node.can_accept_users
     
-    async def _save_user_assignment(self, user_id: int, node: VPNNode, country: Country):
-        """Сохранить назначение пользователя на сервер"""
+    async def _save_user_assignment(self, user_id: int, node: VPNNode, country: Country) -> bool:
+        """
+        Сохранить назначение пользователя на сервер
+        Returns: False - на ноде не осталось мест (назначение не изменено)
+        """
         try:
             # ИСПРАВЛЕНИЕ: Импортируем timezone для timezone-aware datetime
             from datetime import timezone
             now = datetime.now(timezone.utc)
             
+            # Счетчики нод ведутся по users.id: место занимаем, только если пользователя
+            # на ноде еще нет (по любому назначению), освобождаем - где его не осталось
+            capacity = NodeCapacity(self.db)
+            internal_user_id = await self._resolve_user_id(user_id)
+            before = await capacity.placed_map([internal_user_id]) if internal_user_id else {}
+            
             # Простой подход: сначала удаляем старое назначение, потом создаем новое
             # Удаляем существующее назначение пользователя
             delete_stmt = delete(UserServerAssignment).where(
@@ -329,6 +259,13 @@ class UserServerService:
             )
             await self.db.execute(delete_stmt)
             
+            # Место на новой ноде занимаем атомарно
+            if internal_user_id and node.id not in before[internal_user_id]:
+                if not await capacity.reserve(node.id):
+                    await self.db.rollback()
+                    logger.info("Node is full, assignment not saved", user_id=user_id, node_id=node.id)
+                    return False
+            
             # Создаем новое назначение
             new_assignment = UserServerAssignment(
                 user_id=user_id,
@@ -339,6 +276,7 @@ class UserServerService:
             )
             
             self.db.add(new_assignment)
+            await capacity.settle(before)
             await self.db.commit()
             
             logger.info("User assignment saved successfully", 
@@ -346,6 +284,8 @@ class UserServerService:
                        node_id=node.id, 
                        country_id=country.id)
             
+            return True
+            
         except Exception as e:
             logger.error("Failed to save user assignment", 
                         user_id=user_id, node_id=node.id, error=str(e))
@@ -411,23 +351,35 @@ class UserServerService:
         # Используем тот же подход без рекурсии
         return await self._handle_no_nodes_fallback(country_code, user_id)
     
-    async def _retry_selection_without_node(self, country_code: str, user_id: int, exclude_node_id: int) -> NodeSelectionResult:
-        """Повторить выбор, исключив определенную ноду"""
+    async def _retry_selection_without_node(self, country_code: str, user_id: int,
+                                            exclude_node_ids: Set[int],
+                                            ranked_nodes: Optional[List[ScoredNode]] = None) -> NodeSelectionResult:
+        """Повторить выбор, исключив определенные ноды (по готовому рейтингу, если он есть)"""
         try:
+            if ranked_nodes:
+                remaining = [scored for scored in ranked_nodes
+                             if scored.node.id not in exclude_node_ids and scored.node.can_accept_users]
+                if remaining:
+                    logger.info("Retry node selection from ranked candidates", 
+                              user_id=user_id, 
+                              excluded_nodes=sorted(exclude_node_ids),
+                              selected_node=remaining[0].node.id)
+                    return NodeSelectionResult.success_result(remaining[0].node, ranked_nodes=remaining[1:])
+            
             # Получаем страну и ноды, исключая проблемную
             country = await self.country_service.get_country_by_code(country_code)
             if not country:
                 return NodeSelectionResult.error_result("Country not found in retry")
             
             nodes = await self._get_healthy_nodes_by_country(country.id)
-            available_nodes = [node for node in nodes if node.id != exclude_node_id and node.can_accept_users]
+            available_nodes = [node for node in nodes if node.id not in exclude_node_ids and node.can_accept_users]
             
             if available_nodes:
                 # Выбираем первую доступную ноду
                 best_node = available_nodes[0]
                 logger.info("Retry node selection successful", 
                           user_id=user_id, 
-                          excluded_node=exclude_node_id,
+                          excluded_nodes=sorted(exclude_node_ids),
                           selected_node=best_node.id)
                 return NodeSelectionResult.success_result(best_node)
             
@@ -437,22 +389,18 @@ class UserServerService:
         except Exception as e:
             logger.error("Retry selection failed", 
                         user_id=user_id, 
-                        exclude_node_id=exclude_node_id, 
+                        exclude_node_ids=sorted(exclude_node_ids), 
                         error=str(e))
             return NodeSelectionResult.error_result(f"Retry failed: {str(e)}")
     
     async def _emergency_fallback_selection(self, user_id: int) -> NodeSelectionResult:
         """Экстренный fallback - любая работающая нода"""
         try:
-            query = select(VPNNode).where(
-                and_(
-                    VPNNode.status == "active",
-                    VPNNode.current_users < VPNNode.max_users
-                )
-            ).limit(1)
-            
-            result = await self.db.execute(query)
-            node = result.scalar_one_or_none()
+            snapshot = await node_registry.get_snapshot()
+            node = next(
+                (n for n in snapshot.select(status="active") if n.current_users < n.max_users),
+                None
+            )
             
             if node:
                 logger.info("Emergency fallback successful", user_id=user_id, node_id=node.id)
@@ -0,0 +1,145 @@
+"""
+VLESS URL Builder - локальная сборка VLESS/Reality URL без обращения к панели
+URL полностью определяется UUID клиента, полями VPNNode и шаблоном stream settings inbound'а
+"""
+
+from dataclasses import dataclass, replace
+from typing import Dict, Any, Optional, Tuple
+from urllib.parse import quote, urlparse
+
+import structlog
+
+from services.x3ui_http_pool import X3UIHttpPool
+
+logger = structlog.get_logger(__name__)
+
+DEFAULT_SNI = "apple.com"
+DEFAULT_FLOW = "xtls-rprx-vision"
+
+
+@dataclass(frozen=True)
+class RealityUrlTemplate:
+    """Неизменяемая часть VLESS URL для inbound'а (все, кроме UUID и имени клиента)"""
+    port: int
+    network: str = "tcp"
+    security: str = "reality"
+    public_key: str = ""
+    short_id: str = ""
+    sni: str = DEFAULT_SNI
+    fingerprint: str = "chrome"
+    spider_x: str = "/"
+
+    @classmethod
+    def from_stream_settings(cls, port: int, stream_settings: Dict[str, Any]) -> "RealityUrlTemplate":
+        """Шаблон из распарсенного streamSettings inbound'а"""
+        reality = stream_settings.get("realitySettings") or {}
+        nested = reality.get("settings") or {}
+
+        # Публичный ключ хранится в корне realitySettings или в realitySettings.settings (3X-UI)
+        public_key = reality.get("publicKey") or nested.get("publicKey") or ""
+        short_ids = reality.get("shortIds") or []
+        server_names = reality.get("serverNames") or []
+
+        return cls(
+            port=port,
+            network=stream_settings.get("network") or "tcp",
+            security=stream_settings.get("security") or "reality",
+            public_key=public_key,
+            short_id=short_ids[0] if short_ids else "",
+            sni=server_names[0] if server_names else DEFAULT_SNI,
+            fingerprint=nested.get("fingerprint") or "chrome",
+            spider_x=nested.get("spiderX") or "/"
+        )
+
+    def with_node(self, node) -> "RealityUrlTemplate":
+        """Поля Reality из VPNNode имеют приоритет над шаблоном панели"""
+        return replace(
+            self,
+            public_key=getattr(node, "public_key", None) or self.public_key,
+            short_id=getattr(node, "short_id", None) or self.short_id,
+            sni=getattr(node, "sni_mask", None) or self.sni
+        )
+
+
+def host_from_url(url: str) -> Optional[str]:
+    """Хост ноды из x3ui_url"""
+    return urlparse(url).hostname if url else None
+
+
+def build_vless_url(client_id: str, host: str, template: RealityUrlTemplate,
+                    remark: Optional[str] = None, flow: Optional[str] = None) -> str:
+    """
+    Собрать VLESS URL (чистая функция - одинаковые аргументы дают одинаковый URL)
+
+    Args:
+        client_id: UUID клиента
+        host: Хост ноды
+        template: Шаблон inbound'а
+        remark: Имя подключения (обычно email клиента)
+        flow: Flow клиента (по умолчанию xtls-rprx-vision)
+    """
+    return (
+        f"vless://{client_id}@{host}:{template.port}?"
+        f"type={template.network}&security={template.security}"
+        f"&fp={template.fingerprint}"
+        f"&pbk={template.public_key}"
+        f"&sni={template.sni}"
+        f"&flow={flow or DEFAULT_FLOW}"
+        f"&sid={template.short_id}"
+        f"&spx={quote(template.spider_x, safe='')}"
+        f"#{quote(remark or 'VPN', safe='@')}"
+    )
+
+
+def with_remark(vless_url: str, remark: Optional[str]) -> str:
+    """Тот же URL с другим именем подключения (фрагмент после #)"""
+    return f"{vless_url.split('#', 1)[0]}#{quote(remark or 'VPN', safe='@')}"
+
+
+def build_node_vless_url(node, client_id: str, template: RealityUrlTemplate,
+                         remark: Optional[str] = None, flow: Optional[str] = None) -> Optional[str]:
+    """VLESS URL для ноды: хост и ключи Reality из VPNNode, порт и транспорт из шаблона"""
+    host = host_from_url(node.x3ui_url)
+    if not host:
+        return None
+    return build_vless_url(client_id, host, template.with_node(node), remark, flow)
+
+
+class RealityTemplateCache:
+    """
+    Процессный кэш шаблонов URL по (нода, inbound)
+    streamSettings меняются только при смене ключей Reality, поэтому TTL не нужен -
+    шаблон сбрасывается явно (update_inbound_reality_keys, правка ноды)
+    """
+
+    def __init__(self):
+        self._templates: Dict[Tuple[str, int], RealityUrlTemplate] = {}
+
+    def get(self, base_url: str, inbound_id: int) -> Optional[RealityUrlTemplate]:
+        return self._templates.get((X3UIHttpPool.node_key(base_url), inbound_id))
+
+    def remember(self, base_url: str, inbound_id: int, port: int,
+                 stream_settings: Dict[str, Any]) -> RealityUrlTemplate:
+        template = RealityUrlTemplate.from_stream_settings(port, stream_settings)
+        self._templates[(X3UIHttpPool.node_key(base_url), inbound_id)] = template
+        if not template.public_key:
+            logger.warning("Public key not found in Reality settings - VLESS URL will not work!",
+                          node=X3UIHttpPool.node_key(base_url),
+                          inbound_id=inbound_id)
+        return template
+
+    def invalidate(self, base_url: Optional[str] = None) -> None:
+        """Сбросить шаблоны ноды (или всех нод)"""
+        if base_url is None:
+            self._templates.clear()
+            return
+        node_key = X3UIHttpPool.node_key(base_url)
+        for key in [k for k in self._templates if k[0] == node_key]:
+            del self._templates[key]
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {"templates": len(self._templates)}
+
+
+# Глобальный кэш шаблонов (один на процесс)
+reality_template_cache = RealityTemplateCache()
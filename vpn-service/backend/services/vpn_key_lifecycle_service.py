@@ -60,44 +60,25 @@ class VPNKeyLifecycleService:
                        user_id=user_id,
                        keys_count=len(active_keys))
             
-            deactivated_count = 0
             errors = []
             
-            # 2. Деактивируем каждый ключ
+            # 2. Деактивируем ключи в 3xUI пакетно: одно обновление на inbound каждой ноды
+            x3ui_results = await self._set_keys_enabled_in_x3ui(active_keys, enable=False)
+            
             for key in active_keys:
-                try:
-                    logger.info("🔒 Deactivating key", 
-                               key_id=key.id,
-                               email=key.xui_email,
-                               node_id=key.node_id)
-                    
-                    # Деактивируем в 3xUI панели
-                    x3ui_success = await self._disable_key_in_x3ui(key)
-                    
-                    if x3ui_success:
-                        # Обновляем статус в БД на 'suspended'
-                        await self._update_key_status(key.id, VPNKeyStatus.SUSPENDED.value)
-                        deactivated_count += 1
-                        
-                        logger.info("✅ Key deactivated successfully", 
-                                   key_id=key.id,
-                                   email=key.xui_email)
-                    else:
-                        # Даже если 3xUI не сработал, помечаем как suspended в БД
-                        await self._update_key_status(key.id, VPNKeyStatus.SUSPENDED.value)
-                        deactivated_count += 1
-                        errors.append(f"Key {key.id}: 3xUI deactivation failed, but marked as suspended")
-                        
-                        logger.warning("⚠️ Key marked as suspended despite 3xUI failure", 
-                                     key_id=key.id,
-                                     email=key.xui_email)
-                        
-                except Exception as e:
-                    error_msg = f"Key {key.id}: {str(e)}"
-                    errors.append(error_msg)
-                    logger.error("💥 Error deactivating key", 
+                if x3ui_results.get(key.id):
+                    logger.info("✅ Key deactivated successfully", 
                                key_id=key.id,
-                               error=str(e))
+                               email=key.xui_email)
+                else:
+                    errors.append(f"Key {key.id}: 3xUI deactivation failed, but marked as suspended")
+                    logger.warning("⚠️ Key marked as suspended despite 3xUI failure", 
+                                 key_id=key.id,
+                                 email=key.xui_email)
+            
+            # Даже если 3xUI не сработал, помечаем как suspended в БД (одним UPDATE)
+            await self._update_keys_status([key.id for key in active_keys], VPNKeyStatus.SUSPENDED.value)
+            deactivated_count = len(active_keys)
             
             # 3. Коммитим изменения
             await self.db.commit()
@@ -165,42 +146,28 @@ class VPNKeyLifecycleService:
                        user_id=user_id,
                        keys_count=len(suspended_keys))
             
-            reactivated_count = 0
             errors = []
             
-            # 2. Реактивируем каждый ключ
+            # 2. Реактивируем ключи в 3xUI пакетно: одно обновление на inbound каждой ноды
+            x3ui_results = await self._set_keys_enabled_in_x3ui(suspended_keys, enable=True)
+            
+            reactivated_ids = []
             for key in suspended_keys:
-                try:
-                    logger.info("🔓 Reactivating key", 
-                               key_id=key.id,
-                               email=key.xui_email,
-                               node_id=key.node_id)
-                    
-                    # Реактивируем в 3xUI панели
-                    x3ui_success = await self._enable_key_in_x3ui(key)
-                    
-                    if x3ui_success:
-                        # Обновляем статус в БД на 'active'
-                        await self._update_key_status(key.id, VPNKeyStatus.ACTIVE.value)
-                        reactivated_count += 1
-                        
-                        logger.info("✅ Key reactivated successfully", 
-                                   key_id=key.id,
-                                   email=key.xui_email)
-                    else:
-                        # Если 3xUI не сработал, оставляем suspended
-                        errors.append(f"Key {key.id}: 3xUI reactivation failed")
-                        
-                        logger.warning("⚠️ Key reactivation failed in 3xUI", 
-                                     key_id=key.id,
-                                     email=key.xui_email)
-                        
-                except Exception as e:
-                    error_msg = f"Key {key.id}: {str(e)}"
-                    errors.append(error_msg)
-                    logger.error("💥 Error reactivating key", 
+                if x3ui_results.get(key.id):
+                    reactivated_ids.append(key.id)
+                    logger.info("✅ Key reactivated successfully", 
                                key_id=key.id,
-                               error=str(e))
+                               email=key.xui_email)
+                else:
+                    # Если 3xUI не сработал, оставляем suspended
+                    errors.append(f"Key {key.id}: 3xUI reactivation failed")
+                    logger.warning("⚠️ Key reactivation failed in 3xUI", 
+                                 key_id=key.id,
+                                 email=key.xui_email)
+            
+            # Обновляем статус в БД на 'active' (одним UPDATE)
+            await self._update_keys_status(reactivated_ids, VPNKeyStatus.ACTIVE.value)
+            reactivated_count = len(reactivated_ids)
             
             # 3. Коммитим изменения
             await self.db.commit()
@@ -287,119 +254,82 @@ class VPNKeyLifecycleService:
                 "user_id": user_id
             }
     
-    async def _disable_key_in_x3ui(self, key: VPNKey) -> bool:
-        """Деактивировать ключ в 3xUI панели"""
-        try:
-            if not key.node_id:
-                logger.warning("No node assigned to key", key_id=key.id)
-                return False
-            
-            # Получаем информацию о ноде
-            node_result = await self.db.execute(
-                select(VPNNode).where(VPNNode.id == key.node_id)
-            )
-            node = node_result.scalar_one_or_none()
-            
-            if not node:
-                logger.warning("Node not found", key_id=key.id, node_id=key.node_id)
-                return False
-            
-            # Создаем клиент для ноды
-            x3ui_client = X3UIClient(
-                base_url=node.x3ui_url,
-                username=node.x3ui_username,
-                password=node.x3ui_password
-            )
-            
-            # Деактивируем клиента по email
-            success = await x3ui_client.disable_client_by_email(key.xui_email)
-            
-            if success:
-                logger.info("✅ Key disabled in 3xUI successfully", 
-                           key_id=key.id,
-                           email=key.xui_email,
-                           node=node.name)
-            else:
-                logger.warning("⚠️ Failed to disable key in 3xUI", 
-                             key_id=key.id,
-                             email=key.xui_email,
-                             node=node.name)
-            
-            return success
-            
-        except Exception as e:
-            logger.error("💥 Error disabling key in 3xUI", 
-                        key_id=key.id,
-                        error=str(e))
-            return False
-    
-    async def _enable_key_in_x3ui(self, key: VPNKey) -> bool:
-        """Реактивировать ключ в 3xUI панели"""
-        try:
-            if not key.node_id:
-                logger.warning("No node assigned to key", key_id=key.id)
-                return False
-            
-            # Получаем информацию о ноде
-            node_result = await self.db.execute(
-                select(VPNNode).where(VPNNode.id == key.node_id)
-            )
-            node = node_result.scalar_one_or_none()
-            
+    async def _set_keys_enabled_in_x3ui(self, keys: List[VPNKey], enable: bool) -> Dict[int, bool]:
+        """
+        Включить/отключить ключи в 3xUI панелях пакетно
+
+        Ключи группируются по нодам, для каждой ноды - один вызов set_clients_enabled
+        (одно обновление на inbound). Возвращает {key_id: успех}
+        """
+        results: Dict[int, bool] = {key.id: False for key in keys}
+        
+        keys_by_node: Dict[int, List[VPNKey]] = {}
+        for key in keys:
+            if not key.node_id or not key.xui_email:
+                logger.warning("No node or email assigned to key", key_id=key.id)
+                continue
+            keys_by_node.setdefault(key.node_id, []).append(key)
+        
+        if not keys_by_node:
+            return results
+        
+        # Получаем информацию о нодах одним запросом
+        node_result = await self.db.execute(
+            select(VPNNode).where(VPNNode.id.in_(keys_by_node.keys()))
+        )
+        nodes = {node.id: node for node in node_result.scalars().all()}
+        
+        for node_id, node_keys in keys_by_node.items():
+            node = nodes.get(node_id)
             if not node:
-                logger.warning("Node not found", key_id=key.id, node_id=key.node_id)
-                return False
-            
-            # Создаем клиент для ноды
-            x3ui_client = X3UIClient(
-                base_url=node.x3ui_url,
-                username=node.x3ui_username,
-                password=node.x3ui_password
-            )
-            
-            # Реактивируем клиента по email
-            success = await x3ui_client.enable_client_by_email(key.xui_email)
+                logger.warning("Node not found", node_id=node_id, keys_count=len(node_keys))
+                continue
             
-            if success:
-                logger.info("✅ Key enabled in 3xUI successfully", 
-                           key_id=key.id,
-                           email=key.xui_email,
-                           node=node.name)
-            else:
-                logger.warning("⚠️ Failed to enable key in 3xUI", 
-                             key_id=key.id,
-                             email=key.xui_email,
-                             node=node.name)
-            
-            return success
-            
-        except Exception as e:
-            logger.error("💥 Error enabling key in 3xUI", 
-                        key_id=key.id,
-                        error=str(e))
-            return False
+            try:
+                x3ui_client = X3UIClient.from_node(node)
+                emails = [key.xui_email for key in node_keys]
+                email_results = await x3ui_client.set_clients_enabled(emails, enable)
+                
+                for key in node_keys:
+                    results[key.id] = email_results.get(key.xui_email, False)
+                
+                logger.info("✅ Keys updated in 3xUI" if all(email_results.values()) else "⚠️ Some keys failed in 3xUI",
+                           node=node.name,
+                           enable=enable,
+                           requested=len(emails),
+                           succeeded=sum(1 for ok in email_results.values() if ok))
+                
+            except Exception as e:
+                logger.error("💥 Error updating keys in 3xUI", 
+                            node_id=node_id,
+                            enable=enable,
+                            error=str(e))
+        
+        return results
     
-    async def _update_key_status(self, key_id: int, new_status: str) -> bool:
-        """Обновить статус ключа в БД"""
+    async def _update_keys_status(self, key_ids: List[int], new_status: str) -> bool:
+        """Обновить статус набора ключей в БД одним UPDATE"""
+        if not key_ids:
+            return True
         try:
             await self.db.execute(
                 update(VPNKey)
-                .where(VPNKey.id == key_id)
+                .where(VPNKey.id.in_(key_ids))
                 .values(
                     status=new_status,
                     updated_at=datetime.now(timezone.utc)
                 )
             )
             
-            logger.debug("📝 Key status updated in database", 
-                        key_id=key_id,
+            logger.debug("📝 Keys status updated in database", 
+                        keys_count=len(key_ids),
                         new_status=new_status)
             
             return True
             
         except Exception as e:
-            logger.error("💥 Error updating key status in database", 
-                        key_id=key_id,
+            logger.error("💥 Error updating keys status in database", 
+                        keys_count=len(key_ids),
                         new_status=new_status,
                         error=str(e))
             return False
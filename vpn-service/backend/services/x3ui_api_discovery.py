@@ -0,0 +1,144 @@
+"""
+X3UI API Discovery - определение набора API путей панели (один раз на ноду)
+Разные версии 3X-UI / X-UI публикуют API под разными префиксами
+"""
+
+from typing import Dict, Any, Optional, List
+from datetime import datetime, timedelta
+
+import structlog
+
+from services.x3ui_http_pool import X3UIHttpPool
+
+logger = structlog.get_logger(__name__)
+
+# Варианты API в порядке приоритета: flavour -> префикс inbound API
+API_FLAVOURS: Dict[str, str] = {
+    "panel_api": "/panel/api/inbounds",  # Стандартный новый путь (3X-UI)
+    "panel": "/panel/inbounds",          # Альтернативный путь
+    "xui": "/xui/inbounds",              # Старый путь (X-UI)
+    "api": "/api/inbounds",              # Еще один вариант
+}
+
+# Префиксы server API для каждого варианта
+SERVER_PREFIXES: Dict[str, str] = {
+    "panel_api": "/panel/api/server",
+    "panel": "/panel/server",
+    "xui": "/server",
+    "api": "/api/server",
+}
+
+# Шаблоны endpoint'ов относительно префикса inbound API
+ENDPOINT_TEMPLATES: Dict[str, str] = {
+    "inbounds_list": "{inbounds}/list",
+    "add_client": "{inbounds}/addClient",
+    "update_client": "{inbounds}/updateClient/{client_id}",
+    "update_inbound": "{inbounds}/update/{inbound_id}",
+    "del_client": "{inbounds}/{inbound_id}/delClient/{client_id}",
+    "client_traffics": "{inbounds}/getClientTraffics/{email}",
+    "onlines": "{inbounds}/onlines",
+    "reset_client_traffic": "{inbounds}/resetClientTraffic",
+    "server_status": "{server}/status",
+}
+
+# Сколько 404 подряд считаем признаком смены API (обновление панели)
+NOT_FOUND_BURST_THRESHOLD = 3
+NOT_FOUND_BURST_WINDOW = timedelta(minutes=5)
+
+
+class ApiCapabilities:
+    """Результат probe: вариант API и версия панели"""
+
+    def __init__(self, flavour: str, version: Optional[str] = None,
+                 probed_at: Optional[datetime] = None):
+        self.flavour = flavour
+        self.version = version
+        self.probed_at = probed_at or datetime.utcnow()
+
+    @property
+    def inbounds_prefix(self) -> str:
+        return API_FLAVOURS[self.flavour]
+
+    @property
+    def server_prefix(self) -> str:
+        return SERVER_PREFIXES[self.flavour]
+
+    def endpoint(self, name: str, **params: Any) -> str:
+        """Собрать путь endpoint'а для этой панели"""
+        return ENDPOINT_TEMPLATES[name].format(
+            inbounds=self.inbounds_prefix,
+            server=self.server_prefix,
+            **params
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "flavour": self.flavour,
+            "version": self.version,
+            "probed_at": self.probed_at.isoformat()
+        }
+
+    @classmethod
+    def from_dict(cls, data: Optional[Dict[str, Any]]) -> Optional["ApiCapabilities"]:
+        if not data or data.get("flavour") not in API_FLAVOURS:
+            return None
+        probed_at = None
+        if data.get("probed_at"):
+            try:
+                probed_at = datetime.fromisoformat(data["probed_at"])
+            except ValueError:
+                probed_at = None
+        return cls(data["flavour"], data.get("version"), probed_at)
+
+
+class X3UIApiRegistry:
+    """Процессный реестр определенных API по нодам + детектор всплесков 404"""
+
+    def __init__(self):
+        self._capabilities: Dict[str, ApiCapabilities] = {}
+        self._not_found: Dict[str, List[datetime]] = {}
+
+    def get(self, base_url: str) -> Optional[ApiCapabilities]:
+        return self._capabilities.get(X3UIHttpPool.node_key(base_url))
+
+    def set(self, base_url: str, capabilities: ApiCapabilities) -> None:
+        key = X3UIHttpPool.node_key(base_url)
+        self._capabilities[key] = capabilities
+        self._not_found.pop(key, None)
+        logger.info("X3UI API capabilities resolved",
+                   node=key,
+                   flavour=capabilities.flavour,
+                   version=capabilities.version)
+
+    def seed(self, base_url: str, data: Optional[Dict[str, Any]]) -> None:
+        """Загрузить сохраненный в БД результат probe, если в процессе его еще нет"""
+        if self.get(base_url) is None:
+            capabilities = ApiCapabilities.from_dict(data)
+            if capabilities:
+                self._capabilities[X3UIHttpPool.node_key(base_url)] = capabilities
+
+    def invalidate(self, base_url: str) -> None:
+        key = X3UIHttpPool.node_key(base_url)
+        self._capabilities.pop(key, None)
+        self._not_found.pop(key, None)
+
+    def record_success(self, base_url: str) -> None:
+        self._not_found.pop(X3UIHttpPool.node_key(base_url), None)
+
+    def record_not_found(self, base_url: str) -> None:
+        """Учесть 404; при всплеске сбрасываем capabilities - следующий вызов сделает re-probe"""
+        key = X3UIHttpPool.node_key(base_url)
+        now = datetime.utcnow()
+        recent = [t for t in self._not_found.get(key, []) if now - t < NOT_FOUND_BURST_WINDOW]
+        recent.append(now)
+        self._not_found[key] = recent
+
+        if len(recent) >= NOT_FOUND_BURST_THRESHOLD and key in self._capabilities:
+            logger.warning("404 burst from X3UI panel, API will be re-probed",
+                          node=key,
+                          not_found_count=len(recent))
+            self.invalidate(base_url)
+
+
+# Глобальный реестр (один на процесс)
+x3ui_api_registry = X3UIApiRegistry()
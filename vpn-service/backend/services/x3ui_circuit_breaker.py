@@ -0,0 +1,166 @@
+"""
+X3UI Circuit Breaker - автомат защиты для вызовов панели (по ноде)
+closed -> open при высокой доле ошибок или медленных ответов в скользящем окне,
+open -> half_open по истечении паузы, half_open -> closed/open по результату пробных запросов
+"""
+
+import random
+import time
+from collections import deque
+from enum import Enum
+from typing import Dict, Any, Optional, Deque, Tuple
+
+import structlog
+
+from config.settings import get_settings
+from services.x3ui_http_pool import X3UIHttpPool
+
+logger = structlog.get_logger(__name__)
+
+
+class CircuitState(str, Enum):
+    """Состояние автомата"""
+    closed = "closed"
+    open = "open"
+    half_open = "half_open"
+
+
+class NodeCircuit:
+    """Автомат одной ноды: окно последних вызовов (успех, задержка)"""
+
+    def __init__(self, key: str):
+        settings = get_settings()
+        self.key = key
+        self.window_size = settings.x3ui_breaker_window
+        self.min_calls = settings.x3ui_breaker_min_calls
+        self.failure_rate_threshold = settings.x3ui_breaker_failure_rate
+        self.slow_call_ms = settings.x3ui_breaker_slow_call_ms
+        self.slow_rate_threshold = settings.x3ui_breaker_slow_rate
+        self.open_seconds = settings.x3ui_breaker_open_seconds
+        self.half_open_max_calls = settings.x3ui_breaker_half_open_calls
+        # Дольше таймаута запроса проба длиться не может
+        self.probe_timeout = settings.x3ui_request_timeout * 2
+
+        self.state = CircuitState.closed
+        self.calls: Deque[Tuple[bool, float]] = deque(maxlen=self.window_size)
+        self.opened_at: Optional[float] = None
+        self.half_open_inflight = 0
+        self.half_open_successes = 0
+        self.last_probe_at: Optional[float] = None
+        self.times_opened = 0
+        self.rejected = 0
+
+    def _maybe_half_open(self) -> None:
+        if (self.state == CircuitState.open
+                and time.monotonic() - self.opened_at >= self.open_seconds):
+            self.state = CircuitState.half_open
+            self.half_open_inflight = 0
+            self.half_open_successes = 0
+            logger.info("Circuit half-open, probing X3UI panel", node=self.key)
+
+    @property
+    def is_open(self) -> bool:
+        """Открыт ли автомат (без резервирования пробного вызова)"""
+        self._maybe_half_open()
+        return self.state == CircuitState.open
+
+    def allow_request(self) -> bool:
+        """Можно ли выполнить вызов; в half_open пропускается ограниченное число проб"""
+        self._maybe_half_open()
+        if self.state == CircuitState.closed:
+            return True
+        if self.state == CircuitState.half_open:
+            if (self.half_open_inflight >= self.half_open_max_calls
+                    and time.monotonic() - self.last_probe_at >= self.probe_timeout):
+                # Пробы не вернули результат (потерянный record) - считаем их неудачными
+                logger.warning("Circuit half-open probes timed out", node=self.key)
+                self._open()
+                self.rejected += 1
+                return False
+            if self.half_open_inflight < self.half_open_max_calls:
+                self.half_open_inflight += 1
+                self.last_probe_at = time.monotonic()
+                return True
+        self.rejected += 1
+        return False
+
+    def record(self, success: bool, latency_ms: float) -> None:
+        """Учесть результат вызова, разрешенного allow_request"""
+        if self.state == CircuitState.half_open:
+            self.half_open_inflight = max(0, self.half_open_inflight - 1)
+            if not success or latency_ms >= self.slow_call_ms:
+                self._open()
+                return
+            self.half_open_successes += 1
+            if self.half_open_successes >= self.half_open_max_calls:
+                self._close()
+            return
+
+        self.calls.append((success, latency_ms))
+        if self.state == CircuitState.closed and len(self.calls) >= self.min_calls:
+            total = len(self.calls)
+            failure_rate = sum(1 for ok, _ in self.calls if not ok) / total
+            slow_rate = sum(1 for _, ms in self.calls if ms >= self.slow_call_ms) / total
+            if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_rate_threshold:
+                logger.warning("Circuit opened for X3UI panel",
+                              node=self.key,
+                              failure_rate=round(failure_rate, 3),
+                              slow_rate=round(slow_rate, 3))
+                self._open()
+
+    def _open(self) -> None:
+        self.state = CircuitState.open
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+        self.calls.clear()
+
+    def _close(self) -> None:
+        self.state = CircuitState.closed
+        self.opened_at = None
+        self.calls.clear()
+        logger.info("Circuit closed, X3UI panel recovered", node=self.key)
+
+    def to_dict(self) -> Dict[str, Any]:
+        self._maybe_half_open()
+        total = len(self.calls)
+        return {
+            "state": self.state.value,
+            "window_calls": total,
+            "failure_rate": round(sum(1 for ok, _ in self.calls if not ok) / total, 3) if total else 0.0,
+            "times_opened": self.times_opened,
+            "rejected": self.rejected
+        }
+
+
+class X3UICircuitBreakers:
+    """Процессный реестр автоматов по нодам"""
+
+    def __init__(self):
+        self._circuits: Dict[str, NodeCircuit] = {}
+
+    def get(self, base_url: str) -> NodeCircuit:
+        key = X3UIHttpPool.node_key(base_url)
+        if key not in self._circuits:
+            self._circuits[key] = NodeCircuit(key)
+        return self._circuits[key]
+
+    def is_open(self, base_url: Optional[str]) -> bool:
+        """Для балансировщика: нода с открытым автоматом не выбирается"""
+        if not base_url:
+            return False
+        circuit = self._circuits.get(X3UIHttpPool.node_key(base_url))
+        return circuit.is_open if circuit else False
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        return {key: circuit.to_dict() for key, circuit in self._circuits.items()}
+
+
+def retry_delay(attempt: int) -> float:
+    """Экспоненциальная пауза с ограничением и full jitter: U(0, min(cap, base * 2^attempt))"""
+    settings = get_settings()
+    return random.uniform(0, min(settings.x3ui_retry_max_delay,
+                                 settings.x3ui_retry_base_delay * (2 ** attempt)))
+
+
+# Глобальный реестр автоматов (один на процесс)
+x3ui_circuit_breakers = X3UICircuitBreakers()
@@ -3,15 +3,46 @@ import asyncio
 import hashlib
 import uuid
 import json
-from typing import Optional, Dict, Any, List
+from http.cookies import Morsel
+from typing import Optional, Dict, Any, List, Tuple
 import structlog
 from datetime import datetime, timedelta
 import urllib.parse
+import time
 
 from config.settings import get_settings
+from services.x3ui_http_pool import x3ui_http_pool
+from services.x3ui_inbound_cache import x3ui_inbound_cache, InboundSnapshot
+from services.x3ui_api_discovery import x3ui_api_registry, ApiCapabilities, API_FLAVOURS
+from services.x3ui_session_registry import x3ui_session_registry, PanelSession
+from services.x3ui_circuit_breaker import x3ui_circuit_breakers, retry_delay
+from services.vless_url_builder import (
+    RealityUrlTemplate, reality_template_cache, build_vless_url, build_node_vless_url, host_from_url
+)
 
 logger = structlog.get_logger(__name__)
 
+# Ссылки на фоновые задачи, чтобы их не собрал GC до завершения
+_background_tasks: set = set()
+
+# Cookie сессии 3X-UI; старые панели выдают cookie под другим именем (x-ui, session)
+SESSION_COOKIE_NAME = "3x-ui"
+
+
+def session_cookie(cookies) -> Optional[Morsel]:
+    """Cookie сессии из ответа логина: 3x-ui, иначе первый выданный панелью"""
+    morsel = cookies.get(SESSION_COOKIE_NAME)
+    if morsel is None and len(cookies) > 0:
+        morsel = next(iter(cookies.values()))
+    return morsel
+
+
+def _panel_json(value: Any) -> str:
+    """Поле inbound'а (streamSettings, sniffing) для update: строка панели уходит как есть"""
+    if isinstance(value, str):
+        return value
+    return json.dumps(value or {})
+
 class X3UIClient:
     """Клиент для работы с 3X-UI панелью"""
     
@@ -23,7 +54,19 @@ class X3UIClient:
         self.username = username or "admin"
         self.password = password or "admin"
         self.session_token: Optional[str] = None
+        self.cookie_name = SESSION_COOKIE_NAME
         self.token_expires: Optional[datetime] = None
+
+    @classmethod
+    def from_node(cls, node) -> "X3UIClient":
+        """Создать клиент для ноды, подхватив сохраненный в БД результат API probe"""
+        client = cls(
+            base_url=node.x3ui_url,
+            username=node.x3ui_username,
+            password=node.x3ui_password
+        )
+        x3ui_api_registry.seed(node.x3ui_url, getattr(node, "api_capabilities", None))
+        return client
         
     async def _ensure_session(self) -> bool:
         """Обеспечение активной сессии"""
@@ -32,9 +75,51 @@ class X3UIClient:
             return True
             
         return await self._login()
+
+    async def close(self) -> None:
+        """HTTP сессия принадлежит общему пулу x3ui_http_pool - закрывать нечего"""
+        return None
+
+    def _timeout(self) -> aiohttp.ClientTimeout:
+        """Общий таймаут запроса + короткий таймаут на установку соединения"""
+        return aiohttp.ClientTimeout(
+            total=self.settings.x3ui_request_timeout,
+            sock_connect=self.settings.x3ui_connect_timeout
+        )
+
+    def get_connection_stats(self) -> Dict[str, Any]:
+        """Статистика переиспользования keep-alive соединений к ноде"""
+        if not self.base_url:
+            return {}
+        return x3ui_http_pool.get_stats(self.base_url)
+
+    async def _login(self, stale_token: Optional[str] = None) -> bool:
+        """
+        Аутентификация в 3X-UI через общий реестр сессий
+        Параллельные логины к одной ноде схлопываются в один запрос, cookie общий
+        """
+        if not self.base_url:
+            logger.error("No base_url provided for X3UI client")
+            return False
+        
+        key = x3ui_session_registry.session_key(self.base_url, self.username, self.password)
+        
+        async def login() -> Optional[PanelSession]:
+            if not await self._perform_login():
+                return None
+            return PanelSession(self.session_token, self.token_expires, self.cookie_name)
+        
+        session = await x3ui_session_registry.acquire(key, login, stale_token=stale_token)
+        if not session:
+            return False
+        
+        self.session_token = session.token
+        self.cookie_name = session.cookie_name or SESSION_COOKIE_NAME
+        self.token_expires = session.expires_at
+        return True
     
-    async def _login(self) -> bool:
-        """Аутентификация в 3X-UI"""
+    async def _perform_login(self) -> bool:
+        """Фактический запрос логина к 3X-UI"""
         try:
             if not self.base_url:
                 logger.error("No base_url provided for X3UI client")
@@ -48,6 +133,12 @@ class X3UIClient:
                 logger.error("Invalid URL format, must start with http:// or https://", url=base_url)
                 return False
                 
+            # Панель недавно не отвечала - не ждем таймаут, отказываем сразу
+            circuit = x3ui_circuit_breakers.get(base_url)
+            if not circuit.allow_request():
+                logger.warning("X3UI circuit open, login rejected", url=base_url)
+                return False
+            
             logger.info("Attempting to login to X3UI", url=base_url)
             
             # Определяем правильный путь для login
@@ -56,78 +147,96 @@ class X3UIClient:
             login_url = f"{base_url}/login"
             logger.info("Full login URL", login_url=login_url)
             
-            # Отключаем проверку SSL для самоподписанных сертификатов
-            connector = aiohttp.TCPConnector(ssl=False) if base_url.startswith('https://') else None
-            async with aiohttp.ClientSession(connector=connector) as session:
-                login_data = {
-                    "username": self.username,
-                    "password": self.password
-                }
+            # Используем общую keep-alive сессию ноды
+            session = await x3ui_http_pool.get_session(base_url)
+            login_data = {
+                "username": self.username,
+                "password": self.password
+            }
                 
-                logger.info("Preparing login request with credentials")
+            logger.info("Preparing login request with credentials")
                 
-                async with session.post(
-                    login_url,
-                    json=login_data,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
-                    logger.info("Login response status", status=response.status)
+            started = time.monotonic()
+            ok = False
+            try:
+                response = await session.post(login_url, json=login_data, timeout=self._timeout())
+                ok = response.status < 500
+            finally:
+                # И при отмене (дедлайн health check'а) - иначе проба half_open не вернется
+                circuit.record(ok, (time.monotonic() - started) * 1000)
+            
+            async with response:
+                logger.info("Login response status", status=response.status)
                     
-                    # Логирование заголовков и кук для отладки
-                    logger.info("Response headers", headers=dict(response.headers))
-                    logger.info("Response cookies", cookies={k:v for k,v in response.cookies.items()})
+                # Логирование заголовков и кук для отладки
+                logger.info("Response headers", headers=dict(response.headers))
+                logger.info("Response cookies", cookies=list(response.cookies.keys()))
                     
-                    # Читаем тело ответа
-                    response_body = await response.text()
-                    logger.info("Response body", body_length=len(response_body))
+                # Читаем тело ответа
+                response_body = await response.text()
+                logger.info("Response body", body_length=len(response_body))
                     
-                    try:
-                        # Пытаемся распарсить JSON
-                        data = json.loads(response_body)
-                        logger.info("Response parsed as JSON", success=data.get("success", False))
+                try:
+                    # Пытаемся распарсить JSON
+                    data = json.loads(response_body)
+                    logger.info("Response parsed as JSON", success=data.get("success", False))
                         
-                        if data.get("success"):
-                            # Получаем cookie из заголовков
-                            session_cookie = None
-                            for cookie_name, cookie_value in response.cookies.items():
-                                if cookie_name == '3x-ui':
-                                    session_cookie = cookie_value
-                                    break
+                    if data.get("success"):
+                        # Получаем cookie из заголовков
+                        morsel = session_cookie(response.cookies)
                             
-                            if session_cookie:
-                                self.session_token = session_cookie
-                                # Токен действует 1 час согласно cookie
-                                self.token_expires = datetime.utcnow() + timedelta(minutes=50)
-                                logger.info("Successfully authenticated with 3X-UI")
-                                return True
-                            else:
-                                # Все равно пытаемся продолжить даже без cookie
-                                logger.warning("No session cookie received from 3X-UI, trying to continue anyway")
-                                self.session_token = "dummy_token"
-                                self.token_expires = datetime.utcnow() + timedelta(minutes=50)
-                                return True
+                        if morsel is not None:
+                            self.session_token = morsel.value
+                            self.cookie_name = morsel.key
+                            # Токен действует 1 час согласно cookie
+                            self.token_expires = datetime.utcnow() + timedelta(minutes=50)
+                            logger.info("Successfully authenticated with 3X-UI")
+                            return True
                         else:
-                            logger.error("3X-UI login failed", error=data.get("msg"))
-                            return False
-                    except json.JSONDecodeError:
-                        logger.warning("Response not JSON", body=response_body[:100])
-                        
-                        # Возможно устаревшая панель без API, пробуем через cookie
-                        if response.status == 200 and len(response.cookies) > 0:
-                            self.session_token = next(iter(response.cookies.values()))
+                            # Все равно пытаемся продолжить даже без cookie
+                            logger.warning("No session cookie received from 3X-UI, trying to continue anyway")
+                            self.session_token = "dummy_token"
+                            self.cookie_name = SESSION_COOKIE_NAME
                             self.token_expires = datetime.utcnow() + timedelta(minutes=50)
-                            logger.info("Using fallback cookie authentication")
                             return True
-                        
-                        logger.error("3X-UI login failed, response not JSON")
+                    else:
+                        logger.error("3X-UI login failed", error=data.get("msg"))
                         return False
+                except json.JSONDecodeError:
+                    logger.warning("Response not JSON", body=response_body[:100])
+                        
+                    # Возможно устаревшая панель без API, пробуем через cookie
+                    morsel = session_cookie(response.cookies)
+                    if response.status == 200 and morsel is not None:
+                        self.session_token = morsel.value
+                        self.cookie_name = morsel.key
+                        self.token_expires = datetime.utcnow() + timedelta(minutes=50)
+                        logger.info("Using fallback cookie authentication")
+                        return True
+                        
+                    logger.error("3X-UI login failed, response not JSON")
+                    return False
                         
         except Exception as e:
             logger.error("Error connecting to 3X-UI", error=str(e))
             return False
     
-    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None) -> Optional[Dict]:
-        """Выполнение запроса к 3X-UI API с диагностикой"""
+    async def _make_request(self, method: str, endpoint: str, data: Optional[Dict] = None,
+                            retry_on_unauthorized: bool = True,
+                            idempotent: Optional[bool] = None, _attempt: int = 0) -> Optional[Dict]:
+        """
+        Выполнение запроса к 3X-UI API с диагностикой
+
+        Вызовы проходят через circuit breaker ноды; идемпотентные запросы (по умолчанию GET)
+        при сетевых ошибках и 5xx повторяются с экспоненциальной паузой и jitter
+        """
+        if idempotent is None:
+            idempotent = method.upper() == "GET"
+        
+        if self.base_url and x3ui_circuit_breakers.is_open(self.base_url):
+            logger.warning("X3UI circuit open, request rejected", endpoint=endpoint)
+            return None
+        
         if not await self._ensure_session():
             return None
             
@@ -149,8 +258,9 @@ class X3UIClient:
                 "Accept": "application/json"
             }
             
+            # Cookie отправляется под тем именем, под которым его выдала панель
             cookies = {
-                "x-ui": self.session_token  # Исправлено: используем правильное имя cookie
+                self.cookie_name: self.session_token
             }
             
             full_url = f"{base_url}{endpoint}"
@@ -163,94 +273,145 @@ class X3UIClient:
                            method=method,
                            data=data,
                            headers=headers,
-                           cookies_present=bool(cookies.get("x-ui")))
+                           cookies_present=bool(self.session_token))
             else:
                 logger.info("Making X3UI request", url=full_url, method=method)
             
-            # Отключаем проверку SSL для самоподписанных сертификатов
-            connector = aiohttp.TCPConnector(ssl=False) if base_url.startswith('https://') else None
-            async with aiohttp.ClientSession(connector=connector) as session:
-                async with session.request(
-                    method,
-                    full_url,
-                    json=data if data else None,
-                    headers=headers,
-                    cookies=cookies,
-                    timeout=aiohttp.ClientTimeout(total=30)
-                ) as response:
+            circuit = x3ui_circuit_breakers.get(base_url)
+            if not circuit.allow_request():
+                logger.warning("X3UI circuit open, request rejected", endpoint=endpoint)
+                return None
+            
+            # Используем общую keep-alive сессию ноды
+            session = await x3ui_http_pool.get_session(base_url)
+            started = time.monotonic()
+            ok = False
+            try:
+                try:
+                    response = await session.request(
+                        method,
+                        full_url,
+                        json=data if data else None,
+                        headers=headers,
+                        cookies=cookies,
+                        timeout=self._timeout()
+                    )
+                    ok = response.status < 500
+                finally:
+                    # И при отмене (дедлайн health check'а) - иначе проба half_open не вернется
+                    circuit.record(ok, (time.monotonic() - started) * 1000)
+            except Exception as e:
+                if idempotent and _attempt < self.settings.x3ui_retry_attempts:
+                    logger.warning("X3UI request failed, retrying",
+                                  endpoint=endpoint, attempt=_attempt + 1, error=str(e))
+                    await asyncio.sleep(retry_delay(_attempt))
+                    return await self._make_request(method, endpoint, data, retry_on_unauthorized,
+                                                    idempotent, _attempt + 1)
+                raise
+            
+            if response.status >= 500 and idempotent and _attempt < self.settings.x3ui_retry_attempts:
+                response.release()
+                logger.warning("X3UI server error, retrying",
+                              endpoint=endpoint, status=response.status, attempt=_attempt + 1)
+                await asyncio.sleep(retry_delay(_attempt))
+                return await self._make_request(method, endpoint, data, retry_on_unauthorized,
+                                                idempotent, _attempt + 1)
+            
+            async with response:
                     
-                    if is_delete_request:
-                        logger.info("🔍 ДИАГНОСТИКА: Получен ответ на DELETE запрос", 
-                                   status=response.status, 
-                                   content_type=response.content_type,
-                                   headers=dict(response.headers))
-                    else:
-                        logger.info("X3UI response", status=response.status, content_type=response.content_type)
+                if is_delete_request:
+                    logger.info("🔍 ДИАГНОСТИКА: Получен ответ на DELETE запрос", 
+                               status=response.status, 
+                               content_type=response.content_type,
+                               headers=dict(response.headers))
+                else:
+                    logger.info("X3UI response", status=response.status, content_type=response.content_type)
                     
-                    if response.status == 200:
-                        response_text = await response.text()
+                if response.status == 401 and retry_on_unauthorized:
+                    # Общий cookie истек - ниже выполняем ровно один повторный логин
+                    logger.warning("X3UI session rejected, re-authenticating", url=full_url)
+                elif response.status == 200:
+                    x3ui_api_registry.record_success(self.base_url)
+                    response_text = await response.text()
                         
-                        if is_delete_request:
-                            logger.info("🔍 ДИАГНОСТИКА: Текст ответа на DELETE запрос", 
-                                       full_text=response_text,
-                                       text_length=len(response_text))
-                        else:
-                            logger.info("Response text preview", preview=response_text[:200])
+                    if is_delete_request:
+                        logger.info("🔍 ДИАГНОСТИКА: Текст ответа на DELETE запрос", 
+                                   full_text=response_text,
+                                   text_length=len(response_text))
+                    else:
+                        logger.info("Response text preview", preview=response_text[:200])
                         
-                        try:
-                            # Пытаемся парсить как JSON
-                            parsed_json = json.loads(response_text)
+                    try:
+                        # Пытаемся парсить как JSON
+                        parsed_json = json.loads(response_text)
                             
-                            if is_delete_request:
-                                logger.info("🔍 ДИАГНОСТИКА: JSON ответ на DELETE запрос", 
-                                           parsed_json=parsed_json,
-                                           json_keys=list(parsed_json.keys()) if isinstance(parsed_json, dict) else "Not a dict")
+                        if is_delete_request:
+                            logger.info("🔍 ДИАГНОСТИКА: JSON ответ на DELETE запрос", 
+                                       parsed_json=parsed_json,
+                                       json_keys=list(parsed_json.keys()) if isinstance(parsed_json, dict) else "Not a dict")
                             
-                            return parsed_json
-                        except json.JSONDecodeError as e:
-                            if is_delete_request:
-                                logger.info("🔍 ДИАГНОСТИКА: Ошибка парсинга JSON в DELETE ответе - проверяем пустой ответ", 
-                                           error=str(e),
-                                           response_text=response_text,
-                                           response_length=len(response_text))
+                        return parsed_json
+                    except json.JSONDecodeError as e:
+                        if is_delete_request:
+                            logger.info("🔍 ДИАГНОСТИКА: Ошибка парсинга JSON в DELETE ответе - проверяем пустой ответ", 
+                                       error=str(e),
+                                       response_text=response_text,
+                                       response_length=len(response_text))
                                 
-                                # Для DELETE запросов панель может возвращать пустой ответ при успехе
-                                if len(response_text.strip()) == 0:
-                                    logger.info("🔍 ДИАГНОСТИКА: Пустой ответ на DELETE - считаем успешным")
-                                    return {"success": True, "msg": "Empty response interpreted as success"}
+                            # Для DELETE запросов панель может возвращать пустой ответ при успехе
+                            if len(response_text.strip()) == 0:
+                                logger.info("🔍 ДИАГНОСТИКА: Пустой ответ на DELETE - считаем успешным")
+                                return {"success": True, "msg": "Empty response interpreted as success"}
                             
-                            # Если не JSON, проверяем что это может быть успешный ответ
-                            if response_text.strip():
-                                logger.warning("Non-JSON response received", 
-                                             content_type=response.content_type,
-                                             text_preview=response_text[:100])
+                        # Если не JSON, проверяем что это может быть успешный ответ
+                        if response_text.strip():
+                            logger.warning("Non-JSON response received", 
+                                         content_type=response.content_type,
+                                         text_preview=response_text[:100])
                                 
-                                # Для некоторых endpoints может возвращаться простой текст
-                                # В таком случае считаем что запрос неудачный
-                                return None
+                            # Для некоторых endpoints может возвращаться простой текст
+                            # В таком случае считаем что запрос неудачный
+                            return None
+                        else:
+                            if is_delete_request:
+                                # Для DELETE запросов пустой ответ со статусом 200 = успех
+                                logger.info("🔍 ДИАГНОСТИКА: Пустой ответ на DELETE со статусом 200 - успех")
+                                return {"success": True, "msg": "Empty response with 200 status"}
                             else:
-                                if is_delete_request:
-                                    # Для DELETE запросов пустой ответ со статусом 200 = успех
-                                    logger.info("🔍 ДИАГНОСТИКА: Пустой ответ на DELETE со статусом 200 - успех")
-                                    return {"success": True, "msg": "Empty response with 200 status"}
-                                else:
-                                    logger.error("Empty response received")
-                                    return None
-                    else:
-                        response_text = await response.text()
+                                logger.error("Empty response received")
+                                return None
+                else:
+                    response_text = await response.text()
+                    
+                    if response.status == 404:
+                        x3ui_api_registry.record_not_found(self.base_url)
                         
-                        if is_delete_request:
-                            logger.error("🔍 ДИАГНОСТИКА: DELETE запрос завершился с ошибкой", 
-                                       endpoint=endpoint, 
-                                       status=response.status,
-                                       response_text=response_text,
-                                       response_headers=dict(response.headers))
-                        else:
-                            logger.error("3X-UI request failed", 
-                                       endpoint=endpoint, 
-                                       status=response.status,
-                                       response_text=response_text[:200])
-                        return None
+                    if is_delete_request:
+                        logger.error("🔍 ДИАГНОСТИКА: DELETE запрос завершился с ошибкой", 
+                                   endpoint=endpoint, 
+                                   status=response.status,
+                                   response_text=response_text,
+                                   response_headers=dict(response.headers))
+                    else:
+                        logger.error("3X-UI request failed", 
+                                   endpoint=endpoint, 
+                                   status=response.status,
+                                   response_text=response_text[:200])
+                    return None
+            
+            # Сюда попадаем только после 401: один повторный логин и один повтор запроса
+            stale_token = self.session_token
+            self.session_token = None
+            self.token_expires = None
+            # Отвергнутый cookie больше не раздаем другим клиентам
+            x3ui_session_registry.invalidate(
+                x3ui_session_registry.session_key(self.base_url, self.username, self.password),
+                stale_token
+            )
+            if not await self._login(stale_token=stale_token):
+                return None
+            return await self._make_request(method, endpoint, data, retry_on_unauthorized=False,
+                                            idempotent=idempotent)
                         
         except Exception as e:
             if "delClient" in endpoint:
@@ -264,64 +425,138 @@ class X3UIClient:
                             error=str(e))
             return None
     
+    async def probe_api(self) -> Optional[ApiCapabilities]:
+        """Определить вариант API и версию панели (выполняется один раз на ноду)"""
+        capabilities, _ = await self._probe_api()
+        return capabilities
+
+    async def _probe_api(self) -> tuple:
+        """Probe: перебираем известные варианты API, возвращаем (capabilities, inbounds)"""
+        for flavour in API_FLAVOURS:
+            capabilities = ApiCapabilities(flavour)
+            api_path = capabilities.endpoint("inbounds_list")
+            logger.info("Probing inbounds API path", path=api_path)
+            
+            result = await self._make_request("GET", api_path)
+            
+            if result and result.get("success"):
+                # Версию берем из статуса сервера (xray version), если endpoint доступен
+                status = await self._make_request("POST", capabilities.endpoint("server_status"), idempotent=True)
+                if status and status.get("success"):
+                    capabilities.version = (status.get("obj") or {}).get("xray", {}).get("version")
+                
+                x3ui_api_registry.set(self.base_url, capabilities)
+                return capabilities, result.get("obj", [])
+            elif result is not None:
+                logger.warning("API path returned unsuccessful result", path=api_path, result=result)
+        
+        logger.error("All inbounds API paths failed")
+        return None, None
+
+    async def _endpoint(self, name: str, **params: Any) -> str:
+        """Путь endpoint'а по карте, определенной для этой ноды"""
+        capabilities = x3ui_api_registry.get(self.base_url)
+        if capabilities is None:
+            capabilities = await self.probe_api()
+        if capabilities is None:
+            # Панель недоступна - используем стандартный путь, запрос все равно упадет
+            capabilities = ApiCapabilities("panel_api")
+        return capabilities.endpoint(name, **params)
+
     async def get_inbounds(self) -> Optional[List[Dict]]:
         """Получение списка inbound правил"""
-        # Пробуем разные API пути в порядке приоритета  
-        api_paths = [
-            "/panel/api/inbounds/list",  # Стандартный новый путь
-            "/panel/inbounds/list",      # Альтернативный путь
-            "/xui/inbounds/list",        # Старый путь
-            "/api/inbounds/list"         # Еще один вариант
-        ]
+        capabilities = x3ui_api_registry.get(self.base_url)
         
-        for api_path in api_paths:
-            logger.info("Trying inbounds API path", path=api_path)
-            
+        if capabilities:
+            api_path = capabilities.endpoint("inbounds_list")
             result = await self._make_request("GET", api_path)
             
             if result and result.get("success"):
                 logger.info("Successfully got inbounds", path=api_path, count=len(result.get("obj", [])))
                 return result.get("obj", [])
-            elif result is None:
-                # Пробуем следующий путь
-                continue
-            else:
-                logger.warning("API path returned unsuccessful result", path=api_path, result=result)
+            
+            # Повторный probe только если всплеск 404 сбросил определенный API
+            if x3ui_api_registry.get(self.base_url) is not None:
+                logger.error("Failed to get inbounds", path=api_path, result=result)
+                return None
         
-        logger.error("All inbounds API paths failed")
-        return None
+        _, inbounds = await self._probe_api()
+        return inbounds
+
+    async def get_inbound_snapshot(self, force_refresh: bool = False) -> Optional[InboundSnapshot]:
+        """Индексированный снимок inbound'ов ноды (кэш с коротким TTL)"""
+        if not self.base_url:
+            return None
+        return await x3ui_inbound_cache.get_snapshot(
+            self.base_url, self.get_inbounds, force_refresh=force_refresh
+        )
+
+    async def _lookup_client(self, email: Optional[str] = None,
+                             client_id: Optional[str] = None
+                             ) -> Tuple[Optional[InboundSnapshot], Optional[tuple]]:
+        """Поиск клиента в снимке; к панели обращаемся только при промахе. Возвращает (снимок, запись)"""
+        snapshot = await self.get_inbound_snapshot()
+        if not snapshot:
+            return None, None
+
+        def lookup(snap: InboundSnapshot):
+            return snap.find_by_email(email) if email else snap.find_by_client_id(client_id)
+
+        entry = lookup(snapshot)
+        if entry is None:
+            snapshot = await self.get_inbound_snapshot(force_refresh=True)
+            entry = lookup(snapshot) if snapshot else None
+        return snapshot, entry
+
+    async def _find_client(self, email: Optional[str] = None,
+                           client_id: Optional[str] = None) -> Optional[tuple]:
+        """Поиск клиента в снимке; к панели обращаемся только при промахе"""
+        _, entry = await self._lookup_client(email=email, client_id=client_id)
+        return entry
+    
+    @staticmethod
+    def _build_new_client(client_config: Dict[str, Any], taken_emails) -> Dict[str, Any]:
+        """Сформировать клиента для addClient с уникальным среди taken_emails email"""
+        # Используем client_id из конфигурации или генерируем новый
+        client_id = client_config.get("id") or client_config.get("client_id") or str(uuid.uuid4())
+        
+        # Использую email из client_config или формирую [telegram_id]_[timestamp]
+        if client_config.get("email"):
+            unique_email = client_config.get("email")
+        else:
+            telegram_id = client_config.get("telegram_id", "")
+            timestamp = int(datetime.utcnow().timestamp())
+            unique_email = f"{telegram_id}_{timestamp}"
+        
+        # Убеждаемся что email уникален
+        counter = 1
+        final_email = unique_email
+        while final_email in taken_emails:
+            final_email = f"{unique_email}_{counter}"
+            counter += 1
+        
+        # Формируем конфигурацию клиента
+        return {
+            "id": client_id,
+            "email": final_email,
+            "flow": client_config.get("flow", "xtls-rprx-vision"),
+            "limitIp": client_config.get("limit_ip", 2),
+            "totalGB": client_config.get("total_gb", 0),  # 0 = безлимитный
+            "expiryTime": client_config.get("expiry_time", 0),  # 0 = без истечения
+            "enable": client_config.get("enable", True),
+            "tgId": str(client_config.get("telegram_id", "")),
+            "subId": client_config.get("sub_id", "")
+        }
     
     async def create_client(self, inbound_id: int, client_config: Dict[str, Any]) -> Optional[Dict]:
         """Создание нового клиента VPN"""
         try:
-            # Используем client_id из конфигурации или генерируем новый
-            client_id = client_config.get("id") or client_config.get("client_id") or str(uuid.uuid4())
-            
-            # Использую email из client_config или формирую [telegram_id]_[timestamp]
-            if client_config.get("email"):
-                unique_email = client_config.get("email")
-            else:
-                telegram_id = client_config.get("telegram_id", "")
-                timestamp = int(datetime.utcnow().timestamp())
-                unique_email = f"{telegram_id}_{timestamp}"
-            
             # Проверяем существующих клиентов для избежания дублирования
-            existing_inbounds = await self.get_inbounds()
-            existing_emails = set()
-            
-            if existing_inbounds:
-                for inbound in existing_inbounds:
-                    settings = json.loads(inbound.get('settings', '{}'))
-                    clients = settings.get('clients', [])
-                    for client in clients:
-                        existing_emails.add(client.get('email', ''))
-            
-            # Убеждаемся что email уникален
-            counter = 1
-            final_email = unique_email
-            while final_email in existing_emails:
-                final_email = f"{unique_email}_{counter}"
-                counter += 1
+            snapshot = await self.get_inbound_snapshot()
+            existing_emails = snapshot.clients_by_email if snapshot else {}
+            
+            new_client = self._build_new_client(client_config, existing_emails)
+            client_id = new_client["id"]
             
             # Логируем использование переданного или нового UUID
             if client_config.get("id") or client_config.get("client_id"):
@@ -329,27 +564,33 @@ class X3UIClient:
             else:
                 logger.info("🔄 Generated new client_id for X3UI client creation", client_id=client_id)
             
-            # Формируем конфигурацию клиента
             client_data = {
                 "id": inbound_id,
-                "settings": json.dumps({
-                    "clients": [{
-                        "id": client_id,
-                        "email": final_email,
-                        "flow": client_config.get("flow", "xtls-rprx-vision"),
-                        "limitIp": client_config.get("limit_ip", 2),
-                        "totalGB": client_config.get("total_gb", 0),  # 0 = безлимитный
-                        "expiryTime": client_config.get("expiry_time", 0),  # 0 = без истечения
-                        "enable": True,
-                        "tgId": str(client_config.get("telegram_id", "")),
-                        "subId": client_config.get("sub_id", "")
-                    }]
-                })
+                "settings": json.dumps({"clients": [new_client]})
             }
             
-            result = await self._make_request("POST", f"/panel/api/inbounds/addClient", client_data)
+            result = await self._make_request("POST", await self._endpoint("add_client"), client_data)
+            
+            if result and not result.get("success") and self._is_duplicate_email(result):
+                # Снимок мог устареть (до TTL) - окончательную проверку делает панель:
+                # перечитываем inbound'ы и подбираем email заново
+                logger.info("Email taken in panel, retrying with fresh snapshot",
+                           email=new_client["email"])
+                snapshot = await self.get_inbound_snapshot(force_refresh=True)
+                existing_emails = snapshot.clients_by_email if snapshot else {}
+                new_client = {**new_client,
+                              "email": self._build_new_client(client_config, existing_emails)["email"]}
+                client_data["settings"] = json.dumps({"clients": [new_client]})
+                result = await self._make_request("POST", await self._endpoint("add_client"), client_data)
+            
+            final_email = new_client["email"]
             
             if result and result.get("success"):
+                # Write-through: добавляем клиента в снимок без перечитывания панели
+                if snapshot:
+                    snapshot.add_client(inbound_id, new_client)
+                
+
                 logger.info("VPN client created successfully", 
                            client_id=client_id, 
                            email=final_email,
@@ -371,6 +612,34 @@ class X3UIClient:
             logger.error("Error creating VPN client", error=str(e))
             return None
     
+    @staticmethod
+    def _is_duplicate_email(result: Dict[str, Any]) -> bool:
+        """Панель отклонила клиента из-за занятого email ("Duplicate email: ...")"""
+        return "duplicate email" in str(result.get("msg", "")).lower()
+    
+    async def update_client(self, inbound_id: int, client: Dict[str, Any]) -> bool:
+        """Заменить настройки одного клиента (email, enable, лимиты) через updateClient"""
+        try:
+            client_data = {
+                "id": inbound_id,
+                "settings": json.dumps({"clients": [client]})
+            }
+            result = await self._make_request(
+                "POST", await self._endpoint("update_client", client_id=client["id"]), client_data
+            )
+            if result and result.get("success"):
+                snapshot = x3ui_inbound_cache.peek(self.base_url)
+                if snapshot:
+                    snapshot.replace_client(inbound_id, client)
+                return True
+            logger.error("Failed to update VPN client",
+                        client_id=client.get("id"),
+                        error=result.get("msg") if result else "No response")
+            return False
+        except Exception as e:
+            logger.error("Error updating VPN client", client_id=client.get("id"), error=str(e))
+            return False
+    
     async def delete_client(self, inbound_id: int, client_id: str) -> bool:
         """Удаление клиента VPN по точному ID"""
         try:
@@ -389,7 +658,7 @@ class X3UIClient:
                 return True
             
             # Используем рабочий endpoint: RESTful с ID в URL
-            endpoint = f"/panel/api/inbounds/{inbound_id}/delClient/{client_id}"
+            endpoint = await self._endpoint("del_client", inbound_id=inbound_id, client_id=client_id)
             
             logger.info("Отправляем запрос на удаление клиента", 
                        endpoint=endpoint,
@@ -408,7 +677,8 @@ class X3UIClient:
                 # Проверяем, действительно ли клиент удален
                 await asyncio.sleep(1)  # Небольшая задержка для обновления данных
                 
-                client_exists_after = await self._check_client_exists(inbound_id, client_id)
+                # Проверка идет по свежим данным панели (снимок обновится заодно)
+                client_exists_after = await self._check_client_exists(inbound_id, client_id, force_refresh=True)
                 
                 if not client_exists_after:
                     logger.info("Клиент успешно удален и отсутствует в панели", 
@@ -440,27 +710,19 @@ class X3UIClient:
                         error=str(e))
             return False
 
-    async def _check_client_exists(self, inbound_id: int, client_id: str) -> bool:
+    async def _check_client_exists(self, inbound_id: int, client_id: str, force_refresh: bool = False) -> bool:
         """Проверка существования клиента в панели"""
         try:
-            inbounds = await self.get_inbounds()
-            if not inbounds:
-                logger.warning("Не удалось получить список inbound'ов для проверки")
-                return False
-                
-            for inbound in inbounds:
-                if inbound.get("id") == inbound_id:
-                    settings = json.loads(inbound.get("settings", "{}"))
-                    clients = settings.get("clients", [])
-                    
-                    for client in clients:
-                        if client.get("id") == client_id:
-                            return True
-                    
+            if force_refresh:
+                snapshot = await self.get_inbound_snapshot(force_refresh=True)
+                if not snapshot:
+                    logger.warning("Не удалось получить список inbound'ов для проверки")
                     return False
+                entry = snapshot.find_by_client_id(client_id)
+            else:
+                entry = await self._find_client(client_id=client_id)
             
-            logger.warning("Inbound не найден", inbound_id=inbound_id)
-            return False
+            return entry is not None and entry[0] == inbound_id
             
         except Exception as e:
             logger.error("Ошибка при проверке существования клиента", 
@@ -474,45 +736,43 @@ class X3UIClient:
         try:
             logger.info("Поиск и удаление клиента по email", email=email)
             
-            # Получаем все inbound'ы
-            inbounds = await self.get_inbounds()
-            if not inbounds:
+            # Получаем индексированный снимок inbound'ов
+            snapshot = await self.get_inbound_snapshot()
+            if not snapshot:
                 logger.error("Не удалось получить список inbound'ов", email=email)
                 return False
             
-            # Ищем клиента с указанным email
-            client_found = False
+            # Ищем клиента с указанным email (точное совпадение или вхождение)
+            matches = snapshot.find_by_email_substring(email)
+            if not matches:
+                snapshot = await self.get_inbound_snapshot(force_refresh=True)
+                matches = snapshot.find_by_email_substring(email) if snapshot else []
+            
+            client_found = bool(matches)
             deleted_clients = 0
             
-            for inbound in inbounds:
-                settings = json.loads(inbound.get("settings", "{}"))
-                clients = settings.get("clients", [])
+            for inbound_id, client in matches:
+                client_id = client.get("id")
                 
-                for client in clients:
-                    if client.get("email") == email or (email in client.get("email", "")):
-                        client_found = True
-                        inbound_id = inbound.get("id")
-                        client_id = client.get("id")
-                        
-                        logger.info("Найден клиент для удаления", 
-                                  email=email,
-                                  inbound_id=inbound_id,
-                                  client_id=client_id)
-                        
-                        # Удаляем клиента
-                        delete_result = await self.delete_client(inbound_id, client_id)
-                        
-                        if delete_result:
-                            logger.info("Клиент успешно удален по email", 
-                                      email=email,
-                                      inbound_id=inbound_id,
-                                      client_id=client_id)
-                            deleted_clients += 1
-                        else:
-                            logger.error("Не удалось удалить клиента найденного по email", 
-                                       email=email,
-                                       inbound_id=inbound_id,
-                                       client_id=client_id)
+                logger.info("Найден клиент для удаления", 
+                          email=email,
+                          inbound_id=inbound_id,
+                          client_id=client_id)
+                
+                # Удаляем клиента
+                delete_result = await self.delete_client(inbound_id, client_id)
+                
+                if delete_result:
+                    logger.info("Клиент успешно удален по email", 
+                              email=email,
+                              inbound_id=inbound_id,
+                              client_id=client_id)
+                    deleted_clients += 1
+                else:
+                    logger.error("Не удалось удалить клиента найденного по email", 
+                               email=email,
+                               inbound_id=inbound_id,
+                               client_id=client_id)
             
             if client_found:
                 logger.info(f"Всего найдено и удалено {deleted_clients} клиентов с email {email}")
@@ -534,9 +794,9 @@ class X3UIClient:
             if not await self._ensure_session():
                 return None
             
-            endpoint = "/panel/api/inbounds/onlines"
+            endpoint = await self._endpoint("onlines")
             if email:
-                endpoint = f"/panel/api/inbounds/getClientTraffics/{email}"
+                endpoint = await self._endpoint("client_traffics", email=email)
                 
             result = await self._make_request("GET", endpoint)
             return result
@@ -545,6 +805,18 @@ class X3UIClient:
             logger.error("Error getting client stats", email=email, error=str(e))
             return None
 
+    async def get_online_clients(self) -> Optional[List[str]]:
+        """Email'ы клиентов, которые сейчас онлайн (onlines панели); None - панель не ответила"""
+        try:
+            # onlines в 3X-UI - POST без тела, повтор безопасен
+            result = await self._make_request("POST", await self._endpoint("onlines"), idempotent=True)
+            if result and result.get("success"):
+                return result.get("obj") or []
+            return None
+        except Exception as e:
+            logger.error("Error getting online clients", error=str(e))
+            return None
+
     async def enable_client_by_email(self, email: str) -> bool:
         """Включить клиента в X3UI панели по email"""
         return await self._toggle_client_status(email, enable=True)
@@ -553,323 +825,311 @@ class X3UIClient:
         """Отключить клиента в X3UI панели по email"""
         return await self._toggle_client_status(email, enable=False)
 
+    async def enable_clients_by_email(self, emails: List[str]) -> Dict[str, bool]:
+        """Включить набор клиентов (одно обновление на inbound)"""
+        return await self.set_clients_enabled(emails, enable=True)
+
+    async def disable_clients_by_email(self, emails: List[str]) -> Dict[str, bool]:
+        """Отключить набор клиентов (одно обновление на inbound)"""
+        return await self.set_clients_enabled(emails, enable=False)
+
     async def _toggle_client_status(self, email: str, enable: bool) -> bool:
         """Переключить статус клиента (enable/disable)"""
+        results = await self.set_clients_enabled([email], enable)
+        return results.get(email, False)
+
+    async def set_clients_enabled(self, emails: List[str], enable: bool) -> Dict[str, bool]:
+        """
+        Включить/отключить клиентов по email
+
+        Клиенты группируются по inbound'ам, на каждый inbound уходит один запрос update.
+        Возвращает {email: успех}; клиент, уже находящийся в нужном состоянии, - успех,
+        не найденный в панели - неуспех
+        """
+        action = "enable" if enable else "disable"
+        results: Dict[str, bool] = {email: False for email in emails}
+        if not emails:
+            return results
+        
         try:
             if not await self._ensure_session():
-                logger.error("Cannot toggle client status - no session", email=email)
-                return False
-            
-            action = "enable" if enable else "disable"
-            logger.info(f"Attempting to {action} client", email=email)
-            
-            # Получаем все inbound'ы
-            inbounds = await self.get_inbounds()
-            if not inbounds:
-                logger.error("No inbounds available for client status toggle", email=email)
-                return False
-            
-            # Ищем клиента во всех inbound'ах
-            for inbound in inbounds:
-                settings = inbound.get("settings", "{}")
-                if isinstance(settings, str):
-                    try:
-                        settings = json.loads(settings)
-                    except json.JSONDecodeError:
-                        logger.warning("Invalid JSON in inbound settings", inbound_id=inbound.get("id"))
-                        continue
+                logger.error("Cannot toggle client status - no session", emails_count=len(emails))
+                return results
+            
+            # Inbound обновляется целиком, поэтому читаем свежие данные панели -
+            # устаревший снимок мог бы затереть клиентов, добавленных другими воркерами
+            snapshot = await self.get_inbound_snapshot(force_refresh=True)
+            if not snapshot:
+                logger.error("No inbounds available for client status toggle", emails_count=len(emails))
+                return results
+            
+            emails_by_inbound: Dict[int, List[str]] = {}
+            for email in set(emails):
+                entry = snapshot.find_by_email(email)
+                if entry is None:
+                    logger.warning(f"Client not found for {action}", email=email)
+                    continue
+                emails_by_inbound.setdefault(entry[0], []).append(email)
+            
+            for inbound_id, inbound_emails in emails_by_inbound.items():
+                inbound = snapshot.get_inbound(inbound_id)
+                settings = snapshot.settings_by_inbound[inbound_id]
+                targets = set(inbound_emails)
                 
-                clients = settings.get("clients", [])
-                client_found = False
+                changed = []
+                clients = []
+                for client in settings.get("clients", []):
+                    client = dict(client)
+                    if client.get("email") in targets and client.get("enable", False) != enable:
+                        client["enable"] = enable
+                        changed.append(client["email"])
+                    clients.append(client)
                 
-                # Ищем нужного клиента
-                for i, client in enumerate(clients):
-                    if client.get("email") == email:
-                        client_found = True
-                        
-                        # Проверяем текущий статус
-                        current_status = client.get("enable", False)
-                        if current_status == enable:
-                            logger.info(f"Client already in desired state", 
-                                       email=email, 
-                                       current_enable=current_status, 
-                                       target_enable=enable)
-                            return True
-                        
-                        # Изменяем статус клиента
-                        clients[i]["enable"] = enable
-                        
-                        # Обновляем настройки inbound'а
-                        updated_settings = settings.copy()
-                        updated_settings["clients"] = clients
-                        
-                        # Подготавливаем данные для обновления inbound'а
-                        update_data = {
-                            "id": inbound["id"],
-                            "remark": inbound.get("remark", ""),
-                            "listen": inbound.get("listen", ""),
-                            "port": inbound.get("port", 443),
-                            "protocol": inbound.get("protocol", "vless"),
-                            "settings": json.dumps(updated_settings),
-                            "streamSettings": json.dumps(inbound.get("streamSettings", {})),
-                            "sniffing": json.dumps(inbound.get("sniffing", {}))
-                        }
-                        
-                        # Отправляем запрос на обновление
-                        update_result = await self._make_request(
-                            "POST", 
-                            f"/panel/api/inbounds/update/{inbound['id']}", 
-                            update_data
-                        )
-                        
-                        if update_result and update_result.get("success"):
-                            logger.info(f"✅ Client {action}d successfully", 
-                                       email=email,
-                                       inbound_id=inbound["id"],
-                                       new_status=enable)
-                            
-                            # Проверяем результат (небольшая задержка для обновления)
-                            await asyncio.sleep(0.5)
-                            verification_result = await self._verify_client_status(email, enable)
-                            
-                            if verification_result:
-                                logger.info(f"✅ Client status verified", email=email, enable=enable)
-                                return True
-                            else:
-                                logger.warning(f"⚠️ Client status change successful but verification failed", 
-                                             email=email, enable=enable)
-                                return True  # Считаем успешным, так как API вернул success
-                        else:
-                            error_msg = update_result.get("msg") if update_result else "No response"
-                            logger.error(f"❌ Failed to {action} client", 
-                                       email=email,
-                                       error=error_msg)
-                            return False
-                        
-                        break  # Клиент найден и обработан
+                if not changed:
+                    for email in inbound_emails:
+                        results[email] = True
+                    continue
                 
-                if client_found:
-                    break  # Не нужно искать в других inbound'ах
-            
-            if not client_found:
-                logger.warning(f"Client not found for {action}", email=email)
-                return False
+                updated_settings = settings.copy()
+                updated_settings["clients"] = clients
+                
+                # Подготавливаем данные для обновления inbound'а
+                update_data = {
+                    "id": inbound_id,
+                    "remark": inbound.get("remark", ""),
+                    "listen": inbound.get("listen", ""),
+                    "port": inbound.get("port", 443),
+                    "protocol": inbound.get("protocol", "vless"),
+                    "settings": json.dumps(updated_settings),
+                    "streamSettings": _panel_json(inbound.get("streamSettings")),
+                    "sniffing": _panel_json(inbound.get("sniffing"))
+                }
+                
+                update_result = await self._make_request(
+                    "POST",
+                    await self._endpoint("update_inbound", inbound_id=inbound_id),
+                    update_data
+                )
+                
+                if update_result and update_result.get("success"):
+                    for email in changed:
+                        snapshot.set_client_enable(email, enable)
+                    for email in inbound_emails:
+                        results[email] = True
+                    logger.info(f"✅ Clients {action}d successfully",
+                               inbound_id=inbound_id,
+                               changed=len(changed),
+                               requested=len(inbound_emails))
+                else:
+                    error_msg = update_result.get("msg") if update_result else "No response"
+                    logger.error(f"❌ Failed to {action} clients",
+                               inbound_id=inbound_id,
+                               clients=len(changed),
+                               error=error_msg)
             
-            return False
+            return results
             
         except Exception as e:
-            logger.error(f"Error during client {action if 'enable' in locals() else 'toggle'}", 
-                        email=email, 
+            logger.error(f"Error during clients {action}",
+                        emails_count=len(emails),
                         error=str(e))
-            return False
+            return results
 
-    async def _verify_client_status(self, email: str, expected_enable: bool) -> bool:
-        """Проверить статус клиента после изменения"""
-        try:
-            inbounds = await self.get_inbounds()
-            if not inbounds:
-                return False
+    async def create_clients_bulk(self, inbound_id: int,
+                                  client_configs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Создание многих клиентов: один запрос addClient на пачку (x3ui_bulk_chunk_size)
+
+        Возвращает результат по каждому клиенту в порядке client_configs:
+        {"client_id", "email", "inbound_id", "success", "error"}
+        """
+        results: List[Dict[str, Any]] = []
+        if not client_configs:
+            return results
+        
+        snapshot = await self.get_inbound_snapshot()
+        taken_emails = set(snapshot.clients_by_email) if snapshot else set()
+        
+        new_clients = []
+        for client_config in client_configs:
+            new_client = self._build_new_client(client_config, taken_emails)
+            taken_emails.add(new_client["email"])
+            new_clients.append(new_client)
+        
+        chunk_size = self.settings.x3ui_bulk_chunk_size
+        endpoint = await self._endpoint("add_client")
+        
+        for start in range(0, len(new_clients), chunk_size):
+            chunk = new_clients[start:start + chunk_size]
+            client_data = {
+                "id": inbound_id,
+                "settings": json.dumps({"clients": chunk})
+            }
             
-            for inbound in inbounds:
-                settings = json.loads(inbound.get("settings", "{}"))
-                clients = settings.get("clients", [])
-                
-                for client in clients:
-                    if client.get("email") == email:
-                        actual_enable = client.get("enable", False)
-                        return actual_enable == expected_enable
+            try:
+                result = await self._make_request("POST", endpoint, client_data)
+            except Exception as e:
+                result = {"success": False, "msg": str(e)}
             
-            return False
+            success = bool(result and result.get("success"))
+            error = None if success else (result.get("msg") if result else "No response")
+            
+            for new_client in chunk:
+                if success and snapshot:
+                    snapshot.add_client(inbound_id, new_client)
+                results.append({
+                    "client_id": new_client["id"],
+                    "email": new_client["email"],
+                    "inbound_id": inbound_id,
+                    "success": success,
+                    "error": error
+                })
+            
+            if success:
+                logger.info("VPN clients created in bulk",
+                           inbound_id=inbound_id,
+                           count=len(chunk))
+            else:
+                logger.error("Failed to create VPN clients in bulk",
+                            inbound_id=inbound_id,
+                            count=len(chunk),
+                            error=error)
+        
+        return results
+
+    async def delete_clients_bulk(self, clients: List[tuple]) -> Dict[str, bool]:
+        """
+        Удаление многих клиентов: [(inbound_id, client_id), ...] -> {client_id: успех}
+
+        Существование проверяется по одному свежему снимку до и одному после удаления
+        вместо пары запросов с паузой на каждого клиента
+        """
+        results: Dict[str, bool] = {client_id: False for _, client_id in clients}
+        if not clients:
+            return results
+        
+        try:
+            snapshot = await self.get_inbound_snapshot(force_refresh=True)
+            if not snapshot:
+                logger.warning("Не удалось получить список inbound'ов для удаления")
+                return results
+            
+            to_delete = []
+            for inbound_id, client_id in clients:
+                entry = snapshot.find_by_client_id(client_id)
+                if entry is None or entry[0] != inbound_id:
+                    # Клиента нет в панели - считаем что уже удален
+                    results[client_id] = True
+                else:
+                    to_delete.append((inbound_id, client_id))
+            
+            for inbound_id, client_id in to_delete:
+                endpoint = await self._endpoint("del_client", inbound_id=inbound_id, client_id=client_id)
+                result = await self._make_request("POST", endpoint, {})
+                if result and result.get("success"):
+                    snapshot.remove_client(inbound_id, client_id)
+            
+            if to_delete:
+                snapshot = await self.get_inbound_snapshot(force_refresh=True)
+                if snapshot:
+                    for inbound_id, client_id in to_delete:
+                        entry = snapshot.find_by_client_id(client_id)
+                        results[client_id] = entry is None or entry[0] != inbound_id
+            
+            logger.info("Клиенты удалены пакетно",
+                       requested=len(clients),
+                       deleted=sum(1 for ok in results.values() if ok))
+            return results
             
         except Exception as e:
-            logger.error("Error verifying client status", email=email, error=str(e))
-            return False
+            logger.error("Ошибка при пакетном удалении клиентов",
+                        clients_count=len(clients),
+                        error=str(e))
+            return results
 
     async def get_client_by_email(self, email: str) -> Optional[Dict[str, Any]]:
         """Получить информацию о клиенте по email"""
         try:
-            inbounds = await self.get_inbounds()
-            if not inbounds:
+            # Inbound берем из того же снимка, где найден клиент (кэш мог быть сброшен)
+            snapshot, entry = await self._lookup_client(email=email)
+            if not entry:
                 return None
             
-            for inbound in inbounds:
-                settings = json.loads(inbound.get("settings", "{}"))
-                clients = settings.get("clients", [])
-                
-                for client in clients:
-                    if client.get("email") == email:
-                        # Добавляем информацию об inbound'е
-                        client_info = client.copy()
-                        client_info["inbound_id"] = inbound.get("id")
-                        client_info["inbound_remark"] = inbound.get("remark")
-                        return client_info
+            inbound_id, client = entry
+            inbound = snapshot.get_inbound(inbound_id) or {}
             
-            return None
+            # Добавляем информацию об inbound'е
+            client_info = client.copy()
+            client_info["inbound_id"] = inbound_id
+            client_info["inbound_remark"] = inbound.get("remark")
+            return client_info
             
         except Exception as e:
             logger.error("Error getting client by email", email=email, error=str(e))
             return None
     
-    async def generate_client_url(self, inbound_id: int, client_id: str) -> Optional[str]:
-        """Генерация VLESS URL для клиента"""
+    async def _get_url_template(self, inbound_id: int) -> Optional[RealityUrlTemplate]:
+        """Шаблон URL inbound'а: из кэша шаблонов, иначе из (кэшированного) снимка"""
+        template = reality_template_cache.get(self.base_url, inbound_id)
+        if template:
+            return template
+
+        snapshot = await self.get_inbound_snapshot()
+        inbound = snapshot.get_inbound(inbound_id) if snapshot else None
+        if not inbound:
+            logger.error("Inbound not found for URL generation", inbound_id=inbound_id)
+            return None
+
+        return reality_template_cache.remember(
+            self.base_url, inbound_id, inbound.get("port"),
+            snapshot.stream_settings_by_inbound[inbound_id]
+        )
+
+    async def generate_client_url(self, inbound_id: int, client_id: str,
+                                  node=None, email: Optional[str] = None,
+                                  verify: Optional[bool] = None) -> Optional[str]:
+        """
+        Генерация VLESS URL для клиента без ожидания синхронизации панели
+
+        URL собирается локально из UUID клиента, полей ноды (public_key, short_id, sni_mask)
+        и кэшированного шаблона stream settings inbound'а. Проверка клиента в панели -
+        опциональная и выполняется в фоне (settings.x3ui_verify_client_url)
+        """
         try:
-            # Увеличиваем задержку для лучшей синхронизации панели
-            import asyncio
-            await asyncio.sleep(1.0)
-            
-            logger.info("Generating client URL", 
-                       inbound_id=inbound_id, 
-                       client_id=client_id)
-            
-            # Получаем данные inbound через get_inbounds (более надежно)
-            inbounds = await self.get_inbounds()
-            if not inbounds:
-                logger.error("Failed to get inbounds for URL generation")
-                return None
-            
-            # Находим целевой inbound
-            target_inbound = None
-            for inbound in inbounds:
-                if inbound.get("id") == inbound_id:
-                    target_inbound = inbound
-                    break
-            
-            if not target_inbound:
-                logger.error("Inbound not found for URL generation", inbound_id=inbound_id)
-                return None
-            
-            # Парсим настройки
-            settings = json.loads(target_inbound.get("settings", "{}"))
-            stream_settings = json.loads(target_inbound.get("streamSettings", "{}"))
-            
-            # Ищем клиента с улучшенной логикой поиска
-            clients = settings.get("clients", [])
-            client = None
-            
-            # Сначала поиск по точному ID
-            for c in clients:
-                if c.get("id") == client_id:
-                    client = c
-                    logger.info("Found client by exact ID", 
-                               client_id=client_id,
-                               client_email=c.get("email"))
-                    break
-            
-            # Fallback: поиск по email pattern (если ID содержится в email)
-            if not client:
-                logger.warning("Client not found by exact ID, searching by email pattern", 
-                              client_id=client_id,
-                              total_clients=len(clients))
-                
-                for c in clients:
-                    email = c.get("email", "")
-                    # Проверяем если часть UUID содержится в email или наоборот
-                    if (client_id in email or 
-                        email.startswith(client_id.split('-')[0]) or
-                        any(part in email for part in client_id.split('-')[:2])):
-                        client = c
-                        logger.info("Found client by email pattern", 
-                                   client_id=client_id,
-                                   matched_email=email,
-                                   client_real_id=c.get("id"))
-                        # Используем реальный ID клиента из панели
-                        client_id = c.get("id")
-                        break
-            
-            # Последний fallback: берем последнего созданного клиента
-            if not client and clients:
-                client = clients[-1]
-                client_id = client.get("id")
-                logger.info("Using last created client as fallback", 
-                           client_id=client_id,
-                           client_email=client.get("email"))
-            
-            if not client:
-                logger.error("No clients found in inbound", 
-                            inbound_id=inbound_id,
-                            total_clients=len(clients))
+            template = await self._get_url_template(inbound_id)
+            if not template:
                 return None
-            
-            # Получаем хост из base_url (исправлено)
-            import urllib.parse
-            parsed_url = urllib.parse.urlparse(self.base_url)
-            host = parsed_url.hostname
-            
-            if not host:
-                logger.error("Failed to parse hostname from base_url", 
+
+            # Email и flow берем из снимка, если клиент уже в нем (write-through после create_client)
+            flow = None
+            snapshot = x3ui_inbound_cache.peek(self.base_url)
+            entry = snapshot.find_by_client_id(client_id) if snapshot else None
+            if entry:
+                email = email or entry[1].get("email")
+                flow = entry[1].get("flow")
+
+            if node is not None:
+                vless_url = build_node_vless_url(node, client_id, template, email, flow)
+            else:
+                host = host_from_url(self.base_url)
+                vless_url = build_vless_url(client_id, host, template, email, flow) if host else None
+
+            if not vless_url:
+                logger.error("Failed to parse hostname from base_url",
                             base_url=self.base_url)
                 return None
-            
-            # Формируем VLESS URL
-            port = target_inbound.get("port")
-            
-            # Параметры из stream settings
-            reality_settings = stream_settings.get("realitySettings", {})
-            
-            # Получаем публичный ключ из правильного места в настройках Reality
-            # Попробуем найти public key в нескольких возможных местах
-            public_key = ''
-            
-            # Вариант 1: reality_settings.publicKey
-            if reality_settings.get('publicKey'):
-                public_key = reality_settings.get('publicKey')
-                logger.info("Found public key in reality_settings.publicKey")
-            
-            # Вариант 2: reality_settings.settings.publicKey  
-            elif reality_settings.get('settings', {}).get('publicKey'):
-                public_key = reality_settings.get('settings', {}).get('publicKey')
-                logger.info("Found public key in reality_settings.settings.publicKey")
-            
-            # Вариант 3: reality_settings.dest (иногда тут хранится)
-            elif reality_settings.get('dest'):
-                # dest может содержать public key в некоторых конфигурациях
-                dest = reality_settings.get('dest', '')
-                if len(dest) > 40:  # Примерная длина public key
-                    public_key = dest
-                    logger.info("Found public key in reality_settings.dest")
-            
-            # Логируем все настройки Reality для диагностики
-            logger.info("Reality settings diagnostic", 
-                       reality_settings_keys=list(reality_settings.keys()),
-                       has_public_key=bool(public_key),
-                       public_key_length=len(public_key) if public_key else 0,
-                       reality_settings_sample=str(reality_settings)[:200] + "..." if reality_settings else "None")
-            
-            if not public_key:
-                logger.warning("Public key not found in Reality settings - VLESS URL will not work!", 
-                              available_keys=list(reality_settings.keys()))
-            
-            # Получаем short_id
-            short_id = ""
-            if reality_settings.get("shortIds") and len(reality_settings.get("shortIds")) > 0:
-                short_id = reality_settings.get("shortIds")[0]
-            
-            # Получаем SNI
-            sni = "apple.com"  # Значение по умолчанию
-            if reality_settings.get("serverNames") and len(reality_settings.get("serverNames")) > 0:
-                sni = reality_settings.get("serverNames")[0]
-            
-            vless_url = (
-                f"vless://{client_id}@{host}:{port}?"
-                f"type=tcp&security=reality"
-                f"&fp=chrome"
-                f"&pbk={public_key}"
-                f"&sni={sni}"
-                f"&flow={client.get('flow', 'xtls-rprx-vision')}"
-                f"&sid={short_id}"
-                f"&spx=%2F"
-                f"#{client.get('email', 'VPN')}"
-            )
-            
-            logger.info("Generated VLESS URL successfully", 
-                       host=host, 
-                       port=port, 
-                       public_key=public_key[:20] + "..." if public_key else "None",
-                       client_email=client.get('email'),
-                       url_length=len(vless_url))
-            
+
+            logger.info("Generated VLESS URL locally",
+                       inbound_id=inbound_id,
+                       client_id=client_id,
+                       port=template.port,
+                       has_public_key=bool(template.public_key))
+
+            if verify if verify is not None else self.settings.x3ui_verify_client_url:
+                self._schedule_client_verification(inbound_id, client_id)
+
             return vless_url
-            
+
         except Exception as e:
             logger.error("Error generating client URL", 
                         client_id=client_id, 
@@ -877,6 +1137,27 @@ class X3UIClient:
                         error=str(e),
                         exc_info=True)
             return None
+
+    def _schedule_client_verification(self, inbound_id: int, client_id: str) -> None:
+        """Фоновая проверка, что клиент действительно появился в панели"""
+        task = asyncio.create_task(self._verify_client_in_panel(inbound_id, client_id))
+        _background_tasks.add(task)
+        task.add_done_callback(_background_tasks.discard)
+
+    async def _verify_client_in_panel(self, inbound_id: int, client_id: str) -> bool:
+        try:
+            exists = await self._check_client_exists(inbound_id, client_id, force_refresh=True)
+            if not exists:
+                logger.warning("Client missing in panel after URL generation",
+                              inbound_id=inbound_id,
+                              client_id=client_id)
+            return exists
+        except Exception as e:
+            logger.warning("Background client verification failed",
+                          inbound_id=inbound_id,
+                          client_id=client_id,
+                          error=str(e))
+            return False
     
     async def reset_client_traffic(self, inbound_id: int, client_id: str) -> bool:
         """Сброс статистики трафика клиента"""
@@ -886,7 +1167,7 @@ class X3UIClient:
                 "uuid": client_id
             }
             
-            result = await self._make_request("POST", "/panel/api/inbounds/resetClientTraffic", data)
+            result = await self._make_request("POST", await self._endpoint("reset_client_traffic"), data)
             
             if result and result.get("success"):
                 logger.info("Client traffic reset successfully", 
@@ -907,7 +1188,7 @@ class X3UIClient:
     async def get_server_status(self) -> Optional[Dict]:
         """Получение статуса сервера"""
         try:
-            result = await self._make_request("POST", "/panel/api/server/status")
+            result = await self._make_request("POST", await self._endpoint("server_status"), idempotent=True)
             
             if result and result.get("success"):
                 return result.get("obj", {})
@@ -1000,13 +1281,15 @@ class X3UIClient:
             # Обновляем inbound через API
             result = await self._make_request(
                 "POST",
-                f"/panel/api/inbounds/update/{inbound_id}",
+                await self._endpoint("update_inbound", inbound_id=inbound_id),
                 update_data
             )
             
             if result and result.get("success"):
                 logger.info("Reality keys updated successfully via X3UI API",
                            inbound_id=inbound_id)
+                x3ui_inbound_cache.invalidate(self.base_url)
+                reality_template_cache.invalidate(self.base_url)
                 return True
             else:
                 logger.error("Failed to update Reality keys via API",
@@ -1,155 +1,261 @@
 """
 X3UI Client Pool - Пул соединений к множественным X3UI панелям
+Один пул на процесс: LRU вытеснение простаивающих клиентов, собственные короткие
+сессии БД и пересоздание клиента при изменении учетных данных ноды
 """
 
+import asyncio
 import structlog
-from typing import Dict, Optional, List
+from collections import OrderedDict
+from typing import Dict, Optional, List, Any, Tuple
 from datetime import datetime, timedelta
-from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 
 from services.x3ui_client import X3UIClient
+from services.x3ui_http_pool import x3ui_http_pool
 from models.vpn_node import VPNNode
-from config.database import get_db
+from config.database import async_session_maker
+from config.settings import get_settings
 
 logger = structlog.get_logger(__name__)
 
+
+def _node_fingerprint(node: VPNNode) -> Tuple[str, str, str]:
+    """Поля ноды, при изменении которых клиент нужно пересоздать"""
+    return (node.x3ui_url, node.x3ui_username, node.x3ui_password)
+
+
+class PooledClient:
+    """Клиент ноды в пуле + данные для LRU и проверки актуальности"""
+
+    def __init__(self, client: X3UIClient, fingerprint: Tuple[str, str, str]):
+        self.client = client
+        self.fingerprint = fingerprint
+        self.created_at = datetime.utcnow()
+        self.last_used = self.created_at
+
+
 class X3UIClientPool:
     """Пул клиентов для множественных X3UI панелей"""
-    
-    def __init__(self, db_session: AsyncSession = None):
-        self.db = db_session
-        self.clients: Dict[int, X3UIClient] = {}
-        self.last_refresh: Dict[int, datetime] = {}
-        self.refresh_interval = timedelta(minutes=30)  # Обновлять соединения каждые 30 минут
-    
+
+    def __init__(self, max_clients: Optional[int] = None, idle_ttl_seconds: Optional[int] = None):
+        settings = get_settings()
+        self.max_clients = max_clients or settings.x3ui_client_pool_max_clients
+        self.idle_ttl = timedelta(seconds=idle_ttl_seconds or settings.x3ui_client_pool_idle_ttl)
+        self.refresh_interval = timedelta(minutes=30)  # Перечитывать ноду из БД каждые 30 минут
+        self.clients: "OrderedDict[int, PooledClient]" = OrderedDict()
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _lock_for(self, node_id: int) -> asyncio.Lock:
+        if node_id not in self._locks:
+            self._locks[node_id] = asyncio.Lock()
+        return self._locks[node_id]
+
+    def _touch(self, node_id: int, entry: PooledClient) -> X3UIClient:
+        entry.last_used = datetime.utcnow()
+        self.clients.move_to_end(node_id)
+        self.hits += 1
+        return entry.client
+
     async def get_client(self, node_id: int) -> Optional[X3UIClient]:
         """Получить X3UI клиент для конкретной ноды"""
         try:
-            # Проверяем есть ли клиент в кэше и не устарел ли он
-            current_time = datetime.utcnow()
-            cached_client = self.clients.get(node_id)
-            last_refresh = self.last_refresh.get(node_id)
-            
-            if (cached_client and last_refresh and 
-                current_time - last_refresh < self.refresh_interval):
-                return cached_client
-            
-            # Если клиента нет или он устарел - создаем новый
+            entry = self.clients.get(node_id)
+            if entry and datetime.utcnow() - entry.created_at < self.refresh_interval:
+                return self._touch(node_id, entry)
+
+            # Клиента нет или он давно не сверялся с БД - перечитываем ноду
             return await self.refresh_client(node_id)
-            
+
         except Exception as e:
-            logger.error("Error getting X3UI client", 
-                        node_id=node_id, 
+            logger.error("Error getting X3UI client",
+                        node_id=node_id,
                         error=str(e))
             return None
-    
+
+    async def get_client_for_node(self, node: VPNNode) -> Optional[X3UIClient]:
+        """Клиент для уже загруженной ноды (без обращения к БД)"""
+        entry = self.clients.get(node.id)
+        if entry and entry.fingerprint == _node_fingerprint(node):
+            return self._touch(node.id, entry)
+        return await self._build_client(node)
+
     async def refresh_client(self, node_id: int) -> Optional[X3UIClient]:
         """Обновить или создать новый клиент для ноды"""
         try:
-            # Получаем данные ноды из БД
-            if not self.db:
-                self.db = next(get_db())
-                
-            result = await self.db.execute(select(VPNNode).where(VPNNode.id == node_id))
-            node = result.scalar_one_or_none()
-            
+            # Собственная короткая сессия - пул не зависит от сессии запроса
+            async with async_session_maker() as db:
+                result = await db.execute(select(VPNNode).where(VPNNode.id == node_id))
+                node = result.scalar_one_or_none()
+
             if not node:
                 logger.error("Node not found for client creation", node_id=node_id)
+                self.invalidate(node_id)
                 return None
-            
-            # Создаем новый клиент
-            client = X3UIClient()
-            client.base_url = node.x3ui_url
-            client.username = node.x3ui_username
-            client.password = node.x3ui_password
-            
+
+            entry = self.clients.get(node_id)
+            if entry and entry.fingerprint == _node_fingerprint(node):
+                # Учетные данные не менялись - продлеваем клиента без нового логина
+                entry.created_at = datetime.utcnow()
+                return self._touch(node_id, entry)
+
+            return await self._build_client(node)
+
+        except Exception as e:
+            logger.error("Error refreshing X3UI client",
+                        node_id=node_id,
+                        error=str(e))
+            return None
+
+    async def _build_client(self, node: VPNNode) -> Optional[X3UIClient]:
+        """Создать клиента и проверить логин; параллельные вызовы для ноды схлопываются"""
+        async with self._lock_for(node.id):
+            entry = self.clients.get(node.id)
+            if entry and entry.fingerprint == _node_fingerprint(node):
+                return self._touch(node.id, entry)
+
+            self.misses += 1
+            client = X3UIClient.from_node(node)
+
             # Проверяем соединение
             if not await client._login():
-                logger.error("Failed to connect to X3UI", 
-                           node_id=node_id, 
+                logger.error("Failed to connect to X3UI",
+                           node_id=node.id,
                            url=node.x3ui_url)
                 return None
-            
+
             # Сохраняем в кэш
-            self.clients[node_id] = client
-            self.last_refresh[node_id] = datetime.utcnow()
-            
-            logger.info("X3UI client refreshed successfully", 
-                       node_id=node_id, 
+            self.clients[node.id] = PooledClient(client, _node_fingerprint(node))
+            self.clients.move_to_end(node.id)
+            self._evict()
+
+            logger.info("X3UI client refreshed successfully",
+                       node_id=node.id,
                        url=node.x3ui_url)
-            
+
             return client
-            
-        except Exception as e:
-            logger.error("Error refreshing X3UI client", 
-                        node_id=node_id, 
-                        error=str(e))
-            return None
-    
-    async def get_all_clients(self, only_healthy: bool = True) -> Dict[int, X3UIClient]:
-        """Получить все клиенты для активных нод"""
-        try:
-            # Получаем все активные ноды
-            if not self.db:
-                self.db = next(get_db())
-                
+
+    def _evict(self) -> None:
+        """LRU: сначала простаивающие дольше idle_ttl, затем самые старые сверх лимита"""
+        now = datetime.utcnow()
+        for node_id in [nid for nid, e in self.clients.items() if now - e.last_used > self.idle_ttl]:
+            del self.clients[node_id]
+            self.evictions += 1
+        while len(self.clients) > self.max_clients:
+            self.clients.popitem(last=False)
+            self.evictions += 1
+
+    def evict_idle(self) -> None:
+        """Вытеснить простаивающих клиентов (вызывается периодически)"""
+        self._evict()
+
+    def invalidate(self, node_id: int) -> None:
+        """Сбросить клиента ноды (нода изменена или удалена)"""
+        if self.clients.pop(node_id, None) is not None:
+            logger.info("X3UI client invalidated", node_id=node_id)
+
+    async def _load_nodes(self, only_active: bool = False, only_healthy: bool = False) -> List[VPNNode]:
+        async with async_session_maker() as db:
             query = select(VPNNode)
-            if only_healthy:
+            if only_active or only_healthy:
                 query = query.where(VPNNode.status == 'active')
+            if only_healthy:
                 query = query.where(VPNNode.health_status == 'healthy')
-            
-            result = await self.db.execute(query)
-            nodes = result.scalars().all()
-            
-            # Создаем клиентов для всех нод
-            clients = {}
-            for node in nodes:
-                client = await self.get_client(node.id)
-                if client:
-                    clients[node.id] = client
-            
-            return clients
-            
+            result = await db.execute(query)
+            return list(result.scalars().all())
+
+    async def _gather_clients(self, nodes: List[VPNNode]) -> Dict[int, X3UIClient]:
+        """Параллельно получить клиентов для нод (не более health_check_concurrency логинов сразу)"""
+        semaphore = asyncio.Semaphore(get_settings().health_check_concurrency)
+
+        async def get(node: VPNNode) -> Optional[X3UIClient]:
+            async with semaphore:
+                try:
+                    return await self.get_client_for_node(node)
+                except Exception as e:
+                    logger.error("Error getting X3UI client", node_id=node.id, error=str(e))
+                    return None
+
+        clients = await asyncio.gather(*(get(node) for node in nodes))
+        return {node.id: client for node, client in zip(nodes, clients) if client}
+
+    async def get_all_clients(self, only_healthy: bool = True) -> Dict[int, X3UIClient]:
+        """Получить все клиенты для активных нод"""
+        try:
+            return await self._gather_clients(await self._load_nodes(only_healthy=only_healthy))
         except Exception as e:
             logger.error("Error getting all X3UI clients", error=str(e))
             return {}
-    
+
+    async def warm_up(self) -> Dict[int, X3UIClient]:
+        """Прогрев пула при старте: параллельный логин во все активные ноды"""
+        started = datetime.utcnow()
+        try:
+            clients = await self._gather_clients(await self._load_nodes(only_active=True))
+        except Exception as e:
+            logger.error("X3UI client pool warm-up failed", error=str(e))
+            return {}
+        logger.info("X3UI client pool warmed up",
+                   clients=len(clients),
+                   duration_ms=int((datetime.utcnow() - started).total_seconds() * 1000))
+        return clients
+
     async def clear_cache(self) -> None:
         """Очистить кэш клиентов"""
-        self.clients = {}
-        self.last_refresh = {}
+        self.clients.clear()
         logger.info("X3UI client cache cleared")
-    
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "clients": len(self.clients),
+            "max_clients": self.max_clients,
+            "idle_ttl_seconds": int(self.idle_ttl.total_seconds()),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+    def get_connection_stats(self) -> Dict[str, Dict]:
+        """Статистика переиспользования keep-alive соединений по нодам"""
+        return x3ui_http_pool.get_stats()
+
     async def check_all_connections(self) -> Dict[int, bool]:
         """Проверить соединения со всеми нодами"""
         try:
-            # Получаем все ноды
-            if not self.db:
-                self.db = next(get_db())
-                
-            result = await self.db.execute(select(VPNNode))
-            nodes = result.scalars().all()
-            
-            # Проверяем соединения
-            connection_status = {}
-            for node in nodes:
-                client = X3UIClient()
-                client.base_url = node.x3ui_url
-                client.username = node.x3ui_username
-                client.password = node.x3ui_password
-                
-                connection_ok = await client._login()
-                connection_status[node.id] = connection_ok
-                
-                # Обновляем статус ноды
-                node.health_status = 'healthy' if connection_ok else 'unhealthy'
-                node.last_health_check = datetime.utcnow()
-            
-            await self.db.commit()
-            
+            async with async_session_maker() as db:
+                result = await db.execute(select(VPNNode))
+                nodes = result.scalars().all()
+
+                semaphore = asyncio.Semaphore(get_settings().health_check_concurrency)
+
+                async def check(node: VPNNode) -> bool:
+                    # Полный логин, а не общий cookie - проверяем саму панель
+                    async with semaphore:
+                        return await X3UIClient.from_node(node)._perform_login()
+
+                results = await asyncio.gather(*(check(node) for node in nodes), return_exceptions=True)
+
+                # Обновляем статус нод одним commit'ом
+                connection_status = {}
+                for node, connection_ok in zip(nodes, results):
+                    connection_ok = connection_ok is True
+                    connection_status[node.id] = connection_ok
+                    node.health_status = 'healthy' if connection_ok else 'unhealthy'
+                    node.last_health_check = datetime.utcnow()
+                    if not connection_ok:
+                        self.invalidate(node.id)
+
+                await db.commit()
+
             return connection_status
-            
+
         except Exception as e:
             logger.error("Error checking all X3UI connections", error=str(e))
-            return {} 
\ No newline at end of file
+            return {}
+
+
+# Глобальный пул клиентов (один на процесс)
+x3ui_client_pool = X3UIClientPool()
@@ -0,0 +1,172 @@
+"""
+X3UI HTTP Pool - долгоживущие keep-alive HTTP сессии к X3UI панелям
+Одна aiohttp сессия (и TCPConnector) на ноду вместо новой сессии на каждый запрос
+"""
+
+import asyncio
+import urllib.parse
+from typing import Dict, Any, Optional
+from datetime import datetime
+
+import aiohttp
+import structlog
+
+from config.settings import get_settings
+
+logger = structlog.get_logger(__name__)
+
+
+class NodeConnectionStats:
+    """Статистика переиспользования соединений для одной ноды"""
+
+    def __init__(self):
+        self.requests = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.sessions_created = 0
+        self.created_at = datetime.utcnow()
+        self.last_used_at: Optional[datetime] = None
+
+    @property
+    def reuse_ratio(self) -> float:
+        """Доля запросов, обслуженных уже открытым соединением"""
+        total = self.connections_created + self.connections_reused
+        if total == 0:
+            return 0.0
+        return self.connections_reused / total
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "requests": self.requests,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "reuse_ratio": round(self.reuse_ratio, 3),
+            "sessions_created": self.sessions_created,
+            "created_at": self.created_at.isoformat(),
+            "last_used_at": self.last_used_at.isoformat() if self.last_used_at else None
+        }
+
+
+class X3UIHttpPool:
+    """Процессный пул keep-alive сессий к X3UI панелям (одна сессия на ноду)"""
+
+    def __init__(self):
+        self._sessions: Dict[str, aiohttp.ClientSession] = {}
+        self._session_loops: Dict[str, asyncio.AbstractEventLoop] = {}
+        self._stats: Dict[str, NodeConnectionStats] = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def node_key(base_url: str) -> str:
+        """Ключ ноды: scheme://host:port без пути"""
+        parsed = urllib.parse.urlparse(base_url)
+        port = parsed.port or (443 if parsed.scheme == "https" else 80)
+        return f"{parsed.scheme}://{parsed.hostname}:{port}"
+
+    def _build_trace_config(self, key: str) -> aiohttp.TraceConfig:
+        """Trace hooks для учета новых и переиспользованных соединений"""
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, ctx, params):
+            stats = self._stats[key]
+            stats.requests += 1
+            stats.last_used_at = datetime.utcnow()
+
+        async def on_connection_create_end(session, ctx, params):
+            self._stats[key].connections_created += 1
+
+        async def on_connection_reuseconn(session, ctx, params):
+            self._stats[key].connections_reused += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        return trace_config
+
+    def _create_session(self, key: str) -> aiohttp.ClientSession:
+        """Создать keep-alive сессию для ноды"""
+        settings = get_settings()
+
+        connector = aiohttp.TCPConnector(
+            # Отключаем проверку SSL для самоподписанных сертификатов
+            ssl=False,
+            limit=settings.x3ui_pool_connections_per_node,
+            limit_per_host=settings.x3ui_pool_connections_per_node,
+            keepalive_timeout=settings.x3ui_pool_keepalive_timeout,
+            ttl_dns_cache=settings.x3ui_pool_dns_cache_ttl,
+            use_dns_cache=True
+        )
+
+        stats = self._stats.setdefault(key, NodeConnectionStats())
+        stats.sessions_created += 1
+
+        logger.info("Creating keep-alive session for X3UI node",
+                   node=key,
+                   limit=settings.x3ui_pool_connections_per_node,
+                   keepalive_timeout=settings.x3ui_pool_keepalive_timeout)
+
+        return aiohttp.ClientSession(
+            connector=connector,
+            # unsafe=True - панели часто доступны по IP адресу
+            cookie_jar=aiohttp.CookieJar(unsafe=True),
+            trace_configs=[self._build_trace_config(key)]
+        )
+
+    async def get_session(self, base_url: str) -> aiohttp.ClientSession:
+        """Получить (или создать) общую сессию для ноды"""
+        key = self.node_key(base_url)
+        loop = asyncio.get_running_loop()
+
+        session = self._sessions.get(key)
+        if session and not session.closed and self._session_loops.get(key) is loop:
+            return session
+
+        async with self._lock:
+            session = self._sessions.get(key)
+            if session and not session.closed and self._session_loops.get(key) is loop:
+                return session
+
+            # Сессия привязана к event loop - скрипты с asyncio.run() получают новую
+            if session and not session.closed and self._session_loops.get(key) is not loop:
+                logger.info("Dropping X3UI session bound to another event loop", node=key)
+
+            session = self._create_session(key)
+            self._sessions[key] = session
+            self._session_loops[key] = loop
+            return session
+
+    async def close_node(self, base_url: str) -> None:
+        """Закрыть сессию конкретной ноды (например, при смене URL)"""
+        key = self.node_key(base_url)
+        async with self._lock:
+            session = self._sessions.pop(key, None)
+            loop = self._session_loops.pop(key, None)
+            if session and not session.closed and loop is asyncio.get_running_loop():
+                await session.close()
+                logger.info("X3UI node session closed", node=key)
+
+    async def close_all(self) -> None:
+        """Закрыть все сессии (вызывается при остановке приложения)"""
+        async with self._lock:
+            current_loop = asyncio.get_running_loop()
+            for key, session in list(self._sessions.items()):
+                try:
+                    if not session.closed and self._session_loops.get(key) is current_loop:
+                        await session.close()
+                except Exception as e:
+                    logger.warning("Error closing X3UI session", node=key, error=str(e))
+            self._sessions.clear()
+            self._session_loops.clear()
+            logger.info("All X3UI keep-alive sessions closed")
+
+    def get_stats(self, base_url: Optional[str] = None) -> Dict[str, Any]:
+        """Статистика переиспользования соединений по нодам"""
+        if base_url:
+            stats = self._stats.get(self.node_key(base_url))
+            return stats.to_dict() if stats else NodeConnectionStats().to_dict()
+
+        return {key: stats.to_dict() for key, stats in self._stats.items()}
+
+
+# Глобальный пул сессий (один на процесс)
+x3ui_http_pool = X3UIHttpPool()
@@ -0,0 +1,250 @@
+"""
+X3UI Inbound Cache - индексированный снимок inbound'ов и клиентов панели
+Settings каждого inbound'а парсятся один раз, поиск клиента по email / UUID / telegram_id - O(1)
+"""
+
+import asyncio
+import json
+from typing import Dict, Any, Optional, List, Set, Tuple, Callable, Awaitable
+from datetime import datetime, timedelta
+
+import structlog
+
+from config.settings import get_settings
+from services.x3ui_http_pool import X3UIHttpPool
+
+logger = structlog.get_logger(__name__)
+
+# (inbound_id, client) - клиент хранится как dict из settings.clients
+ClientEntry = Tuple[int, Dict[str, Any]]
+
+
+def _parse_json_field(value: Any) -> Dict[str, Any]:
+    """Поля settings/streamSettings приходят из панели JSON-строкой"""
+    if isinstance(value, dict):
+        return value
+    if not value:
+        return {}
+    try:
+        parsed = json.loads(value)
+        return parsed if isinstance(parsed, dict) else {}
+    except (json.JSONDecodeError, TypeError):
+        return {}
+
+
+class InboundSnapshot:
+    """Снимок inbound'ов одной ноды с хеш-индексами клиентов"""
+
+    def __init__(self, inbounds: List[Dict[str, Any]]):
+        self._inbounds = inbounds
+        self.fetched_at = datetime.utcnow()
+        self.inbounds_by_id: Dict[int, Dict[str, Any]] = {}
+        self.settings_by_inbound: Dict[int, Dict[str, Any]] = {}
+        self.stream_settings_by_inbound: Dict[int, Dict[str, Any]] = {}
+        self.clients_by_email: Dict[str, ClientEntry] = {}
+        self.clients_by_id: Dict[str, ClientEntry] = {}
+        self.clients_by_tg_id: Dict[str, List[ClientEntry]] = {}
+        # Inbound'ы, чье сырое поле settings отстало от распарсенного (см. _mark_dirty)
+        self._dirty: Set[int] = set()
+
+        for inbound in inbounds:
+            inbound_id = inbound.get("id")
+            self.inbounds_by_id[inbound_id] = inbound
+            settings = _parse_json_field(inbound.get("settings"))
+            settings.setdefault("clients", [])
+            self.settings_by_inbound[inbound_id] = settings
+            self.stream_settings_by_inbound[inbound_id] = _parse_json_field(inbound.get("streamSettings"))
+
+            for client in settings["clients"]:
+                self._index_client(inbound_id, client)
+
+    def _index_client(self, inbound_id: int, client: Dict[str, Any]) -> None:
+        entry = (inbound_id, client)
+        if client.get("email"):
+            self.clients_by_email[client["email"]] = entry
+        if client.get("id"):
+            self.clients_by_id[client["id"]] = entry
+        tg_id = str(client.get("tgId") or "")
+        if tg_id:
+            self.clients_by_tg_id.setdefault(tg_id, []).append(entry)
+
+    def _unindex_client(self, inbound_id: int, client: Dict[str, Any]) -> None:
+        if self.clients_by_email.get(client.get("email"), (None,))[0] == inbound_id:
+            self.clients_by_email.pop(client.get("email"), None)
+        if self.clients_by_id.get(client.get("id"), (None,))[0] == inbound_id:
+            self.clients_by_id.pop(client.get("id"), None)
+        tg_id = str(client.get("tgId") or "")
+        if tg_id in self.clients_by_tg_id:
+            self.clients_by_tg_id[tg_id] = [
+                e for e in self.clients_by_tg_id[tg_id] if e[1] is not client
+            ]
+            if not self.clients_by_tg_id[tg_id]:
+                del self.clients_by_tg_id[tg_id]
+
+    def _mark_dirty(self, inbound_id: int) -> None:
+        """
+        Сырое поле settings пересобирается лениво - при чтении inbound'а, один раз
+        на серию write-through изменений, а не на каждого клиента
+        """
+        if inbound_id in self.inbounds_by_id:
+            self._dirty.add(inbound_id)
+
+    def _flush_raw_settings(self, inbound_ids: Optional[List[int]] = None) -> None:
+        for inbound_id in (list(self._dirty) if inbound_ids is None else inbound_ids):
+            if inbound_id in self._dirty:
+                self._dirty.discard(inbound_id)
+                self.inbounds_by_id[inbound_id]["settings"] = json.dumps(self.settings_by_inbound[inbound_id])
+
+    @property
+    def inbounds(self) -> List[Dict[str, Any]]:
+        """Inbound'ы в формате панели (settings - JSON-строка, актуальная)"""
+        self._flush_raw_settings()
+        return self._inbounds
+
+    def is_expired(self, ttl: timedelta) -> bool:
+        return datetime.utcnow() - self.fetched_at > ttl
+
+    def find_by_email(self, email: str) -> Optional[ClientEntry]:
+        return self.clients_by_email.get(email)
+
+    def find_by_client_id(self, client_id: str) -> Optional[ClientEntry]:
+        return self.clients_by_id.get(client_id)
+
+    def find_by_telegram_id(self, telegram_id: Any) -> List[ClientEntry]:
+        return list(self.clients_by_tg_id.get(str(telegram_id), []))
+
+    def find_by_email_substring(self, fragment: str) -> List[ClientEntry]:
+        """Поиск по вхождению в email (без обращения к сети)"""
+        return [entry for email, entry in self.clients_by_email.items() if fragment in email]
+
+    def get_inbound(self, inbound_id: int) -> Optional[Dict[str, Any]]:
+        self._flush_raw_settings([inbound_id])
+        return self.inbounds_by_id.get(inbound_id)
+
+    def get_clients(self, inbound_id: int) -> List[Dict[str, Any]]:
+        return self.settings_by_inbound.get(inbound_id, {}).get("clients", [])
+
+    def find_reality_inbound_id(self, port: int = 443) -> Optional[int]:
+        """Включенный VLESS + Reality inbound на порту (по умолчанию 443)"""
+        for inbound_id, inbound in self.inbounds_by_id.items():
+            if (inbound.get("protocol") == "vless"
+                    and inbound.get("port") == port
+                    and inbound.get("enable") == True
+                    and self.stream_settings_by_inbound.get(inbound_id, {}).get("security") == "reality"):
+                return inbound_id
+        return None
+
+    # Write-through обновления после успешных операций с панелью
+
+    def add_client(self, inbound_id: int, client: Dict[str, Any]) -> None:
+        if inbound_id not in self.settings_by_inbound:
+            return
+        self.settings_by_inbound[inbound_id]["clients"].append(client)
+        self._index_client(inbound_id, client)
+        self._mark_dirty(inbound_id)
+
+    def remove_client(self, inbound_id: int, client_id: str) -> None:
+        clients = self.get_clients(inbound_id)
+        for client in list(clients):
+            if client.get("id") == client_id:
+                clients.remove(client)
+                self._unindex_client(inbound_id, client)
+        self._mark_dirty(inbound_id)
+
+    def replace_client(self, inbound_id: int, client: Dict[str, Any]) -> None:
+        clients = self.get_clients(inbound_id)
+        for index, existing in enumerate(clients):
+            if existing.get("id") == client.get("id"):
+                self._unindex_client(inbound_id, existing)
+                clients[index] = client
+                self._index_client(inbound_id, client)
+        self._mark_dirty(inbound_id)
+
+    def set_client_enable(self, email: str, enable: bool) -> None:
+        entry = self.find_by_email(email)
+        if entry:
+            entry[1]["enable"] = enable
+            self._mark_dirty(entry[0])
+
+
+class X3UIInboundCache:
+    """Процессный кэш снимков inbound'ов по нодам (короткий TTL + write-through)"""
+
+    def __init__(self, ttl_seconds: Optional[int] = None):
+        self.ttl = timedelta(seconds=ttl_seconds if ttl_seconds is not None
+                             else get_settings().x3ui_inbound_cache_ttl)
+        self._snapshots: Dict[str, InboundSnapshot] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _lock_for(self, key: str) -> asyncio.Lock:
+        if key not in self._locks:
+            self._locks[key] = asyncio.Lock()
+        return self._locks[key]
+
+    def peek(self, base_url: str) -> Optional[InboundSnapshot]:
+        """Текущий снимок без обращения к сети (может быть устаревшим)"""
+        return self._snapshots.get(X3UIHttpPool.node_key(base_url))
+
+    async def get_snapshot(
+        self,
+        base_url: str,
+        fetch: Callable[[], Awaitable[Optional[List[Dict[str, Any]]]]],
+        force_refresh: bool = False
+    ) -> Optional[InboundSnapshot]:
+        """
+        Получить снимок ноды, при необходимости загрузив inbound'ы через fetch()
+        Параллельные промахи по одной ноде схлопываются в один запрос к панели
+        """
+        key = X3UIHttpPool.node_key(base_url)
+        snapshot = self._snapshots.get(key)
+        if snapshot and not force_refresh and not snapshot.is_expired(self.ttl):
+            self.hits += 1
+            return snapshot
+
+        requested_at = datetime.utcnow()
+        async with self._lock_for(key):
+            # Пока ждали lock, снимок мог обновить другой запрос
+            snapshot = self._snapshots.get(key)
+            if snapshot and snapshot.fetched_at >= requested_at:
+                self.hits += 1
+                return snapshot
+            if snapshot and not force_refresh and not snapshot.is_expired(self.ttl):
+                self.hits += 1
+                return snapshot
+
+            self.misses += 1
+            inbounds = await fetch()
+            if inbounds is None:
+                logger.warning("Failed to refresh inbound snapshot", node=key)
+                return None
+
+            snapshot = InboundSnapshot(inbounds)
+            self._snapshots[key] = snapshot
+            logger.info("Inbound snapshot refreshed",
+                       node=key,
+                       inbounds=len(inbounds),
+                       clients=len(snapshot.clients_by_id))
+            return snapshot
+
+    def invalidate(self, base_url: Optional[str] = None) -> None:
+        """Сбросить снимок ноды (или всех нод)"""
+        if base_url is None:
+            self._snapshots.clear()
+            return
+        self._snapshots.pop(X3UIHttpPool.node_key(base_url), None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "nodes": len(self._snapshots),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+            "ttl_seconds": int(self.ttl.total_seconds())
+        }
+
+
+# Глобальный кэш снимков (один на процесс)
+x3ui_inbound_cache = X3UIInboundCache()
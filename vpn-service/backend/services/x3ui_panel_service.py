@@ -8,6 +8,7 @@ from typing import Dict, Any, Optional, List
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy import select
 from models.vpn_node import VPNNode
+from services.x3ui_http_pool import x3ui_http_pool
 
 logger = structlog.get_logger(__name__)
 
@@ -19,13 +20,10 @@ class X3UIPanelService:
         self.base_url = node.x3ui_url.rstrip('/')
         self.username = node.x3ui_username
         self.password = node.x3ui_password
-        self.session = None
 
-    async def _get_session(self):
-        """Получить HTTP сессию"""
-        if self.session is None:
-            self.session = aiohttp.ClientSession()
-        return self.session
+    async def _get_session(self) -> aiohttp.ClientSession:
+        """Получить общую keep-alive HTTP сессию ноды"""
+        return await x3ui_http_pool.get_session(self.base_url)
 
     async def login(self) -> bool:
         """Авторизация в X3UI панели"""
@@ -558,10 +556,8 @@ class X3UIPanelService:
             return False
 
     async def close(self):
-        """Закрыть HTTP сессию"""
-        if self.session:
-            await self.session.close()
-            self.session = None
+        """Сессия принадлежит общему пулу x3ui_http_pool и закрывается при остановке приложения"""
+        return None
 
 
 async def get_x3ui_panel_service(session: AsyncSession) -> Optional[X3UIPanelService]:
@@ -0,0 +1,165 @@
+"""
+X3UI Session Registry - общий для процесса реестр сессий X3UI панелей
+Параллельные логины к одной ноде схлопываются в один запрос (single-flight),
+полученный cookie переиспользуется всеми экземплярами X3UIClient до истечения
+"""
+
+import asyncio
+import hashlib
+from typing import Dict, Any, Optional, Callable, Awaitable
+from datetime import datetime
+
+import structlog
+
+from config.settings import get_settings
+from services.x3ui_http_pool import X3UIHttpPool
+
+logger = structlog.get_logger(__name__)
+
+
+class PanelSession:
+    """Cookie сессии панели и время его истечения"""
+
+    def __init__(self, token: str, expires_at: datetime, cookie_name: Optional[str] = None):
+        self.token = token
+        self.expires_at = expires_at
+        self.cookie_name = cookie_name
+
+    @property
+    def is_valid(self) -> bool:
+        return datetime.utcnow() < self.expires_at
+
+
+class X3UISessionRegistry:
+    """Реестр сессий панелей: single-flight логин, общий cookie, опционально - хранение в БД"""
+
+    def __init__(self):
+        self._sessions: Dict[str, PanelSession] = {}
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.logins = 0
+        self.shared_hits = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def session_key(base_url: str, username: str, password: str) -> str:
+        """Ключ сессии; хеш пароля - чтобы смена пароля не использовала старый cookie"""
+        password_hash = hashlib.sha256((password or "").encode()).hexdigest()[:16]
+        return f"{X3UIHttpPool.node_key(base_url)}|{username}|{password_hash}"
+
+    async def acquire(
+        self,
+        key: str,
+        login: Callable[[], Awaitable[Optional[PanelSession]]],
+        stale_token: Optional[str] = None
+    ) -> Optional[PanelSession]:
+        """
+        Получить действующую сессию для ключа
+
+        Args:
+            key: Ключ сессии (session_key)
+            login: Корутина-фабрика, выполняющая реальный логин
+            stale_token: Токен, отвергнутый панелью (401) - его нельзя возвращать повторно
+        """
+        session = self._sessions.get(key)
+        if session and session.is_valid and session.token != stale_token:
+            self.shared_hits += 1
+            return session
+
+        # Чтение сохраненной сессии и логин - внутри одного single-flight запроса на ключ
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.coalesced += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.ensure_future(self._resolve(key, login, stale_token))
+        self._inflight[key] = future
+        future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _resolve(
+        self,
+        key: str,
+        login: Callable[[], Awaitable[Optional[PanelSession]]],
+        stale_token: Optional[str]
+    ) -> Optional[PanelSession]:
+        if get_settings().x3ui_session_persist:
+            session = await self._load_persisted(key)
+            if session and session.token != stale_token:
+                self._sessions[key] = session
+                self.shared_hits += 1
+                return session
+            if session:
+                # Сохранен cookie, отвергнутый панелью: удаляем, даже если логин не удастся
+                await self._delete_persisted(key)
+
+        self.logins += 1
+        session = await login()
+        if session is None:
+            self._sessions.pop(key, None)
+            return None
+
+        self._sessions[key] = session
+        if get_settings().x3ui_session_persist:
+            await self._persist(key, session)
+        return session
+
+    def invalidate(self, key: str, token: Optional[str] = None) -> None:
+        """Сбросить сессию (только если она все еще содержит указанный token)"""
+        session = self._sessions.get(key)
+        if session and (token is None or session.token == token):
+            del self._sessions[key]
+
+    async def _load_persisted(self, key: str) -> Optional[PanelSession]:
+        try:
+            from config.database import async_session_maker
+            from models.x3ui_panel_session import X3UIPanelSession
+
+            async with async_session_maker() as db:
+                row = await db.get(X3UIPanelSession, key)
+                if row and row.is_valid:
+                    return PanelSession(row.token, row.expires_at, row.cookie_name)
+        except Exception as e:
+            logger.warning("Failed to load persisted X3UI session", error=str(e))
+        return None
+
+    async def _delete_persisted(self, key: str) -> None:
+        try:
+            from config.database import async_session_maker
+            from models.x3ui_panel_session import X3UIPanelSession
+
+            async with async_session_maker() as db:
+                row = await db.get(X3UIPanelSession, key)
+                if row:
+                    await db.delete(row)
+                    await db.commit()
+        except Exception as e:
+            logger.warning("Failed to delete persisted X3UI session", error=str(e))
+
+    async def _persist(self, key: str, session: PanelSession) -> None:
+        try:
+            from config.database import async_session_maker
+            from models.x3ui_panel_session import X3UIPanelSession
+
+            async with async_session_maker() as db:
+                await db.merge(X3UIPanelSession(
+                    session_key=key,
+                    cookie_name=session.cookie_name,
+                    token=session.token,
+                    expires_at=session.expires_at
+                ))
+                await db.commit()
+        except Exception as e:
+            logger.warning("Failed to persist X3UI session", error=str(e))
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "valid_sessions": sum(1 for s in self._sessions.values() if s.is_valid),
+            "logins": self.logins,
+            "shared_hits": self.shared_hits,
+            "coalesced_logins": self.coalesced
+        }
+
+
+# Глобальный реестр сессий (один на процесс)
+x3ui_session_registry = X3UISessionRegistry()
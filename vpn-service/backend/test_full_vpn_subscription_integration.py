@@ -123,12 +123,13 @@ class FullVPNSubscriptionIntegrationTester:
         """Тест интеграции cron скрипта"""
         try:
             # Проверяем что скрипт можно импортировать
-            from scripts.subscription_expiry_handler import handle_expired_subscriptions, get_users_with_expired_subscriptions
+            from scripts.subscription_expiry_handler import handle_expired_subscriptions
+            from services.subscription_expiry_sweep import SubscriptionExpirySweep
             
             # Проверяем что функции доступны
             functions_available = [
                 callable(handle_expired_subscriptions),
-                callable(get_users_with_expired_subscriptions)
+                callable(SubscriptionExpirySweep.run)
             ]
             
             success = all(functions_available)
@@ -139,7 +140,7 @@ class FullVPNSubscriptionIntegrationTester:
                 "Subscription expiry handler script importable and callable",
                 {
                     "handle_expired_function": functions_available[0],
-                    "get_expired_users_function": functions_available[1]
+                    "expiry_sweep_run": functions_available[1]
                 }
             )
             
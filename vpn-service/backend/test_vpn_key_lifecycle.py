@@ -7,7 +7,7 @@ import asyncio
 import sys
 import os
 from datetime import datetime, timezone, timedelta
-from unittest.mock import Mock, AsyncMock
+from unittest.mock import Mock, AsyncMock, patch
 
 # Добавляем путь к корневой директории
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
@@ -70,20 +70,26 @@ class VPNKeyLifecycleTester:
                 MockVPNKey(3, 100, "user1_key3@test.com", "ACTIVE")
             ]
             
-            # Мокаем запрос к БД
-            mock_result = Mock()
-            mock_result.scalars.return_value.all.return_value = active_keys
-            mock_session.execute.return_value = mock_result
+            # Мокаем запросы к БД: ключи, затем ноды, затем UPDATE статусов
+            keys_result = Mock()
+            keys_result.scalars.return_value.all.return_value = active_keys
+            nodes_result = Mock()
+            nodes_result.scalars.return_value.all.return_value = [active_keys[0].node]
+            mock_session.execute.side_effect = [keys_result, nodes_result, Mock()]
             
             # Создаем сервис
             service = VPNKeyLifecycleService(mock_session)
             
-            # Мокаем методы деактивации
-            service._disable_key_in_x3ui = AsyncMock(return_value=True)
-            service._update_key_status = AsyncMock(return_value=True)
+            # Мокаем клиент панели: ключи одной ноды отключаются одним пакетным вызовом
+            x3ui_client = Mock()
+            x3ui_client.set_clients_enabled = AsyncMock(
+                return_value={key.xui_email: True for key in active_keys}
+            )
             
             # Тестируем деактивацию
-            result = await service.deactivate_user_keys(100)
+            with patch('services.vpn_key_lifecycle_service.X3UIClient') as mock_client_class:
+                mock_client_class.from_node.return_value = x3ui_client
+                result = await service.deactivate_user_keys(100)
             
             # Проверяем результат
             success = (
@@ -104,9 +110,11 @@ class VPNKeyLifecycleTester:
                 }
             )
             
-            # Проверяем что методы вызывались правильное количество раз
-            assert service._disable_key_in_x3ui.call_count == 3
-            assert service._update_key_status.call_count == 3
+            # Проверяем пакетный вызов панели и один UPDATE статусов
+            x3ui_client.set_clients_enabled.assert_awaited_once_with(
+                [key.xui_email for key in active_keys], False
+            )
+            assert mock_session.execute.await_count == 3
             
             return success
             
@@ -130,20 +138,26 @@ class VPNKeyLifecycleTester:
                 MockVPNKey(2, 100, "user1_key2@test.com", "SUSPENDED")
             ]
             
-            # Мокаем запрос к БД
-            mock_result = Mock()
-            mock_result.scalars.return_value.all.return_value = suspended_keys
-            mock_session.execute.return_value = mock_result
+            # Мокаем запросы к БД: ключи, затем ноды, затем UPDATE статусов
+            keys_result = Mock()
+            keys_result.scalars.return_value.all.return_value = suspended_keys
+            nodes_result = Mock()
+            nodes_result.scalars.return_value.all.return_value = [suspended_keys[0].node]
+            mock_session.execute.side_effect = [keys_result, nodes_result, Mock()]
             
             # Создаем сервис
             service = VPNKeyLifecycleService(mock_session)
             
-            # Мокаем методы реактивации
-            service._enable_key_in_x3ui = AsyncMock(return_value=True)
-            service._update_key_status = AsyncMock(return_value=True)
+            # Мокаем клиент панели: ключи одной ноды включаются одним пакетным вызовом
+            x3ui_client = Mock()
+            x3ui_client.set_clients_enabled = AsyncMock(
+                return_value={key.xui_email: True for key in suspended_keys}
+            )
             
             # Тестируем реактивацию
-            result = await service.reactivate_user_keys(100)
+            with patch('services.vpn_key_lifecycle_service.X3UIClient') as mock_client_class:
+                mock_client_class.from_node.return_value = x3ui_client
+                result = await service.reactivate_user_keys(100)
             
             # Проверяем результат
             success = (
@@ -164,9 +178,11 @@ class VPNKeyLifecycleTester:
                 }
             )
             
-            # Проверяем что методы вызывались правильное количество раз
-            assert service._enable_key_in_x3ui.call_count == 2
-            assert service._update_key_status.call_count == 2
+            # Проверяем пакетный вызов панели и один UPDATE статусов
+            x3ui_client.set_clients_enabled.assert_awaited_once_with(
+                [key.xui_email for key in suspended_keys], True
+            )
+            assert mock_session.execute.await_count == 3
             
             return success
             
@@ -242,8 +258,6 @@ class VPNKeyLifecycleTester:
             mock_session = AsyncMock()
             
             # Мокаем создание сервиса через патчинг
-            from unittest.mock import patch
-            
             with patch('services.vpn_key_lifecycle_service.VPNKeyLifecycleService') as mock_service_class:
                 mock_service = AsyncMock()
                 mock_service_class.return_value = mock_service
@@ -0,0 +1,56 @@
+"""
+Фикстуры unit-тестов: логика сервисов без панелей и HTTP.
+SQL-тесты идут в Postgres из TEST_DATABASE_URL и пропускаются, если он не задан
+"""
+
+import os
+import uuid
+
+import pytest
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+
+from config.database import Base
+from config.settings import get_settings
+from services.node_hashing import ASSIGNMENT_MODE_SCORE, ASSIGNMENT_MODE_RENDEZVOUS
+
+
+@pytest.fixture
+def score_mode(monkeypatch):
+    """node_assignment_mode = score на время теста"""
+    monkeypatch.setattr(get_settings(), "node_assignment_mode", ASSIGNMENT_MODE_SCORE)
+
+
+@pytest.fixture
+def rendezvous_mode(monkeypatch):
+    """node_assignment_mode = rendezvous на время теста"""
+    monkeypatch.setattr(get_settings(), "node_assignment_mode", ASSIGNMENT_MODE_RENDEZVOUS)
+
+
+@pytest.fixture
+async def pg_session_maker():
+    """
+    Фабрика сессий к TEST_DATABASE_URL (Postgres) во временной схеме, удаляемой после теста.
+    Вызов с моделями создает их таблицы: maker = await pg_session_maker(Model, ...)
+    """
+    url = os.environ.get("TEST_DATABASE_URL")
+    if not url:
+        pytest.skip("TEST_DATABASE_URL is not set")
+    schema = f"unit_{uuid.uuid4().hex[:12]}"
+    admin = create_async_engine(url)
+    async with admin.begin() as conn:
+        await conn.execute(text(f'CREATE SCHEMA "{schema}"'))
+    engine = create_async_engine(url, connect_args={"server_settings": {"search_path": schema}})
+
+    async def make(*models):
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all, tables=[model.__table__ for model in models])
+        return async_sessionmaker(engine, expire_on_commit=False)
+
+    try:
+        yield make
+    finally:
+        await engine.dispose()
+        async with admin.begin() as conn:
+            await conn.execute(text(f'DROP SCHEMA "{schema}" CASCADE'))
+        await admin.dispose()
@@ -0,0 +1,92 @@
+"""
+Unit-тесты расписаний планировщика: CronTrigger, IntervalTrigger, job_lock_key
+"""
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from services.job_scheduler import CronTrigger, IntervalTrigger, job_lock_key, LOCK_NAMESPACE
+
+
+def utc(*args) -> datetime:
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.mark.unit
+class TestCronTrigger:
+    def test_every_15_minutes(self):
+        trigger = CronTrigger("*/15 * * * *")
+        assert trigger.minutes == {0, 15, 30, 45}
+        assert trigger.next_after(utc(2024, 1, 1, 10, 7, 30)) == utc(2024, 1, 1, 10, 15)
+
+    def test_next_after_is_strictly_later(self):
+        trigger = CronTrigger("*/15 * * * *")
+        assert trigger.next_after(utc(2024, 1, 1, 10, 45)) == utc(2024, 1, 1, 11, 0)
+
+    def test_rolls_over_day_and_year(self):
+        trigger = CronTrigger("*/15 * * * *")
+        assert trigger.next_after(utc(2024, 12, 31, 23, 50)) == utc(2025, 1, 1, 0, 0)
+
+    def test_day_of_month_or_day_of_week(self):
+        # Оба поля заданы: срабатывает 1-го числа ИЛИ в понедельник
+        trigger = CronTrigger("0 0 1 * 1")
+        # 2024-01-01 - понедельник, следующий понедельник - 8-е
+        assert trigger.next_after(utc(2024, 1, 1, 0, 0)) == utc(2024, 1, 8)
+        # После понедельника 29-го - 1 февраля (четверг) по дню месяца
+        assert trigger.next_after(utc(2024, 1, 29, 0, 0)) == utc(2024, 2, 1)
+        # После 1 февраля - понедельник 5-го по дню недели
+        assert trigger.next_after(utc(2024, 2, 1, 0, 0)) == utc(2024, 2, 5)
+
+    def test_wildcard_weekday_means_day_of_month_only(self):
+        trigger = CronTrigger("0 0 1 * *")
+        assert trigger.next_after(utc(2024, 1, 8)) == utc(2024, 2, 1)
+
+    def test_wildcard_day_means_weekday_only(self):
+        trigger = CronTrigger("0 0 * * 1")
+        assert trigger.next_after(utc(2024, 1, 29)) == utc(2024, 2, 5)
+
+    def test_sunday_as_0_and_7(self):
+        assert CronTrigger("0 0 * * 0").weekdays == CronTrigger("0 0 * * 7").weekdays == {0}
+
+    def test_february_29_waits_for_leap_year(self):
+        trigger = CronTrigger("0 12 29 2 *")
+        assert trigger.next_after(utc(2024, 2, 28, 13, 0)) == utc(2024, 2, 29, 12, 0)
+        assert trigger.next_after(utc(2024, 3, 1)) == utc(2028, 2, 29, 12, 0)
+
+    def test_expression_that_never_fires(self):
+        with pytest.raises(ValueError):
+            CronTrigger("0 0 30 2 *").next_after(utc(2024, 1, 1))
+
+    @pytest.mark.parametrize("expression", ["* * * *", "60 * * * *", "* 24 * * *", "*/0 * * * *", "5-1 * * * *"])
+    def test_invalid_expressions(self, expression):
+        with pytest.raises(ValueError):
+            CronTrigger(expression)
+
+
+@pytest.mark.unit
+class TestIntervalTrigger:
+    def test_first_run_after_interval(self):
+        now = utc(2024, 1, 1)
+        assert IntervalTrigger(60).first(now) == now + timedelta(seconds=60)
+
+    def test_run_immediately(self):
+        now = utc(2024, 1, 1)
+        assert IntervalTrigger(60, run_immediately=True).first(now) == now
+
+
+@pytest.mark.unit
+class TestJobLockKey:
+    def test_stable_across_processes(self):
+        # crc32 не зависит от PYTHONHASHSEED: ключ - константа
+        assert job_lock_key("subscription_events") == job_lock_key("subscription_events")
+        assert job_lock_key("a") == (LOCK_NAMESPACE << 32) | 0xE8B7BE43
+
+    def test_namespace_and_bigint_range(self):
+        key = job_lock_key("notification_outbox")
+        assert key >> 32 == LOCK_NAMESPACE
+        assert 0 < key < 2 ** 63
+
+    def test_distinct_jobs_get_distinct_keys(self):
+        names = ["subscription_events", "notification_outbox", "autopay", "health_check"]
+        assert len({job_lock_key(name) for name in names}) == len(names)
@@ -0,0 +1,38 @@
+"""
+Unit-тесты симуляции балансировки: детерминированность и изоляция от глобального состояния
+"""
+
+import pytest
+
+from config.settings import get_settings
+from services.load_balancer_simulation import (
+    FleetSpec, WorkloadSpec, STRATEGIES, generate_fleet, generate_workload, run_simulation
+)
+from services.node_hashing import ASSIGNMENT_MODE_SCORE, ASSIGNMENT_MODE_RENDEZVOUS
+from services.node_registry import node_registry
+
+FLEET = generate_fleet(FleetSpec(nodes=6, countries=2, min_users=300, max_users=600), seed=3)
+EVENTS = generate_workload(WorkloadSpec(arrivals=1500, node_failures=2, rebalance_every=500), FLEET, seed=3)
+
+
+@pytest.mark.unit
+class TestRunSimulation:
+    @pytest.mark.parametrize("strategy", STRATEGIES)
+    @pytest.mark.parametrize("mode", [ASSIGNMENT_MODE_SCORE, ASSIGNMENT_MODE_RENDEZVOUS])
+    async def test_deterministic(self, strategy, mode):
+        first = (await run_simulation(FLEET, EVENTS, strategy, mode)).to_dict()
+        second = (await run_simulation(FLEET, EVENTS, strategy, mode)).to_dict()
+        for report in (first, second):
+            report.pop("wall_seconds")
+            report.pop("decisions_per_second")
+            report.pop("p50_selection_ms")
+            report.pop("p99_selection_ms")
+        assert first == second
+        assert first["decisions"] == 1500
+        assert first["failover_moves"] > 0
+
+    async def test_global_registry_and_settings_untouched(self, score_mode):
+        version = node_registry.version
+        await run_simulation(FLEET, EVENTS, STRATEGIES[0], ASSIGNMENT_MODE_RENDEZVOUS)
+        assert node_registry.version == version
+        assert get_settings().node_assignment_mode == ASSIGNMENT_MODE_SCORE
@@ -0,0 +1,52 @@
+"""
+Unit-тесты сверки счетчиков current_users с назначениями (Postgres из TEST_DATABASE_URL)
+"""
+
+import pytest
+from sqlalchemy import select
+
+from models.country import Country
+from models.user import User
+from models.vpn_node import VPNNode
+from models.user_node_assignment import UserNodeAssignment
+from models.user_server_assignment import UserServerAssignment
+from services.node_capacity import NodeCapacity
+
+
+@pytest.fixture
+async def capacity_db(pg_session_maker):
+    return await pg_session_maker(Country, User, VPNNode, UserNodeAssignment, UserServerAssignment)
+
+
+def node(node_id: int, current_users: int) -> VPNNode:
+    return VPNNode(id=node_id, name=f"node-{node_id}", x3ui_url=f"https://node-{node_id}.example.com",
+                   x3ui_username="admin", x3ui_password="admin", current_users=current_users)
+
+
+@pytest.mark.unit
+class TestReconcile:
+    async def test_counters_follow_assignments(self, capacity_db):
+        async with capacity_db() as db:
+            db.add(Country(id=1, code="NL", name="Нидерланды", flag_emoji="🇳🇱"))
+            db.add_all([User(id=i, telegram_id=1000 + i) for i in range(1, 4)])
+            db.add_all([node(1, 5), node(2, 0), node(3, 3), node(4, 1)])
+            await db.flush()
+            db.add_all([
+                UserNodeAssignment(user_id=1, node_id=1),
+                UserNodeAssignment(user_id=2, node_id=1),
+                UserNodeAssignment(user_id=3, node_id=3, is_active=False),
+                # Пользователь 3 на ноде 2 по обоим назначениям - учитывается один раз
+                UserNodeAssignment(user_id=3, node_id=2),
+                UserServerAssignment(user_id=1003, node_id=2, country_id=1),
+                UserServerAssignment(user_id=1001, node_id=4, country_id=1),
+            ])
+            await db.commit()
+
+        async with capacity_db() as db:
+            drift = await NodeCapacity(db).reconcile()
+        assert drift == {1: (5, 2), 2: (0, 1), 3: (3, 0)}
+
+        async with capacity_db() as db:
+            counters = dict((await db.execute(select(VPNNode.id, VPNNode.current_users))).all())
+            assert counters == {1: 2, 2: 1, 3: 0, 4: 1}
+            assert await NodeCapacity(db).reconcile() == {}
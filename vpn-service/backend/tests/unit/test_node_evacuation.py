@@ -0,0 +1,94 @@
+"""
+Unit-тесты эвакуации ноды: распределение пользователей (plan_destinations), выбор
+переносимых ключей (Postgres из TEST_DATABASE_URL) и уведомления
+"""
+
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+
+from models.country import Country
+from models.user import User
+from models.vpn_key import VPNKey
+from models.vpn_node import VPNNode
+from models.user_node_assignment import UserNodeAssignment
+from models.user_server_assignment import UserServerAssignment
+from services.node_evacuation import NodeEvacuation, EvacuatedUser, EvacuatedKey, plan_destinations
+from services.node_hashing import rank_nodes_hrw
+from services.notification_service import notification_service
+from tests.utils.node_factory import make_node
+
+USERS = range(1, 201)
+
+
+@pytest.mark.unit
+class TestPlanDestinations:
+    def test_score_mode_fills_least_loaded_first(self, score_mode):
+        nodes = [make_node(1, current_users=500), make_node(2, current_users=0)]
+        plan = plan_destinations(list(range(1, 101)), nodes)
+        assert set(plan.values()) == {2}
+
+    def test_score_mode_respects_capacity(self, score_mode):
+        nodes = [make_node(1, max_users=10, current_users=8), make_node(2, max_users=10, current_users=9)]
+        plan = plan_destinations(list(range(1, 11)), nodes)
+        assert len(plan) == 3
+        assert sum(1 for node_id in plan.values() if node_id == 1) == 2
+        assert sum(1 for node_id in plan.values() if node_id == 2) == 1
+
+    def test_rendezvous_mode_uses_hrw_home(self, rendezvous_mode):
+        nodes = [make_node(i) for i in range(1, 5)]
+        plan = plan_destinations(list(USERS), nodes)
+        assert plan == {user_id: rank_nodes_hrw(user_id, nodes)[0].id for user_id in USERS}
+
+    def test_rendezvous_mode_overflows_to_next_choice(self, rendezvous_mode):
+        nodes = [make_node(1, max_users=5), make_node(2, max_users=1000)]
+        plan = plan_destinations(list(range(1, 101)), nodes)
+        assert len(plan) == 100
+        assert sum(1 for node_id in plan.values() if node_id == 1) == 5
+
+
+def vpn_key(key_id: int, user_id: int, status: str) -> VPNKey:
+    return VPNKey(id=key_id, user_id=user_id, node_id=1, uuid=f"uuid-{key_id}", key_name=f"key-{key_id}",
+                  vless_url="vless://old", status=status, xui_email=f"{key_id}@vpn.local")
+
+
+@pytest.fixture
+async def evacuation_db(pg_session_maker):
+    return await pg_session_maker(Country, User, VPNNode, VPNKey, UserNodeAssignment, UserServerAssignment)
+
+
+@pytest.mark.unit
+class TestEvacuatedKeys:
+    async def test_all_but_revoked_keys_move(self, evacuation_db):
+        async with evacuation_db() as db:
+            db.add_all([User(id=i, telegram_id=1000 + i) for i in range(1, 4)])
+            db.add(VPNNode(id=1, name="node-1", x3ui_url="https://node-1.example.com",
+                           x3ui_username="admin", x3ui_password="admin"))
+            await db.flush()
+            db.add_all([
+                vpn_key(1, 1, "active"),
+                vpn_key(2, 1, "revoked"),
+                vpn_key(3, 2, "suspended"),
+                vpn_key(4, 3, "revoked"),
+            ])
+            await db.commit()
+
+        async with evacuation_db() as db:
+            users = await NodeEvacuation(db)._load_users(1)
+        keys = {user.user_id: [(key.key_id, key.is_active) for key in user.keys] for user in users}
+        # Пользователь только с отозванными ключами не переносится
+        assert keys == {1: [(1, True)], 2: [(3, False)]}
+
+    async def test_only_active_keys_are_announced(self, monkeypatch):
+        queue = AsyncMock(return_value=True)
+        monkeypatch.setattr(notification_service, "queue_vpn_key_moved_notification", queue)
+        user = EvacuatedUser(1, 1001, keys=[
+            EvacuatedKey(1, "key-1", None, "active", vless_url="vless://new-1"),
+            EvacuatedKey(2, "key-2", None, "suspended", vless_url="vless://new-2"),
+        ])
+        db = object()
+        snapshot = SimpleNamespace(get=lambda node_id: make_node(node_id, location="Amsterdam"))
+
+        assert await NodeEvacuation(db)._notify({2: [user]}, snapshot) == 1
+        queue.assert_awaited_once_with(db, 1001, "key-1", "Amsterdam", "vless://new-1")
@@ -0,0 +1,65 @@
+"""
+Unit-тесты выбора домашней ноды по rendezvous hashing (HRW)
+"""
+
+import pytest
+
+from services.node_hashing import hrw_weight, pick_node_hrw, rank_nodes_hrw, rank_available_hrw
+from tests.utils.node_factory import make_node
+
+USERS = range(1, 5001)
+
+
+def homes(nodes):
+    return {user_id: rank_nodes_hrw(user_id, nodes)[0].id for user_id in USERS}
+
+
+@pytest.mark.unit
+class TestRendezvousHashing:
+    def test_ranking_is_deterministic_and_order_independent(self):
+        nodes = [make_node(i) for i in range(1, 6)]
+        forward = [n.id for n in rank_nodes_hrw(42, nodes)]
+        backward = [n.id for n in rank_nodes_hrw(42, list(reversed(nodes)))]
+        assert forward == backward
+        assert hrw_weight(42, 3, 1.0) == hrw_weight(42, 3, 1.0)
+
+    def test_adding_node_moves_only_users_to_new_node(self):
+        nodes = [make_node(i) for i in range(1, 6)]
+        before = homes(nodes)
+        after = homes(nodes + [make_node(6)])
+        moved = [user_id for user_id in USERS if before[user_id] != after[user_id]]
+        assert all(after[user_id] == 6 for user_id in moved)
+        # Новая нода забирает около 1/6 пользователей
+        assert 0.12 < len(moved) / len(USERS) < 0.22
+
+    def test_removing_node_moves_only_its_users(self):
+        nodes = [make_node(i) for i in range(1, 6)]
+        before = homes(nodes)
+        after = homes([n for n in nodes if n.id != 3])
+        for user_id in USERS:
+            if before[user_id] != 3:
+                assert after[user_id] == before[user_id]
+
+    def test_share_follows_weight(self):
+        nodes = [make_node(1, weight=1.0), make_node(2, weight=3.0)]
+        share = sum(1 for node_id in homes(nodes).values() if node_id == 2) / len(USERS)
+        assert 0.7 < share < 0.8
+
+    def test_zero_weight_never_home(self):
+        nodes = [make_node(1, weight=0.0), make_node(2)]
+        assert set(homes(nodes).values()) == {2}
+
+    def test_pick_skips_rejected_nodes(self):
+        nodes = [make_node(i) for i in range(1, 4)]
+        ranked = rank_nodes_hrw(7, nodes)
+        picked = pick_node_hrw(7, nodes, accept=lambda n: n.id != ranked[0].id)
+        assert picked.id == ranked[1].id
+        assert pick_node_hrw(7, nodes, accept=lambda n: False) is None
+
+    def test_rank_available_filters_full_and_unhealthy(self):
+        nodes = [
+            make_node(1),
+            make_node(2, current_users=1000),
+            make_node(3, health_status="unhealthy"),
+        ]
+        assert [scored.node.id for scored in rank_available_hrw(9, nodes)] == [1]
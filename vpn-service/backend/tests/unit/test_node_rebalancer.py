@@ -0,0 +1,41 @@
+"""
+Unit-тесты целевого распределения перебалансировки (water_fill)
+"""
+
+import pytest
+
+from services.node_rebalancer import water_fill
+from tests.utils.node_factory import make_node
+
+
+@pytest.mark.unit
+class TestWaterFill:
+    def test_equal_nodes_split_evenly(self):
+        nodes = [make_node(i) for i in range(1, 4)]
+        assert water_fill(nodes, 300) == {1: 100, 2: 100, 3: 100}
+
+    def test_targets_sum_to_total(self):
+        nodes = [make_node(1, weight=1.0), make_node(2, weight=2.0), make_node(3, weight=0.5)]
+        targets = water_fill(nodes, 1001)
+        assert sum(targets.values()) == 1001
+
+    def test_weight_and_priority_scale_share(self):
+        nodes = [make_node(1, weight=1.0), make_node(2, weight=2.0), make_node(3, priority=50)]
+        targets = water_fill(nodes, 700)
+        assert targets == {1: 200, 2: 400, 3: 100}
+
+    def test_saturated_node_spills_to_others(self):
+        # Уровень заполнения упирается в max_users ноды 1 раньше, чем у остальных
+        nodes = [make_node(1, max_users=100, weight=3.0), make_node(2), make_node(3)]
+        targets = water_fill(nodes, 900)
+        assert targets[1] == 100
+        assert targets[2] == targets[3] == 400
+
+    def test_never_exceeds_capacity(self):
+        nodes = [make_node(1, max_users=100), make_node(2, max_users=200)]
+        targets = water_fill(nodes, 1000)
+        assert targets == {1: 100, 2: 200}
+
+    def test_zero_weight_gets_nothing(self):
+        nodes = [make_node(1, weight=0.0), make_node(2)]
+        assert water_fill(nodes, 50) == {1: 0, 2: 50}
@@ -0,0 +1,152 @@
+"""
+Unit-тесты outbox уведомлений: ограничение скорости (TokenBucket) и SQL постановки,
+захвата и записи итогов (Postgres из TEST_DATABASE_URL)
+"""
+
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest.mock import AsyncMock
+
+import pytest
+from sqlalchemy import select, update
+
+from config.settings import get_settings
+from models.notification_outbox import NotificationOutbox
+from services import notification_outbox
+from services.notification_outbox import (
+    TokenBucket, NotificationOutboxService, PENDING, SENT, FAILED, PRIORITY_HIGH, PRIORITY_LOW
+)
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    state = SimpleNamespace(now=100.0)
+    monkeypatch.setattr(notification_outbox, "time", SimpleNamespace(monotonic=lambda: state.now))
+    return state
+
+
+@pytest.mark.unit
+class TestTokenBucket:
+    def test_burst_up_to_capacity(self, clock):
+        bucket = TokenBucket(rate=2, capacity=2)
+        assert bucket.reserve() == 0.0
+        assert bucket.reserve() == 0.0
+
+    def test_reservations_beyond_capacity_queue_up(self, clock):
+        bucket = TokenBucket(rate=2, capacity=2)
+        bucket.reserve()
+        bucket.reserve()
+        # Токены уходят в долг: каждый следующий ждет еще 1/rate
+        assert bucket.reserve() == pytest.approx(0.5)
+        assert bucket.reserve() == pytest.approx(1.0)
+
+    def test_refill_over_time(self, clock):
+        bucket = TokenBucket(rate=2, capacity=2)
+        for _ in range(4):
+            bucket.reserve()
+        clock.now += 1.0
+        assert bucket.reserve() == pytest.approx(0.5)
+
+    def test_refill_is_capped_by_capacity(self, clock):
+        bucket = TokenBucket(rate=2, capacity=2)
+        clock.now += 60
+        bucket.reserve()
+        bucket.reserve()
+        assert bucket.reserve() == pytest.approx(0.5)
+
+    def test_is_idle(self, clock):
+        bucket = TokenBucket(rate=1, capacity=1)
+        assert bucket.is_idle()
+        bucket.reserve()
+        assert not bucket.is_idle()
+        clock.now += 1.0
+        assert bucket.is_idle()
+
+
+@pytest.fixture
+async def outbox_db(pg_session_maker, monkeypatch):
+    """Таблица notification_outbox во временной схеме; сервис ходит в нее же"""
+    session_maker = await pg_session_maker(NotificationOutbox)
+    monkeypatch.setattr(notification_outbox, "async_session_maker", session_maker)
+    return session_maker
+
+
+async def _rows(session_maker):
+    async with session_maker() as db:
+        return (await db.execute(select(NotificationOutbox).order_by(NotificationOutbox.id))).scalars().all()
+
+
+@pytest.mark.unit
+class TestOutboxSQL:
+    async def test_add_deduplicates_pending(self, outbox_db):
+        outbox = NotificationOutboxService()
+        async with outbox_db() as db:
+            assert await outbox.add(db, 1, "hello") is True
+            assert await outbox.add(db, 1, "hello") is False
+            assert await outbox.add(db, 2, "hello") is True
+            await db.commit()
+
+        rows = await _rows(outbox_db)
+        assert [(row.telegram_id, row.status) for row in rows] == [(1, PENDING), (2, PENDING)]
+        assert (outbox.enqueued, outbox.deduplicated) == (2, 1)
+
+    async def test_sent_message_can_be_queued_again(self, outbox_db):
+        outbox = NotificationOutboxService()
+        assert await outbox.send(1, "hello") is True
+        async with outbox_db() as db:
+            await db.execute(update(NotificationOutbox).values(status=SENT))
+            await db.commit()
+
+        async with outbox_db() as db:
+            assert await outbox.add(db, 1, "hello") is True
+            await db.commit()
+        assert [row.status for row in await _rows(outbox_db)] == [SENT, PENDING]
+
+    async def test_claim_by_priority_with_lease(self, outbox_db, monkeypatch):
+        monkeypatch.setattr(get_settings(), "notification_batch_size", 2)
+        outbox = NotificationOutboxService()
+        async with outbox_db() as db:
+            await outbox.add(db, 1, "low", priority=PRIORITY_LOW)
+            await outbox.add(db, 2, "normal")
+            await outbox.add(db, 3, "high", priority=PRIORITY_HIGH)
+            await db.commit()
+
+        first = await outbox._claim_batch()
+        assert [message.text for message in first] == ["high", "normal"]
+        # Захваченные арендованы: повторный захват их не видит
+        second = await outbox._claim_batch()
+        assert [message.text for message in second] == ["low"]
+        assert await outbox._claim_batch() == []
+
+        rows = await _rows(outbox_db)
+        assert all(row.locked_until > datetime.now(timezone.utc) for row in rows)
+
+    async def test_send_batch_applies_results(self, outbox_db, monkeypatch):
+        from services.notification_service import notification_service
+
+        monkeypatch.setattr(notification_service, "_get_bot_token", AsyncMock(return_value="token"))
+        outcomes = {
+            "ok": (SENT, None, None),
+            "slow": (PENDING, 7, "429: Too Many Requests"),
+            "bad": (FAILED, None, "403: Forbidden"),
+            "flaky": (PENDING, None, "500: Internal Server Error")
+        }
+        outbox = NotificationOutboxService()
+        monkeypatch.setattr(outbox, "_post", AsyncMock(side_effect=lambda url, message: outcomes[message.text]))
+        async with outbox_db() as db:
+            for telegram_id, text in enumerate(outcomes, start=1):
+                await outbox.add(db, telegram_id, text)
+            await db.commit()
+
+        started = datetime.now(timezone.utc)
+        await outbox._send_batch(await outbox._claim_batch())
+
+        rows = {row.text: row for row in await _rows(outbox_db)}
+        assert rows["ok"].status == SENT and rows["ok"].sent_at is not None
+        assert rows["bad"].status == FAILED and rows["bad"].last_error == "403: Forbidden"
+        # 429 - попытка не засчитана, сообщение отложено на retry_after
+        assert rows["slow"].status == PENDING and rows["slow"].attempts == 0
+        assert rows["slow"].available_at > started
+        assert rows["flaky"].status == PENDING and rows["flaky"].attempts == 1
+        assert all(row.locked_until is None for row in rows.values())
+        assert await outbox._claim_batch() == []
@@ -0,0 +1,24 @@
+"""
+Unit-тесты разбора настроек движка сроков подписок
+"""
+
+import pytest
+
+from services.subscription_event_engine import parse_reminder_days
+
+
+@pytest.mark.unit
+class TestParseReminderDays:
+    @pytest.mark.parametrize("spec, expected", [
+        ("3,1", [3, 1]),
+        ("1, 3 ,7", [7, 3, 1]),
+        ("3,3,1", [3, 1]),
+        ("3,,1,", [3, 1]),
+        ("", []),
+    ])
+    def test_parse(self, spec, expected):
+        assert parse_reminder_days(spec) == expected
+
+    def test_invalid_value(self):
+        with pytest.raises(ValueError):
+            parse_reminder_days("3,x")
@@ -0,0 +1,81 @@
+"""
+Unit-тесты локальной сборки VLESS/Reality URL
+"""
+
+import pytest
+
+from services.vless_url_builder import (
+    RealityUrlTemplate, DEFAULT_SNI, build_vless_url, build_node_vless_url, host_from_url, with_remark
+)
+from tests.utils.node_factory import make_node
+
+CLIENT_ID = "0b6c7f2e-4d3a-4f1b-9c1e-2a7d5e8f9a10"
+
+STREAM_SETTINGS = {
+    "network": "tcp",
+    "security": "reality",
+    "realitySettings": {
+        "shortIds": ["ab12", "cd34"],
+        "serverNames": ["www.google.com"],
+        "settings": {"publicKey": "PBK", "fingerprint": "firefox", "spiderX": "/path"}
+    }
+}
+
+
+@pytest.mark.unit
+class TestRealityUrlTemplate:
+    def test_from_stream_settings(self):
+        template = RealityUrlTemplate.from_stream_settings(443, STREAM_SETTINGS)
+        assert template == RealityUrlTemplate(
+            port=443, network="tcp", security="reality", public_key="PBK", short_id="ab12",
+            sni="www.google.com", fingerprint="firefox", spider_x="/path"
+        )
+
+    def test_defaults_for_empty_reality_settings(self):
+        template = RealityUrlTemplate.from_stream_settings(8443, {})
+        assert template.sni == DEFAULT_SNI
+        assert template.public_key == ""
+        assert template.fingerprint == "chrome"
+
+    def test_node_fields_take_priority(self):
+        template = RealityUrlTemplate.from_stream_settings(443, STREAM_SETTINGS)
+        node = make_node(1, public_key="NODE_PBK", short_id=None, sni_mask="cdn.example.com")
+        patched = template.with_node(node)
+        assert patched.public_key == "NODE_PBK"
+        assert patched.short_id == "ab12"
+        assert patched.sni == "cdn.example.com"
+
+
+@pytest.mark.unit
+class TestBuildVlessUrl:
+    def test_exact_url(self):
+        template = RealityUrlTemplate(port=443, public_key="PBK", short_id="ab12", sni="www.google.com")
+        assert build_vless_url(CLIENT_ID, "1.2.3.4", template, "user@test.com") == (
+            f"vless://{CLIENT_ID}@1.2.3.4:443?type=tcp&security=reality&fp=chrome&pbk=PBK"
+            "&sni=www.google.com&flow=xtls-rprx-vision&sid=ab12&spx=%2F#user@test.com"
+        )
+
+    def test_pure_function(self):
+        template = RealityUrlTemplate(port=443)
+        assert build_vless_url(CLIENT_ID, "host", template) == build_vless_url(CLIENT_ID, "host", template)
+
+    def test_remark_is_quoted(self):
+        url = build_vless_url(CLIENT_ID, "host", RealityUrlTemplate(port=443), "my key")
+        assert url.endswith("#my%20key")
+
+    def test_with_remark_replaces_fragment(self):
+        url = build_vless_url(CLIENT_ID, "host", RealityUrlTemplate(port=443), "spare_1_abc")
+        renamed = with_remark(url, "user@test.com")
+        assert renamed.split("#")[0] == url.split("#")[0]
+        assert renamed.endswith("#user@test.com")
+        assert with_remark(url, None).endswith("#VPN")
+
+    def test_node_url_uses_panel_host(self):
+        node = make_node(1, x3ui_url="https://vpn-1.example.com:2053", public_key="NODE_PBK")
+        url = build_node_vless_url(node, CLIENT_ID, RealityUrlTemplate(port=443))
+        assert url.startswith(f"vless://{CLIENT_ID}@vpn-1.example.com:443?")
+        assert "&pbk=NODE_PBK&" in url
+
+    def test_node_without_host(self):
+        assert build_node_vless_url(make_node(1, x3ui_url=""), CLIENT_ID, RealityUrlTemplate(port=443)) is None
+        assert host_from_url("") is None
@@ -0,0 +1,124 @@
+"""
+Unit-тесты автомата защиты панели: closed -> open -> half_open -> closed/open
+"""
+
+from types import SimpleNamespace
+
+import pytest
+
+from services import x3ui_circuit_breaker
+from services.x3ui_circuit_breaker import NodeCircuit, CircuitState
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeClock()
+    monkeypatch.setattr(x3ui_circuit_breaker, "time", SimpleNamespace(monotonic=fake))
+    return fake
+
+
+@pytest.fixture
+def circuit(clock):
+    circuit = NodeCircuit("node-1")
+    circuit.min_calls = 4
+    circuit.failure_rate_threshold = 0.5
+    circuit.slow_call_ms = 5000
+    circuit.slow_rate_threshold = 0.8
+    circuit.open_seconds = 30
+    circuit.half_open_max_calls = 1
+    circuit.probe_timeout = 60
+    return circuit
+
+
+def trip(circuit: NodeCircuit) -> None:
+    for _ in range(circuit.min_calls):
+        assert circuit.allow_request()
+        circuit.record(False, 10)
+
+
+@pytest.mark.unit
+class TestNodeCircuit:
+    def test_stays_closed_below_min_calls(self, circuit):
+        for _ in range(circuit.min_calls - 1):
+            circuit.record(False, 10)
+        assert circuit.state == CircuitState.closed
+
+    def test_opens_on_failure_rate(self, circuit):
+        trip(circuit)
+        assert circuit.state == CircuitState.open
+        assert circuit.is_open
+        assert not circuit.allow_request()
+        assert circuit.rejected == 1
+
+    def test_opens_on_slow_calls(self, circuit):
+        for _ in range(circuit.min_calls):
+            circuit.record(True, circuit.slow_call_ms + 1)
+        assert circuit.state == CircuitState.open
+
+    def test_half_open_admits_limited_probes(self, circuit, clock):
+        trip(circuit)
+        clock.advance(circuit.open_seconds)
+        assert not circuit.is_open
+        assert circuit.allow_request()
+        assert circuit.state == CircuitState.half_open
+        # Проба уже выполняется - остальные вызовы отклоняются
+        assert not circuit.allow_request()
+
+    def test_successful_probe_closes(self, circuit, clock):
+        trip(circuit)
+        clock.advance(circuit.open_seconds)
+        assert circuit.allow_request()
+        circuit.record(True, 10)
+        assert circuit.state == CircuitState.closed
+        assert circuit.allow_request()
+
+    def test_failed_probe_reopens(self, circuit, clock):
+        trip(circuit)
+        clock.advance(circuit.open_seconds)
+        assert circuit.allow_request()
+        circuit.record(False, 10)
+        assert circuit.state == CircuitState.open
+        assert circuit.times_opened == 2
+        assert not circuit.allow_request()
+
+    def test_slow_probe_reopens(self, circuit, clock):
+        trip(circuit)
+        clock.advance(circuit.open_seconds)
+        assert circuit.allow_request()
+        circuit.record(True, circuit.slow_call_ms)
+        assert circuit.state == CircuitState.open
+
+    def test_lost_probe_does_not_wedge_half_open(self, circuit, clock):
+        trip(circuit)
+        clock.advance(circuit.open_seconds)
+        assert circuit.allow_request()
+        # Проба отменена без record: до probe_timeout слот занят
+        clock.advance(circuit.probe_timeout - 1)
+        assert not circuit.allow_request()
+        assert circuit.state == CircuitState.half_open
+        # После probe_timeout проба считается неудачной
+        clock.advance(1)
+        assert not circuit.allow_request()
+        assert circuit.state == CircuitState.open
+        # И после паузы автомат снова пробует панель
+        clock.advance(circuit.open_seconds)
+        assert circuit.allow_request()
+        circuit.record(True, 10)
+        assert circuit.state == CircuitState.closed
+
+    def test_to_dict(self, circuit):
+        trip(circuit)
+        stats = circuit.to_dict()
+        assert stats["state"] == "open"
+        assert stats["times_opened"] == 1
@@ -0,0 +1,54 @@
+"""
+Unit-тесты массового включения/отключения клиентов X3UIClient (без панели)
+"""
+
+import json
+from unittest.mock import AsyncMock
+
+import pytest
+
+from services.x3ui_client import X3UIClient
+from services.x3ui_inbound_cache import InboundSnapshot
+
+STREAM_SETTINGS = '{"network": "tcp", "security": "reality"}'
+SNIFFING = '{"enabled": true, "destOverride": ["http", "tls"]}'
+
+
+@pytest.fixture
+def client(monkeypatch):
+    snapshot = InboundSnapshot([{
+        "id": 1, "remark": "main", "port": 443, "protocol": "vless",
+        "settings": json.dumps({"clients": [
+            {"id": "a", "email": "a@test", "enable": True},
+            {"id": "b", "email": "b@test", "enable": True},
+        ]}),
+        "streamSettings": STREAM_SETTINGS,
+        "sniffing": SNIFFING,
+    }])
+    client = X3UIClient("https://node-1.example.com:2053")
+    monkeypatch.setattr(client, "_ensure_session", AsyncMock(return_value=True))
+    monkeypatch.setattr(client, "get_inbound_snapshot", AsyncMock(return_value=snapshot))
+    monkeypatch.setattr(client, "_endpoint", AsyncMock(return_value="/panel/api/inbounds/update/1"))
+    monkeypatch.setattr(client, "_make_request", AsyncMock(return_value={"success": True}))
+    client.snapshot = snapshot
+    return client
+
+
+@pytest.mark.unit
+class TestSetClientsEnabled:
+    async def test_inbound_fields_sent_unchanged(self, client):
+        assert await client.set_clients_enabled(["a@test", "missing@test"], False) == {
+            "a@test": True, "missing@test": False
+        }
+
+        payload = client._make_request.await_args.args[2]
+        # Строки панели не кодируются повторно
+        assert payload["streamSettings"] == STREAM_SETTINGS
+        assert payload["sniffing"] == SNIFFING
+        clients = json.loads(payload["settings"])["clients"]
+        assert [c["enable"] for c in clients] == [False, True]
+        assert client.snapshot.find_by_email("a@test")[1]["enable"] is False
+
+    async def test_no_request_when_state_matches(self, client):
+        assert await client.set_clients_enabled(["b@test"], True) == {"b@test": True}
+        client._make_request.assert_not_awaited()
@@ -0,0 +1,70 @@
+"""
+Unit-тесты индексированного снимка inbound'ов: write-through изменения и сырое поле settings
+"""
+
+import json
+from types import SimpleNamespace
+
+import pytest
+
+from services import x3ui_inbound_cache
+from services.x3ui_inbound_cache import InboundSnapshot
+
+
+def make_snapshot() -> InboundSnapshot:
+    return InboundSnapshot([
+        {"id": 1, "settings": json.dumps({"clients": [{"id": "a", "email": "a@test", "enable": True}]})},
+        {"id": 2, "settings": json.dumps({"clients": []})},
+    ])
+
+
+@pytest.fixture
+def dumps_calls(monkeypatch):
+    calls = []
+
+    def dumps(value, *args, **kwargs):
+        calls.append(value)
+        return json.dumps(value, *args, **kwargs)
+
+    monkeypatch.setattr(x3ui_inbound_cache, "json", SimpleNamespace(dumps=dumps, loads=json.loads,
+                                                                    JSONDecodeError=json.JSONDecodeError))
+    return calls
+
+
+@pytest.mark.unit
+class TestWriteThrough:
+    def test_indexes_follow_changes(self):
+        snapshot = make_snapshot()
+        snapshot.add_client(2, {"id": "b", "email": "b@test", "tgId": "42"})
+        snapshot.replace_client(1, {"id": "a", "email": "a2@test"})
+        snapshot.remove_client(2, "b")
+
+        assert snapshot.find_by_email("a@test") is None
+        assert snapshot.find_by_email("a2@test")[0] == 1
+        assert snapshot.find_by_client_id("b") is None
+        assert snapshot.find_by_telegram_id(42) == []
+
+    def test_raw_settings_serialized_once_per_batch(self, dumps_calls):
+        snapshot = make_snapshot()
+        for i in range(100):
+            snapshot.add_client(2, {"id": f"c{i}", "email": f"c{i}@test"})
+        snapshot.set_client_enable("a@test", False)
+        assert dumps_calls == []
+
+        raw = {inbound["id"]: json.loads(inbound["settings"]) for inbound in snapshot.inbounds}
+        assert len(raw[2]["clients"]) == 100
+        assert raw[1]["clients"][0]["enable"] is False
+        assert len(dumps_calls) == 2
+
+        # Повторное чтение без изменений ничего не сериализует
+        assert len(snapshot.inbounds) == 2
+        assert len(dumps_calls) == 2
+
+    def test_get_inbound_flushes_only_that_inbound(self, dumps_calls):
+        snapshot = make_snapshot()
+        snapshot.add_client(1, {"id": "b", "email": "b@test"})
+        snapshot.add_client(2, {"id": "c", "email": "c@test"})
+
+        inbound = snapshot.get_inbound(2)
+        assert [c["id"] for c in json.loads(inbound["settings"])["clients"]] == ["c"]
+        assert len(dumps_calls) == 1
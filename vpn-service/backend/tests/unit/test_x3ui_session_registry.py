@@ -0,0 +1,89 @@
+"""
+Unit-тесты общего реестра сессий X3UI: имя cookie из ответа логина и его
+сохранение в БД (Postgres из TEST_DATABASE_URL)
+"""
+
+from datetime import datetime, timedelta
+from http.cookies import SimpleCookie
+from unittest.mock import AsyncMock
+
+import pytest
+
+import config.database
+from config.settings import get_settings
+from models.x3ui_panel_session import X3UIPanelSession
+from services import x3ui_client
+from services.x3ui_client import X3UIClient, session_cookie, SESSION_COOKIE_NAME
+from services.x3ui_session_registry import X3UISessionRegistry, PanelSession
+
+KEY = X3UISessionRegistry.session_key("https://node-1.example.com:2053", "admin", "secret")
+
+
+@pytest.mark.unit
+class TestSessionCookie:
+    def test_prefers_3x_ui_cookie(self):
+        morsel = session_cookie(SimpleCookie("lang=ru; 3x-ui=abc"))
+        assert (morsel.key, morsel.value) == (SESSION_COOKIE_NAME, "abc")
+
+    def test_falls_back_to_legacy_cookie(self):
+        morsel = session_cookie(SimpleCookie("x-ui=legacy"))
+        assert (morsel.key, morsel.value) == ("x-ui", "legacy")
+
+    def test_no_cookies(self):
+        assert session_cookie(SimpleCookie()) is None
+
+    async def test_clients_share_cookie_name(self, monkeypatch):
+        monkeypatch.setattr(get_settings(), "x3ui_session_persist", False)
+        monkeypatch.setattr(x3ui_client, "x3ui_session_registry", X3UISessionRegistry())
+
+        first = X3UIClient("https://node-1.example.com:2053", "admin", "secret")
+
+        async def perform_login():
+            first.session_token = "legacy"
+            first.cookie_name = "x-ui"
+            first.token_expires = datetime.utcnow() + timedelta(minutes=50)
+            return True
+
+        monkeypatch.setattr(first, "_perform_login", perform_login)
+        assert await first._login()
+
+        second = X3UIClient("https://node-1.example.com:2053", "admin", "secret")
+        monkeypatch.setattr(second, "_perform_login", AsyncMock(return_value=False))
+        assert await second._login()
+        assert (second.cookie_name, second.session_token) == ("x-ui", "legacy")
+
+
+@pytest.fixture
+async def persisted_sessions(pg_session_maker, monkeypatch):
+    """Таблица x3ui_panel_sessions во временной схеме, хранение сессий включено"""
+    session_maker = await pg_session_maker(X3UIPanelSession)
+    monkeypatch.setattr(config.database, "async_session_maker", session_maker)
+    monkeypatch.setattr(get_settings(), "x3ui_session_persist", True)
+    return session_maker
+
+
+@pytest.mark.unit
+class TestPersistedSessions:
+    async def test_round_trip_keeps_cookie_name(self, persisted_sessions):
+        expires_at = datetime.utcnow() + timedelta(minutes=50)
+        login = AsyncMock(return_value=PanelSession("abc", expires_at, "x-ui"))
+        await X3UISessionRegistry().acquire(KEY, login)
+
+        # Новый процесс: сессия читается из БД, логина нет
+        restarted_login = AsyncMock(return_value=None)
+        session = await X3UISessionRegistry().acquire(KEY, restarted_login)
+        restarted_login.assert_not_awaited()
+        assert (session.token, session.cookie_name) == ("abc", "x-ui")
+        assert session.expires_at == expires_at
+
+    async def test_stale_persisted_session_is_replaced(self, persisted_sessions):
+        expires_at = datetime.utcnow() + timedelta(minutes=50)
+        await X3UISessionRegistry().acquire(KEY, AsyncMock(return_value=PanelSession("old", expires_at, "3x-ui")))
+
+        login = AsyncMock(return_value=PanelSession("new", expires_at, "3x-ui"))
+        session = await X3UISessionRegistry().acquire(KEY, login, stale_token="old")
+        login.assert_awaited_once()
+        assert session.token == "new"
+
+        async with persisted_sessions() as db:
+            assert (await db.get(X3UIPanelSession, KEY)).token == "new"
@@ -0,0 +1,26 @@
+"""
+Фабрика NodeView для unit-тестов выбора нод (без БД)
+"""
+
+from dataclasses import replace
+from datetime import datetime, timezone
+
+from services.node_registry import NodeView
+
+
+def make_node(node_id: int, **overrides) -> NodeView:
+    """Здоровая активная нода; поля переопределяются через overrides"""
+    now = datetime.now(timezone.utc)
+    node = NodeView(
+        id=node_id, name=f"node-{node_id}", description=None,
+        location="test", country_id=1,
+        x3ui_url=f"https://node-{node_id}.example.com:2053", x3ui_username="admin", x3ui_password="admin",
+        mode="reality", public_key=None, short_id=None, sni_mask=None,
+        max_users=1000, current_users=0,
+        status="active", health_status="healthy", last_health_check=now,
+        response_time_ms=100, priority=100, weight=1.0,
+        reality_config=None, api_capabilities=None,
+        live_online_clients=None, live_throughput_mbps=None, live_load_updated_at=None,
+        created_at=now, updated_at=now
+    )
+    return replace(node, **overrides)